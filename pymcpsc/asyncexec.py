@@ -0,0 +1,227 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" asyncio executor driving the external PSC binaries from one process.
+
+Classes:
+    - *PSC_ASYNC_SCHEDULER*: scheduler executing the pairwise tasks as asyncio subprocesses
+
+Functions:
+    - *run_command_async*: execute a PSC binary with wall-clock and CPU limits as a coroutine
+
+The pool workers of PSC_SCHEDULER are complete Python processes, each
+holding a copy of the handlers, pairs and imported modules while it mostly
+waits for a CE, TM-align or FAST binary to finish. The asyncio executor
+starts the binaries of all pairs from the main process instead. A fixed
+number of coroutines, the concurrency, take the tasks longest-expected-first
+and each keeps one binary running at a time, so that the concurrency bounds
+the number of running binaries. The output of a binary is read line by line
+as it is written and parsed once the binary exits. The concurrency can
+exceed the number of cores, e.g. when the binaries wait for a network file
+system, without starting more Python processes. Long running jobs such as
+the GR-align shards still run on a pool of worker processes.
+
+Binaries run in their own session with the limits and failure records of
+*run_command*. Handlers without *command*/*parse* methods (e.g. the USM
+handler) are executed on a thread of the event loop. The methods added with
+*add_thread* hold as many of the concurrency slots as they keep cores busy
+for as long as their thread runs.
+
+This module requires Python 3.5 or later.
+"""
+import asyncio
+from multiprocessing import Pool
+from queue import Queue
+from timeit import default_timer as timer
+
+from pymcpsc.execute import PSC_FAILURE, EXIT, check_exit
+from pymcpsc.execute import resource, _PRLIMIT, _limit, _kill
+from pymcpsc.scheduler import PSC_SCHEDULER, WAIT
+
+
+async def run_command_async(cmd, timeout=None, cpuLimit=None, cwd=None):
+    """ Execute a PSC binary and collect its output lines as they are
+    written. The output of stdout and stderr is combined.
+
+    :param cmd: (list) Binary and its arguments
+    :param timeout: (float) Wall-clock limit in seconds, None or 0 for no limit
+    :param cpuLimit: (int) CPU limit in seconds, None or 0 for no limit
+    :param cwd: (string) Directory to execute the binary in
+    :rtype: (list) Lines of output of the binary
+    """
+    if cpuLimit and not _PRLIMIT:
+        options = {'preexec_fn': _limit(cpuLimit)}
+    else:
+        options = {'start_new_session': True}
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT, cwd=cwd, **options)
+    except OSError as e:
+        # binary missing or not executable
+        raise PSC_FAILURE(EXIT, str(e))
+    if cpuLimit and _PRLIMIT:
+        # SIGXCPU at the soft limit, SIGKILL one second later
+        resource.prlimit(proc.pid, resource.RLIMIT_CPU,
+                         (int(cpuLimit), int(cpuLimit) + 1))
+    lines = []
+
+    async def read():
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                break
+            lines.append(line.decode('utf-8', 'replace').rstrip('\r\n'))
+        return await proc.wait()
+
+    expired = [False]
+    try:
+        returncode = await asyncio.wait_for(read(), timeout or None)
+    except asyncio.TimeoutError:
+        _kill(proc.pid, expired)
+        returncode = await proc.wait()
+    except BaseException:
+        _kill(proc.pid, [False])
+        raise
+    check_exit(returncode, expired[0], timeout, cpuLimit)
+    return lines
+
+
+class PSC_ASYNC_SCHEDULER(PSC_SCHEDULER):
+
+    def __init__(self, threads, concurrency=None, metrics=None):
+        """ Set the number of pool workers and of concurrent binaries
+
+        :param threads: (int) Number of worker processes running the long jobs
+        :param concurrency: (int) Number of binaries executed at a time, None for the number of worker processes
+        :param metrics: (PSC_METRICS) Metrics updated as outputs arrive, None to print them only
+        :rtype: None
+        """
+        PSC_SCHEDULER.__init__(self, threads, metrics)
+        self._concurrency = max(1, concurrency or threads)
+
+    async def _process(self, m, i, slot, loop):
+        """ Process a pair of a method
+
+        :param m: (int) Method index
+        :param i: (int) Pair index
+        :param slot: (int) Execution slot
+        :param loop: (AbstractEventLoop) Event loop
+        :rtype: (list) Program output or PSC_FAILURE
+        """
+        _, procmethod, pscmethod, pairs = self._methods[m][:4]
+        pair = pairs[i]
+        if not hasattr(pscmethod, 'command'):
+            try:
+                return await loop.run_in_executor(
+                    None, procmethod, (pscmethod, pair, None))
+            except PSC_FAILURE as e:
+                return e
+        res = pscmethod.from_cache(*pair)
+        if res is not None:
+            return res
+        cmd, cwd, timeout, cpuLimit = pscmethod.command(
+            pair[0], pair[1], pair[2], slot)
+        try:
+            lines = await run_command_async(cmd, timeout, cpuLimit, cwd)
+            return pscmethod.parse(pair[0], pair[1], pair[2], lines)
+        except PSC_FAILURE as e:
+            return pscmethod.failed(pair[0], pair[1], pair[2], e)
+
+    async def _execute(self, left, done, running, threads, queue, loop):
+        """ Execute all tasks, at most concurrency at a time
+
+        :param left: (list) Pairs left per method
+        :param done: (dict) Seconds from start until each method completed
+        :param running: (list) Running jobs
+        :param threads: (set) Indices of the running threads
+        :param queue: (Queue) Queue the outputs of the threads are put in
+        :param loop: (AbstractEventLoop) Event loop
+        :rtype: (float) Seconds spent by the tasks
+        """
+        tasks = iter(self._tasks())
+        state = {'inflight': 0, 'secs': 0.0}
+
+        async def execute(slot):
+            # the coroutines share the task iterator
+            while True:
+                # the first slots are left to the threads while they run
+                while slot < self._slots(threads):
+                    await asyncio.sleep(WAIT)
+                try:
+                    m, i = next(tasks)
+                except StopIteration:
+                    return
+                start = timer()
+                state['inflight'] += 1
+                self._metrics.inflight(state['inflight'])
+                res = await self._process(m, i, slot, loop)
+                state['inflight'] -= 1
+                self._metrics.inflight(state['inflight'])
+                state['secs'] += self._collect(
+                    m, [(i, res, timer() - start)], left, done)
+                self._finish_jobs(running, False, done)
+                self._collect_threads(queue, threads, 0, done)
+
+        async def poll():
+            # outputs of the threads and jobs are passed on also while long
+            # binaries run
+            while len(running) > 0 or len(threads) > 0 or \
+                    not all(map(lambda x: x.done(), workers)):
+                self._finish_jobs(running, False, done)
+                self._collect_threads(queue, threads, 0, done)
+                await asyncio.sleep(WAIT)
+
+        workers = list(map(lambda x: loop.create_task(execute(x)),
+                           range(self._concurrency)))
+        poller = loop.create_task(poll())
+        try:
+            await asyncio.gather(poller, *workers)
+        except BaseException:
+            for worker in [poller] + workers:
+                worker.cancel()
+            # the cancelled workers kill their binaries
+            await asyncio.gather(poller, *workers, return_exceptions=True)
+            raise
+        self._metrics.report()
+        return state['secs']
+
+    def run(self):
+        """ Execute the tasks of all methods as subprocesses of this process,
+        the jobs on a worker pool and the methods added with *add_thread* on
+        threads of this process. Outputs are passed on as they arrive,
+        in completion order, and each PSC method is finished as soon as all
+        its pairs are done.
+
+        :rtype: (dict) Seconds from start until each method completed
+        """
+        left, done = self._start()
+        p = None
+        if len(self._jobs) > 0:
+            p = Pool(self._threads)
+        loop = asyncio.new_event_loop()
+        queue = Queue()
+        try:
+            running = []
+            if p is not None:
+                running = self._start_jobs(p)
+            threads = self._start_threads(queue, done)
+            print('pairwise jobs started: %d pairs for %s, %d at a time' % (
+                sum(left), ', '.join(map(lambda x: x[0], self._methods)),
+                self._concurrency))
+            secs = loop.run_until_complete(
+                self._execute(left, done, running, threads, queue, loop))
+            if p is not None:
+                p.close()
+        except BaseException:
+            if p is not None:
+                p.terminate()
+            raise
+        finally:
+            if p is not None:
+                p.join()
+            loop.close()
+        wall = timer() - self._start_time
+        if wall > 0:
+            print('pairwise processing took %d seconds, %0.1f binaries '
+                  'running on average' % (wall, secs / wall))
+        return done
@@ -0,0 +1,294 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Persistent content-addressed cache for pairwise PSC results.
+
+Classes:
+    - *PSC_CACHE*: sqlite backed store of pairwise PSC method output
+
+Functions:
+    - *file_digest*: calculates the content hash of a file
+
+A cache entry is keyed by the PSC method name, a hash of the method binary and
+the hashes of the contents of both structure files. An entry therefore remains
+valid across runs for as long as neither the input structures nor the PSC
+program change, independent of the file names or the work directory used.
+Domain names are not stored with the cached output, they are filled in from
+the current file names when an entry is read back. Files derived from a
+single structure, such as the GR-align contact maps, are cached the same way
+keyed by the hash of the structure file.
+
+The cache is bounded in size. Once the stored output exceeds the configured
+number of bytes the least recently used entries are evicted. The database may
+be shared by several worker processes, each process opens its own connection
+on first use, one per thread of the process that uses the cache.
+"""
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from time import time
+
+# default cache size bound (bytes)
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024 * 1024
+# fraction of the size bound to evict down to once it has been exceeded
+_EVICT_TO = 0.9
+_BLOCK_SIZE = 1024 * 1024
+_DB_NAME = 'results.sqlite'
+
+# per process memo of file digests keyed by path, size and mtime
+_digests = {}
+# per thread database connections keyed by process, thread and database
+# path, shared by the cache objects unpickled in a worker process
+_connections = {}
+
+
+def file_digest(fname):
+    """ Calculate the sha1 hash of the contents of a file. Hashes are memoized
+    per process for as long as the size and modification time of the file do
+    not change.
+
+    :param fname: (string) Path to the file
+    :rtype: (string) Hex digest of the file contents
+    """
+    st = os.stat(fname)
+    path = os.path.abspath(fname)
+    sig = (st.st_size, st.st_mtime)
+    known = _digests.get(path)
+    if known is not None and known[0] == sig:
+        return known[1]
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(_BLOCK_SIZE), b''):
+            h.update(block)
+    digest = h.hexdigest()
+    _digests[path] = (sig, digest)
+    return digest
+
+
+class PSC_CACHE:
+
+    def __init__(self, cacheDir, maxBytes=DEFAULT_MAX_BYTES):
+        """ Set paths and limits for the cache
+
+        :param cacheDir: (string) Directory where the cache database is stored
+        :param maxBytes: (int) Upper bound on the size of cached output
+        :rtype: None
+        """
+        self._cacheDir = os.path.abspath(cacheDir)
+        if not os.path.exists(self._cacheDir):
+            os.makedirs(self._cacheDir)
+        self._dbPath = '%s%s%s' % (self._cacheDir, os.path.sep, _DB_NAME)
+        self._maxBytes = int(maxBytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._connect()
+
+    def _connect(self):
+        """ Open the database connection of this process and thread,
+        creating the tables when required. sqlite connections cannot be used
+        from another thread than the one that opened them.
+
+        :rtype: (Connection) sqlite connection
+        """
+        k = (os.getpid(), threading.current_thread().ident, self._dbPath)
+        conn = _connections.get(k)
+        if conn is not None:
+            return conn
+        conn = sqlite3.connect(self._dbPath, timeout=600,
+                               isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                     'key TEXT PRIMARY KEY, value TEXT, size INTEGER, '
+                     'atime REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS results_atime '
+                     'ON results (atime)')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                     'name TEXT PRIMARY KEY, value INTEGER)')
+        conn.execute("INSERT OR IGNORE INTO meta VALUES ('bytes', 0)")
+        _connections[k] = conn
+        return conn
+
+    def key(self, method, binDigest, fname1, fname2=None):
+        """ Make the cache key for a pair of structures or a single structure
+
+        :param method: (string) PSC method name
+        :param binDigest: (string) Hash identifying the PSC program version
+        :param fname1: (string) Path to file containing structure of domain 1
+        :param fname2: (string) Path to file containing structure of domain 2, None for a single structure
+        :rtype: (string) Cache key
+        """
+        if fname2 is None:
+            k = '%s|%s|%s' % (method, binDigest, file_digest(fname1))
+        else:
+            k = '%s|%s|%s|%s' % (method, binDigest,
+                                 file_digest(fname1), file_digest(fname2))
+        return hashlib.sha1(k.encode('utf-8')).hexdigest()
+
+    def _load(self, k):
+        """ Read an entry, marking it as recently used
+
+        :param k: (string) Cache key
+        :rtype: (string) Stored value or None
+        """
+        conn = self._connect()
+        row = conn.execute('SELECT value FROM results WHERE key = ?',
+                           (k,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        conn.execute('UPDATE results SET atime = ? WHERE key = ?',
+                     (time(), k))
+        return row[0]
+
+    def _store(self, k, value):
+        """ Write an entry, evicting least recently used entries when the
+        cache grows beyond its size bound
+
+        :param k: (string) Cache key
+        :param value: (string) Value to store
+        :rtype: None
+        """
+        size = len(value) + len(k)
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            old = conn.execute('SELECT size FROM results WHERE key = ?',
+                               (k,)).fetchone()
+            delta = size - (old[0] if old is not None else 0)
+            conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                         (k, value, size, time()))
+            conn.execute("UPDATE meta SET value = value + ? "
+                         "WHERE name = 'bytes'", (delta,))
+            total = conn.execute("SELECT value FROM meta "
+                                 "WHERE name = 'bytes'").fetchone()[0]
+            if total > self._maxBytes:
+                self._evict(conn, total)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def get(self, method, binDigest, fname1, fname2, names):
+        """ Look up the output of a PSC method for a pair of structures
+
+        :param method: (string) PSC method name
+        :param binDigest: (string) Hash identifying the PSC program version
+        :param fname1: (string) Path to file containing structure of domain 1
+        :param fname2: (string) Path to file containing structure of domain 2
+        :param names: (list) Domain names to prefix the cached output rows with
+        :rtype: (list) Output data in the format of the PSC handler or None
+        """
+        try:
+            k = self.key(method, binDigest, fname1, fname2)
+        except (OSError, IOError):
+            self.misses += 1
+            return None
+        value = self._load(k)
+        if value is None:
+            return None
+        return [list(names) + r for r in json.loads(value)]
+
+    def put(self, method, binDigest, fname1, fname2, res):
+        """ Store the output of a PSC method for a pair of structures. The
+        leading domain names of each output row are not stored.
+
+        :param method: (string) PSC method name
+        :param binDigest: (string) Hash identifying the PSC program version
+        :param fname1: (string) Path to file containing structure of domain 1
+        :param fname2: (string) Path to file containing structure of domain 2
+        :param res: (list) Output data in the format of the PSC handler
+        :rtype: None
+        """
+        k = self.key(method, binDigest, fname1, fname2)
+        self._store(k, json.dumps([list(r[2:]) for r in res]))
+
+    def get_files(self, method, binDigest, fname, outnames):
+        """ Look up the files a program derived from a structure and write
+        them to the given paths
+
+        :param method: (string) Name of the program
+        :param binDigest: (string) Hash identifying the program version
+        :param fname: (string) Path to file containing the structure
+        :param outnames: (list) Paths to write the derived files to
+        :rtype: (boolean) True if the files were found in the cache
+        """
+        try:
+            k = self.key(method, binDigest, fname)
+        except (OSError, IOError):
+            self.misses += 1
+            return False
+        value = self._load(k)
+        if value is None:
+            return False
+        for outname, data in zip(outnames, json.loads(value)):
+            with open('%s.part' % outname, 'w') as f:
+                f.write(data)
+            os.rename('%s.part' % outname, outname)
+        return True
+
+    def put_files(self, method, binDigest, fname, outnames):
+        """ Store the files a program derived from a structure
+
+        :param method: (string) Name of the program
+        :param binDigest: (string) Hash identifying the program version
+        :param fname: (string) Path to file containing the structure
+        :param outnames: (list) Paths to the derived files
+        :rtype: None
+        """
+        data = []
+        for outname in outnames:
+            with open(outname) as f:
+                data.append(f.read())
+        self._store(self.key(method, binDigest, fname), json.dumps(data))
+
+    def _evict(self, conn, total):
+        """ Remove least recently used entries until the cache size is below
+        the eviction target. Must be called inside a transaction.
+
+        :param conn: (Connection) sqlite connection
+        :param total: (int) Current size of the cache
+        :rtype: None
+        """
+        target = int(self._maxBytes * _EVICT_TO)
+        cursor = conn.execute('SELECT key, size FROM results ORDER BY atime')
+        evicted = []
+        for k, size in cursor:
+            if total <= target:
+                break
+            evicted.append((k,))
+            total -= size
+        cursor.close()
+        conn.executemany('DELETE FROM results WHERE key = ?', evicted)
+        conn.execute("UPDATE meta SET value = ? WHERE name = 'bytes'",
+                     (total,))
+        self.evictions += len(evicted)
+
+    def stats(self):
+        """ Usage statistics of the cache as seen from this process
+
+        :rtype: (dict) hits, misses, hit rate, evictions, entries and bytes
+        """
+        conn = self._connect()
+        entries = conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        size = conn.execute("SELECT value FROM meta "
+                            "WHERE name = 'bytes'").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits * 1.0 / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': entries,
+                'bytes': size}
+
+    def reset_stats(self):
+        """ Reset the hit/miss counters of this process
+
+        :rtype: None
+        """
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
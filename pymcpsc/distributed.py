@@ -0,0 +1,539 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Coordinator and workers executing the pairwise PSC jobs on many nodes.
+
+Classes:
+    - *PSC_COORDINATOR*: scheduler serving the pairwise tasks to worker nodes over TCP
+
+Functions:
+    - *parse_address*: parse a host:port network address
+    - *run_worker*: worker loop processing the tasks of a coordinator
+    - *start_workers*: start worker processes on the local node
+    - *write_authkey*: write a generated authentication key to a file readable by its owner only
+
+The coordinator orders and chunks the pairwise tasks exactly like
+PSC_SCHEDULER, but instead of feeding the chunks to a local pool it leases
+them as batches to worker processes connecting over TCP. Every worker
+process receives the PSC handlers once, adapts them to its node (the PSC
+binaries are looked up in the local program directory, inputs are staged in
+a local workspace) and then repeatedly asks for a batch. The structure
+files of a batch are shipped along on first use, so the worker nodes need
+the PSC binaries but no shared file system. Results are streamed back per
+batch and recorded by the coordinator in the journal of the run, the result
+files of the work directory are written from the journal as usual. Long
+running jobs such as the GR-align shards run on a local pool of the
+coordinator. The local workers held by the methods added with *add_thread*
+are started once their threads are done.
+
+Workers send a heartbeat every *HEARTBEAT* seconds while they process a
+batch. The batches leased to a worker whose connection is lost or that has
+not been heard of for the lease timeout are put back at the head of the
+queue and leased to the next worker asking. Should the original worker
+still deliver, the first result of a batch is kept and later ones are
+dropped, so every pair is recorded once. A batch released *MAX_RELEASES*
+times is given up, its pairs are recorded as failures, so that a run whose
+workers all fail on a batch still completes. A worker that cannot
+stage the files of a batch or process its pairs, e.g. because its scratch
+file system is full, returns failure records for the pairs of the batch and
+asks for the next one.
+
+Connections are authenticated with a shared key (HMAC challenge of
+multiprocessing.connection). Messages are pickled, so the coordinator must
+only be reachable by trusted workers. The key is therefore never printed: a
+key generated by the coordinator is written to the *AUTHKEY* file of the
+work directory, readable by its owner only.
+"""
+import os
+import socket
+import threading
+import time
+import binascii
+from collections import deque
+from multiprocessing import Pool, Process
+from multiprocessing.connection import Client, Listener
+from timeit import default_timer as timer
+
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+from pymcpsc.execute import PSC_FAILURE, WORKER
+from pymcpsc.scheduler import PSC_SCHEDULER, init_worker, process_chunk
+from pymcpsc.workspace import PSC_WORKSPACE
+
+DEFAULT_PORT = 7733
+# seconds between heartbeats of a worker and without any message after
+# which the batches of a worker are leased again
+HEARTBEAT = 5.0
+LEASE_TIMEOUT = 30.0
+# seconds a worker waits before asking again when no batch is available
+WAIT = 1.0
+# number of times a batch is released before its pairs are given up
+MAX_RELEASES = 3
+# file of the work directory a generated authentication key is written to
+AUTHKEY = 'authkey'
+
+_POM_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'ext',
+                         'x86_64', 'linux', 'pom')
+
+
+def parse_address(address, host='localhost'):
+    """ Parse a network address
+
+    :param address: (string) host:port, host or :port
+    :param host: (string) Host to use when the address has none
+    :rtype: (tuple) Host and port
+    """
+    if ':' not in address:
+        return address or host, DEFAULT_PORT
+    name, port = address.rsplit(':', 1)
+    return name or host, int(port)
+
+
+def _keep_handler(pscmethod, progDir, workspace):
+    """ Use a PSC handler on a worker node as it is
+
+    :param pscmethod: (object) PSC handler object
+    :param progDir: (string) Unused
+    :param workspace: (PSC_WORKSPACE) Unused
+    :rtype: (object) The handler
+    """
+    return pscmethod
+
+
+def run_worker(address, authkey, progDir=None, scratchDir=None,
+               heartbeat=HEARTBEAT):
+    """ Connect to a coordinator and process the batches it leases until all
+    pairs are done
+
+    :param address: (tuple) Host and port of the coordinator
+    :param authkey: (bytes) Shared authentication key
+    :param progDir: (string) Local directory of the PSC binaries, None to use the paths of the coordinator
+    :param scratchDir: (string) Directory to create the workspace in, None for the default
+    :param heartbeat: (float) Seconds between heartbeats
+    :rtype: (int) Number of pairs processed
+    """
+    conn = Client(address, authkey=authkey)
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def send(msg):
+        with lock:
+            conn.send(msg)
+
+    def beat():
+        while not stop.wait(heartbeat):
+            try:
+                send(('heartbeat',))
+            except (OSError, IOError):
+                return
+
+    def process(m, items, missing, files):
+        # local errors fail the pairs of the batch, not the connection
+        try:
+            for fname, data in files:
+                workspace.put(fname, data)
+            fetched.update(missing)
+            installed[m][2].update(items)
+            return process_chunk((m, list(map(lambda x: x[0], items))))[1]
+        except (OSError, IOError) as e:
+            detail = str(e)
+        print('worker %d: batch failed: %s' % (os.getpid(), detail))
+        return list(map(lambda x: (x[0], installed[m][1].failed(
+            x[1][0], x[1][1], x[1][2], PSC_FAILURE(WORKER, detail)), 0.0),
+            items))
+
+    workspace = None
+    fetched = set()
+    count = 0
+    try:
+        send(('hello', socket.gethostname(), os.getpid()))
+        _, methods, localize = conn.recv()
+        pom_path = None
+        if os.path.isdir(_POM_PATH):
+            pom_path = _POM_PATH
+        workspace = PSC_WORKSPACE(scratchDir, pom_path)
+        # the pairs of a method are filled in batch by batch
+        installed = list(map(lambda x: (
+            x[0], localize(x[1], progDir, workspace), {}), methods))
+        init_worker(installed)
+        thread = threading.Thread(target=beat)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                send(('ready',))
+                msg = conn.recv()
+                if msg[0] == 'done':
+                    break
+                if msg[0] == 'wait':
+                    time.sleep(msg[1])
+                    continue
+                _, b, m, items = msg
+                missing = sorted(set(sum(map(lambda x: list(x[1][:2]), items),
+                                         [])) - fetched)
+                files = []
+                if len(missing) > 0:
+                    send(('fetch', missing))
+                    files = conn.recv()[1]
+                out = process(m, items, missing, files)
+                send(('result', b, out))
+                count += len(out)
+        except (EOFError, OSError, IOError):
+            # the coordinator is gone, its leases are void
+            print('worker %d: connection to coordinator lost' % os.getpid())
+    finally:
+        stop.set()
+        conn.close()
+        if workspace is not None:
+            workspace.remove()
+    return count
+
+
+def write_authkey(fname, authkey):
+    """ Write an authentication key to a file readable by its owner only,
+    replacing an existing file
+
+    :param fname: (string) Path to the key file
+    :param authkey: (bytes) Shared authentication key
+    :rtype: None
+    """
+    if os.path.lexists(fname):
+        os.remove(fname)
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as out:
+        out.write(authkey)
+
+
+def start_workers(address, authkey, count, progDir=None, scratchDir=None):
+    """ Start worker processes on the local node
+
+    :param address: (tuple) Host and port of the coordinator
+    :param authkey: (bytes) Shared authentication key
+    :param count: (int) Number of worker processes
+    :param progDir: (string) Local directory of the PSC binaries, None to use the paths of the coordinator
+    :param scratchDir: (string) Directory to create the workspaces in, None for the default
+    :rtype: (list) Started processes
+    """
+    workers = []
+    for _ in range(count):
+        worker = Process(target=run_worker,
+                         args=(address, authkey, progDir, scratchDir))
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+class PSC_COORDINATOR(PSC_SCHEDULER):
+
+    def __init__(self, threads, address, authkey=None, localWorkers=0,
+                 leaseTimeout=LEASE_TIMEOUT, localize=None, store=None,
+                 scratchDir=None, metrics=None):
+        """ Listen for worker connections
+
+        :param threads: (int) Number of local worker processes running the long jobs
+        :param address: (tuple) Host and port to listen on, port 0 for any free port
+        :param authkey: (bytes) Shared authentication key, None to generate one
+        :param localWorkers: (int) Number of worker processes started on this node
+        :param leaseTimeout: (float) Seconds without a message after which the batches of a worker are leased again
+        :param localize: (function) Called on a worker node with a PSC handler, program directory and workspace, returning the handler to use, None to use the handlers as they are
+        :param store: (function) Called with the method name, PSC handler, pair and output of each pair processed, None to ignore
+        :param scratchDir: (string) Directory to create the workspaces of the local workers in, None for the default
+        :param metrics: (PSC_METRICS) Metrics updated as batches arrive, None to print them only
+        :rtype: None
+        """
+        PSC_SCHEDULER.__init__(self, threads, metrics)
+        if authkey is None:
+            authkey = binascii.hexlify(os.urandom(16))
+        self.authkey = authkey
+        self._listener = Listener(address, authkey=authkey)
+        self.address = self._listener.address
+        self._localWorkers = localWorkers
+        self._leaseTimeout = leaseTimeout
+        self._localize = localize or _keep_handler
+        self._store = store
+        self._scratchDir = scratchDir
+        self._lock = threading.Lock()
+        self._results = Queue()
+        self._closed = False
+        # lease state, shared by the connection threads
+        self._batches = []
+        self._files = set()
+        self._pending = deque()
+        self._done = set()
+        self._held = {}
+        self._seen = {}
+        self._released = 0
+        self._releases = {}
+        self._workers = 0
+
+    def _accept(self):
+        """ Accept worker connections, each served on its own thread
+
+        :rtype: None
+        """
+        while True:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                if self._closed:
+                    return
+                # failed authentication or handshake
+                continue
+            if self._closed:
+                conn.close()
+                return
+            with self._lock:
+                self._workers += 1
+                wid = self._workers
+            thread = threading.Thread(target=self._serve, args=(conn, wid))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn, wid):
+        """ Answer the messages of a worker until it disconnects
+
+        :param conn: (Connection) Connection to the worker
+        :param wid: (int) Worker number
+        :rtype: None
+        """
+        try:
+            while True:
+                msg = conn.recv()
+                with self._lock:
+                    self._seen[wid] = timer()
+                if msg[0] == 'hello':
+                    print('worker %d connected: %s pid %d' % (
+                        wid, msg[1], msg[2]))
+                    conn.send(('setup', list(map(
+                        lambda x: (x[1], x[2]), self._methods)),
+                        self._localize))
+                elif msg[0] == 'ready':
+                    conn.send(self._lease(wid))
+                elif msg[0] == 'fetch':
+                    conn.send(('files', list(map(
+                        lambda x: (x, open(x, 'rb').read()),
+                        filter(lambda x: x in self._files, msg[1])))))
+                elif msg[0] == 'result':
+                    self._complete(wid, msg[1], msg[2])
+        except (EOFError, OSError, IOError):
+            pass
+        finally:
+            self._release(wid, 'disconnected')
+            conn.close()
+
+    def _lease(self, wid):
+        """ Lease the next batch to a worker
+
+        :param wid: (int) Worker number
+        :rtype: (tuple) Batch message, or message to wait or stop
+        """
+        with self._lock:
+            while len(self._pending) > 0:
+                b = self._pending.popleft()
+                if b in self._done:
+                    continue
+                self._held.setdefault(wid, set()).add(b)
+                m, indices = self._batches[b]
+                pairs = self._methods[m][3]
+                return ('batch', b, m, list(map(
+                    lambda x: (x, pairs[x]), indices)))
+            if len(self._done) == len(self._batches):
+                return ('done',)
+        # leased batches may still come back from a failed worker
+        return ('wait', WAIT)
+
+    def _complete(self, wid, b, out):
+        """ Pass on the result of a batch, unless it was already delivered by
+        another worker
+
+        :param wid: (int) Worker number
+        :param b: (int) Batch number
+        :param out: (list) Pair index, program output or PSC_FAILURE and seconds spent of each task
+        :rtype: None
+        """
+        with self._lock:
+            self._held.get(wid, set()).discard(b)
+            if b in self._done:
+                return
+            self._done.add(b)
+        self._results.put((b, wid, out))
+
+    def _inflight(self):
+        """ Number of pairs in the batches leased to the workers
+
+        :rtype: (int) Pairs being processed
+        """
+        with self._lock:
+            return sum(map(lambda x: sum(map(
+                lambda b: len(self._batches[b][1]), x)),
+                self._held.values()))
+
+    def _release(self, wid, reason):
+        """ Put the batches leased to a worker back at the head of the queue
+
+        :param wid: (int) Worker number
+        :param reason: (string) Why the worker is given up
+        :rtype: None
+        """
+        with self._lock:
+            self._seen.pop(wid, None)
+            held = sorted(self._held.pop(wid, set()) - self._done)
+            for b in held:
+                self._releases[b] = self._releases.get(b, 0) + 1
+            given = list(filter(
+                lambda x: self._releases[x] >= MAX_RELEASES, held))
+            held = list(filter(
+                lambda x: self._releases[x] < MAX_RELEASES, held))
+            for b in reversed(held):
+                self._pending.appendleft(b)
+            self._released += len(held)
+            self._done.update(given)
+        if len(held) > 0:
+            print('worker %d %s, %d batches leased again' % (
+                wid, reason, len(held)))
+        for b in given:
+            print('worker %d %s, batch %d given up after %d releases' % (
+                wid, reason, b, MAX_RELEASES))
+            self._results.put((b, None, self._give_up(b)))
+
+    def _give_up(self, b):
+        """ Failure records for the pairs of a batch that is given up
+
+        :param b: (int) Batch number
+        :rtype: (list) Pair index, PSC_FAILURE and seconds spent of each task
+        """
+        m, indices = self._batches[b]
+        pscmethod, pairs = self._methods[m][2], self._methods[m][3]
+        failure = 'batch released %d times' % MAX_RELEASES
+        return list(map(lambda x: (x, pscmethod.failed(
+            pairs[x][0], pairs[x][1], pairs[x][2],
+            PSC_FAILURE(WORKER, failure)), 0.0), indices))
+
+    def _reap(self):
+        """ Give up the workers that have not been heard of for the lease
+        timeout while holding batches
+
+        :rtype: None
+        """
+        now = timer()
+        with self._lock:
+            stale = list(filter(
+                lambda x: now - self._seen[x] > self._leaseTimeout and
+                len(self._held.get(x, ())) > 0, self._seen))
+        for wid in stale:
+            self._release(wid, 'timed out')
+
+    def close(self):
+        """ Stop accepting worker connections
+
+        :rtype: None
+        """
+        if self._closed:
+            return
+        self._closed = True
+        # wake up the accepting thread
+        host, port = self.address[0], self.address[1]
+        if host in ('', '0.0.0.0'):
+            host = '127.0.0.1'
+        try:
+            socket.create_connection((host, port), 1.0).close()
+        except (OSError, IOError):
+            pass
+        self._listener.close()
+
+    def _start_local(self, local, threads):
+        """ Start the local workers not held by the running threads
+
+        :param local: (list) Started local worker processes, extended with the new ones
+        :param threads: (set) Indices of the running threads
+        :rtype: None
+        """
+        count = self._localWorkers - self._slots(threads) - len(local)
+        if count > 0:
+            local.extend(start_workers(self.address, self.authkey, count,
+                                       None, self._scratchDir))
+
+    def run(self):
+        """ Serve all tasks to the workers, execute the jobs on a local pool
+        and the methods added with *add_thread* on threads of this process.
+        Outputs are passed on as batches arrive, each PSC method is
+        finished as soon as all its pairs are done.
+
+        :rtype: (dict) Seconds from start until each method completed
+        """
+        left, done = self._start()
+        self._batches = self._chunks()
+        self._pending = deque(range(len(self._batches)))
+        self._files = set()
+        for method in self._methods:
+            for pair in method[3]:
+                self._files.update(pair[:2])
+        total = sum(map(lambda x: len(x[1]), self._batches))
+        counts = {}
+        p = None
+        if len(self._jobs) > 0:
+            p = Pool(self._threads)
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+        local = []
+        queue = Queue()
+        try:
+            running = []
+            if p is not None:
+                running = self._start_jobs(p)
+            threads = self._start_threads(queue, done)
+            self._start_local(local, threads)
+            print('pairwise jobs served on %s:%d: %d pairs for %s' % (
+                self.address[0], self.address[1], total,
+                ', '.join(map(lambda x: x[0], self._methods))))
+            count = 0
+            while count < total:
+                try:
+                    b, wid, out = self._results.get(True, WAIT)
+                except Empty:
+                    self._reap()
+                    self._finish_jobs(running, False, done)
+                    self._collect_threads(queue, threads, 0, done)
+                    self._start_local(local, threads)
+                    continue
+                m = self._batches[b][0]
+                methodname, _, pscmethod, pairs = self._methods[m][:4]
+                if self._store is not None:
+                    for i, res, _ in out:
+                        if not isinstance(res, PSC_FAILURE):
+                            self._store(methodname, pscmethod, pairs[i], res)
+                self._metrics.inflight(self._inflight())
+                self._collect(m, out, left, done)
+                count += len(out)
+                if wid is not None:
+                    counts[wid] = counts.get(wid, 0) + len(out)
+                self._finish_jobs(running, False, done)
+                self._collect_threads(queue, threads, 0, done)
+                self._start_local(local, threads)
+            while len(threads) > 0:
+                self._collect_threads(queue, threads, WAIT, done)
+                self._finish_jobs(running, False, done)
+            self._finish_jobs(running, True, done)
+            self._metrics.inflight(0)
+            self._metrics.report()
+            if p is not None:
+                p.close()
+        except BaseException:
+            if p is not None:
+                p.terminate()
+            for worker in local:
+                worker.terminate()
+            raise
+        finally:
+            if p is not None:
+                p.join()
+            for worker in local:
+                worker.join()
+            self.close()
+        print('pairwise processing took %d seconds on %d workers, %d batches '
+              'leased again' % (timer() - self._start_time, len(counts),
+                                self._released))
+        return done
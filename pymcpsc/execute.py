@@ -0,0 +1,302 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Resource limited execution of the external PSC binaries.
+
+Classes:
+    - *PSC_FAILURE*: structured record of a failed pairwise PSC execution
+
+Functions:
+    - *run_command*: execute a PSC binary with wall-clock and CPU limits
+    - *check_exit*: raise the failure of a PSC binary that did not exit successfully
+    - *parse_limits*: parse per PSC method limits given on the command line
+    - *read_failures*: read the failure records written by a run
+
+Every binary is started in its own process group (session). When the
+wall-clock limit expires the whole group is killed, so that no helper
+processes started by the binary are left behind, and the child is always
+waited for. The CPU limit is enforced by the operating system through
+RLIMIT_CPU. Commands given as argument lists are executed directly, without
+a shell, using posix_spawn where the platform provides it; this avoids the
+cost of forking the (large) worker process and of starting /bin/sh for
+every pair. A pair that times out, exceeds its CPU limit, exits with an error,
+produces output that cannot be parsed or cannot be processed by the worker
+node of a distributed run yields a failure record instead of a result, these
+are collected in the *FAILURES* file of the work directory.
+"""
+import os
+import signal
+import subprocess
+import threading
+
+try:
+    import resource
+except ImportError:  # not available on all platforms
+    resource = None
+
+# posix_spawn with a new session is available from Python 3.8 on, setting the
+# CPU limit of the spawned child requires prlimit
+_POSIX_SPAWN = hasattr(os, 'posix_spawnp') and hasattr(os, 'POSIX_SPAWN_DUP2')
+_PRLIMIT = resource is not None and hasattr(resource, 'prlimit')
+
+FAILURES = 'failures.txt'
+
+# failure reasons
+TIMEOUT = 'timeout'
+CPU = 'cpu'
+EXIT = 'exit'
+PARSE = 'parse'
+WORKER = 'worker'
+
+
+class PSC_FAILURE(Exception):
+
+    def __init__(self, reason, detail=''):
+        """ Set the reason of the failure
+
+        :param reason: (string) One of TIMEOUT, CPU, EXIT, PARSE or WORKER
+        :param detail: (string) Additional information, e.g. the exit status
+        :rtype: None
+        """
+        Exception.__init__(self, reason, detail)
+        self.reason = reason
+        self.detail = detail
+        self.method = None
+        self.names = None
+
+    def set_pair(self, method, name1, name2):
+        """ Set the PSC method and domain pair the failure occurred for
+
+        :param method: (string) PSC method name
+        :param name1: (string) Name of domain 1
+        :param name2: (string) Name of domain 2
+        :rtype: (PSC_FAILURE) This failure
+        """
+        self.method = method
+        self.names = [name1, name2]
+        return self
+
+    def record(self):
+        """ Format the failure as a line of the failure file
+
+        :rtype: (string) Tab separated domain names, method, reason and detail
+        """
+        return '\t'.join(self.names + [self.method, self.reason,
+                                       self.detail.replace('\t', ' ')])
+
+    def __str__(self):
+        """ Return the failure as string
+
+        :rtype: string
+        """
+        if self.detail:
+            return '%s (%s)' % (self.reason, self.detail)
+        return self.reason
+
+
+def _limit(cpuLimit):
+    """ Make the function run in the child before executing the binary. It
+    starts a new session, making the child the leader of its own process
+    group, and sets the CPU limit.
+
+    :param cpuLimit: (int) CPU seconds, None or 0 for no limit
+    :rtype: (function) Function to run in the child process
+    """
+    def preexec():
+        os.setsid()
+        if cpuLimit and resource is not None:
+            # SIGXCPU at the soft limit, SIGKILL one second later
+            resource.setrlimit(resource.RLIMIT_CPU,
+                               (int(cpuLimit), int(cpuLimit) + 1))
+    return preexec
+
+
+def _kill(pgid, expired):
+    """ Kill the process group of a child
+
+    :param pgid: (int) Process group id, the pid of the child
+    :param expired: (list) Set to True when the group is killed
+    :rtype: None
+    """
+    expired[0] = True
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        pass  # already gone
+
+
+def _watchdog(pgid, timeout, expired):
+    """ Start the timer killing the process group of a child once the
+    wall-clock limit expires
+
+    :param pgid: (int) Process group id, the pid of the child
+    :param timeout: (float) Wall-clock limit in seconds, None or 0 for no limit
+    :param expired: (list) Set to True when the group is killed
+    :rtype: (Timer) Started timer or None
+    """
+    if not timeout:
+        return None
+    watchdog = threading.Timer(timeout, _kill, (pgid, expired))
+    watchdog.daemon = True
+    watchdog.start()
+    return watchdog
+
+
+def _popen(cmd, timeout, cpuLimit, cwd):
+    """ Execute a command through subprocess
+
+    :param cmd: (string or list) Command line run by the shell or argument list
+    :param timeout: (float) Wall-clock limit in seconds, None or 0 for no limit
+    :param cpuLimit: (int) CPU limit in seconds, None or 0 for no limit
+    :param cwd: (string) Directory to execute the binary in
+    :rtype: (tuple) Exit status, output and whether the wall-clock limit expired
+    """
+    proc = subprocess.Popen(
+        cmd,
+        shell=not isinstance(cmd, list),
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        preexec_fn=_limit(cpuLimit))
+    expired = [False]
+    watchdog = _watchdog(proc.pid, timeout, expired)
+    try:
+        output = proc.communicate()[0]
+    except BaseException:
+        _kill(proc.pid, [False])
+        proc.wait()
+        raise
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+    return proc.returncode, output, expired[0]
+
+
+def _spawn(argv, timeout, cpuLimit):
+    """ Execute a binary directly through posix_spawn
+
+    :param argv: (list) Binary and its arguments
+    :param timeout: (float) Wall-clock limit in seconds, None or 0 for no limit
+    :param cpuLimit: (int) CPU limit in seconds, None or 0 for no limit
+    :rtype: (tuple) Exit status, output and whether the wall-clock limit expired
+    """
+    r, w = os.pipe()
+    try:
+        pid = os.posix_spawnp(argv[0], argv, os.environ, file_actions=[
+            (os.POSIX_SPAWN_DUP2, w, 1),
+            (os.POSIX_SPAWN_DUP2, w, 2)], setsid=True)
+    except BaseException:
+        os.close(r)
+        raise
+    finally:
+        os.close(w)
+    if cpuLimit:
+        # SIGXCPU at the soft limit, SIGKILL one second later
+        resource.prlimit(pid, resource.RLIMIT_CPU,
+                         (int(cpuLimit), int(cpuLimit) + 1))
+    expired = [False]
+    watchdog = _watchdog(pid, timeout, expired)
+    chunks = []
+    try:
+        while True:
+            data = os.read(r, 65536)
+            if not data:
+                break
+            chunks.append(data)
+    except BaseException:
+        _kill(pid, [False])
+        raise
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+        os.close(r)
+        status = os.waitpid(pid, 0)[1]
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    output = b''.join(chunks).decode('utf-8', 'replace')
+    return returncode, output.replace('\r\n', '\n').replace('\r', '\n'), \
+        expired[0]
+
+
+def run_command(cmd, timeout=None, cpuLimit=None, cwd=None):
+    """ Execute a PSC binary and collect its output. The output of stdout and
+    stderr is combined. A command line given as string is run by the shell,
+    an argument list is executed directly.
+
+    :param cmd: (string or list) Command line or binary and its arguments
+    :param timeout: (float) Wall-clock limit in seconds, None or 0 for no limit
+    :param cpuLimit: (int) CPU limit in seconds, None or 0 for no limit
+    :param cwd: (string) Directory to execute the binary in
+    :rtype: (string) Output of the binary
+    """
+    try:
+        if isinstance(cmd, list) and cwd is None and _POSIX_SPAWN and \
+                (_PRLIMIT or not cpuLimit):
+            returncode, output, expired = _spawn(cmd, timeout, cpuLimit)
+        else:
+            returncode, output, expired = _popen(cmd, timeout, cpuLimit, cwd)
+    except OSError as e:
+        # binary missing or not executable, as reported by the shell
+        raise PSC_FAILURE(EXIT, str(e))
+    check_exit(returncode, expired, timeout, cpuLimit)
+    return output
+
+
+def check_exit(returncode, expired, timeout, cpuLimit):
+    """ Raise the failure of a PSC binary that did not exit successfully
+
+    :param returncode: (int) Exit status, negative signal number if killed by a signal
+    :param expired: (boolean) The wall-clock limit expired
+    :param timeout: (float) Wall-clock limit in seconds, None or 0 for no limit
+    :param cpuLimit: (int) CPU limit in seconds, None or 0 for no limit
+    :rtype: None
+    """
+    if expired:
+        raise PSC_FAILURE(TIMEOUT, '%gs' % timeout)
+    if returncode < 0 and -returncode in (
+            signal.SIGXCPU, signal.SIGKILL) and cpuLimit:
+        raise PSC_FAILURE(CPU, '%ds' % int(cpuLimit))
+    if returncode != 0:
+        raise PSC_FAILURE(EXIT, 'status %d' % returncode)
+
+
+def parse_limits(text, methods):
+    """ Parse per PSC method limits. The limits are given either as a single
+    number of seconds applying to all methods or as a comma separated list of
+    method=seconds entries.
+
+    :param text: (string) Limits, None or empty for no limits
+    :param methods: (list) PSC method names a single number applies to
+    :rtype: (dict) PSC method name to seconds
+    """
+    limits = {}
+    if not text:
+        return limits
+    for entry in text.split(','):
+        if entry.find('=') == -1:
+            for method in methods:
+                limits[method] = float(entry)
+        else:
+            method, secs = entry.split('=')
+            limits[method.strip()] = float(secs)
+    return limits
+
+
+def read_failures(workdir):
+    """ Read the failure records written by a run
+
+    :param workdir: (string) Work directory of the run
+    :rtype: (dict) PSC method name to dict of domain name pair to failure reason
+    """
+    failures = {}
+    fname = '%s%s%s' % (workdir, os.path.sep, FAILURES)
+    if not os.path.exists(fname):
+        return failures
+    for line in open(fname):
+        data = line.replace('\n', '').split('\t')
+        if len(data) < 4:
+            continue
+        failures.setdefault(data[2], {})[(data[0], data[1])] = data[3]
+    return failures
@@ -0,0 +1,118 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Reading and writing of the ground truth.
+
+Functions:
+    - *ground_truth_format*: format of a ground truth file
+    - *read_ground_truth*: read the domains, their classifications and the pairs of a ground truth file
+    - *write_classification*: write a classification ground truth file
+    - *convert*: convert a pairwise ground truth file to a classification ground truth file
+
+The ground truth is the classification (e.g. SCOP or CATH) of each domain.
+A classification ground truth file has a line per domain, the domain name and
+its classification separated by a tab. Its pairs are all pairs of different
+domains, their labels are derived from the classifications of the domains.
+
+The pairwise ground truth file has a line per pair instead, the two domain
+names and their classifications separated by tabs, and only the listed pairs
+are benchmarked. It is converted to the classifications of its domains and
+the domain numbers of its pairs when read, *convert* writes the equivalent
+classification file once for all its pairs. Both formats are accepted
+wherever a ground truth file is expected.
+"""
+import csv
+
+import numpy as np
+import pandas as pd
+
+CLASSIFICATION = 'classification'
+PAIRWISE = 'pairwise'
+# number of fields of a line of each format
+FIELDS = {CLASSIFICATION: 2, PAIRWISE: 4}
+
+
+def ground_truth_format(fname):
+    """ Format of a ground truth file, from the fields of its first line
+
+    :param fname: (string) Path to the ground truth file
+    :rtype: (string) CLASSIFICATION or PAIRWISE
+    """
+    for line in open(fname):
+        if line.strip() != '':
+            if len(line.rstrip('\n').split('\t')) == FIELDS[CLASSIFICATION]:
+                return CLASSIFICATION
+            return PAIRWISE
+    return PAIRWISE
+
+
+def _read(fname, fields):
+    """ Read the fields of a ground truth file as strings
+
+    :param fname: (string) Path to the ground truth file
+    :param fields: (int) Number of fields read from each line
+    :rtype: (dataframe) A column per field
+    """
+    try:
+        return pd.read_csv(fname, sep='\t', header=None,
+                           usecols=list(range(fields)), dtype=str,
+                           na_filter=False, quoting=csv.QUOTE_NONE,
+                           engine='c')
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame(dict(map(lambda x: (x, []), range(fields))))
+
+
+def read_ground_truth(fname):
+    """ Read the domains, their classifications and the pairs of a ground
+    truth file of either format. A domain listed more than once keeps its
+    last classification, at the position of its first listing. A pair
+    listed more than once in a pairwise file is kept once, at its first
+    listing.
+
+    :param fname: (string) Path to the ground truth file
+    :rtype: (tuple) Domain names and the classification of each domain in the order they are listed, and arrays of the domain numbers of the pairs, None for all pairs of different domains
+    """
+    if ground_truth_format(fname) == CLASSIFICATION:
+        gt = _read(fname, FIELDS[CLASSIFICATION])
+        gt = gt.groupby(0, sort=False).last()
+        return (np.asarray(gt.index.values, dtype=object),
+                np.asarray(gt[1].values, dtype=object), None)
+    gt = _read(fname, FIELDS[PAIRWISE])
+    # every domain of the pairs in the order listed
+    names = np.column_stack([gt[0].values, gt[1].values]).ravel()
+    klass = pd.Series(np.column_stack([gt[2].values, gt[3].values]).ravel(),
+                      index=names)
+    klass = klass[~klass.index.duplicated(keep='last')]
+    domains = pd.Index(pd.unique(names))
+    gt = gt.drop_duplicates([0, 1])
+    return (np.asarray(domains.values, dtype=object),
+            np.asarray(klass.loc[domains].values, dtype=object),
+            (domains.get_indexer(gt[0].values),
+             domains.get_indexer(gt[1].values)))
+
+
+def write_classification(fname, domains, classifications):
+    """ Write a classification ground truth file
+
+    :param fname: (string) Path to the ground truth file
+    :param domains: (list) Domain names
+    :param classifications: (list) Classification of each domain
+    :rtype: None
+    """
+    out = open(fname, 'w')
+    out.writelines(map(lambda x: '%s\t%s\n' % x,
+                       zip(domains, classifications)))
+    out.close()
+
+
+def convert(fname, outname):
+    """ Convert a pairwise ground truth file to a classification ground
+    truth file. All pairs of its domains are benchmarked with the converted
+    file, not only the listed ones.
+
+    :param fname: (string) Path to the pairwise ground truth file
+    :param outname: (string) Path to the classification ground truth file
+    :rtype: (int) Number of domains
+    """
+    domains, classifications, _ = read_ground_truth(fname)
+    write_classification(outname, domains, classifications)
+    return len(domains)
@@ -21,11 +21,13 @@ import numpy as np
 import seaborn as sb
 import os
 
+from pymcpsc.scorematrix import PSC_SCORE_MATRIX, MCPSC, condensed_pairs
+
 
 def generate_heatmaps(
         folds,
         dom_classification,
-        rdata,
+        matrix,
         colname,
         outdir,
         make_images):
@@ -34,7 +36,7 @@ def generate_heatmaps(
 
     :param folds:  (list)  Unique folds in the dataset
     :param dom_classification:  (dict ) Key-value pairs of domains their classifications
-    :param rdata:  (dataframe)  Pairwise psc scores data
+    :param matrix:  (PSC_SCORE_MATRIX)  Pairwise psc scores data
     :param colname:  (string)  Column name data from which to include in heatmap
     :param outdir:  (string)  Path to output directory where heatmap csv files are written
     :param make_images:  (boolean)  Enable or disable image generation. Image is not generated for datasets of size > 300
@@ -42,15 +44,22 @@ def generate_heatmaps(
     """
     # distance between pair of folds is the mean of the distance between pairs
     # of domains belonging to those folds
-    fold_pair_distances = []
-    for fold1 in folds:
-        for fold2 in folds:
-            x = rdata[
-                np.logical_and(
-                    rdata['fold1'] == fold1,
-                    rdata['fold2'] == fold2)]
-            d = x[colname].mean()
-            fold_pair_distances.append([fold1, fold2, d])
+    domains = matrix.domains()
+    fold = pd.Index(folds).get_indexer(list(map(
+        lambda x: '.'.join(dom_classification[x].split('.')[:2]), domains)))
+    first, second = condensed_pairs(matrix.pairs(), len(domains))
+    values = np.asarray(matrix.condensed(colname)[matrix.pairs()],
+                        dtype=float)
+    scored = ~np.isnan(values)
+    # every pair in both orders
+    keys = np.concatenate([fold[first] * len(folds) + fold[second],
+                           fold[second] * len(folds) + fold[first]])
+    keys = keys[np.concatenate([scored, scored])]
+    sums = np.bincount(keys, weights=np.concatenate(
+        [values[scored], values[scored]]), minlength=len(folds) ** 2)
+    counts = np.bincount(keys, minlength=len(folds) ** 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        d = sums / counts
 
     sorted_dom = sorted(dom_classification, key=dom_classification.get)
 
@@ -60,10 +69,10 @@ def generate_heatmaps(
     classes = ['SCOP Class A', 'SCOP Class B', 'SCOP Class C', 'SCOP Class D']
     legend_TN = [mpatches.Patch(color=c, label=l) for c, l in zip(class_colours, classes)]
 
-    fold_pair_distances_df = pd.DataFrame(fold_pair_distances)
-    fold_pair_distances_df.columns = ['fold1', 'fold2', 'd']
-    p1 = fold_pair_distances_df.pivot(
-        index='fold1', columns='fold2', values='d')
+    p1 = pd.DataFrame(d.reshape(len(folds), len(folds)),
+                      index=pd.Index(folds, name='fold1'),
+                      columns=pd.Index(folds, name='fold2'))
+    p1 = p1.sort_index().sort_index(axis=1)
 
     # generate fold-pair heatmap
     if make_images and len(p1) <= 300:
@@ -84,14 +93,9 @@ def generate_heatmaps(
         plt.close(fig)
     p1.to_csv('%s%s%s_fold_heatmap.csv' % (outdir, os.path.sep, colname))
 
-    similarity_map = dict(map(lambda x: [(x[0], x[1]), x[2]], rdata[
-                          ['dom1', 'dom2', colname]].as_matrix()))
-    for dom1 in sorted_dom:
-        similarity_map[(dom1, dom1)] = 1
-
     # generate domain-pair heatmap
-    p = [list(map(lambda x: similarity_map.get((dom1, x)), sorted_dom))
-         for dom1 in sorted_dom]
+    p = matrix.square(colname, pd.Index(domains).get_indexer(sorted_dom))
+    np.fill_diagonal(p, 1)
     p_df = pd.DataFrame(p)
     p_df.columns = sorted_dom
     p_df.index = sorted_dom
@@ -118,41 +122,32 @@ def make(
     make_images=True,
         psc_cols=[]):
     """ Manages creation of Heatmaps. Reades in pairwise domain
-    PSC and MCPSC scores from a file. Heatmaps are then generated for each
-    method.
+    PSC and MCPSC scores from the MCPSC score matrix. Heatmaps are then
+    generated for each method.
 
     :param outdir:  (string)  The output directory where the heatmap csv data is stored for user to visualize using other tools. The default value is 'outdir'
     :param make_images:  (boolean)  Enable or disable image generation
-    :param psc_cols:  (list)  The list of psc methods for which the heatmaps will be generated. Imputed pairwise PSC scores corresponding to these are expected to be found in the outdir/processed.imputed.mcpsc.csv file
+    :param psc_cols:  (list)  The list of psc methods for which the heatmaps will be generated. Imputed pairwise PSC scores corresponding to these are expected to be found in the MCPSC score matrix of outdir
     :rtype: None
     """
-    # read input data from file generated by pre-processing step
-    rdata = pd.read_csv(
-        '%s%sprocessed.imputed.mcpsc.csv' %
-        (outdir, os.path.sep))
-
-    # set class values for domains
-    rdata['fold1'] = rdata.apply(
-        lambda x: '.'.join(
-            x['cath1'].split('.')[
-                :2]), axis=1)
-    rdata['fold2'] = rdata.apply(
-        lambda x: '.'.join(
-            x['cath2'].split('.')[
-                :2]), axis=1)
+    # read input data from the matrices generated by the pre-processing steps
+    matrix = PSC_SCORE_MATRIX(outdir, MCPSC)
 
     # make name to class matrix
-    dom_classification = dict(rdata[['dom1', 'cath1']].as_matrix())
+    dom_classification = dict(zip(matrix.domains(),
+                                  matrix.classifications()))
 
     # get unique folds
-    folds = list(rdata['fold1'].unique())
+    folds = list(pd.unique(np.array(list(map(
+        lambda x: '.'.join(x.split('.')[:2]), dom_classification.values())),
+        dtype=object)))
 
     # generate maps
     for colname in ['%s_fill_mean' % x for x in psc_cols]:
         generate_heatmaps(
             folds,
             dom_classification,
-            rdata,
+            matrix,
             colname,
             outdir,
             make_images)
@@ -160,7 +155,7 @@ def make(
         generate_heatmaps(
             folds,
             dom_classification,
-            rdata,
+            matrix,
             colname,
             outdir,
             make_images)
@@ -11,8 +11,11 @@ PSC method.
 """
 
 import os
-import pandas as pd
 import numpy as np
+import pandas as pd
+
+from pymcpsc.scorematrix import PSC_SCORE_MATRIX, PROCESSED, IMPUTED, \
+    condensed_pairs, condensed_row
 
 
 def cmean2(x, f, mean_v):
@@ -24,7 +27,8 @@ def cmean2(x, f, mean_v):
     :param mean_v:  (float)  Global mean similarity score
     :rtype: float
     """
-    if x[2] and not np.isnan(x[2]):
+    # a score of 0 is the explicit low score of a pair pruned by the prefilter
+    if x[2] is not None and not np.isnan(x[2]):
         return x[2]
     r = np.mean(f[x[0]] + f[x[1]])
     if np.isnan(r):
@@ -32,7 +36,7 @@ def cmean2(x, f, mean_v):
     return r
 
 
-def make(OUTDIR='outdir'):
+def make(OUTDIR='outdir', csv=False):
     """ Fills missing data per column for the pairwise PSC scores.
 
     Assuming that pairwise PSC scores were successfully generated for s
@@ -46,30 +50,48 @@ def make(OUTDIR='outdir'):
     - merge the two sets and use the mean value of scores in the set union as the PSC score for that domain pair
     - if the two aforementioned sets are empty then use the global average of scores for that PSC method to supply the missing score's value.
 
+    Pairs pruned by the prefilter are not missing, they keep their explicit low score.
+
+    The scores are read from the PROCESSED score matrix, the scores of a
+    domain are a row of the matrix. The scores with missing values as NaN
+    and the filled in scores are written to the IMPUTED score matrix.
+
     :param outdir: (string) Path to output directory where processed data files can be found
+    :param csv: (boolean) Also write the processed.imputed.csv file
     :rtype: None    
     """
-    full_psc_data = pd.read_csv('%s%sprocessed.csv' % (OUTDIR, os.path.sep))
-    full_psc_data = full_psc_data.replace([-1], [None])
-
-    for col in full_psc_data.columns[8:]:
+    matrix = PSC_SCORE_MATRIX(OUTDIR, PROCESSED)
+    psc_cols = matrix.columns()[4:]
+    n = len(matrix.domains())
+    pairs = matrix.pairs()
+    dom1, dom2 = condensed_pairs(pairs, n)
+    full_psc_data = pd.DataFrame(index=range(len(pairs)))
+
+    for col in psc_cols:
         print('.')
+        # missing scores and pairs not in the ground truth are NaN
+        values = np.array(matrix.condensed(col), dtype=float)
+        values[values == -1] = np.nan
+        full_psc_data[col] = values[pairs]
         # print col, len(full_psc_data[col].dropna())
         mean_v = full_psc_data[col].mean()
 
-        # local mean fill
-        f1 = full_psc_data[['dom1', col]]
-        f2 = f1.groupby(by='dom1', as_index=True)
+        # local mean fill, from the rows of the domains of the missing pairs
+        missing = np.flatnonzero(np.isnan(full_psc_data[col].values))
         f = {}
         # print 'making map'
 
         def f_isnan(x): return filter(lambda i: not np.isnan(i), x)
-        for k in np.unique(f1['dom1']):
-            # NOTE THE ADDED DROPNA HERE FOR PY3
-            f[k] = list(f_isnan(f2.get_group(k)[col].dropna()))
+        for k in np.unique(np.concatenate([dom1[missing], dom2[missing]])):
+            f[k] = list(f_isnan(condensed_row(values, k, n).tolist()))
         # print 'going for mean'
 
-        full_psc_data['%s_fill_mean' % col] = full_psc_data[
-            ['dom1', 'dom2', col]].apply(lambda x: cmean2(x, f, mean_v), axis=1)
+        fill = full_psc_data[col].values.copy()
+        for i in missing:
+            fill[i] = cmean2([dom1[i], dom2[i], fill[i]], f, mean_v)
+        full_psc_data['%s_fill_mean' % col] = fill
 
-    full_psc_data.to_csv('%s%sprocessed.imputed.csv' % (OUTDIR, os.path.sep))
+    imputed = PSC_SCORE_MATRIX(OUTDIR, IMPUTED)
+    imputed.write(full_psc_data, parent=matrix)
+    if csv:
+        imputed.to_csv('%s%sprocessed.imputed.csv' % (OUTDIR, os.path.sep))
@@ -0,0 +1,142 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Methods for incrementally growing a processed dataset.
+
+Functions:
+    - *read_manifest*: read the domain manifest of a previous run
+    - *write_manifest*: write the domain manifest of the current run
+    - *diff_manifest*: split the domains of a dataset into new and old domains
+    - *incremental_pairs*: make the list of pairs to process for new domains
+    - *merge_result_file*: merge new pairwise results into an existing output file
+
+The manifest stored in the work directory records the content hash of every
+PDB file processed by a run. When domains are added to (or changed in) the
+dataset only the pairs involving the new domains need to be processed, i.e.
+the new x new and new x old pairs. Their results are merged into the existing
+PSC output files, from which the rows of changed and removed domains are
+dropped, so that the post-processing sees a complete set of pairwise scores.
+"""
+import os
+
+from pymcpsc.cache import file_digest
+
+MANIFEST = 'domains.manifest'
+
+
+def read_manifest(workdir):
+    """ Read the domain manifest of a previous run
+
+    :param workdir: (string) Path to the work directory of the run
+    :rtype: (dict) PDB file name to content hash or None if there is no manifest
+    """
+    fname = '%s%s%s' % (workdir, os.path.sep, MANIFEST)
+    if not os.path.exists(fname):
+        return None
+    manifest = {}
+    for line in open(fname):
+        data = line.replace('\n', '').split('\t')
+        if len(data) == 2:
+            manifest[data[0]] = data[1]
+    return manifest
+
+
+def write_manifest(workdir, datadir, pdb_files):
+    """ Write the domain manifest of the current run
+
+    :param workdir: (string) Path to the work directory of the run
+    :param datadir: (string) Path where PDB files are stored
+    :param pdb_files: (list) Names of the processed PDB files
+    :rtype: None
+    """
+    fname = '%s%s%s' % (workdir, os.path.sep, MANIFEST)
+    out = open(fname + '.tmp', 'w')
+    for pdb_file in pdb_files:
+        out.write('%s\t%s\n' % (pdb_file, file_digest(
+            '%s%s%s' % (datadir, os.path.sep, pdb_file))))
+    out.close()
+    os.rename(fname + '.tmp', fname)
+
+
+def diff_manifest(manifest, datadir, pdb_files):
+    """ Split the domains of a dataset into new (or changed) domains and
+    domains that were already processed by a previous run.
+
+    :param manifest: (dict) Manifest of the previous run
+    :param datadir: (string) Path where PDB files are stored
+    :param pdb_files: (list) Names of the PDB files in the dataset
+    :rtype: (tuple) New PDB files, old PDB files, removed or changed PDB files
+    """
+    new = []
+    old = []
+    for pdb_file in pdb_files:
+        digest = file_digest('%s%s%s' % (datadir, os.path.sep, pdb_file))
+        if manifest.get(pdb_file) == digest:
+            old.append(pdb_file)
+        else:
+            new.append(pdb_file)
+    processed = set(old)
+    stale = [x for x in manifest if x not in processed]
+    return new, old, stale
+
+
+def incremental_pairs(new, old):
+    """ Make the list of pairs to process when new items are added to a set of
+    already processed items. These are all pairs within the new items (the
+    upper triangle including self pairs) and all pairs of a new and an old
+    item. If there are no old items this is the full upper triangle.
+
+    :param new: (list) New items
+    :param old: (list) Already processed items
+    :rtype: (list) Pairs of items
+    """
+    pairs = []
+    for x in range(0, len(new)):
+        for y in range(x, len(new)):
+            pairs.append((new[x], new[y]))
+        for y in range(0, len(old)):
+            pairs.append((new[x], old[y]))
+    return pairs
+
+
+def merge_result_file(outfilename, newfilenames, keep, sep=' ', header=False):
+    """ Merge new pairwise results into an existing output file. Rows of the
+    existing file are kept only if both domains are in the keep set, the rows
+    of the new files are appended after them.
+
+    :param outfilename: (string) Path to the existing output file
+    :param newfilenames: (list) Paths to files with the new results
+    :param keep: (set) Names of domains whose existing results remain valid
+    :param sep: (string) Column separator
+    :param header: (boolean) Files start with a header line
+    :rtype: (int) Number of rows dropped from the existing output
+    """
+    out = open(outfilename + '.tmp', 'w')
+    dropped = 0
+    head = None
+    if os.path.exists(outfilename):
+        lines = open(outfilename)
+        if header:
+            head = lines.readline()
+            out.write(head)
+        for line in lines:
+            data = line.replace('\n', '').split(sep)
+            if len(data) > 1 and data[0] in keep and data[1] in keep:
+                out.write(line)
+            else:
+                dropped += 1
+        lines.close()
+    for newfilename in newfilenames:
+        if not os.path.exists(newfilename):
+            continue
+        lines = open(newfilename)
+        if header:
+            line = lines.readline()
+            if head is None:
+                head = line
+                out.write(head)
+        for line in lines:
+            out.write(line)
+        lines.close()
+    out.close()
+    os.rename(outfilename + '.tmp', outfilename)
+    return dropped
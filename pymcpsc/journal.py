@@ -0,0 +1,209 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Append-only journal of pairwise PSC results.
+
+Classes:
+    - *PSC_JOURNAL*: streaming, checkpointed store of pairwise PSC output
+
+Results of the pairwise PSC methods are appended to the journal as soon as
+they arrive from the worker pool instead of being held in memory until all
+pairs of a method are done. The journal is flushed and synced to disk
+periodically, so that an interrupted run loses at most the results of the
+last sync interval. A resumed run reads the journal, skips the pairs already
+recorded in it and produces the final PSC output files from the journal.
+
+Each record is one line holding the PSC method name and the output line of a
+pair, separated by a tab. Records of long running jobs that complete as a
+whole (e.g. GR-align) hold the *DONE* marker instead of an output line. The
+journal may optionally be gzip compressed, every sync then closes a gzip
+member and starts a new one. Pairs whose PSC binary failed are recorded with
+the *FAILED* marker as method name and the failure record as line, they count
+as processed for the method that failed and are not retried on resume.
+"""
+import os
+import gzip
+import zlib
+from timeit import default_timer as timer
+
+JOURNAL = 'pairs.journal'
+DONE = '#done'
+FAILED = '#failed'
+
+
+class PSC_JOURNAL:
+
+    def __init__(self, workdir, compress=False, fsyncInterval=10):
+        """ Set path and sync settings of the journal
+
+        :param workdir: (string) Work directory where the journal is stored
+        :param compress: (boolean) gzip compress the journal
+        :param fsyncInterval: (float) Seconds between syncs of the journal to disk
+        :rtype: None
+        """
+        self._fname = '%s%s%s' % (workdir, os.path.sep, JOURNAL)
+        self._compress = compress
+        if compress:
+            self._fname += '.gz'
+        self._fsyncInterval = fsyncInterval
+        self._f = None
+        self._lastSync = timer()
+
+    def exists(self):
+        """ Check if there is a journal of a previous run
+
+        :rtype: (boolean)
+        """
+        return os.path.exists(self._fname)
+
+    def _open(self):
+        """ Open the journal for appending
+
+        :rtype: None
+        """
+        if self._compress:
+            self._f = gzip.open(self._fname, 'ab')
+        else:
+            self._f = open(self._fname, 'ab')
+
+    def _read(self):
+        """ Read the valid records of the journal. Reading stops at a
+        truncated or corrupted tail, as left behind by an interrupted run.
+
+        :rtype: (generator) Tuples of method name and output line
+        """
+        if not os.path.exists(self._fname):
+            return
+        if self._compress:
+            f = gzip.open(self._fname, 'rb')
+        else:
+            f = open(self._fname, 'rb')
+        try:
+            for line in f:
+                line = line.decode('utf-8')
+                if not line.endswith('\n'):
+                    break
+                data = line[:-1].split('\t', 1)
+                if len(data) == 2:
+                    yield data[0], data[1]
+        except (EOFError, IOError, OSError, zlib.error):
+            pass
+        finally:
+            f.close()
+
+    def start(self, resume=False):
+        """ Open the journal for a run. When resuming, the valid records of
+        the existing journal are kept and rewritten, dropping any truncated
+        tail, otherwise the journal is emptied.
+
+        :param resume: (boolean) Keep the records of the previous run
+        :rtype: (dict) Method name to the set of domain name pairs already recorded
+        """
+        done = {}
+        tmpname = '%s.tmp' % self._fname
+        if self._compress:
+            out = gzip.open(tmpname, 'wb')
+        else:
+            out = open(tmpname, 'wb')
+        if resume:
+            for method, line in self._read():
+                out.write(('%s\t%s\n' % (method, line)).encode('utf-8'))
+                if line == DONE:
+                    done.setdefault(method, set()).add(DONE)
+                    continue
+                if method == FAILED:
+                    # domain names, method, reason and detail
+                    data = line.split('\t')
+                    done.setdefault(data[2], set()).add((data[0], data[1]))
+                    continue
+                data = line.split(' ')
+                done.setdefault(method, set()).add((data[0], data[1]))
+        out.close()
+        os.rename(tmpname, self._fname)
+        self._open()
+        self._lastSync = timer()
+        return done
+
+    def record(self, method, line):
+        """ Append the output line of a pair to the journal
+
+        :param method: (string) PSC method name
+        :param line: (string) Output line for the pair
+        :rtype: None
+        """
+        self._f.write(('%s\t%s\n' % (method, line)).encode('utf-8'))
+        if timer() - self._lastSync >= self._fsyncInterval:
+            self.sync()
+
+    def record_done(self, method):
+        """ Record the completion of a job that is processed as a whole
+
+        :param method: (string) PSC method name
+        :rtype: None
+        """
+        self.record(method, DONE)
+        self.sync()
+
+    def record_failure(self, failure):
+        """ Record a pair whose PSC binary failed
+
+        :param failure: (PSC_FAILURE) Failure of the pair
+        :rtype: None
+        """
+        self.record(FAILED, failure.record())
+
+    def sync(self):
+        """ Flush the journal and sync it to disk
+
+        :rtype: None
+        """
+        if self._f is None:
+            return
+        if self._compress:
+            # close the gzip member so that the synced data is readable
+            self._f.close()
+            fd = os.open(self._fname, os.O_RDONLY)
+            os.fsync(fd)
+            os.close(fd)
+            self._open()
+        else:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+        self._lastSync = timer()
+
+    def lines(self, method):
+        """ Output lines recorded for a PSC method
+
+        :param method: (string) PSC method name
+        :rtype: (generator) Output lines
+        """
+        self.sync()
+        for m, line in self._read():
+            if m == method and line != DONE:
+                yield line
+
+    def failures(self):
+        """ Failure records of all PSC methods
+
+        :rtype: (generator) Failure records
+        """
+        return self.lines(FAILED)
+
+    def close(self):
+        """ Sync and close the journal
+
+        :rtype: None
+        """
+        if self._f is None:
+            return
+        self.sync()
+        self._f.close()
+        self._f = None
+
+    def remove(self):
+        """ Close and remove the journal once all output files are written
+
+        :rtype: None
+        """
+        self.close()
+        if os.path.exists(self._fname):
+            os.remove(self._fname)
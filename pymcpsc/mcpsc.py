@@ -15,6 +15,8 @@ import os
 import pandas as pd
 import numpy as np
 
+from pymcpsc.scorematrix import PSC_SCORE_MATRIX, IMPUTED, MCPSC
+
 
 def get_wv_dataset_size(df, colnames):
     """calculates the weight vector proportional to the number of pairs processed by the PSC method.
@@ -97,10 +99,10 @@ def make(
         4,
         1,
         1],
-        psc_cols=[], do_user_mcpsc=True):
+        psc_cols=[], do_user_mcpsc=True, csv=False):
     """The main method for generating the consensus scores. Expects to load
-    the imputed data file and writes as output a file with consensus scores
-    appended for each protein domain pair.
+    the imputed scores from the IMPUTED score matrix and writes the consensus
+    scores of each protein domain pair to the MCPSC score matrix.
 
     - **M1**: It is the Generalized Mean of the available PSC scores. In the current implementation it is essentially the average of the available PSC scores for the pair.
     - **M2**: It is a weighted average of the PSC scores of the different methods. For each domain pair we weight the available PSC method scores by the percentage of pairs successfully processed by each PSC method in the whole dataset (coverage based weighting).
@@ -113,13 +115,13 @@ def make(
     :param weights_u: (list) List of user defined weights for the PSC methods
     :param psc_cols: (list) List of psc method names to be included in mean calculations
     :param do_user_mcpsc: (boolean) Calculate weighted average based on user specified weights
+    :param csv: (boolean) Also write the processed.imputed.mcpsc.csv file
     :rtype: None
     """
     imputed_psc_cols = list(map(lambda x: '%s_fill_mean' % x, psc_cols))
     # processing
-    full_psc_data = pd.read_csv(
-        '%s%sprocessed.imputed.csv' %
-        (outdir, os.path.sep), na_values='')
+    matrix = PSC_SCORE_MATRIX(outdir, IMPUTED)
+    full_psc_data = matrix.read(psc_cols + imputed_psc_cols)
     # full_psc_data = full_psc_data.replace([-1], [None])
 
     print('.')
@@ -157,6 +159,8 @@ def make(
         colnames_fill].median(axis=1)
 
     print('.')
-    full_psc_data.to_csv(
-        '%s%sprocessed.imputed.mcpsc.csv' %
-        (outdir, os.path.sep))
+    mcpsc = PSC_SCORE_MATRIX(outdir, MCPSC)
+    mcpsc.write(full_psc_data[colnames_full + colnames_fill + [
+        'mcpsc_full_median', 'mcpsc_fill_median']], parent=matrix)
+    if csv:
+        mcpsc.to_csv('%s%sprocessed.imputed.mcpsc.csv' % (outdir, os.path.sep))
@@ -0,0 +1,306 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Live throughput, latency and ETA metrics of the pairwise PSC methods.
+
+Classes:
+    - *PSC_METRICS*: metrics of the pairwise PSC methods of a run
+
+Functions:
+    - *format_duration*: format seconds as h:mm:ss
+
+The schedulers record every pair as its output arrives: the seconds spent
+on it and whether its binary failed. For each method the metrics hold the
+number of pairs to process, done and failed, the overall throughput and the
+throughput over the last *WINDOW* seconds, the latency distribution of the
+pairs as a histogram with fixed bucket bounds (from which the percentiles
+are estimated) and the ETA at the recent throughput, along with the number
+of pairs in flight. No work is done between results.
+
+Every *INTERVAL* seconds, checked when a result arrives, a line per
+running method is printed and the metrics are written to the *JSON* and
+*PROMETHEUS* files of the work directory, the latter in the Prometheus text
+exposition format as read by e.g. the node exporter textfile collector.
+Both files are written to a temporary name and renamed, readers never see
+a partial file.
+"""
+import os
+import json
+import time
+from collections import deque
+from timeit import default_timer as timer
+
+JSON = 'metrics.json'
+PROMETHEUS = 'metrics.prom'
+# seconds between updates of the console and files, and of the window the
+# recent throughput is measured over
+INTERVAL = 10.0
+WINDOW = 60
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0,
+           50.0, 100.0, 250.0, 500.0, 1000.0, float('inf')]
+PERCENTILES = [50, 90, 99]
+
+
+def format_duration(secs):
+    """ Format seconds as h:mm:ss
+
+    :param secs: (float) Seconds, None if unknown
+    :rtype: (string) Formatted duration, ? if unknown
+    """
+    if secs is None:
+        return '?'
+    secs = int(secs)
+    return '%d:%02d:%02d' % (secs // 3600, secs // 60 % 60, secs % 60)
+
+
+class PSC_METRICS:
+
+    def __init__(self, workdir=None, interval=INTERVAL):
+        """ Set where and how often the metrics are reported
+
+        :param workdir: (string) Work directory the metrics files are written to, None to print them only
+        :param interval: (float) Seconds between reports
+        :rtype: None
+        """
+        self._workdir = workdir
+        self._interval = interval
+        self._methods = {}
+        self._order = []
+        self._inflight = 0
+        self._start = timer()
+        self._startTime = time.time()
+        self._last = self._start
+
+    def start(self, methodname, total):
+        """ Start tracking a method
+
+        :param methodname: (string) PSC method name
+        :param total: (int) Number of pairs to process
+        :rtype: None
+        """
+        if methodname not in self._methods:
+            self._order.append(methodname)
+        self._methods[methodname] = {
+            'total': total, 'done': 0, 'failed': 0, 'start': timer(),
+            'end': None, 'buckets': [0] * len(BUCKETS), 'sum': 0.0,
+            'timed': 0, 'window': deque()}
+
+    def inflight(self, count):
+        """ Set the number of pairs in flight
+
+        :param count: (int) Pairs being processed
+        :rtype: None
+        """
+        self._inflight = count
+
+    def record(self, methodname, secs=None, failed=False):
+        """ Record the output of a pair as it arrives
+
+        :param methodname: (string) PSC method name
+        :param secs: (float) Seconds spent on the pair, None if not measured
+        :param failed: (boolean) The binary failed for the pair
+        :rtype: None
+        """
+        m = self._methods[methodname]
+        now = timer()
+        m['done'] += 1
+        if failed:
+            m['failed'] += 1
+        if secs is not None:
+            k = 0
+            while secs > BUCKETS[k]:
+                k += 1
+            m['buckets'][k] += 1
+            m['sum'] += secs
+            m['timed'] += 1
+        # pairs per second of the window
+        second = int(now)
+        window = m['window']
+        if len(window) > 0 and window[-1][0] == second:
+            window[-1][1] += 1
+        else:
+            window.append([second, 1])
+        while window[0][0] <= second - WINDOW:
+            window.popleft()
+        if m['done'] == m['total']:
+            m['end'] = now
+        if now - self._last >= self._interval:
+            self.report()
+
+    def finish(self, methodname):
+        """ Stop tracking a method and print its summary
+
+        :param methodname: (string) PSC method name
+        :rtype: None
+        """
+        m = self._methods[methodname]
+        if m['end'] is None:
+            m['end'] = timer()
+        print('\t%s' % self._line(methodname))
+        self.write()
+
+    def percentile(self, methodname, q):
+        """ Estimate a percentile of the latencies of a method from its
+        histogram, interpolating within the bucket
+
+        :param methodname: (string) PSC method name
+        :param q: (float) Percentile, 0 to 100
+        :rtype: (float) Seconds, None if no latencies were recorded
+        """
+        m = self._methods[methodname]
+        if m['timed'] == 0:
+            return None
+        rank = q / 100. * m['timed']
+        count = 0
+        for k, n in enumerate(m['buckets']):
+            if n > 0 and count + n >= rank:
+                low = BUCKETS[k - 1] if k > 0 else 0.
+                high = BUCKETS[k]
+                if high == float('inf'):
+                    return low
+                return low + (high - low) * (rank - count) / n
+            count += n
+        return BUCKETS[-2]
+
+    def summary(self, methodname):
+        """ Metrics of a method
+
+        :param methodname: (string) PSC method name
+        :rtype: (dict) Pair counts, throughput, latency and ETA
+        """
+        m = self._methods[methodname]
+        now = timer() if m['end'] is None else m['end']
+        elapsed = now - m['start']
+        rate = m['done'] / elapsed if elapsed > 0 else 0.
+        # the window spans whole seconds, the current one partially
+        recent = rate
+        if m['end'] is None and len(m['window']) > 0:
+            span = min(elapsed, now - m['window'][0][0])
+            if span > 0:
+                recent = sum(map(lambda x: x[1], m['window'])) / span
+        left = m['total'] - m['done']
+        eta = 0.
+        if left > 0:
+            eta = left / recent if recent > 0 else None
+        latency = {}
+        for q in PERCENTILES:
+            latency['p%d' % q] = self.percentile(methodname, q)
+        latency['mean'] = m['sum'] / m['timed'] if m['timed'] > 0 else None
+        return {'total': m['total'], 'done': m['done'],
+                'failed': m['failed'], 'finished': m['end'] is not None,
+                'elapsed_seconds': elapsed, 'pairs_per_second': rate,
+                'recent_pairs_per_second': recent, 'eta_seconds': eta,
+                'latency_seconds': latency}
+
+    def _line(self, methodname):
+        """ Console line of a method
+
+        :param methodname: (string) PSC method name
+        :rtype: (string) Metrics of the method
+        """
+        s = self.summary(methodname)
+        line = '%s: %d/%d pairs, %0.1f pairs/s' % (
+            methodname, s['done'], s['total'],
+            s['recent_pairs_per_second'] if not s['finished'] else
+            s['pairs_per_second'])
+        latency = s['latency_seconds']
+        if latency['p50'] is not None:
+            line += ', latency ' + ' '.join(map(
+                lambda x: 'p%d %0.2fs' % (x, latency['p%d' % x]),
+                PERCENTILES))
+        line += ', %d failed' % s['failed']
+        if s['finished']:
+            return '%s, done in %s' % (line, format_duration(
+                s['elapsed_seconds']))
+        return '%s, ETA %s' % (line, format_duration(s['eta_seconds']))
+
+    def report(self):
+        """ Print the metrics of the running methods and write the metrics
+        files
+
+        :rtype: None
+        """
+        self._last = timer()
+        running = [x for x in self._order if self._methods[x]['end'] is None]
+        if len(running) > 0:
+            print('%d pairs in flight, %s elapsed' % (
+                self._inflight, format_duration(self._last - self._start)))
+        for methodname in running:
+            print('\t%s' % self._line(methodname))
+        self.write()
+
+    def to_json(self):
+        """ Metrics of all methods
+
+        :rtype: (dict) Metrics as written to the JSON file
+        """
+        return {'updated': time.time(), 'start': self._startTime,
+                'elapsed_seconds': timer() - self._start,
+                'inflight': self._inflight,
+                'methods': dict(map(lambda x: (x, self.summary(x)),
+                                    self._order))}
+
+    def to_prometheus(self):
+        """ Metrics of all methods in the Prometheus text format
+
+        :rtype: (string) Metrics as written to the Prometheus file
+        """
+        lines = []
+
+        def metric(name, kind, text, values):
+            lines.append('# HELP pymcpsc_%s %s' % (name, text))
+            lines.append('# TYPE pymcpsc_%s %s' % (name, kind))
+            for labels, value in values:
+                lines.append('pymcpsc_%s%s %s' % (name, labels, repr(
+                    float(value))))
+
+        summaries = list(map(lambda x: (x, self.summary(x)), self._order))
+
+        def per_method(key):
+            return [('{method="%s"}' % x, s[key]) for x, s in summaries
+                    if s[key] is not None]
+
+        metric('start_time_seconds', 'gauge', 'Start of the run',
+               [('', self._startTime)])
+        metric('inflight_pairs', 'gauge', 'Pairs being processed',
+               [('', self._inflight)])
+        metric('pairs', 'gauge', 'Pairs to process', per_method('total'))
+        metric('pairs_done_total', 'counter', 'Pairs processed',
+               per_method('done'))
+        metric('pairs_failed_total', 'counter', 'Pairs whose binary failed',
+               per_method('failed'))
+        metric('pairs_per_second', 'gauge',
+               'Pairs processed per second over the last %d seconds' %
+               WINDOW, per_method('recent_pairs_per_second'))
+        metric('eta_seconds', 'gauge', 'Expected seconds until done',
+               per_method('eta_seconds'))
+        values = []
+        for x in self._order:
+            m = self._methods[x]
+            count = 0
+            for bound, n in zip(BUCKETS, m['buckets']):
+                count += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                values.append(('_bucket{method="%s",le="%s"}' % (x, le),
+                               count))
+            values.append(('_sum{method="%s"}' % x, m['sum']))
+            values.append(('_count{method="%s"}' % x, m['timed']))
+        metric('pair_latency_seconds', 'histogram',
+               'Seconds spent on a pair', values)
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """ Write the metrics files to the work directory
+
+        :rtype: None
+        """
+        if self._workdir is None or not os.path.isdir(self._workdir):
+            return
+        for name, data in [
+                (JSON, json.dumps(self.to_json(), indent=1, sort_keys=True)),
+                (PROMETHEUS, self.to_prometheus())]:
+            fname = '%s%s%s' % (self._workdir, os.path.sep, name)
+            out = open('%s.tmp' % fname, 'w')
+            out.write(data)
+            out.close()
+            os.rename('%s.tmp' % fname, fname)
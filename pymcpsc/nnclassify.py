@@ -4,49 +4,48 @@
 similiarty score matrices.
 
 Functions:
-    - *_nnclassifyacc*: Calculates the nearest neighbor for each domain by creating a pivot table.
+    - *_nnclassifyacc*: Calculates the nearest neighbor for each domain from the square matrix of scores.
     - *nnclassifyacc*: Calculates the performance of nearest neighbor classifier.
     - *multi_nnclassifyacc*:
     - *make*: main entry method
     
 Leave-one-out nearest neighbor analysis accuracy performances of classifiers built with PSC and MCPSC scores.
 """
-import os
-import pandas as pd
 from collections import Counter
 
+import numpy as np
 
-def _nnclassifyacc(df, colname):
-    """Calculates the nearest neighbor for each domain by creating a pivot table.
+from pymcpsc.scorematrix import PSC_SCORE_MATRIX, MCPSC
 
-    :param df: (dataframe) Dataframe containing pairwise similarity scores of domains
-    :param colname: (list) PSC method for which the nearest neighbors are to be calculated
+
+def _nnclassifyacc(scores, domains):
+    """Calculates the nearest neighbor for each domain from the square matrix of scores.
+
+    :param scores: (array) Square matrix of pairwise similarity scores of domains, NaN where missing
+    :param domains: (array) Domains of the rows and columns of the matrix
     :rtype: (list) Domain pairs and corresponding scores where the pairs are nearest neighbors
     """
-    # create pivot table from domain pairs
-    p = df.pivot(index='dom1', columns='dom2', values=colname)
+    # domains with scores
+    scored = np.flatnonzero(~np.all(np.isnan(scores), axis=1))
     # find the column with max value for each row
-    nnidxs = p.idxmax(axis=1)
+    nnidxs = np.nanargmax(scores[scored], axis=1)
     # find the score corresponding to nearest neighbor pairs
-    scores = []
-    for d1, d2 in zip(nnidxs.index, nnidxs):
-        scores.append(p[d1][d2])
-    return zip(nnidxs.index, nnidxs, scores)
+    return zip(domains[scored], domains[nnidxs], scores[scored, nnidxs])
 
 
-def nnclassifyacc(df, colname, klass):
+def nnclassifyacc(scores, domains, klass):
     """Calculates the performance of nearest neighbor classifier.
 
-    :param df: (dataframe) Dataframe containing pairwise similarity scores of domains
-    :param colname: (list) PSC method for which the nearest neighbors are to be calculated
+    :param scores: (array) Square matrix of pairwise similarity scores of domains, NaN where missing
+    :param domains: (array) Domains of the rows and columns of the matrix
     :param klass: (dict) Key-value pair of domain and their classifications.
     :rtype: (float) Accuracy
     """
     try:
-        dfi = df.dropna(subset=[colname])
-        total = len(dfi['dom1'].unique())
+        total = 0
         correct = 0
-        for dom1, dom2, s in _nnclassifyacc(dfi, colname):
+        for dom1, dom2, s in _nnclassifyacc(scores, domains):
+            total += 1
             correct += klass[dom1] == klass[dom2]
         return correct * 1.0 / total
     except:
@@ -66,7 +65,7 @@ def make(
     """
 
     # define column names for which nn performance is to be calculated
-    imputed_cols = map(lambda x: '%s_fill_mean' % x, psc_cols)
+    imputed_cols = list(map(lambda x: '%s_fill_mean' % x, psc_cols))
     if do_user_mcpsc:
         mcpsc_cols = [
             'mcpsc_fill_0',
@@ -81,17 +80,26 @@ def make(
             'mcpsc_fill_2',
             'mcpsc_fill_3']
 
-    # read the similarity scores data
-    full_psc_data = pd.read_csv(
-        '%s%sprocessed.imputed.mcpsc.csv' %
-        (outdir, os.path.sep))
+    # read the similarity scores data, square matrices with the domains
+    # ordered by name
+    matrix = PSC_SCORE_MATRIX(outdir, MCPSC)
+    index = np.argsort(matrix.domains())
+    domains = matrix.domains()[index]
+    common = np.ones((len(domains), len(domains)), dtype=bool)
+    for method in psc_cols:
+        common &= ~np.isnan(matrix.square(method, index))
+
+    def common_square(colname):
+        scores = matrix.square(colname, index)
+        scores[~common] = np.nan
+        return scores
 
     # create the domain-classification maps
     d2l1 = {}
     d2l2 = {}
     d2l3 = {}
     d2l4 = {}
-    for d, k in full_psc_data[['dom1', 'cath1']].as_matrix():
+    for d, k in zip(domains, matrix.classifications()[index]):
         s = k.split('.')
         d2l1[d] = s[0]
         d2l2[d] = '.'.join(s[:2])
@@ -104,66 +112,63 @@ def make(
     print('\% original psc methods')
     for method in psc_cols:
         perfs = [method]
+        scores = matrix.square(method, index)
         for dmap in [d2l1, d2l2, d2l3, d2l4]:
-            perfs.append('%0.2f' % nnclassifyacc(full_psc_data, method, dmap))
+            perfs.append('%0.2f' % nnclassifyacc(scores, domains, dmap))
         print(' & '.join([method] + perfs) + ' \\\hline')
     print('\% common subset psc methods')
     for method in psc_cols:
         perfs = [method]
+        scores = common_square(method)
         for dmap in [d2l1, d2l2, d2l3, d2l4]:
-            perfs.append(
-                '%0.2f' %
-                nnclassifyacc(
-                    full_psc_data.dropna(
-                        subset=psc_cols),
-                    method,
-                    dmap))
+            perfs.append('%0.2f' % nnclassifyacc(scores, domains, dmap))
         print(' & '.join([method] + perfs) + ' \\\hline')
     print('\% imputed psc methods')
     for method in imputed_cols:
         perfs = [method]
+        scores = matrix.square(method, index)
         for dmap in [d2l1, d2l2, d2l3, d2l4]:
-            perfs.append('%0.2f' % nnclassifyacc(full_psc_data, method, dmap))
+            perfs.append('%0.2f' % nnclassifyacc(scores, domains, dmap))
         print(' & '.join([method] + perfs) + ' \\\hline')
 
     print('\% original mcpsc methods')
     for method in map(lambda x: x.replace('fill', 'full'), mcpsc_cols):
         perfs = [method]
+        scores = matrix.square(method, index)
         for dmap in [d2l1, d2l2, d2l3, d2l4]:
-            perfs.append('%0.2f' % nnclassifyacc(full_psc_data, method, dmap))
+            perfs.append('%0.2f' % nnclassifyacc(scores, domains, dmap))
         print(' & '.join([method] + perfs) + ' \\\hline')
     print('\% common subset mcpsc methods')
     for method in map(lambda x: x.replace('fill', 'full'), mcpsc_cols):
         perfs = [method]
+        scores = common_square(method)
         for dmap in [d2l1, d2l2, d2l3, d2l4]:
-            perfs.append(
-                '%0.2f' %
-                nnclassifyacc(
-                    full_psc_data.dropna(
-                        subset=psc_cols),
-                    method,
-                    dmap))
+            perfs.append('%0.2f' % nnclassifyacc(scores, domains, dmap))
         print(' & '.join([method] + perfs) + ' \\\hline')
     print('\% imputed mcpsc methods')
     for method in mcpsc_cols:
         perfs = [method]
+        scores = matrix.square(method, index)
         for dmap in [d2l1, d2l2, d2l3, d2l4]:
-            perfs.append('%0.2f' % nnclassifyacc(full_psc_data, method, dmap))
+            perfs.append('%0.2f' % nnclassifyacc(scores, domains, dmap))
         print(' & '.join([method] + perfs) + ' \\\hline')
 
     # mcpsc_full_median,mcpsc_fill_median
     print('\% original median')
     perfs = ['mcpsc_full_median']
+    scores = matrix.square('mcpsc_full_median', index)
     for dmap in [d2l1, d2l2, d2l3, d2l4]:
-        perfs.append('%0.2f' % nnclassifyacc(full_psc_data, 'mcpsc_full_median', dmap))
+        perfs.append('%0.2f' % nnclassifyacc(scores, domains, dmap))
     print(' & '.join(perfs) + ' \\\hline')
     print('\% common subset median')
     perfs = ['mcpsc_full_median']
+    scores = common_square('mcpsc_full_median')
     for dmap in [d2l1, d2l2, d2l3, d2l4]:
-        perfs.append('%0.2f' % nnclassifyacc(full_psc_data.dropna(subset=psc_cols), 'mcpsc_full_median', dmap))
+        perfs.append('%0.2f' % nnclassifyacc(scores, domains, dmap))
     print(' & '.join(perfs) + ' \\\hline')
     print('\% imputed median')
     perfs = ['mcpsc_fill_median']
+    scores = matrix.square('mcpsc_fill_median', index)
     for dmap in [d2l1, d2l2, d2l3, d2l4]:
-        perfs.append('%0.2f' % nnclassifyacc(full_psc_data, 'mcpsc_fill_median', dmap))
+        perfs.append('%0.2f' % nnclassifyacc(scores, domains, dmap))
     print(' & '.join(perfs) + ' \\\hline')
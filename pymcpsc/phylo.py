@@ -6,7 +6,6 @@ Functions:
     - *plot_phylo_tree*: 
     - *make*: main entry method
 """
-import pandas as pd
 import dendropy
 try:
     from ete3 import Tree, NodeStyle, TreeStyle
@@ -14,16 +13,20 @@ except Exception as e:
     print(
         'ete3 installation does not seem correct. pymcpsc phylogentic tree feature may not work correctly. (%s)' % str(e))
 import os
+import numpy as np
+import pandas as pd
+
+from pymcpsc.scorematrix import PSC_SCORE_MATRIX, MCPSC
 
 
-def plot_phylo_tree(rdata, colname, name, workdir, outdir):
+def plot_phylo_tree(matrix, colname, name, workdir, outdir):
     """ Generate the phylogenetic tree (dendrogram) for the PSC method. A 
     dendrogram is generated using domain pairwise scores and written in the
     newick format to a file in the workdir. The file is then read in for
     generating the phylogenetic visualizations if the number of domains in 
     the dataset is less than 300.
 
-    :param rdata: (dataframe) Pairwise similarity scores data
+    :param matrix: (PSC_SCORE_MATRIX) Pairwise similarity scores data
     :param colname: (string) Name of column to take similarity scores from
     :param name: (string) Name of PSC method
     :param workdir: (string) Path to output directory where intermediate processing data files can be stored
@@ -35,21 +38,25 @@ def plot_phylo_tree(rdata, colname, name, workdir, outdir):
     dendro_path = '%s%s%s_dendro.nw' % (outdir, os.path.sep, name)
     tree_path = "figures%s%s_ptree.png" % (os.path.sep, name)
 
-    # create pivot table for similarity scores of psc method
+    # square matrix of similarity scores of psc method, domains ordered by
+    # name
+    index = np.argsort(matrix.domains())
     try:
-        p = rdata.pivot(index='dom1', columns='dom2', values=colname)
+        scores = matrix.square(colname, index)
     except:
-        print('pivot not generated for %s' % colname)
+        print('score matrix not generated for %s' % colname)
         return
-    # write pivot table to file
-    for i in range(len(p)):
-        p.iloc[i][i] = 1
+    # write square matrix to file
+    np.fill_diagonal(scores, 1)
     # (convert to distance matrix)
-    p = 1 - p
+    p = pd.DataFrame(1 - scores, index=pd.Index(
+        matrix.domains()[index], name='dom1'), columns=pd.Index(
+        matrix.domains()[index], name='dom2'))
     p.to_csv(dist_file)
 
     # make name to class matrix
-    dom_classification = dict(rdata[['dom1', 'cath1']].as_matrix())
+    dom_classification = dict(zip(matrix.domains(),
+                                  matrix.classifications()))
     classes = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k']  # SCOP
     cl = [
         'blue',
@@ -142,25 +149,23 @@ def make(outdir='outdir',
          psc_cols=[],
          psc_names=[]):
     """ Manages creation of Phylogenetic Trees. Reads in pairwise domain
-    PSC and MCPSC scores from a file. Trees are then generated for each
-    method.
+    PSC and MCPSC scores from the MCPSC score matrix. Trees are then generated
+    for each method.
 
     :param outdir: (string) Path to output directory where processed data files can be found
     :param workdir: (string) Path to output directory where intermediate processing data files can be stored
     :param psc_cols: (list) List of psc method names to be included in mean calculations
     :rtype: None
     """
-    cols = map(
+    cols = list(map(
         lambda x: '%s_fill_mean' % x,
-        psc_cols) + ['mcpsc_fill_0',
+        psc_cols)) + ['mcpsc_fill_0',
                      'mcpsc_fill_1',
                      'mcpsc_fill_2',
                      'mcpsc_fill_3',
                      'mcpsc_fill_4',
                      'mcpsc_fill_median']
     names = psc_names + ['M1', 'M2', 'M3', 'M4', 'M5', 'Median_MCPSC']
-    rdata = pd.read_csv(
-        '%s%sprocessed.imputed.mcpsc.csv' %
-        (outdir, os.path.sep))
-    list(map(lambda x: plot_phylo_tree(rdata, x[0], x[
+    matrix = PSC_SCORE_MATRIX(outdir, MCPSC)
+    list(map(lambda x: plot_phylo_tree(matrix, x[0], x[
         1], workdir, outdir), list(zip(cols, names))))
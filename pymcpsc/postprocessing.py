@@ -4,8 +4,9 @@
 PSC methods in order to prepare them for performance benchmarking.
 
 Functions:
-    - *gtreadline*: read ground truth file entry
-    - *norm1*: normalize given data
+    - *iter_psc_data*: stream raw scores from output file generated by PSC method run
+    - *load_psc_data*: bulk parse raw scores from output file generated by PSC method run into arrays
+    - *scale_psc_data*: normalize raw scores
     - *read_psc_data*: read similarity scores from output file generated by PSC method run
 
 Classes:
@@ -17,51 +18,181 @@ dissimilarity score ($X$) for a PSC method, its scaled  version is obtained.
 Effectively, the dissimilarity scores are  first autoscaled (to make the 
 different PSC method scores comparable) and then the logistic sigmoid is 
 applied. As a result, at the end we obtain similarity scores in the range 0 to 1.
+The Logistic Sigmoid is the default scaler, the others are listed in
+*pymcpsc.scaling*.
 """
 import matplotlib
 matplotlib.use('Agg')
 
 import os
+import csv
 import numpy as np
-import math
-from math import exp
-import sys
+import pandas as pd
+from multiprocessing.pool import ThreadPool
+from io import BytesIO
+
+from pymcpsc.execute import read_failures
+from pymcpsc.prefilter import read_pruned
+from pymcpsc.groundtruth import read_ground_truth
+from pymcpsc.scaling import DEFAULT_SCALER, CALIBRATION, calibrate, scale, \
+    write_calibration, read_calibration
+from pymcpsc.scorematrix import PSC_SCORE_MATRIX, PROCESSED, \
+    condensed_size, condensed_index, condensed_pairs
 
 matplotlib.rcParams['pdf.fonttype'] = 42
 matplotlib.rcParams['ps.fonttype'] = 42
 
-NO_SCALE = -1
-MIN_MAX_SCALE = 0
-VARIANCE_SCALE = 1
-LOGISTIC_SIGMOID = 2
-SCALE_TYPE = LOGISTIC_SIGMOID
+SCALE_TYPE = DEFAULT_SCALER
 DO_NORM = 0
+# score of pairs pruned by the prefilter, the lowest possible similarity
+PRUNED_SCORE = 0.0
+# pairs written to the processed scores CSV file at a time
+WRITE_CHUNK = 100000
 #
 V_FILE = 'violin_softmax_norm.png'
+# output file of each PSC method with the column of its score, whether the
+# score is a distance to invert and the column separator
+PSC_OUTPUTS = [
+    ('ce', 'ce_results_1.txt', 7, 0, ' '),
+    ('fast', 'fast_results_1.txt', 5, 0, ' '),
+    ('gralign', 'gralign/results.txt.sim', 6, 1, '\t'),
+    ('tmalign', 'tm_results_1.txt', 8, 1, ' '),
+    ('usm', 'usm_results.txt', 2, 0, ' ')]
+
+
+def iter_psc_data(fname, idx, inv=0, sep=' '):
+    """ Utility method for streaming PSC method output data (pairwise scores)
+    without holding the whole file in memory.
+
+    :param fname: (string) Path to data file with similarity scores
+    :param idx: (int) Column index where similarity score is in the data file
+    :param inv: (int) Set to 1 if score needs to be inverted (some methods output distance rather than similarity)
+    :param sep: (string) Column separator
+    :rtype: (generator) Domain name pair and raw score of each valid line
+    """
+    for line in open(fname):
+        data = line.replace('\n', '').split(sep)
+        try:
+            k1 = data[0].split('.')[0]
+            k2 = data[1].split('.')[0]
+            if data[idx] == '-0':
+                continue  # this is for gr-align failed cases
+            if line.find('(0.0%)') != -1:
+                continue  # this is for ce failed cases
+            value = abs(inv - float(data[idx]))
+        except:
+            continue
+        yield (k1, k2), value
+
+
+def _field_count(text, sep):
+    """ Number of fields of the longest line of separated text lines
+
+    :param text: (bytes) Text lines
+    :param sep: (string) Column separator, a single character
+    :rtype: (int) Number of fields
+    """
+    if len(text) == 0:
+        return 0
+    data = np.frombuffer(text, dtype=np.uint8)
+    seps = np.flatnonzero(data == ord(sep))
+    ends = np.concatenate([[-1], np.flatnonzero(data == ord('\n')),
+                           [len(data)]])
+    return int(np.max(np.searchsorted(seps, ends[1:]) -
+                      np.searchsorted(seps, ends[:-1]))) + 1
+
 
+def _read_columns(text, sep, columns):
+    """ Bulk parse the columns of separated text lines as strings. Lines
+    with fewer fields get empty strings.
+
+    :param text: (bytes) Text lines
+    :param sep: (string) Column separator, a single character
+    :param columns: (list) Indices of the columns to read
+    :rtype: (list) Array of strings of each column, None if no line has all columns
+    """
+    # as many names as fields in the longest line, so that no line is rejected
+    width = _field_count(text, sep)
+    if width <= max(columns):
+        return None
+    df = pd.read_csv(BytesIO(text), sep=sep, header=None,
+                     names=list(range(width)), usecols=columns, dtype=str,
+                     na_filter=False, quoting=csv.QUOTE_NONE, engine='c')
+    return list(map(lambda x: np.asarray(df[x].values, dtype=object),
+                    columns))
 
-def gtreadline(line):
-    """ Read ground truth file entry
 
-    :param line: (string) Data line
-    :rtype: tuple 
+def _domain_ids(names1, names2):
+    """ Number the domains of pairs of domain names, dropping the part of the
+    names after the first '.'
+
+    :param names1: (array) First domain name of each pair
+    :param names2: (array) Second domain name of each pair
+    :rtype: (tuple) Array of domain names and arrays of the domain numbers of each pair
     """
-    d = line.replace('\n', '').split('\t')
-    return ((d[0], d[1]), (d[2], d[3]))
+    codes, uniques = pd.factorize(np.concatenate([names1, names2]))
+    # few distinct names, strip them once each
+    codes2, names = pd.factorize(np.array(list(map(
+        lambda x: x.split('.')[0], uniques)), dtype=object))
+    ids = codes2[codes]
+    return np.asarray(names, dtype=object), ids[:len(names1)], \
+        ids[len(names1):]
 
 
-def norm1(vals):
-    """ Normalize given data. higher similarity == higher value
+def load_psc_data(fname, idx, inv=0, sep=' '):
+    """ Bulk parse the pairwise scores of a PSC method output file into
+    arrays. The lines skipped by *iter_psc_data* are skipped alike.
 
-    :param vals: (list) Data to be normalized
-    :rtype: list Normalized data.
+    :param fname: (string) Path to data file with similarity scores
+    :param idx: (int) Column index where similarity score is in the data file
+    :param inv: (int) Set to 1 if score needs to be inverted (some methods output distance rather than similarity)
+    :param sep: (string) Column separator
+    :rtype: (tuple) Array of domain names, arrays of the domain numbers of each pair and array of raw scores, in file order
     """
-    sig = np.nanstd(vals)
-    mu = np.nanmean(vals)
+    text = open(fname, 'rb').read()
+    if text.find(b'(0.0%)') != -1:
+        # ce failed cases
+        text = b'\n'.join(filter(lambda x: x.find(b'(0.0%)') == -1,
+                                 text.split(b'\n')))
+    try:
+        columns = _read_columns(text, sep, [0, 1, idx])
+    except ValueError:
+        # not parsable in bulk, e.g. quotes, fall back to the line reader
+        pairs = list(iter_psc_data(fname, idx, inv, sep))
+        names, id1, id2 = _domain_ids(
+            np.array(list(map(lambda x: x[0][0], pairs)), dtype=object),
+            np.array(list(map(lambda x: x[0][1], pairs)), dtype=object))
+        return names, id1, id2, np.array(list(map(lambda x: x[1], pairs)),
+                                         dtype=float)
+    if columns is None:
+        return np.array([], dtype=object), np.array([], dtype=int), \
+            np.array([], dtype=int), np.array([], dtype=float)
+    names1, names2, raw = columns
+    values = pd.to_numeric(pd.Series(raw), errors='coerce').values
+    # this is for gr-align failed cases
+    keep = ~np.isnan(values) & (raw != '-0')
+    names, id1, id2 = _domain_ids(names1[keep], names2[keep])
+    return names, id1, id2, np.abs(inv - values[keep])
+
 
-    def f(x): return 1 - 1. / \
-        (1 + math.exp(-(1.0 * x - mu) / sig)) if x is not None else x
-    return list(map(lambda v: f(v), vals))
+def scale_psc_data(values, scaler=None, stats=None):
+    """ Normalize the raw scores of a PSC method with a scaler of
+    pymcpsc.scaling.SCALERS, and as set by DO_NORM, higher similarity ==
+    higher value
+
+    :param values: (array) Raw scores of all lines of the output file
+    :param scaler: (string) Name of the scaler, None for SCALE_TYPE
+    :param stats: (PSC_SCALE_STATS) Statistics of the raw scores, e.g. of a calibration, None to calibrate on the given scores
+    :rtype: (array) Normalized scores
+    """
+    anp = np.asarray(values, dtype=float)
+    if len(anp) == 0:
+        return anp
+    normanp = scale(anp, SCALE_TYPE if scaler is None else scaler, stats)
+    if DO_NORM == 1:
+        # the scores were normalized over both orders of every pair
+        normanp = normanp / (2 * np.nansum(normanp))
+    return normanp
 
 
 def read_psc_data(fname, idx, inv=0, sep=' '):
@@ -73,39 +204,71 @@ def read_psc_data(fname, idx, inv=0, sep=' '):
     :param sep: (string) Column separator
     :rtype: (dict) Pairwise normalized similarity scores
     """
-    retlist = []
-    for line in open(fname):
-        data = line.replace('\n', '').split(sep)
-        try:
-            k1 = data[0].split('.')[0]
-            k2 = data[1].split('.')[0]
-            if data[idx] == '-0':
-                continue  # this is for gr-align failed cases
-            if line.find('(0.0%)') != -1:
-                continue  # this is for ce failed cases
-            # read front and back because we process triangular
-            retlist.append(((k1, k2), abs(inv - float(data[idx]))))
-            retlist.append(((k2, k1), abs(inv - float(data[idx]))))
-        except:
-            pass
-    anp = np.array(list(map(lambda x: x[1], retlist)))
-    normanp = anp  # higher similarity == lower value
-    if SCALE_TYPE == MIN_MAX_SCALE:  # higher similarity == higher value
-            # MinMax scaling
-        normanp = list(1 - (anp - min(anp)) / (max(anp) - min(anp)))
-    if SCALE_TYPE == VARIANCE_SCALE:  # higher similarity == higher value
-        # Variance scaling PS (x) = exp(-s(x))/var(s)
-        normanp = list(map(exp, -1 * anp / np.nanvar(anp)))
-    if SCALE_TYPE == LOGISTIC_SIGMOID:
-        normanp = norm1(anp)
-    if SCALE_TYPE == NO_SCALE:  # higher similarity == higher value
-        normanp = max(normanp) - normanp
-    if DO_NORM == 1:
-        normanp = list(np.array(normanp) / np.nansum(normanp))
+    names, id1, id2, values = load_psc_data(fname, idx, inv, sep)
+    ret = {}
+    # read front and back because we process triangular, the last line of a
+    # pair wins
+    for k1, k2, value in zip(names[id1], names[id2],
+                             scale_psc_data(values).tolist()):
+        ret[(k1, k2)] = value
+        ret[(k2, k1)] = value
+    return ret
+
+
+def _interleave(first, second):
+    """ Interleave two arrays, the rows of the pairs of domains in both orders
 
-    ret = dict(list(
-        map(lambda x: (retlist[x][0], normanp[x]), range(len(normanp)))))
-    return ret  # dict(retlist)
+    :param first: (array) Values of the rows of the pairs in the given order
+    :param second: (array) Values of the rows of the pairs in reverse order
+    :rtype: (array) Values of both rows of every pair
+    """
+    out = np.empty(2 * len(first), dtype=np.asarray(first).dtype)
+    out[0::2] = first
+    out[1::2] = second
+    return out
+
+
+def _write_csv(fname, gt1, gt2, cath1, cath2, scores):
+    """ Write the processed scores as CSV, every pair in both orders
+
+    :param fname: (string) Path to the CSV file
+    :param gt1: (array) First domain of each pair
+    :param gt2: (array) Second domain of each pair
+    :param cath1: (array) Classification of the first domain
+    :param cath2: (array) Classification of the second domain
+    :param scores: (dict) PSC method name to scores of the pairs, -1 where missing
+    :rtype: None
+    """
+    klass = pd.unique(np.concatenate([cath1, cath2]))
+    knn = dict(map(lambda x: (x, x.split('.')[0]), klass))
+    kr = dict(map(lambda x: (x, '.'.join(x.split('.')[:4])), klass))
+
+    def both(first, second):
+        return _interleave(first, second).tolist()
+
+    pp_outfile = open(fname, 'w')
+    pp_outfile.write(
+        'dom1,dom2,cath1,cath2,k_r1,k_r2,k_nn1,k_nn2,ce,fast,gralign,tmalign,usm\n')
+    # a chunk of pairs at a time, the rows of all pairs would take more
+    # memory than the scores
+    for start in range(0, len(gt1), WRITE_CHUNK):
+        chunk = slice(start, start + WRITE_CHUNK)
+        cath = both(cath1[chunk], cath2[chunk])
+        htac = both(cath2[chunk], cath1[chunk])
+        columns = [both(gt1[chunk], gt2[chunk]),
+                   both(gt2[chunk], gt1[chunk]), cath, htac,
+                   list(map(kr.get, cath)), list(map(kr.get, htac)),
+                   list(map(knn.get, cath)), list(map(knn.get, htac))]
+        for method, _, _, _, _ in PSC_OUTPUTS:
+            # formatted once per pair, formatting floats is the bulk of
+            # writing the file
+            score = np.array(list(map(lambda x: '%f' % x,
+                                      scores[method][chunk].tolist())),
+                             dtype=object)
+            columns.append(both(score, score))
+        pp_outfile.writelines(map(lambda x: ','.join(x) + '\n',
+                                  zip(*columns)))
+    pp_outfile.close()
 
 
 class PostProcessor:
@@ -114,15 +277,22 @@ class PostProcessor:
         """ Run method for post processing the data and combining PSC output for
         multiple methods into one file.
 
+        The output files of the PSC methods are parsed concurrently into
+        arrays and scattered into condensed matrices over the domains of the
+        ground truth, numbered as listed. The ground truth is either the
+        classification of each domain or the pairwise file, see
+        *pymcpsc.groundtruth*. The scores are written to the PROCESSED score
+        matrix, and to processed.csv as well if config.CSV is set.
+
+        The raw scores are scaled with the scaler config.SCALING (see
+        *pymcpsc.scaling*), calibrated on the scores of this run or frozen
+        from the calibration file config.CALIBRATION of a previous run. The
+        calibration used is written to the output directory.
+
         :param config: (Config) configuration parameters for finding work, output directories etc.
         """
         print('Preparing PSC scores')
-        infiles = [
-            'ce_results_1.txt',
-            'fast_results_1.txt',
-            'gralign/results.txt.sim',
-            'tm_results_1.txt',
-            'usm_results.txt']
+        infiles = list(map(lambda x: x[1], PSC_OUTPUTS))
         if config is None:
             indir = 'work'
             ground_truth = 'ground_truth'
@@ -133,6 +303,17 @@ class PostProcessor:
             # infiles        = config['infiles']
             # methods        = config.PROGRAMS.split(',') #config['methods']
             OUTDIR = config.OUTDIR  # config['OUTDIR']
+        scaler = None if config is None else getattr(config, 'SCALING', None)
+        calibration = None if config is None else getattr(
+            config, 'CALIBRATION', None)
+        stats = {}
+        if calibration is not None:
+            # frozen statistics of a previous run
+            stored, stats = read_calibration(calibration)
+            if scaler is None:
+                scaler = stored
+        if scaler is None:
+            scaler = SCALE_TYPE
 
         if not os.path.exists(OUTDIR):
             os.makedirs(OUTDIR)
@@ -140,69 +321,125 @@ class PostProcessor:
         if not os.path.exists('figures'):
             os.makedirs('figures')
 
-        raw_gt = None
-
         # read PSC method output
-        CE_INFILE, FS_INFILE, GR_INFILE, TM_INFILE, UM_INFILE = infiles
-        raw_ce = read_psc_data(
-            '%s%s%s' %
-            (indir, os.path.sep, CE_INFILE), 7)
-        raw_fs = read_psc_data(
-            '%s%s%s' %
-            (indir, os.path.sep, FS_INFILE), 5)
-        raw_gr = read_psc_data(
-            '%s%s%s' %
-            (indir, os.path.sep, GR_INFILE), 6, sep='\t', inv=1)
-        raw_tm = read_psc_data(
-            '%s%s%s' %
-            (indir, os.path.sep, TM_INFILE), 8, inv=1)
-        raw_us = read_psc_data(
-            '%s%s%s' %
-            (indir, os.path.sep, UM_INFILE), 2)
-
-        pp_outfile = open('%s%sprocessed.csv' % (OUTDIR, os.path.sep), 'w')
-        pp_outfile.write(
-            'dom1,dom2,cath1,cath2,k_r1,k_r2,k_nn1,k_nn2,ce,fast,gralign,tmalign,usm\n')
+        pool = ThreadPool(len(PSC_OUTPUTS))
+        try:
+            loaded = pool.map(lambda x: load_psc_data(
+                '%s%s%s' % (indir, os.path.sep, x[1]), x[2], inv=x[3],
+                sep=x[4]), PSC_OUTPUTS)
+        finally:
+            pool.close()
+            pool.join()
 
         # if ground has not been specified fake it
         if ground_truth is None:
-            raw_gt = dict(map(lambda x: (x, '0.0.0.0'), set(
-                raw_ce.keys() + raw_fs.keys() + raw_gr.keys() + raw_tm.keys() + raw_us.keys())))
+            pairs = pd.DataFrame({
+                0: np.concatenate(list(map(
+                    lambda x: np.concatenate([x[0][x[1]], x[0][x[2]]]),
+                    loaded))),
+                1: np.concatenate(list(map(
+                    lambda x: np.concatenate([x[0][x[2]], x[0][x[1]]]),
+                    loaded)))}).drop_duplicates()
+            domains = pd.Index(pd.unique(_interleave(
+                np.asarray(pairs[0].values, dtype=object),
+                np.asarray(pairs[1].values, dtype=object))))
+            klass = np.full(len(domains), '0.0.0.0', dtype=object)
+            gt_pairs = (domains.get_indexer(pairs[0].values),
+                        domains.get_indexer(pairs[1].values))
         else:
-            raw_gt = dict(map(gtreadline, open(ground_truth)))
+            domains, klass, gt_pairs = read_ground_truth(ground_truth)
+            domains = pd.Index(domains)
 
-        if sys.version_info < (3, 0):
-            items = raw_gt.iteritems()
+        # number the domains of the ground truth, the scores of a method are
+        # a condensed matrix over them
+        n = len(domains)
+        listed = np.zeros(condensed_size(n), dtype=bool)
+        if gt_pairs is None:
+            # all pairs of different domains
+            listed[:] = True
+            listed[condensed_index(np.arange(n), np.arange(n), n)] = False
         else:
-            items = raw_gt.items()
-
-        # write pairwise scores to output file
-        for k, v in items:
-            # set missing values in PSC method scores to -1
-            cev = raw_ce.get(k)
-            if cev is None:
-                cev = -1
-            fastv = raw_fs.get(k)
-            if fastv is None:
-                fastv = -1
-            grv = raw_gr.get(k)
-            if grv is None:
-                grv = -1
-            tmv = raw_tm.get(k)
-            if tmv is None:
-                tmv = -1
-            usmv = raw_us.get(k)
-            if usmv is None:
-                usmv = -1
-            knn1 = v[0].split('.')[0]
-            knn2 = v[1].split('.')[0]
-            kr1 = '.'.join(v[0].split('.')[:4])
-            kr2 = '.'.join(v[1].split('.')[:4])
-            pp_outfile.write('%s,%s,%s,%s,%s,%s,%s,%s,%f,%f,%f,%f,%f\n' % (k[0], k[1], v[0], v[
-                             1], kr1, kr2, knn1, knn2, max(-1, cev), max(-1, fastv), max(-1, grv), max(-1, tmv), max(-1, usmv)))
-            pp_outfile.write('%s,%s,%s,%s,%s,%s,%s,%s,%f,%f,%f,%f,%f\n' % (k[1], k[0], v[1], v[
-                             0], kr2, kr1, knn2, knn1, max(-1, cev), max(-1, fastv), max(-1, grv), max(-1, tmv), max(-1, usmv)))
-        pp_outfile.close()
+            listed[condensed_index(gt_pairs[0], gt_pairs[1], n)] = True
+
+        def positions(ids1, ids2):
+            known = (ids1 >= 0) & (ids2 >= 0)
+            return condensed_index(ids1[known], ids2[known], n)
+
+        def named_positions(pairs):
+            pairs = list(pairs)
+            return positions(
+                domains.get_indexer(list(map(lambda x: x[0].split('.')[0],
+                                             pairs))),
+                domains.get_indexer(list(map(lambda x: x[1].split('.')[0],
+                                             pairs))))
+
+        scores = {}
+        found = {}
+        for (method, _, _, _, _), (names, id1, id2, values) in zip(
+                PSC_OUTPUTS, loaded):
+            ids = domains.get_indexer(names)
+            # scaled over all scores of the method, pairs of domains not in
+            # the ground truth included
+            if method not in stats:
+                stats[method] = calibrate(values)
+            values = scale_psc_data(values, scaler, stats[method])
+            known = (ids[id1] >= 0) & (ids[id2] >= 0)
+            series = pd.Series(values[known], index=positions(ids[id1],
+                                                              ids[id2]))
+            # the last line of a pair wins
+            series = series[~series.index.duplicated(keep='last')]
+            found[method] = np.zeros(len(listed), dtype=bool)
+            found[method][series.index.values] = True
+            scores[method] = np.full(len(listed), -1.)
+            scores[method][series.index.values] = series.values
+
+        # pairs whose PSC binary failed, as opposed to pairs without scores
+        failures = {}
+        for method, pairs in read_failures(indir).items():
+            failures[method] = named_positions(pairs)
+        # pairs pruned by the prefilter get an explicit low score
+        pruned = np.zeros(len(listed), dtype=bool)
+        pruned[named_positions(read_pruned(indir))] = True
+        pruned &= listed
+        npruned = int(np.sum(pruned))
+        for method, infile in [('ce', infiles[0]), ('fast', infiles[1]),
+                               ('tmalign', infiles[3])]:
+            lost = listed & ~found[method] & ~pruned
+            scores[method][~found[method] & pruned] = PRUNED_SCORE
+            failed = np.zeros(len(listed), dtype=bool)
+            failed[failures.get(method, np.array([], dtype=np.int64))] = True
+            failed &= lost
+            if np.sum(lost) > 0:
+                print('%s: %d pairs failed, %d pairs missing' % (
+                    infile, np.sum(failed), np.sum(lost & ~failed)))
+        if npruned > 0:
+            print('%d pairs pruned by the prefilter scored %f' % (
+                npruned, PRUNED_SCORE))
+
+        # missing values in PSC method scores are set to -1
+        for method, _, _, _, _ in PSC_OUTPUTS:
+            # as max(-1, score), a NaN score is written as -1
+            score = scores[method]
+            scores[method] = np.where(np.isnan(score) | (score < -1), -1.,
+                                      score)
+        write_calibration('%s%s%s' % (OUTDIR, os.path.sep, CALIBRATION),
+                          scaler, stats)
+        pairs = np.flatnonzero(listed)
+        data = pd.DataFrame(dict(map(lambda x: (x, scores[x][pairs]),
+                                     scores)),
+                            columns=list(map(lambda x: x[0], PSC_OUTPUTS)))
+        PSC_SCORE_MATRIX(OUTDIR, PROCESSED).write(
+            data, domains=domains, classifications=klass, pairs=pairs)
+        if config is not None and config.CSV:
+            # the pairs as listed in the ground truth
+            if gt_pairs is None:
+                gt_pairs = condensed_pairs(pairs, n)
+            pairs = condensed_index(gt_pairs[0], gt_pairs[1], n)
+            names = np.asarray(domains.values, dtype=object)
+            _write_csv('%s%sprocessed.csv' % (OUTDIR, os.path.sep),
+                       names[gt_pairs[0]], names[gt_pairs[1]],
+                       klass[gt_pairs[0]], klass[gt_pairs[1]],
+                       dict(map(lambda x: (x, scores[x][pairs]), scores)))
         #
 
 
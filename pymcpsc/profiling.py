@@ -0,0 +1,154 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Per stage profiling of a pyMCPSC run.
+
+Classes:
+    - *PSC_PROFILER*: runs the stages of a run under cProfile and tracemalloc
+
+Functions:
+    - *cpu_times*: CPU seconds of this process and of its waited for children
+
+With run-pymcpsc --profile every stage called by *process* runs through
+*PSC_PROFILER.run*. The stage is executed under cProfile, and tracemalloc
+traces the Python memory allocations. The profile is written as
+NN-stage.prof (e.g. for python -m pstats or snakeviz), and NN-stage.alloc.txt
+lists the peak traced memory and the source lines holding the most memory at
+the end of the stage. After the last stage the wall time, CPU time of the
+process and of its children (pool workers and PSC binaries) and peak traced
+memory of every stage are printed and written to *SUMMARY*.
+
+Only the main process is profiled. The PSC binaries and pool workers of the
+pairwise stage show up as waiting time and children CPU time. tracemalloc
+slows allocation heavy stages down considerably, the wall times of a
+profiled run are not comparable to those of a normal run. tracemalloc is
+not available before Python 3.4; there the memory is not traced.
+"""
+import os
+import cProfile
+from timeit import default_timer as timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+SUMMARY = 'summary.txt'
+# source lines listed in the allocation reports, and frames traced per
+# allocation
+TOP = 25
+FRAMES = 1
+
+
+def cpu_times():
+    """ CPU seconds of this process and of its waited for children
+
+    :rtype: (tuple) User plus system seconds of the process and of its children
+    """
+    t = os.times()
+    return t[0] + t[1], t[2] + t[3]
+
+
+class PSC_PROFILER:
+
+    def __init__(self, profileDir=None, top=TOP):
+        """ Set where the profiles are written
+
+        :param profileDir: (string) Directory the profiles are written to, None to run the stages without profiling
+        :param top: (int) Number of source lines listed in the allocation reports
+        :rtype: None
+        """
+        self._profileDir = profileDir
+        self._top = top
+        self._stages = []
+        if profileDir is not None and not os.path.exists(profileDir):
+            os.makedirs(profileDir)
+
+    def run(self, name, fn, *args, **kwargs):
+        """ Run a stage, profiled if a profile directory is set
+
+        :param name: (string) Stage name
+        :param fn: (function) Stage to run
+        :rtype: Return value of the stage
+        """
+        if self._profileDir is None:
+            return fn(*args, **kwargs)
+        prefix = '%s%s%02d-%s' % (self._profileDir, os.path.sep,
+                                  len(self._stages) + 1, name)
+        profile = cProfile.Profile()
+        if tracemalloc is not None:
+            tracemalloc.start(FRAMES)
+        cpu, children = cpu_times()
+        start = timer()
+        try:
+            profile.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.disable()
+        finally:
+            wall = timer() - start
+            end = cpu_times()
+            peak = None
+            snapshot = None
+            if tracemalloc is not None:
+                peak = tracemalloc.get_traced_memory()[1]
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+            profile.dump_stats('%s.prof' % prefix)
+            self._report('%s.alloc.txt' % prefix, name, peak, snapshot)
+            self._stages.append((name, wall, end[0] - cpu,
+                                 end[1] - children, peak))
+
+    def _report(self, fname, name, peak, snapshot):
+        """ Write the allocation report of a stage
+
+        :param fname: (string) Path to the report
+        :param name: (string) Stage name
+        :param peak: (int) Peak traced memory in bytes, None if not traced
+        :param snapshot: (Snapshot) Traced allocations at the end of the stage, None if not traced
+        :rtype: None
+        """
+        out = open(fname, 'w')
+        if snapshot is None:
+            out.write('%s: memory not traced, tracemalloc is not available\n'
+                      % name)
+            out.close()
+            return
+        out.write('%s: peak traced memory %0.1f MB\n' % (name,
+                                                         peak / 1048576.))
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib.*>')])
+        stats = snapshot.statistics('lineno')
+        out.write('top %d of %d source lines by memory held at the end of '
+                  'the stage:\n' % (min(self._top, len(stats)), len(stats)))
+        for stat in stats[:self._top]:
+            frame = stat.traceback[0]
+            out.write('%10.1f KB %8d blocks  %s:%d\n' % (
+                stat.size / 1024., stat.count, frame.filename, frame.lineno))
+        out.close()
+
+    def summary(self):
+        """ Print the wall time, CPU times and peak memory of the profiled
+        stages and write them to the SUMMARY file
+
+        :rtype: None
+        """
+        if self._profileDir is None or len(self._stages) == 0:
+            return
+        lines = ['%-16s %10s %10s %12s %10s' % (
+            'stage', 'wall s', 'cpu s', 'children s', 'peak MB')]
+        for name, wall, cpu, children, peak in self._stages:
+            lines.append('%-16s %10.2f %10.2f %12.2f %10s' % (
+                name, wall, cpu, children,
+                '-' if peak is None else '%0.1f' % (peak / 1048576.)))
+        lines.append('%-16s %10.2f %10.2f %12.2f' % (
+            'total', sum(map(lambda x: x[1], self._stages)),
+            sum(map(lambda x: x[2], self._stages)),
+            sum(map(lambda x: x[3], self._stages))))
+        out = open('%s%s%s' % (self._profileDir, os.path.sep, SUMMARY), 'w')
+        for line in lines:
+            print(line)
+            out.write(line + '\n')
+        out.close()
+        print('profiles written to %s' % self._profileDir)
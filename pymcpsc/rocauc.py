@@ -14,9 +14,10 @@ matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 
 import os
-import pandas as pd
 from sklearn import metrics
 
+from pymcpsc.scorematrix import PSC_SCORE_MATRIX, MCPSC
+
 matplotlib.rcParams['pdf.fonttype'] = 42
 matplotlib.rcParams['ps.fonttype'] = 42
 
@@ -102,9 +103,11 @@ def make(
             'mcpsc_fill_2',
             'mcpsc_fill_3']
 
-    full_psc_data = pd.read_csv(
-        '%s%sprocessed.imputed.mcpsc.csv' %
-        (outdir, os.path.sep))
+    full_psc_data = PSC_SCORE_MATRIX(outdir, MCPSC).read(
+        ['cath1', 'cath2'] + psc_cols +
+        list(map(lambda x: '%s_fill_mean' % x, psc_cols)) + mcpsc_cols +
+        list(map(lambda x: x.replace('fill', 'full'), mcpsc_cols)) +
+        ['mcpsc_full_median', 'mcpsc_fill_median'])
 
     if not os.path.exists('figures'):
         os.makedirs('figures')
@@ -10,34 +10,66 @@ Classes:
     - *GR_HANDLER*: gr-align execution handler
     - *USM_HANDLER*: pairwise usm execution handler
     - *RunPairwisePSC*: main execution class for generating pairwise PSC scores
+
+The CE, TM-align, FAST and USM handlers optionally take a *PSC_CACHE* object.
+When given, the output for a pair of structures is looked up in the cache
+before the PSC method is executed and stored in it afterwards.
+The CE, TM-align and FAST handlers optionally limit the wall-clock and CPU
+time spent on a pair and raise a *PSC_FAILURE* when a binary fails.
     
 Functions:
     - *fast_process_pair*: convinience wrapper for fast pairwise processing
     - *usm_process_pair*: convinience wrapper for usm pairwise processing
     - *tm_process_pair*: convinience wrapper for tm-align pairwise processing
     - *ce_process_pair*: convinience wrapper for ce pairwise processing
+    - *localize_handler*: prepare a PSC handler for execution on a worker node
+    - *cache_result*: cache the output of a pair processed on a worker node
+    - *gr_process_shard*: convinience wrapper for gr-align processing of a shard
+    - *gr_shards*: split a gr-align all-to-all run into shards
+    - *gr_merge_shards*: merge the output of gr-align shards
+    - *format_result*: format pairwise PSC output as output file line
+    - *pair_names*: domain names of a pair as they appear in output files
 """
 import sys
 import os
-import subprocess
+from multiprocessing.pool import ThreadPool
 import re
 import zlib
-from multiprocessing import Pool
 from timeit import default_timer as timer
 import shutil
-from time import sleep
+
+from pymcpsc.cache import PSC_CACHE, file_digest
+from pymcpsc.incremental import read_manifest, write_manifest, diff_manifest
+from pymcpsc.incremental import incremental_pairs, merge_result_file
+from pymcpsc.scheduler import PSC_SCHEDULER, estimate_cost
+from pymcpsc.distributed import PSC_COORDINATOR, parse_address, \
+    write_authkey, AUTHKEY as AUTHKEY_FILE
+from pymcpsc.metrics import PSC_METRICS
+from pymcpsc.journal import PSC_JOURNAL, DONE
+from pymcpsc.execute import PSC_FAILURE, PARSE, FAILURES, run_command
+from pymcpsc.execute import parse_limits
+from pymcpsc.workspace import PSC_WORKSPACE
+from pymcpsc.usm import USM_ENGINE, MAX_CONTACTS, read_contact_map, usm_score
+from pymcpsc.prefilter import PRUNED, compute_descriptors, prune_pairs
+from pymcpsc.prefilter import write_pruned, pair_similarities, fold_recall
+from pymcpsc.prefilter import recall_threshold
+from pymcpsc.groundtruth import read_ground_truth
+from pymcpsc.structures import PSC_STRUCTURE_STORE
+from pymcpsc.shards import parse_shard, shard_dir, assign_shard, write_shard
 
 # PRE-PROCESS
 
 
 class GRALIGN_PRE_PROCESSOR:
 
-    def __init__(self, binPath1, binPath2, tmpDir):
+    def __init__(self, binPath1, binPath2, tmpDir, cache=None, threads=1):
         """ Set paths for the class
 
         :param binPath1: (string) Path to CMap binary
         :param binPath2: (string) Path to Dcount binary
         :param tmpDir: (string) Path where intermediate processing files may be stored
+        :param cache: (PSC_CACHE) Cache of contact maps, None to disable caching
+        :param threads: (int) Number of domains processed concurrently
         :rtype: None
         """
         self._binPath1 = os.path.abspath(binPath1)
@@ -45,42 +77,140 @@ class GRALIGN_PRE_PROCESSOR:
         self._tmpDir = '%s%sgralign' % (tmpDir, os.path.sep)
         if not os.path.exists(self._tmpDir):
             os.makedirs(self._tmpDir)
+        self._cache = cache
+        self._threads = max(1, int(threads))
+        if cache is not None:
+            # both programs and their settings identify the contact maps
+            self._binDigest = '%s|%s|chain|12.0' % (
+                file_digest(self._binPath1), file_digest(self._binPath2))
+
+    def _chain(self, fname):
+        """ Read the chain of a domain from the first ATOM record of its PDB
+        file
+
+        :param fname: (string) Path to the PDB file
+        :rtype: (string) Chain id, A if there are no ATOM records
+        """
+        try:
+            for line in open(fname):
+                if line.startswith('ATOM') and len(line) > 21:
+                    return line[21]
+        except (IOError, OSError):
+            pass
+        return 'A'
+
+    def _verify(self, fname, header):
+        """ Check that a contact map or signature file was written completely
+
+        :param fname: (string) Path to the file
+        :param header: (boolean) Node count is in the header line (signature file)
+        :rtype: (int) Number of nodes (residues)
+        """
+        try:
+            with open(fname) as f:
+                if header:
+                    nodes = int(f.readline().split(' ')[0])
+                else:
+                    # LEDA graph: 3 header lines then the node count
+                    if f.readline().strip() != 'LEDA.GRAPH':
+                        nodes = 0
+                    else:
+                        f.readline()
+                        f.readline()
+                        nodes = int(f.readline())
+        except (IOError, OSError, ValueError):
+            nodes = 0
+        if nodes <= 0:
+            raise PSC_FAILURE(PARSE, 'no contacts in %s' % os.path.basename(
+                fname))
+        return nodes
+
+    def pre_process(self, pdbDir, file1, pdbextn):
+        """ Execute the pre-processing steps of GR-align for one domain. The
+        contact map is generated by CMap, its signature then by DCount. Both
+        are written under temporary names and only renamed once verified.
 
-    def pre_process_all_to_all(self, pdbDir, pdbextn):
+        :param pdbDir: (string) Path where PDB files are stored
+        :param file1: (string) Name of the PDB file
+        :param pdbextn: (string) The extension of PDB files
+        :rtype: (tuple) Name of the PDB file and PSC_FAILURE or None
+        """
+        # ./CMap -i 1amk.pdb -c A -o 1amkA.gw -d 12.0
+        # ./DCount -i 1amkA.gw -o 1amkA.ndump
+        f1 = '%s%s%s' % (self._tmpDir, os.path.sep,
+                         file1.replace(pdbextn, '.gw'))
+        f2 = '%s%s%s' % (self._tmpDir, os.path.sep,
+                         file1.replace(pdbextn, '.ndump'))
+        part1 = '%s.part' % f1
+        part2 = '%s.part' % f2
+        pdb = '%s%s%s' % (pdbDir, os.path.sep, file1)
+        try:
+            # contacts are only generated for the given chain
+            run_command([self._binPath1, '-i', pdb, '-c', self._chain(pdb),
+                         '-o', part1, '-d', '12.0'])
+            nodes = self._verify(part1, False)
+            run_command([self._binPath2, '-i', part1, '-o', part2])
+            if self._verify(part2, True) != nodes:
+                raise PSC_FAILURE(PARSE, 'signature does not match contacts')
+        except PSC_FAILURE as e:
+            for part in [part1, part2]:
+                if os.path.exists(part):
+                    os.remove(part)
+            name = file1.replace(pdbextn, '')
+            return file1, e.set_pair('gralign', name, name)
+        os.rename(part1, f1)
+        os.rename(part2, f2)
+        return file1, None
+
+    def pre_process_all_to_all(self, pdbDir, pdbextn, files=None):
         """ Execute the pre-processing steps of GR-align that generate the 
-        contact maps used for generating similarity scores.
+        contact maps used for generating similarity scores. Contact maps found
+        in the cache are written directly, the remaining domains are processed
+        concurrently.
 
         :param pdbDir: (string) Path where PDB files are stored
         :param pdbextn: (string) The extension of PDB files
-        :rtype: None
+        :param files: (list) Names of the PDB files to process, all files in pdbDir if None
+        :rtype: (list) Failures of the domains that could not be processed
         """
-        for file1 in os.listdir(pdbDir):
-            # ./CMap -i 1amk.pdb -c A -o 1amkA.gw -d 12.0
-            # ./DCount -i 1amkA.gw -o 1amkA.ndump
-            f1 = file1.replace(pdbextn, '.gw')
-            f2 = file1.replace(pdbextn, '.ndump')
-            cmd = '%s -i %s%s%s -c A -o %s%s%s -d 12.0' % (
-                self._binPath1, pdbDir, os.path.sep, file1, self._tmpDir, os.path.sep, f1)
-            subprocess.Popen(
-                cmd,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT)
-            # print proc.stdout.readlines()
-            cmd = '%s -i %s%s%s -o %s%s%s' % (self._binPath2,
-                                              self._tmpDir,
-                                              os.path.sep,
-                                              f1,
-                                              self._tmpDir,
-                                              os.path.sep,
-                                              f2)
-            subprocess.Popen(
-                cmd,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT)
-            # print proc.stdout.readlines()
-        l1 = len(os.listdir(pdbDir))
+        if files is None:
+            files = os.listdir(pdbDir)
+        todo = []
+        cached = 0
+        for file1 in files:
+            outnames = list(map(lambda x: '%s%s%s' % (
+                self._tmpDir, os.path.sep, file1.replace(pdbextn, x)),
+                ['.gw', '.ndump']))
+            if self._cache is not None and self._cache.get_files(
+                    'gralign-pre', self._binDigest, '%s%s%s' % (
+                        pdbDir, os.path.sep, file1), outnames):
+                cached += 1
+            else:
+                todo.append(file1)
+        failures = []
+        # the work is done by the binaries, threads suffice to run them
+        p = ThreadPool(self._threads)
+        try:
+            for file1, failure in p.imap_unordered(
+                    lambda x: self.pre_process(pdbDir, x, pdbextn), todo):
+                if failure is not None:
+                    print('gralign preprocessing failed for %s: %s' % (
+                        file1, failure))
+                    failures.append(failure)
+                elif self._cache is not None:
+                    self._cache.put_files(
+                        'gralign-pre', self._binDigest, '%s%s%s' % (
+                            pdbDir, os.path.sep, file1),
+                        list(map(lambda x: '%s%s%s' % (
+                            self._tmpDir, os.path.sep,
+                            file1.replace(pdbextn, x)), ['.gw', '.ndump'])))
+            p.close()
+        except BaseException:
+            p.terminate()
+            raise
+        finally:
+            p.join()
+        l1 = len(files)
         l2 = len(
             list(
                 filter(
@@ -92,9 +222,10 @@ class GRALIGN_PRE_PROCESSOR:
                 lambda x: x.endswith(".ndump"),
                 os.listdir(
                     self._tmpDir))))
-        pstr = 'pdb file count: %d, contact map count: %d, signature file count: %d' % (
-            l1, l2, l3)
+        pstr = 'pdb file count: %d, contact map count: %d, signature file count: %d, cached: %d, failed: %d' % (
+            l1, l2, l3, cached, len(failures))
         print(pstr)
+        return failures
 
 
 # END OF PRE-PROCESS
@@ -102,43 +233,112 @@ class GRALIGN_PRE_PROCESSOR:
 # HANDLERS
 class CE_HANDLER:
 
-    def __init__(self, binPath, tmpDir):
+    def __init__(self, binPath, tmpDir, cache=None, timeout=None,
+                 cpuLimit=None, workspace=None):
         """ Set paths for the class
 
         :param binPath: Path to ce binary
         :param tmpDir: Path for storing intermediate files
+        :param cache: (PSC_CACHE) Result cache to use, None to disable caching
+        :param timeout: (float) Wall-clock limit per pair in seconds, None for no limit
+        :param cpuLimit: (int) CPU limit per pair in seconds, None for no limit
+        :param workspace: (PSC_WORKSPACE) Workspace holding pom and scratch directories, None to use tmpDir and pom in the current directory
         :rtype: None
         """
         self._binPath = os.path.abspath(binPath)
         self._tmpDir = tmpDir
-        if not os.path.exists(self._tmpDir):
+        if workspace is None and not os.path.exists(self._tmpDir):
             os.makedirs(self._tmpDir)
+        self._cache = cache
+        self._timeout = timeout
+        self._cpuLimit = cpuLimit
+        self._workspace = workspace
+        if cache is not None:
+            self._binDigest = file_digest(self._binPath)
 
-    def process_pair(self, fname1, fname2, pdbextn):
-        """ Process a pair of domains using the CE external binary
+    def from_cache(self, fname1, fname2, pdbextn):
+        """ Look up the CE output for a pair of domains in the result cache
 
         :param fname1: (string) Path to file containing structure of domain 1
         :param fname2: (string) Path to file containing structure of domain 2
         :param pdbextn: (string) Extension of PDB files
-        :rtype: (list) Output data collected from CE execution
+        :rtype: (list) Cached output data or None
+        """
+        if self._cache is None:
+            return None
+        f1 = fname1.split(os.path.sep)[-1].replace(pdbextn, '')
+        f2 = fname2.split(os.path.sep)[-1].replace(pdbextn, '')
+        return self._cache.get(
+            'ce', self._binDigest, fname1, fname2, [f1, f2])
+
+    def _wdir(self, f1, f2):
+        """ Directory CE writes its files to for a pair when no workspace is
+        used
+
+        :param f1: (string) Name of domain 1
+        :param f2: (string) Name of domain 2
+        :rtype: (string) Path to the directory
+        """
+        return '%s%s%s_%s' % (self._tmpDir, os.path.sep, f1, f2)
+
+    def command(self, fname1, fname2, pdbextn, slot=None):
+        """ Prepare the execution of the CE binary for a pair of domains
+
+        :param fname1: (string) Path to file containing structure of domain 1
+        :param fname2: (string) Path to file containing structure of domain 2
+        :param pdbextn: (string) Extension of PDB files
+        :param slot: (int) Concurrent execution slot of the calling process, None if it executes one binary at a time
+        :rtype: (tuple) Binary and its arguments, directory to execute it in, wall-clock and CPU limits
         """
         # note special requirement for pom/mkDB from exec location
         # ./CE - $PDB_DIR/$1 - $PDB_DIR/$2 - $TMP_DIR
         f1 = fname1.split(os.path.sep)[-1].replace(pdbextn, '')
         f2 = fname2.split(os.path.sep)[-1].replace(pdbextn, '')
-        wdir = '%s%s%s_%s' % (self._tmpDir, os.path.sep, f1, f2)
-        os.makedirs(wdir)
-        cmd = '%s - %s - %s - %s' % (self._binPath, fname1, fname2, wdir)
-        proc = subprocess.Popen(
-            cmd,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
+        if self._workspace is None:
+            wdir = self._wdir(f1, f2)
+            # left behind by an interrupted run
+            shutil.rmtree(wdir, ignore_errors=True)
+            os.makedirs(wdir)
+            cmd = [self._binPath, '-', fname1, '-', fname2, '-', wdir]
+            cwd = None
+        else:
+            # reused scratch directory, pom is found in the workspace
+            wdir = self._workspace.scratch(slot)
+            cmd = [self._binPath, '-', self._workspace.stage(fname1),
+                   '-', self._workspace.stage(fname2), '-', wdir]
+            cwd = self._workspace.root
+        return cmd, cwd, self._timeout, self._cpuLimit
+
+    def failed(self, fname1, fname2, pdbextn, failure):
+        """ Clean up after the CE binary failed for a pair of domains
+
+        :param fname1: (string) Path to file containing structure of domain 1
+        :param fname2: (string) Path to file containing structure of domain 2
+        :param pdbextn: (string) Extension of PDB files
+        :param failure: (PSC_FAILURE) Failure of the binary
+        :rtype: (PSC_FAILURE) The failure, set to the pair
+        """
+        f1 = fname1.split(os.path.sep)[-1].replace(pdbextn, '')
+        f2 = fname2.split(os.path.sep)[-1].replace(pdbextn, '')
+        if self._workspace is None:
+            shutil.rmtree(self._wdir(f1, f2), ignore_errors=True)
+        return failure.set_pair('ce', f1, f2)
+
+    def parse(self, fname1, fname2, pdbextn, lines):
+        """ Collect the output data of the CE binary for a pair of domains
+        and store it in the cache
+
+        :param fname1: (string) Path to file containing structure of domain 1
+        :param fname2: (string) Path to file containing structure of domain 2
+        :param pdbextn: (string) Extension of PDB files
+        :param lines: (list) Lines of output of the binary
+        :rtype: (list) Output data collected from CE execution
+        """
+        f1 = fname1.split(os.path.sep)[-1].replace(pdbextn, '')
+        f2 = fname2.split(os.path.sep)[-1].replace(pdbextn, '')
         new_pair = True
         res = []
-        for line in proc.stdout.readlines():
-            line = str(line)
-            line = line.replace('\n', '')
+        for line in lines:
             if line.find('Size=') != -1:
                 if new_pair:
                     new_pair = False
@@ -167,44 +367,116 @@ class CE_HANDLER:
             print(pstr)
             # each entry in res: fname1, fname2, chain1, len1, chain2, len2,
             # Alignment length, Rmsd, Z-Score, Gaps, Sequence identities
-        if len(res) == 0:
-            res.append([f1, f2])
+        if self._workspace is None:
+            shutil.rmtree(self._wdir(f1, f2), ignore_errors=True)
+        if len(res) == 0 or len(list(filter(lambda x: len(x) != 11, res))):
+            raise PSC_FAILURE(PARSE, 'no alignment in output').set_pair(
+                'ce', f1, f2)
         # with lock:
         #  ofile.write('%s\n' %' '.join(res[0]))
-        shutil.rmtree(wdir, ignore_errors=True)
+        if self._cache is not None:
+            self._cache.put('ce', self._binDigest, fname1, fname2, res)
         return res
 
+    def process_pair(self, fname1, fname2, pdbextn):
+        """ Process a pair of domains using the CE external binary
+
+        :param fname1: (string) Path to file containing structure of domain 1
+        :param fname2: (string) Path to file containing structure of domain 2
+        :param pdbextn: (string) Extension of PDB files
+        :rtype: (list) Output data collected from CE execution
+        """
+        res = self.from_cache(fname1, fname2, pdbextn)
+        if res is not None:
+            return res
+        cmd, cwd, timeout, cpuLimit = self.command(fname1, fname2, pdbextn)
+        try:
+            output = run_command(cmd, timeout, cpuLimit, cwd)
+        except PSC_FAILURE as e:
+            raise self.failed(fname1, fname2, pdbextn, e)
+        return self.parse(fname1, fname2, pdbextn, output.splitlines())
+
 
 class TM_HANDLER:
 
-    def __init__(self, binPath):
+    def __init__(self, binPath, cache=None, timeout=None, cpuLimit=None,
+                 workspace=None):
         """ Set paths for the class
 
         :param binPath: Path to ce binary
+        :param cache: (PSC_CACHE) Result cache to use, None to disable caching
+        :param timeout: (float) Wall-clock limit per pair in seconds, None for no limit
+        :param cpuLimit: (int) CPU limit per pair in seconds, None for no limit
+        :param workspace: (PSC_WORKSPACE) Workspace input files are staged to, None to read them in place
         :rtype: None
         """
         self._binPath = os.path.abspath(binPath)
+        self._cache = cache
+        self._timeout = timeout
+        self._cpuLimit = cpuLimit
+        self._workspace = workspace
+        if cache is not None:
+            self._binDigest = file_digest(self._binPath)
 
-    def process_pair(self, fname1, fname2, pdbextn):
-        """ Process a pair of domains using the TM-align external binary
+    def from_cache(self, fname1, fname2, pdbextn):
+        """ Look up the TM-align output for a pair of domains in the result
+        cache
 
         :param fname1: (string) Path to file containing structure of domain 1
         :param fname2: (string) Path to file containing structure of domain 2
-        :rtype: (list) Output data collected from CE execution
+        :param pdbextn: (string) Extension of PDB files
+        :rtype: (list) Cached output data or None
+        """
+        if self._cache is None:
+            return None
+        f1 = fname1.split(os.path.sep)[-1].replace(pdbextn, '')
+        f2 = fname2.split(os.path.sep)[-1].replace(pdbextn, '')
+        return self._cache.get(
+            'tmalign', self._binDigest, fname1, fname2, [f1, f2])
+
+    def command(self, fname1, fname2, pdbextn, slot=None):
+        """ Prepare the execution of the TM-align binary for a pair of domains
+
+        :param fname1: (string) Path to file containing structure of domain 1
+        :param fname2: (string) Path to file containing structure of domain 2
+        :param pdbextn: (string) Extension of PDB files
+        :param slot: (int) Unused, the binary needs no scratch directory
+        :rtype: (tuple) Binary and its arguments, directory to execute it in, wall-clock and CPU limits
         """
         # ./$prg $dir/$x $dir/$y
-        cmd = '%s %s %s' % (self._binPath, fname1, fname2)
-        proc = subprocess.Popen(
-            cmd,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
+        cmd = [self._binPath, fname1, fname2]
+        if self._workspace is not None:
+            cmd = [self._binPath, self._workspace.stage(fname1),
+                   self._workspace.stage(fname2)]
+        return cmd, None, self._timeout, self._cpuLimit
+
+    def failed(self, fname1, fname2, pdbextn, failure):
+        """ Set a failure of the TM-align binary to a pair of domains
+
+        :param fname1: (string) Path to file containing structure of domain 1
+        :param fname2: (string) Path to file containing structure of domain 2
+        :param pdbextn: (string) Extension of PDB files
+        :param failure: (PSC_FAILURE) Failure of the binary
+        :rtype: (PSC_FAILURE) The failure, set to the pair
+        """
+        f1 = fname1.split(os.path.sep)[-1].replace(pdbextn, '')
+        f2 = fname2.split(os.path.sep)[-1].replace(pdbextn, '')
+        return failure.set_pair('tmalign', f1, f2)
+
+    def parse(self, fname1, fname2, pdbextn, lines):
+        """ Collect the output data of the TM-align binary for a pair of
+        domains and store it in the cache
+
+        :param fname1: (string) Path to file containing structure of domain 1
+        :param fname2: (string) Path to file containing structure of domain 2
+        :param pdbextn: (string) Extension of PDB files
+        :param lines: (list) Lines of output of the binary
+        :rtype: (list) Output data collected from TM-align execution
+        """
         f1 = fname1.split(os.path.sep)[-1].replace(pdbextn, '')
         f2 = fname2.split(os.path.sep)[-1].replace(pdbextn, '')
         ret = [[f1, f2]]
-        for line in proc.stdout.readlines():
-            line = str(line)
-            line = line.replace('\n', '')
+        for line in lines:
             if line.find('Length of Chain_') != -1:
                 ret[0].append(
                     line.split(':')[1].replace(
@@ -216,49 +488,142 @@ class TM_HANDLER:
                 ret[0].append(line.split(' ')[1])
         # each entry in res: fname1, fname2, len1, len2, aligned length, RMSD,
         # sequence id, tm1, tm2
-        if len(ret) == 0:
-            ret.append([f1, f2])
+        if len(ret[0]) != 9:
+            raise PSC_FAILURE(PARSE, 'incomplete output').set_pair(
+                'tmalign', f1, f2)
         # with lock:
         #  ofile.write('%s\n' %' '.join(ret[0]))
+        if self._cache is not None:
+            self._cache.put('tmalign', self._binDigest, fname1, fname2, ret)
         return ret
 
+    def process_pair(self, fname1, fname2, pdbextn):
+        """ Process a pair of domains using the TM-align external binary
+
+        :param fname1: (string) Path to file containing structure of domain 1
+        :param fname2: (string) Path to file containing structure of domain 2
+        :rtype: (list) Output data collected from CE execution
+        """
+        res = self.from_cache(fname1, fname2, pdbextn)
+        if res is not None:
+            return res
+        cmd, cwd, timeout, cpuLimit = self.command(fname1, fname2, pdbextn)
+        try:
+            output = run_command(cmd, timeout, cpuLimit, cwd)
+        except PSC_FAILURE as e:
+            raise self.failed(fname1, fname2, pdbextn, e)
+        return self.parse(fname1, fname2, pdbextn, output.splitlines())
+
 
 class FAST_HANDLER:
 
-    def __init__(self, binPath):
+    def __init__(self, binPath, cache=None, timeout=None, cpuLimit=None,
+                 workspace=None):
         """ Set paths for the class
 
         :param binPath: Path to ce binary
+        :param cache: (PSC_CACHE) Result cache to use, None to disable caching
+        :param timeout: (float) Wall-clock limit per pair in seconds, None for no limit
+        :param cpuLimit: (int) CPU limit per pair in seconds, None for no limit
+        :param workspace: (PSC_WORKSPACE) Workspace input files are staged to, None to read them in place
         :rtype: None
         """
         self._binPath = os.path.abspath(binPath)
+        self._cache = cache
+        self._timeout = timeout
+        self._cpuLimit = cpuLimit
+        self._workspace = workspace
+        if cache is not None:
+            self._binDigest = file_digest(self._binPath)
 
-    def process_pair(self, fname1, fname2, pdbextn):
-        """ Process a pair of domains using the FAST external binary
+    def from_cache(self, fname1, fname2, pdbextn):
+        """ Look up the FAST output for a pair of domains in the result cache
 
         :param fname1: (string) Path to file containing structure of domain 1
         :param fname2: (string) Path to file containing structure of domain 2
         :param pdbextn: (string) Extension of PDB files
+        :rtype: (list) Cached output data or None
+        """
+        if self._cache is None:
+            return None
+        f1 = fname1.split(os.path.sep)[-1].replace(pdbextn, '')
+        f2 = fname2.split(os.path.sep)[-1].replace(pdbextn, '')
+        return self._cache.get(
+            'fast', self._binDigest, fname1, fname2, [f1, f2])
+
+    def command(self, fname1, fname2, pdbextn, slot=None):
+        """ Prepare the execution of the FAST binary for a pair of domains
+
+        :param fname1: (string) Path to file containing structure of domain 1
+        :param fname2: (string) Path to file containing structure of domain 2
+        :param pdbextn: (string) Extension of PDB files
+        :param slot: (int) Unused, the binary needs no scratch directory
+        :rtype: (tuple) Binary and its arguments, directory to execute it in, wall-clock and CPU limits
+        """
+        cmd = [self._binPath, fname1, fname2]
+        if self._workspace is not None:
+            cmd = [self._binPath, self._workspace.stage(fname1),
+                   self._workspace.stage(fname2)]
+        return cmd, None, self._timeout, self._cpuLimit
+
+    def failed(self, fname1, fname2, pdbextn, failure):
+        """ Set a failure of the FAST binary to a pair of domains
+
+        :param fname1: (string) Path to file containing structure of domain 1
+        :param fname2: (string) Path to file containing structure of domain 2
+        :param pdbextn: (string) Extension of PDB files
+        :param failure: (PSC_FAILURE) Failure of the binary
+        :rtype: (PSC_FAILURE) The failure, set to the pair
+        """
+        f1 = fname1.split(os.path.sep)[-1].replace(pdbextn, '')
+        f2 = fname2.split(os.path.sep)[-1].replace(pdbextn, '')
+        return failure.set_pair('fast', f1, f2)
+
+    def parse(self, fname1, fname2, pdbextn, lines):
+        """ Collect the output data of the FAST binary for a pair of domains
+        and store it in the cache
+
+        :param fname1: (string) Path to file containing structure of domain 1
+        :param fname2: (string) Path to file containing structure of domain 2
+        :param pdbextn: (string) Extension of PDB files
+        :param lines: (list) Lines of output of the binary
         :rtype: (list) Output data collected from FAST execution
         """
-        cmd = '%s %s %s' % (self._binPath, fname1, fname2)
-        proc = subprocess.Popen(
-            cmd,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
-        ret = [[fname1.split(os.path.sep)[-1].replace(pdbextn, ''),
-                fname2.split(os.path.sep)[-1].replace(pdbextn, '')]]
-        for line in proc.stdout.readlines():
-            line = str(line)
+        f1 = fname1.split(os.path.sep)[-1].replace(pdbextn, '')
+        f2 = fname2.split(os.path.sep)[-1].replace(pdbextn, '')
+        ret = [[f1, f2]]
+        for line in lines:
             if line.find('RMSD=') != -1:
-                data = line.replace('\n', '').split(' ')
+                data = line.split(' ')
                 ret[0] += [data[0].split('=')[1],
                            data[3].split('=')[1],
                            data[4].split('=')[1],
                            data[5].split('=')[1]]
+        if len(ret[0]) != 6:
+            raise PSC_FAILURE(PARSE, 'incomplete output').set_pair(
+                'fast', f1, f2)
+        if self._cache is not None:
+            self._cache.put('fast', self._binDigest, fname1, fname2, ret)
         return ret
 
+    def process_pair(self, fname1, fname2, pdbextn):
+        """ Process a pair of domains using the FAST external binary
+
+        :param fname1: (string) Path to file containing structure of domain 1
+        :param fname2: (string) Path to file containing structure of domain 2
+        :param pdbextn: (string) Extension of PDB files
+        :rtype: (list) Output data collected from FAST execution
+        """
+        res = self.from_cache(fname1, fname2, pdbextn)
+        if res is not None:
+            return res
+        cmd, cwd, timeout, cpuLimit = self.command(fname1, fname2, pdbextn)
+        try:
+            output = run_command(cmd, timeout, cpuLimit, cwd)
+        except PSC_FAILURE as e:
+            raise self.failed(fname1, fname2, pdbextn, e)
+        return self.parse(fname1, fname2, pdbextn, output.splitlines())
+
 
 class GR_HANDLER:
 
@@ -276,47 +641,93 @@ class GR_HANDLER:
         :param dirName: (string) Path to contact map files
         :rtype: None
         """
-        q = '%s%spairs.lst' % (dirName, os.path.sep)
-        f = open(q, 'w')
-        for file1 in list(filter(
+        self.process_queries(dirName, list(map(
+            lambda x: x.replace('.ndump', ''), filter(
                 lambda x: x.endswith(".ndump"),
-                os.listdir(dirName))):
-            f.write('%s\n' % file1.replace('.ndump', ''))
+                os.listdir(dirName)))))
+
+    def process_queries(self, dirName, queries, targets=None,
+                        outName='results.txt'):
+        """ Process pairs of domains using the GR-align external binary. If
+        no targets are given all pairs of queries are processed, otherwise all
+        queries are compared to all targets.
+
+        :param dirName: (string) Path to contact map files
+        :param queries: (list) Names of the query domains
+        :param targets: (list) Names of the target domains
+        :param outName: (string) Name of the output file written to dirName
+        :rtype: None
+        """
+        # concurrent runs on one directory need their own list files
+        lname = 'pairs.lst' if outName == 'results.txt' else \
+            '%s.q.lst' % outName
+        q = '%s%s%s' % (dirName, os.path.sep, lname)
+        f = open(q, 'w')
+        for name in queries:
+            f.write('%s\n' % name)
         f.close()
         # ./GR-Align -q skolnick.lst -r ./skolnick -o results.txt
-        cmd = '%s -q %s -r %s -o %s' % (self._binPath,
-                                        q,
-                                        dirName,
-                                        '%s%sresults.txt' % (dirName,
-                                                             os.path.sep))
-        proc = subprocess.Popen(
-            cmd,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
-        for line in proc.stdout.readlines():
-            line = str(line)
-            print(line)
+        cmd = [self._binPath, '-q', q, '-r', dirName,
+               '-o', '%s%s%s' % (dirName, os.path.sep, outName)]
+        if targets is not None:
+            t = '%s%s%s.t.lst' % (dirName, os.path.sep, outName)
+            f = open(t, 'w')
+            for name in targets:
+                f.write('%s\n' % name)
+            f.close()
+            cmd += ['-t', t, '-u', dirName]
+        try:
+            print(run_command(cmd))
+        except PSC_FAILURE as e:
+            print('gralign failed: %s' % e)
+
+    def process_shard(self, dirName, queries, targets, outName):
+        """ Process one shard of an all-to-all run: all pairs of the shard's
+        queries and all pairs of a query and a target.
+
+        :param dirName: (string) Path to contact map files
+        :param queries: (list) Names of the query domains of the shard
+        :param targets: (list) Names of the domains the queries are compared to
+        :param outName: (string) Prefix of the output files written to dirName
+        :rtype: (list) Paths to the similarity files written
+        """
+        sims = []
+        for names, suffix in [(None, 'txt'), (targets, 'cross.txt')]:
+            if names is not None and len(names) == 0:
+                continue
+            name = '%s.%s' % (outName, suffix)
+            self.process_queries(dirName, queries, names, name)
+            sims.append('%s%s%s.sim' % (dirName, os.path.sep, name))
+        return sims
 
 
 class USM_HANDLER:
 
-    def __init__(self):
+    def __init__(self, cache=None):
         """ Set maximum number of contacts to keep in contact map
 
+        :param cache: (PSC_CACHE) Result cache to use, None to disable caching
         :rtype: None
         """
-        self._MAX_CONTACTS = 1000
+        self._MAX_CONTACTS = MAX_CONTACTS
+        self._cache = cache
+        # USM has no binary, the implementation settings identify the version
+        self._binDigest = 'usm-%d' % self._MAX_CONTACTS
 
-    def _trunc(self, x):
-        """ Truncate contacts to max size
+    def from_cache(self, fname1, fname2, pdbextn=None):
+        """ Look up the USM output for a pair of domains in the result cache
 
-        :param x: (list) Contacts
-        :rtype: (list) Contacts truncated to max size
+        :param fname1: (string) Path to domain 1 contact map file
+        :param fname2: (string) Path to domain 2 contact map file
+        :param pdbextn: (string) Unused, present for handler compatibility
+        :rtype: (list) Cached output data or None
         """
-        if len(x) < self._MAX_CONTACTS:
-            return x
-        return x[:self._MAX_CONTACTS]
+        if self._cache is None:
+            return None
+        f1 = fname1.split(os.path.sep)[-1].replace('.gw', '')
+        f2 = fname2.split(os.path.sep)[-1].replace('.gw', '')
+        return self._cache.get(
+            'usm', self._binDigest, fname1, fname2, [f1, f2])
 
     def process_pair(self, fname1, fname2):
         """ Process a pair of domains using USM
@@ -325,30 +736,24 @@ class USM_HANDLER:
         :param fname2: (string) Path to domain 2 contact map file
         :rtype: (list) Output data collected from USM execution
         """
-        def reader(x): return not x.startswith('|')
-        cm1 = ''.join(
-            self._trunc(
-                list(
-                    filter(
-                        reader,
-                        open(fname1).readlines()))))
-        cm2 = ''.join(
-            self._trunc(
-                list(
-                    filter(
-                        reader,
-                        open(fname2).readlines()))))
-        if sys.version_info < (3, 0):
-            def comp(x): return float(len(zlib.compress(x)))
-        else:
-            def comp(x): return float(len(zlib.compress(x.encode('utf-8'))))
+        res = self.from_cache(fname1, fname2)
+        if res is not None:
+            return res
+
+        cm1 = read_contact_map(fname1, self._MAX_CONTACTS)
+        cm2 = read_contact_map(fname2, self._MAX_CONTACTS)
+
+        def comp(x): return float(len(zlib.compress(x)))
         x = comp(cm1)
         y = comp(cm2)
         xy = comp(cm1 + cm2)
         yx = comp(cm2 + cm1)
         f1 = fname1.split(os.path.sep)[-1].replace('.gw', '')
         f2 = fname2.split(os.path.sep)[-1].replace('.gw', '')
-        return [[f1, f2, '%f' % (max(yx - y, xy - x) / max(x, y))]]
+        res = [[f1, f2, usm_score(x, y, xy, yx)]]
+        if self._cache is not None:
+            self._cache.put('usm', self._binDigest, fname1, fname2, res)
+        return res
 
 # END OF HANDLERS
 
@@ -401,6 +806,144 @@ def ce_process_pair(ps):
         raise ValueError('worker user exit in CE')
 
 
+def localize_handler(pscmethod, progDir, workspace):
+    """ Prepare a PSC handler received from the coordinator for execution on
+    a worker node. The binary is looked up by name in the local program
+    directory, inputs are staged in the local workspace and results are
+    cached by the coordinator only.
+
+    :param pscmethod: (object) CE, TM-align or FAST handler object
+    :param progDir: (string) Local directory of the PSC binaries, None to keep the paths of the coordinator
+    :param workspace: (PSC_WORKSPACE) Local workspace
+    :rtype: (object) The handler
+    """
+    if progDir is not None:
+        pscmethod._binPath = os.path.abspath('%s%s%s' % (
+            progDir, os.path.sep, os.path.basename(pscmethod._binPath)))
+    pscmethod._cache = None
+    pscmethod._workspace = workspace
+    return pscmethod
+
+
+def cache_result(methodname, pscmethod, pair, res):
+    """ Store the output of a pair processed on a worker node in the result
+    cache of the coordinator
+
+    :param methodname: (string) PSC method name
+    :param pscmethod: (object) PSC handler object of the coordinator
+    :param pair: (tuple) Pair of domains
+    :param res: (list) Output data of the pair
+    :rtype: None
+    """
+    if pscmethod._cache is not None:
+        pscmethod._cache.put(methodname, pscmethod._binDigest, pair[0],
+                             pair[1], res)
+
+
+def format_result(res):
+    """ Format the output of a pairwise PSC method as line of its output file
+
+    :param res: (list) Output data of the PSC handler
+    :rtype: (string) Output line
+    """
+    return ' '.join(res[0]).replace('\\n', '').replace("'", '')
+
+
+def pair_names(pair, extn):
+    """ Domain names of a pair as they appear in the PSC output files
+
+    :param pair: (tuple) Paths to the files of the two domains
+    :param extn: (string) Extension of the files
+    :rtype: (tuple) Domain names
+    """
+    return (pair[0].split(os.path.sep)[-1].replace(extn, ''),
+            pair[1].split(os.path.sep)[-1].replace(extn, ''))
+
+
+def gr_shards(queries, targets, count):
+    """ Split the queries of a GR-align run into shards of about equal
+    numbers of pairs. A shard covers all pairs among its queries, all pairs of
+    its queries with the queries of later shards and all pairs of its queries
+    with the targets, so that the shards together cover every pair once.
+
+    :param queries: (list) Names of the query domains
+    :param targets: (list) Names of target domains whose pairs among each other are not processed
+    :param count: (int) Number of shards to make
+    :rtype: (list) Tuples of the queries of a shard and the domains they are compared to
+    """
+    count = max(1, min(count, len(queries)))
+    # a query is compared to itself, the later queries and the targets
+    costs = list(map(lambda x: len(queries) - x + len(targets),
+                     range(len(queries))))
+    bound = sum(costs) * 1.0 / count
+    shards = []
+    first = 0
+    cost = 0
+    for i in range(len(queries)):
+        cost += costs[i]
+        if cost >= bound * (len(shards) + 1) or i == len(queries) - 1:
+            shards.append((queries[first:i + 1],
+                           queries[i + 1:] + targets))
+            first = i + 1
+    return shards
+
+
+def gr_merge_shards(outfilename, simfilenames, order, keep):
+    """ Merge the similarity files of GR-align shards into the output file.
+    The new rows are written in the order of an unsharded run, duplicate rows
+    and self pairs written by GR-align are dropped.
+
+    :param outfilename: (string) Path to the output similarity file
+    :param simfilenames: (list) Paths to the similarity files of the shards
+    :param order: (list) Names of all domains in query order
+    :param keep: (set) Names of domains whose existing results remain valid
+    :rtype: (int) Number of new rows
+    """
+    pos = dict(map(lambda x: (x[1], x[0]), enumerate(order)))
+    head = None
+    rows = {}
+    for simfilename in simfilenames:
+        if not os.path.exists(simfilename):
+            continue
+        lines = open(simfilename)
+        line = lines.readline()
+        if head is None:
+            head = line
+        for line in lines:
+            data = line.split('\t')
+            if len(data) < 2 or data[0] == data[1]:
+                continue
+            k = (pos.get(data[0], -1), pos.get(data[1], -1))
+            if k not in rows:
+                rows[k] = line
+        lines.close()
+    newfilename = '%s.new' % outfilename
+    out = open(newfilename, 'w')
+    if head is not None:
+        out.write(head)
+    for k in sorted(rows):
+        out.write(rows[k])
+    out.close()
+    merge_result_file(outfilename, [newfilename], keep, sep='\t',
+                      header=True)
+    os.remove(newfilename)
+    return len(rows)
+
+
+def gr_process_shard(ps):
+    """ Convinience wrapper for processing a shard of a gr-align all-to-all
+    run
+
+    :param ps: tuple containing object to call, contact map directory, shard name, shard queries and the domains they are compared to
+    :rtype: (list) Paths to the similarity files written
+    """
+    gr, grdir, name, queries, targets = ps
+    try:
+        return gr.process_shard(grdir, queries, targets, name)
+    except KeyboardInterrupt:
+        raise ValueError('worker user exit in GRALIGN')
+
+
 class RunPairwisePSC:
 
     def __init__(self):
@@ -420,6 +963,23 @@ class RunPairwisePSC:
             WORKDIR = 'work/'
             PDBEXTN = 'ent'
             THREADS = 16
+            CACHEDIR = 'pymcpsc_cache'
+            CACHESIZE = 4096
+            INCREMENTAL = False
+            RESUME = False
+            COMPRESSJOURNAL = False
+            FSYNCINTERVAL = 10
+            TIMEOUT = None
+            CPULIMIT = None
+            SCRATCHDIR = None
+            PREFILTER = None
+            GTIN = None
+            COORDINATOR = None
+            AUTHKEY = None
+            LOCALWORKERS = 0
+            SHARD = None
+            EXECUTOR = 'pool'
+            CONCURRENCY = None
             # END OF CONFIGURATIOAN
         else:
             # PROGRAMS = config['PROGRAMS']
@@ -428,38 +988,64 @@ class RunPairwisePSC:
             WORKDIR = config.WORKDIR
             PDBEXTN = config.PDBEXTN
             THREADS = int(config.THREADS)
-
-        if os.path.exists(WORKDIR):
+            CACHEDIR = getattr(config, 'CACHEDIR', None)
+            CACHESIZE = getattr(config, 'CACHESIZE', 4096)
+            INCREMENTAL = getattr(config, 'INCREMENTAL', False)
+            RESUME = getattr(config, 'RESUME', False)
+            COMPRESSJOURNAL = getattr(config, 'COMPRESSJOURNAL', False)
+            FSYNCINTERVAL = float(getattr(config, 'FSYNCINTERVAL', 10))
+            TIMEOUT = getattr(config, 'TIMEOUT', None)
+            CPULIMIT = getattr(config, 'CPULIMIT', None)
+            SCRATCHDIR = getattr(config, 'SCRATCHDIR', None)
+            PREFILTER = getattr(config, 'PREFILTER', None)
+            GTIN = getattr(config, 'GTIN', None)
+            COORDINATOR = getattr(config, 'COORDINATOR', None)
+            AUTHKEY = getattr(config, 'AUTHKEY', None)
+            LOCALWORKERS = int(getattr(config, 'LOCALWORKERS', 0))
+            SHARD = getattr(config, 'SHARD', None)
+            EXECUTOR = getattr(config, 'EXECUTOR', 'pool')
+            CONCURRENCY = getattr(config, 'CONCURRENCY', None)
+        # per method limits of the PSC binaries
+        timeouts = parse_limits(TIMEOUT, PROGRAMS[:3])
+        cpulimits = parse_limits(CPULIMIT, PROGRAMS[:3])
+
+        # a shard of a cluster array job works in its own directory below
+        # the work directory, the shards are merged once all are done
+        shard = None
+        if SHARD is not None:
+            shard = parse_shard(SHARD)
+            if INCREMENTAL:
+                print('Sharded runs can not be incremental')
+                return False
+            WORKDIR = shard_dir(WORKDIR, shard[0], shard[1])
+            print('shard %d of %d: work directory %s' % (
+                shard[0], shard[1], WORKDIR))
+
+        # an interrupted run is resumed from its journal, keeping its work
+        # directory
+        journal = PSC_JOURNAL(WORKDIR, COMPRESSJOURNAL, FSYNCINTERVAL)
+        resume = RESUME and journal.exists()
+        if RESUME and not resume:
+            print('No journal of an interrupted run found, processing all pairs')
+
+        # in incremental mode the work directory of the previous run is kept
+        # and only the pairs involving new or changed domains are processed
+        manifest = None
+        if INCREMENTAL and os.path.exists(WORKDIR):
+            manifest = read_manifest(WORKDIR)
+            if manifest is None:
+                print('No manifest of a previous run found, processing all pairs')
+
+        if manifest is None and not resume and os.path.exists(WORKDIR):
             shutil.rmtree(WORKDIR)
-        os.makedirs(WORKDIR)
+        if not os.path.exists(WORKDIR):
+            os.makedirs(WORKDIR)
+        recorded = journal.start(resume)
 
         if os.path.exists('figures'):
             shutil.rmtree('figures')
         os.makedirs('figures')
 
-        # PROCESS
-        start = timer()
-        gralign_pre_processor = GRALIGN_PRE_PROCESSOR(
-            '%s%sCMap' %
-            (PROGDIR, os.path.sep), '%s%sDCount' %
-            (PROGDIR, os.path.sep), WORKDIR)
-        gralign_pre_processor.pre_process_all_to_all(DATADIR, PDBEXTN)
-        end = timer()
-        print('gralign preprocessing took %d seconds' % (end - start))
-
-        ce = CE_HANDLER(
-            '%s%s%s' %
-            (PROGDIR, os.path.sep, PROGRAMS[0]), '%s%sce' %
-            (WORKDIR, os.path.sep))
-
-        tm = TM_HANDLER('%s%s%s' % (PROGDIR, os.path.sep, PROGRAMS[1]))
-
-        fast = FAST_HANDLER('%s%s%s' % (PROGDIR, os.path.sep, PROGRAMS[2]))
-
-        usm = USM_HANDLER()
-
-        gr = GR_HANDLER('%s%s%s' % (PROGDIR, os.path.sep, PROGRAMS[3]))
-
         pdb_files = list(
             filter(
                 lambda x: x.endswith(
@@ -471,140 +1057,405 @@ class RunPairwisePSC:
             print('No PDB files found.')
             return False
 
-        psc_pairs = []
-        for x in range(0, len(pdb_files)):
-            for y in range(x, len(pdb_files)):
-                psc_pairs.append(
-                    ('%s%s%s' %
-                     (DATADIR, os.path.sep, pdb_files[x]), '%s%s%s' %
-                        (DATADIR, os.path.sep, pdb_files[y]), PDBEXTN))
-        cm_files = list(filter(
-            lambda x: x.endswith(".gw"), os.listdir(
-                '%s%sgralign' %
-                (WORKDIR, os.path.sep))))
-        cm_pairs = []
-        for x in range(0, len(cm_files)):
-            for y in range(x, len(cm_files)):
-                cm_pairs.append(
-                    ('%s%sgralign%s%s' %
-                     (WORKDIR, os.path.sep, os.path.sep, cm_files[x]), '%s%sgralign%s%s' %
-                        (WORKDIR, os.path.sep, os.path.sep, cm_files[y]), PDBEXTN))
-
-        # Do Serial
+        if manifest is None:
+            new_files, old_files, stale_files = pdb_files, [], []
+        else:
+            new_files, old_files, stale_files = diff_manifest(
+                manifest, DATADIR, pdb_files)
+            print('incremental run: %d new or changed domains, %d processed '
+                  'domains, %d removed or changed domains' %
+                  (len(new_files), len(old_files), len(stale_files)))
+        incremental = len(old_files) > 0
+        # names of the domains whose existing results remain valid
+        keep = set(map(lambda x: x.replace(PDBEXTN, ''), old_files))
+
+        # results of previous runs are reused through the cache which lives
+        # outside of the work directory
+        cache = None
+        if CACHEDIR:
+            cache = PSC_CACHE(CACHEDIR, int(CACHESIZE) * 1024 * 1024)
+
+        # every PDB file is parsed once into the structure store shared by
+        # the worker processes, next to the cache it is kept across runs
+        start = timer()
+        store = PSC_STRUCTURE_STORE('%s%sstructures' % (
+            CACHEDIR if CACHEDIR else WORKDIR, os.path.sep))
+        count = store.ingest(list(map(
+            lambda x: '%s%s%s' % (DATADIR, os.path.sep, x), pdb_files)),
+            THREADS)
+        print('structure store: %d of %d PDB files parsed in %d seconds' %
+              (count, len(pdb_files), timer() - start))
+
+        # PROCESS
+        grdir = '%s%sgralign' % (WORKDIR, os.path.sep)
+        for stale_file in stale_files:
+            for extn in ['.gw', '.ndump']:
+                f = '%s%s%s' % (grdir, os.path.sep,
+                                stale_file.replace(PDBEXTN, extn))
+                if os.path.exists(f):
+                    os.remove(f)
         start = timer()
-        print('gralign started:')
-        gr.process_alltoall('%s/gralign' % WORKDIR)
+        gralign_pre_processor = GRALIGN_PRE_PROCESSOR(
+            '%s%sCMap' %
+            (PROGDIR, os.path.sep), '%s%sDCount' %
+            (PROGDIR, os.path.sep), WORKDIR, cache, THREADS)
+        pre_files = new_files
+        if resume:
+            pre_files = list(filter(lambda x: not os.path.exists(
+                '%s%s%s' % (grdir, os.path.sep, x.replace(PDBEXTN, '.ndump'))),
+                new_files))
+        for failure in gralign_pre_processor.pre_process_all_to_all(
+                DATADIR, PDBEXTN, pre_files):
+            journal.record_failure(failure)
         end = timer()
-        print('gralign processed in %d seconds' % (end - start))
-
-        def doMulti(
-                outfilename,
-                procmethod,
-                pairs,
-                threads,
-                pscmethod,
-                methodname):
-            """ Execute job list in parallel using Pool
-
-            :param outfilename: (string)
-            :param procmethod: PSC convinience method to call
-            :param pairs: (list) Pairs of domains to be processed
-            :param pscmethod: (object) PSC handler object
-            :param methodname: (string) PSC method name string
-            :rtype: (boolean) 
-            """
-            start = timer()
-            p = Pool(threads)
-            mlen = len(pairs) - 1
-            print('%s started:' % methodname)
-            results = []
+        print('gralign preprocessing took %d seconds' % (end - start))
+
+        # note special requirement of CE for pom/mkDB from exec location, CE
+        # is executed in the workspace holding a copy of pom
+        pom_path = os.path.join(
+            os.path.dirname(
+                os.path.realpath(__file__)),
+            'ext',
+            'x86_64',
+            'linux',
+            'pom')
+        workspace = PSC_WORKSPACE(SCRATCHDIR, pom_path)
+        print('workspace: %s' % workspace.root)
+        try:
+            ce = CE_HANDLER(
+                '%s%s%s' %
+                (PROGDIR, os.path.sep, PROGRAMS[0]), '%s%sce' %
+                (WORKDIR, os.path.sep), cache, timeouts.get('ce'),
+                cpulimits.get('ce'), workspace)
+
+            tm = TM_HANDLER(
+                '%s%s%s' % (PROGDIR, os.path.sep, PROGRAMS[1]), cache,
+                timeouts.get('tmalign'), cpulimits.get('tmalign'), workspace)
+
+            fast = FAST_HANDLER(
+                '%s%s%s' % (PROGDIR, os.path.sep, PROGRAMS[2]), cache,
+                timeouts.get('fast'), cpulimits.get('fast'), workspace)
+
+            # USM runs next to the pool on one thread, which holds one worker
+            # of the pool while it runs
+            usm = USM_ENGINE(1, cache)
+
+            gr = GR_HANDLER('%s%s%s' % (PROGDIR, os.path.sep, PROGRAMS[3]))
+
+            psc_pairs = list(map(
+                lambda x: ('%s%s%s' % (DATADIR, os.path.sep, x[0]),
+                           '%s%s%s' % (DATADIR, os.path.sep, x[1]), PDBEXTN),
+                incremental_pairs(new_files, old_files)))
+
+            # pairs of domains whose descriptor similarity is below the
+            # prefilter threshold are not sent to the pairwise PSC binaries,
+            # they are recorded as pruned. The prefilter is lossy, with a
+            # ground truth the pairs of the same fold it prunes are reported
+            pruned_pairs, similarities = [], []
+            if PREFILTER is not None:
+                start = timer()
+                descriptors = compute_descriptors(list(map(
+                    lambda x: '%s%s%s' % (DATADIR, os.path.sep, x),
+                    new_files + old_files)), THREADS, store)
+                total = len(psc_pairs)
+                if GTIN:
+                    domains, klass, _ = read_ground_truth(GTIN)
+                    folds = dict(zip(
+                        map(lambda x: x.split('.')[0], domains),
+                        map(lambda x: '.'.join(x.split('.')[:2]), klass)))
+                    names = list(map(lambda x: pair_names(x, PDBEXTN),
+                                     psc_pairs))
+                    scored = pair_similarities(psc_pairs, descriptors)
+                    same, lost, recall = fold_recall(names, scored, folds,
+                                                     float(PREFILTER))
+                    print('prefilter: %d of %d pairs of the same fold '
+                          'pruned below %g (recall %0.3f), a threshold of %g '
+                          'keeps 99%% of them' % (
+                              lost, same, float(PREFILTER), recall,
+                              recall_threshold(names, scored, folds, 0.99)))
+                psc_pairs, pruned_pairs, similarities = prune_pairs(
+                    psc_pairs, descriptors, float(PREFILTER))
+                print('prefilter: %d of %d pairs pruned below %g in %d '
+                      'seconds' % (len(pruned_pairs), total, float(PREFILTER),
+                                   timer() - start))
+            prunedfilename = '%s%s%s' % (WORKDIR, os.path.sep, PRUNED)
+            newfilename = prunedfilename
+            if incremental:
+                newfilename = '%s.new' % prunedfilename
+            write_pruned(newfilename, list(map(
+                lambda x: pair_names(x, PDBEXTN), pruned_pairs)), similarities)
+            if incremental:
+                merge_result_file(prunedfilename, [newfilename], keep,
+                                  sep='\t')
+                os.remove(newfilename)
+
+            def cm_exists(x):
+                return os.path.exists('%s%s%s' % (grdir, os.path.sep, x))
+            new_cm_files = list(filter(cm_exists, map(
+                lambda x: x.replace(PDBEXTN, '.gw'), new_files)))
+            old_cm_files = list(filter(cm_exists, map(
+                lambda x: x.replace(PDBEXTN, '.gw'), old_files)))
+            cm_pairs = list(map(
+                lambda x: ('%s%s%s' % (grdir, os.path.sep, x[0]),
+                           '%s%s%s' % (grdir, os.path.sep, x[1]), PDBEXTN),
+                incremental_pairs(new_cm_files, old_cm_files)))
+
+            method_pairs = {'usm': cm_pairs, 'fast': psc_pairs,
+                            'tmalign': psc_pairs, 'ce': psc_pairs}
+            if shard is not None:
+                # the same cost balanced assignment is computed by every shard
+                methodnames = ['usm', 'fast', 'tmalign', 'ce']
+                tasks = [(m, x) for m in methodnames for x in method_pairs[m]]
+                selected, cost = assign_shard(tasks, shard[0], shard[1])
+                totals = dict(map(lambda x: (x, len(method_pairs[x])),
+                                  methodnames))
+                method_pairs = dict(map(lambda x: (x, []), methodnames))
+                for k in selected:
+                    method_pairs[tasks[k][0]].append(tasks[k][1])
+                write_shard(WORKDIR, shard[0], shard[1], totals, dict(map(
+                    lambda x: (x, list(map(lambda y: pair_names(
+                        y, '.gw' if x == 'usm' else PDBEXTN),
+                        method_pairs[x]))),
+                    methodnames)))
+                print('shard %d of %d: %d of %d pairs, %0.1f%% of the '
+                      'expected cost' % (
+                          shard[0], shard[1], len(selected), len(tasks),
+                          100. * cost / max(sum(map(
+                              lambda x: estimate_cost(*x), tasks)), 1e-9)))
+
+            def finisher(methodname, outfilename):
+                """ Make the function writing the output file of a PSC method
+                from the journal
+
+                :param methodname: (string) PSC method name
+                :param outfilename: (string) Path to the output file
+                :rtype: (function) Called once all pairs of the method are done
+                """
+                def finish():
+                    newfilename = outfilename
+                    if incremental:
+                        newfilename = '%s.new' % outfilename
+                    out = open(newfilename, 'w')
+                    count = 0
+                    for line in journal.lines(methodname):
+                        out.write('%s\n' % line)
+                        count += 1
+                    out.close()
+                    if incremental:
+                        dropped = merge_result_file(
+                            outfilename, [newfilename], keep)
+                        os.remove(newfilename)
+                        print('\tmerged %d new results, dropped %d stale '
+                              'results' % (count, dropped))
+                return finish
+
+            def collector(methodname):
+                """ Make the function recording the output of a pair of a PSC
+                method in the journal
+
+                :param methodname: (string) PSC method name
+                :rtype: (function) Called with the output of each pair
+                """
+                return lambda res: journal.record(methodname,
+                                                  format_result(res))
+
+            def failed(failure):
+                """ Record a pair whose PSC binary failed in the journal
+
+                :param failure: (PSC_FAILURE) Failure of the pair
+                :rtype: None
+                """
+                print('%s failed for %s: %s' % (
+                    failure.method, ' '.join(failure.names), failure))
+                journal.record_failure(failure)
+
+            # Run the pairwise PSC jobs of all methods on a single pool, with
+            # the GR-align all-to-all shards running concurrently. A
+            # coordinator serves the pairs to worker nodes instead and runs the
+            # shards on the local pool. The asyncio executor runs the binaries
+            # as subprocesses of this process. Throughput, latency and ETA of
+            # the methods are reported as outputs arrive.
+            metrics = PSC_METRICS(WORKDIR)
+            if COORDINATOR is None and EXECUTOR == 'async':
+                # binaries are driven from this process, on Python 3 only
+                from pymcpsc.asyncexec import PSC_ASYNC_SCHEDULER
+                scheduler = PSC_ASYNC_SCHEDULER(
+                    THREADS, None if CONCURRENCY is None else int(CONCURRENCY),
+                    metrics)
+            elif COORDINATOR is None:
+                scheduler = PSC_SCHEDULER(THREADS, metrics)
+            else:
+                scheduler = PSC_COORDINATOR(
+                    THREADS, parse_address(COORDINATOR, ''),
+                    None if AUTHKEY is None else AUTHKEY.encode('utf-8'),
+                    LOCALWORKERS, localize=localize_handler,
+                    store=cache_result, scratchDir=SCRATCHDIR,
+                    metrics=metrics)
+                # the key protects the workers from pickled messages of anyone
+                # else and is never printed
+                if AUTHKEY is None:
+                    keyfilename = '%s%s%s' % (WORKDIR, os.path.sep,
+                                              AUTHKEY_FILE)
+                    write_authkey(keyfilename, scheduler.authkey)
+                    authkey = '"$(cat %s)"' % keyfilename
+                else:
+                    authkey = '<the key given to this run>'
+                print('coordinator listening on %s:%d, start workers with: '
+                      'run-pymcpsc worker --connect HOST:%d --authkey %s' % (
+                          scheduler.address[0], scheduler.address[1],
+                          scheduler.address[1], authkey))
+            if DONE in recorded.get('gralign', ()):
+                print('gralign already processed')
+            else:
+                # the GR-align run is split into shards running as parallel
+                # jobs, their output is merged once the last shard is done
+                gr_queries = list(map(lambda x: x.replace('.gw', ''),
+                                      new_cm_files))
+                gr_targets = list(map(lambda x: x.replace('.gw', ''),
+                                      old_cm_files))
+                if shard is not None:
+                    # the queries of the shard against all later domains
+                    shards = gr_shards(gr_queries, gr_targets, shard[1])
+                    gr_queries, gr_targets = ([], [])
+                    if shard[0] <= len(shards):
+                        gr_queries, gr_targets = shards[shard[0] - 1]
+                shards = gr_shards(gr_queries, gr_targets, THREADS)
+                simfilenames = []
+                jobs = []
+                for k, (queries, targets) in enumerate(shards):
+                    shardname = 'gralign shard %d/%d' % (k + 1, len(shards))
+                    outname = 'results.shard%03d' % k
+                    sims = ['%s%s%s.txt.sim' % (grdir, os.path.sep, outname)]
+                    if len(targets) > 0:
+                        sims.append('%s%s%s.cross.txt.sim' % (
+                            grdir, os.path.sep, outname))
+                    simfilenames += sims
+                    # shards completed by an interrupted run are not repeated
+                    if DONE in recorded.get(shardname, ()) and \
+                            all(map(os.path.exists, sims)):
+                        print('%s already processed' % shardname)
+                        continue
+                    print('%s: %d queries against %d domains' % (
+                        shardname, len(queries), len(queries) + len(targets)))
+                    jobs.append((shardname, (gr, grdir, outname, queries,
+                                             targets)))
+                shards_left = [len(jobs)]
+
+                def gr_merge():
+                    """ Merge the output of all GR-align shards
+
+                    :rtype: None
+                    """
+                    count = gr_merge_shards(
+                        '%s%sresults.txt.sim' % (grdir, os.path.sep),
+                        simfilenames, gr_queries + gr_targets, keep)
+                    print('\tmerged %d gralign results' % count)
+                    list(map(os.remove, filter(os.path.exists, simfilenames)))
+                    journal.record_done('gralign')
+
+                def shard_finisher(shardname):
+                    """ Make the function completing a shard of the GR-align
+                    run
+
+                    :param shardname: (string) Name of the shard
+                    :rtype: (function) Called once the shard is done
+                    """
+                    def finish():
+                        journal.record_done(shardname)
+                        shards_left[0] -= 1
+                        print('gralign: %d of %d shards done' % (
+                            len(shards) - shards_left[0], len(shards)))
+                        if shards_left[0] == 0:
+                            gr_merge()
+                    return finish
+
+                if len(jobs) == 0:
+                    gr_merge()
+                for shardname, args in jobs:
+                    scheduler.add_job(shardname, gr_process_shard, args,
+                                      shard_finisher(shardname))
+            for methodname, outfilename, procmethod, pscmethod, pairs, \
+                    extn in [
+                    ('usm', 'usm_results.txt', None, usm, method_pairs['usm'],
+                     '.gw'),
+                    ('fast', 'fast_results_1.txt', fast_process_pair, fast,
+                     method_pairs['fast'], PDBEXTN),
+                    ('tmalign', 'tm_results_1.txt', tm_process_pair, tm,
+                     method_pairs['tmalign'], PDBEXTN),
+                    ('ce', 'ce_results_1.txt', ce_process_pair, ce,
+                     method_pairs['ce'], PDBEXTN)]:
+                # pairs recorded in the journal of an interrupted run are
+                # skipped
+                skip = recorded.get(methodname, set())
+                todo = [x for x in pairs if pair_names(x, extn) not in skip]
+                if resume:
+                    print('%s: %d of %d pairs found in journal' %
+                          (methodname, len(pairs) - len(todo), len(pairs)))
+                # pairs found in the result cache are not sent to the pool
+                if cache is not None:
+                    pending = []
+                    for x in todo:
+                        res = pscmethod.from_cache(*x)
+                        if res is None:
+                            pending.append(x)
+                        else:
+                            journal.record(methodname, format_result(res))
+                    print('%s: %d of %d pairs found in cache' %
+                          (methodname, len(todo) - len(pending), len(todo)))
+                    todo = pending
+                finish = finisher(methodname, '%s%s%s' % (
+                    WORKDIR, os.path.sep, outfilename))
+                if methodname == 'usm':
+                    # USM runs on a thread of this process, next to the pool
+                    scheduler.add_thread(methodname, usm.process_pairs, todo,
+                                         collector(methodname), finish, 1)
+                    continue
+                scheduler.add_pairs(methodname, procmethod, pscmethod, todo,
+                                    collector(methodname), finish, failed)
+
             try:
-                reduced = p.map_async(
-                    procmethod, map(
-                        lambda x: (
-                            pscmethod, x, None), pairs), callback=results.append)
+                scheduler.run()
             except ValueError as error:
                 print(error)
                 sys.exit(-1)
-
-            prev = -1
-            while not reduced.ready():
-                remaining = reduced._number_left * reduced._chunksize
-                rpct = max([mlen - remaining, 0]) * 100. / mlen
-                if prev != rpct:
-                    prev = rpct
-                    print('\t' + str(round(rpct, 0)) + '%')
-                sleep(5)
-            print('\t100%')
-
-            out = open(outfilename, 'w')
-            for res in results[0]:
-                out.write(
-                    '%s\n' %
-                    ' '.join(
-                        res[0]).replace(
-                        '\\n',
-                        '').replace(
-                        "'",
-                        ''))
-            out.close()
-            return timer() - start
-
-        # Run multi-threaded jobs for pairwise PSC processing of the
-        # PSC methods
-        usm_seconds = doMulti(
-            '%s%susm_results.txt' %
-            (WORKDIR,
-             os.path.sep),
-            usm_process_pair,
-            cm_pairs,
-            THREADS,
-            usm,
-            'usm')
-        print('usm processed in %d seconds' % usm_seconds)
-        fast_seconds = doMulti(
-            '%s%sfast_results_1.txt' %
-            (WORKDIR,
-             os.path.sep),
-            fast_process_pair,
-            psc_pairs,
-            THREADS,
-            fast,
-            'fast')
-        print('fast processed in %d seconds' % fast_seconds)
-        tm_seconds = doMulti(
-            '%s%stm_results_1.txt' %
-            (WORKDIR,
-             os.path.sep),
-            tm_process_pair,
-            psc_pairs,
-            THREADS,
-            tm,
-            'tmalign')
-        print('tmalign processed in %d seconds' % tm_seconds)
-        try:
-            pom_path = os.path.join(
-                os.path.dirname(
-                    os.path.realpath(__file__)),
-                'ext',
-                'x86_64',
-                'linux',
-                'pom')
-            shutil.copytree(pom_path, 'pom')
-        except:
-            print('pom exists?')
-
-        ce_seconds = doMulti(
-            '%s%sce_results_1.txt' %
-            (WORKDIR,
-             os.path.sep),
-            ce_process_pair,
-            psc_pairs,
-            THREADS,
-            ce,
-            'ce')
-        shutil.rmtree('pom')
-        print('ce processed in %d seconds' % ce_seconds)
+            finally:
+                journal.close()
+        finally:
+            # the copy of pom and the staged files are removed also when
+            # the setup of the run fails
+            workspace.remove()
+
+        if cache is not None:
+            print('result cache: %(hits)d hits, %(misses)d misses, '
+                  '%(entries)d entries, %(bytes)d bytes' % cache.stats())
+
+        # failed pairs are kept apart from the results, so that they can be
+        # told apart from pairs that were never processed
+        failfilename = '%s%s%s' % (WORKDIR, os.path.sep, FAILURES)
+        newfilename = failfilename
+        if incremental:
+            newfilename = '%s.new' % failfilename
+        out = open(newfilename, 'w')
+        count = 0
+        seen = set()
+        for line in journal.failures():
+            # preprocessing failures are recorded again by a resumed run
+            if line in seen:
+                continue
+            seen.add(line)
+            out.write('%s\n' % line)
+            count += 1
+        out.close()
+        if incremental:
+            merge_result_file(failfilename, [newfilename], keep, sep='\t')
+            os.remove(newfilename)
+        if count > 0:
+            print('%d pairs failed, see %s' % (count, failfilename))
+
+        # record the processed domains for later incremental runs, the
+        # journal is no longer needed once all output files are written
+        write_manifest(WORKDIR, DATADIR, pdb_files)
+        journal.remove()
 
         return True
 
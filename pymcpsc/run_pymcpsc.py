@@ -13,13 +13,25 @@ Classes:
 
 Functions:
     - *process* - main processing sequence of the program
+    - *run_stages* - pipeline stages of a run
+    - *worker* - worker node of a distributed run
     - *main* - entrypoint to pymcpsc for deployment 
     
 Directly calling this script is one way in which pyMCPSC can be executed. Usage
 details are as follows:
     
 run-pymcpsc [-h] [-e PDBEXTN] [-d DATADIR] [-g GTIN] [-t THREADS]
-                   [-w WEIGHTS] [-p PROGDIR]
+                   [-w WEIGHTS] [-p PROGDIR] [-c CACHEDIR]
+                   [--cachesize CACHESIZE] [--incremental] [--resume]
+                   [--compressjournal] [--fsyncinterval FSYNCINTERVAL]
+                   [--timeout TIMEOUT] [--cpulimit CPULIMIT]
+                   [--scratchdir SCRATCHDIR] [--prefilter PREFILTER]
+                   [--topk TOPK] [--coordinator COORDINATOR]
+                   [--authkey AUTHKEY] [--localworkers LOCALWORKERS]
+                   [--shard i/n] [--executor {pool,async}]
+                   [--concurrency CONCURRENCY] [--profile [PROFILE]]
+                   [--csv] [--scaling {minmax,none,sigmoid,variance}]
+                   [--calibration CALIBRATION]
 
 Run pyMCPSC.
 
@@ -30,7 +42,8 @@ optional arguments:
   -d DATADIR, --datadir DATADIR
                         Directory containing the PDB files (default: proteus
                         dataset)
-  -g GTIN, --gtin GTIN  Ground truth file (default: proteus dataset)
+  -g GTIN, --gtin GTIN  Ground truth file, the classification of each domain
+                        or the pairwise file (default: proteus dataset)
   -t THREADS, --threads THREADS
                         Number of threads to use (default: 6)
   -w WEIGHTS, --weights WEIGHTS
@@ -39,6 +52,88 @@ optional arguments:
   -p PROGDIR, --progdir PROGDIR
                         Directory containing the PSC binaries (default: pre
                         packed)
+  -c CACHEDIR, --cachedir CACHEDIR
+                        Directory of the pairwise PSC result cache, empty to
+                        disable caching (default: pymcpsc_cache)
+  --cachesize CACHESIZE
+                        Maximum size of the result cache in MB (default: 4096)
+  --incremental         Only process pairs involving domains that are new or
+                        changed since the previous run and merge them into
+                        its results
+  --resume              Resume an interrupted run, skipping the pairs already
+                        recorded in its journal
+  --compressjournal     gzip compress the journal of pairwise results
+  --fsyncinterval FSYNCINTERVAL
+                        Seconds between syncs of the journal to disk
+                        (default: 10)
+  --timeout TIMEOUT     Wall-clock limit in seconds for a pair of domains,
+                        either for all of ce, tmalign and fast or per method
+                        as e.g. ce=600,tmalign=120 (default: no limit)
+  --cpulimit CPULIMIT   CPU limit in seconds for a pair of domains, given as
+                        for --timeout (default: no limit)
+  --scratchdir SCRATCHDIR
+                        Directory for the run workspace holding staged input
+                        files and scratch files of the PSC binaries (default:
+                        /dev/shm if available)
+  --prefilter PREFILTER
+                        Skip the ce, tmalign and fast runs of pairs of domains
+                        whose descriptor similarity (the smallest of their
+                        size, shape, contact order and secondary structure
+                        similarities, 0 to 1) is below the threshold and give
+                        them the lowest score. The filter is lossy, it is not
+                        a bound on the PSC scores and can prune pairs of the
+                        same fold; with a ground truth the pairs of the same
+                        fold it prunes are reported. On the proteus dataset
+                        0.3 prunes none of them (default: no prefilter)
+  --topk TOPK           Sparse mode for large datasets, keep only the TOPK
+                        most similar neighbors of each domain per method and
+                        for the consensus instead of the dense all-to-all
+                        score tables (default: dense mode)
+  --coordinator COORDINATOR
+                        Serve the ce, tmalign and fast pairs to worker nodes
+                        connecting on host:port, see run-pymcpsc worker
+                        (default: this node only)
+  --authkey AUTHKEY     Key shared with the worker nodes (default:
+                        $PYMCPSC_AUTHKEY or a generated key, written to the
+                        authkey file of the work directory)
+  --localworkers LOCALWORKERS
+                        Number of worker processes started on the coordinator
+                        node (default: 0)
+  --shard i/n           Process only shard i of n of the pairs, balanced by
+                        expected cost, e.g. for cluster array jobs; merge the
+                        shards with run-pymcpsc merge (default: all pairs)
+  --executor {pool,async}
+                        Execute the ce, tmalign and fast binaries on a pool of
+                        worker processes or as subprocesses driven by asyncio
+                        from one process (default: pool)
+  --concurrency CONCURRENCY
+                        Number of binaries executed at a time by the async
+                        executor, may exceed the number of cores (default:
+                        THREADS)
+  --profile [PROFILE]   Profile every stage with cProfile and tracemalloc and
+                        write the profiles, allocation reports and a summary
+                        to PROFILE (default: no profiling, profile if given
+                        without a directory)
+  --csv                 Also write the processed, imputed and consensus scores
+                        as CSV files to the output directory, besides the
+                        score matrices (default: score matrices only)
+  --scaling {minmax,none,sigmoid,variance}
+                        Scaling of the raw scores of the PSC methods to
+                        similarities (default: the scaling of the calibration,
+                        else sigmoid)
+  --calibration CALIBRATION
+                        Scale the raw scores with the frozen statistics of the
+                        scaling.json calibration file written by a previous
+                        run, e.g. for an incremental run or a merge of shards
+                        (default: statistics of the scores of this run)
+
+The shards of a sharded run are checked, merged and post processed with
+run-pymcpsc merge, which takes the same arguments as run-pymcpsc.
+
+Worker nodes of a distributed run are started with:
+
+run-pymcpsc worker [-h] --connect HOST:PORT [--authkey AUTHKEY]
+                   [-t THREADS] [-p PROGDIR] [--scratchdir SCRATCHDIR]
 """
 import os
 import sys
@@ -55,6 +150,11 @@ from pymcpsc.mixedroc import make as mixedroc
 from pymcpsc.visualize2 import make as mdsclust
 from pymcpsc.heatmaps import make as heatmap
 from pymcpsc.phylo import make as phylotree
+from pymcpsc.sparse import make as topk
+from pymcpsc.distributed import parse_address, start_workers
+from pymcpsc.shards import parse_shard, merge_shards
+from pymcpsc.profiling import PSC_PROFILER
+from pymcpsc.scaling import SCALERS, DEFAULT_SCALER
 
 # default values for program arguments
 _base_dir = os.path.dirname(pymcpsc.__file__)
@@ -64,6 +164,9 @@ __def_WEIGHTS__ = "2.55,1.79,4.23,14.36,-0.38"
 __def_DATADIR__ = os.path.join(_base_dir, 'testdata', 'proteus')
 __def_PROGDIR__ = os.path.join(_base_dir, 'ext', 'x86_64', 'linux')
 __def_GTIN__ = os.path.join(_base_dir, 'testdata', 'ground_truth_proteus')
+__def_CACHEDIR__ = 'pymcpsc_cache'
+__def_CACHESIZE__ = 4096
+__def_FSYNCINTERVAL__ = 10
 
 
 class CONF:
@@ -71,6 +174,27 @@ class CONF:
     def __init__(self):
         self.WORKDIR = 'work'
         self.OUTDIR = 'outdir'
+        self.CACHEDIR = __def_CACHEDIR__
+        self.CACHESIZE = __def_CACHESIZE__
+        self.INCREMENTAL = False
+        self.RESUME = False
+        self.COMPRESSJOURNAL = False
+        self.FSYNCINTERVAL = __def_FSYNCINTERVAL__
+        self.TIMEOUT = None
+        self.CPULIMIT = None
+        self.SCRATCHDIR = None
+        self.PREFILTER = None
+        self.TOPK = None
+        self.COORDINATOR = None
+        self.AUTHKEY = None
+        self.LOCALWORKERS = 0
+        self.SHARD = None
+        self.EXECUTOR = 'pool'
+        self.CONCURRENCY = None
+        self.PROFILE = None
+        self.CSV = False
+        self.SCALING = None
+        self.CALIBRATION = None
 
     def set_data_dir(self, datadir):
         """ Set datadir value
@@ -82,7 +206,7 @@ class CONF:
     def set_gtin(self, gtin):
         """ Set ground truth file path
 
-        :param gtin: (string) Path to ground truth file
+        :param gtin: (string) Path to ground truth file, of either format of pymcpsc.groundtruth
         """
         self.GTIN = gtin
 
@@ -114,6 +238,123 @@ class CONF:
         """
         self.PROGDIR = progdir
 
+    def set_cache_dir(self, cachedir):
+        """ Set path to the pairwise PSC result cache
+
+        :param cachedir: (string) Path to cache directory, None to disable caching
+        """
+        self.CACHEDIR = cachedir
+
+    def set_cache_size(self, cachesize):
+        """ Set maximum size of the pairwise PSC result cache
+
+        :param cachesize: (int) Maximum cache size in MB
+        """
+        self.CACHESIZE = cachesize
+
+    def set_incremental(self, incremental):
+        """ Set incremental processing of new domains
+
+        :param incremental: (boolean) Only process pairs involving new domains
+        """
+        self.INCREMENTAL = incremental
+
+    def set_resume(self, resume):
+        """ Set resuming of an interrupted run from its journal
+
+        :param resume: (boolean) Skip pairs recorded in the journal
+        """
+        self.RESUME = resume
+
+    def set_journal(self, compress, fsyncinterval):
+        """ Set journal settings
+
+        :param compress: (boolean) gzip compress the journal
+        :param fsyncinterval: (float) Seconds between syncs of the journal to disk
+        """
+        self.COMPRESSJOURNAL = compress
+        self.FSYNCINTERVAL = fsyncinterval
+
+    def set_limits(self, timeout, cpulimit):
+        """ Set limits on the execution of the PSC binaries for a pair
+
+        :param timeout: (string) Wall-clock limits in seconds, total or per method (e.g. ce=600,fast=60)
+        :param cpulimit: (string) CPU limits in seconds, total or per method
+        """
+        self.TIMEOUT = timeout
+        self.CPULIMIT = cpulimit
+
+    def set_scratch_dir(self, scratchdir):
+        """ Set directory the run workspace is created in
+
+        :param scratchdir: (string) Path to scratch directory, None for /dev/shm if available
+        """
+        self.SCRATCHDIR = scratchdir
+
+    def set_prefilter(self, prefilter):
+        """ Set the similarity threshold of the geometric prefilter
+
+        :param prefilter: (float) Descriptor similarity below which pairs are pruned, None to disable the prefilter
+        """
+        self.PREFILTER = prefilter
+
+    def set_topk(self, topk):
+        """ Set the number of neighbors kept per domain in sparse mode
+
+        :param topk: (int) Number of neighbors, None for dense mode
+        """
+        self.TOPK = topk
+
+    def set_coordinator(self, coordinator, authkey, localworkers):
+        """ Set the address the pairwise jobs are served to worker nodes on
+
+        :param coordinator: (string) host:port to listen on, None to run the pairwise jobs on this node only
+        :param authkey: (string) Key shared with the workers, None to generate one
+        :param localworkers: (int) Number of worker processes started on this node
+        """
+        self.COORDINATOR = coordinator
+        self.AUTHKEY = authkey
+        self.LOCALWORKERS = localworkers
+
+    def set_shard(self, shard):
+        """ Set the shard of the pairs processed by this run
+
+        :param shard: (string) Shard number and number of shards as i/n, None to process all pairs
+        """
+        self.SHARD = shard
+
+    def set_executor(self, executor, concurrency):
+        """ Set how the pairwise PSC binaries are executed
+
+        :param executor: (string) pool for a pool of worker processes, async for subprocesses of one process driven by asyncio
+        :param concurrency: (int) Number of binaries executed at a time by the async executor, None for the number of threads
+        """
+        self.EXECUTOR = executor
+        self.CONCURRENCY = concurrency
+
+    def set_profile(self, profile):
+        """ Set the directory the per stage profiles are written to
+
+        :param profile: (string) Profile directory, None to run without profiling
+        """
+        self.PROFILE = profile
+
+    def set_csv(self, csv):
+        """ Set writing the scores of the post processing stages as CSV files
+
+        :param csv: (boolean) Write the CSV files besides the score matrices
+        """
+        self.CSV = csv
+
+    def set_scaling(self, scaling, calibration):
+        """ Set the scaling of the raw scores of the PSC methods
+
+        :param scaling: (string) Name of the scaler in pymcpsc.scaling.SCALERS, None for the scaler of the calibration or the default
+        :param calibration: (string) Path to the calibration file of a previous run, None to calibrate on the scores of the run
+        """
+        self.SCALING = scaling
+        self.CALIBRATION = calibration
+
     def __repr__(self):
         """ Return class members as string
 
@@ -122,13 +363,22 @@ class CONF:
         return str(self.__dict__)
 
 
-def process():
+def process(argv=None, merge=False):
     """ The main method of the utility.
+
+    :param argv: (list) Program arguments, None for the command line
+    :param merge: (boolean) Merge the results of the shards of a sharded run instead of running the pairwise PSC jobs
     """
 
     # program arguments
     print('initializing parser')
-    parser = argparse.ArgumentParser(description='Run pyMCPSC.')
+    if merge:
+        parser = argparse.ArgumentParser(
+            prog='run-pymcpsc merge',
+            description='Merge the shards of a sharded pyMCPSC run and post '
+                        'process the results.')
+    else:
+        parser = argparse.ArgumentParser(description='Run pyMCPSC.')
     help_text = 'Extension of the PDB files (default: %s)' % __def_PDBEXTN__
     parser.add_argument(
         '-e',
@@ -141,7 +391,7 @@ def process():
         '--datadir',
      default=__def_DATADIR__,
      help=help_text)
-    help_text = 'Ground truth file (default: proteus dataset)'
+    help_text = 'Ground truth file, the classification of each domain or the pairwise file (default: proteus dataset)'
     parser.add_argument('-g', '--gtin', default='', help=help_text)
     help_text = 'Number of threads to use (default: %d)' % __def_THREADS__
     parser.add_argument(
@@ -162,8 +412,136 @@ def process():
         '--progdir',
      default=__def_PROGDIR__,
      help=help_text)
+    help_text = 'Directory of the pairwise PSC result cache, empty to disable caching (default: %s)' % __def_CACHEDIR__
+    parser.add_argument(
+        '-c',
+        '--cachedir',
+     default=__def_CACHEDIR__,
+     help=help_text)
+    help_text = 'Maximum size of the result cache in MB (default: %d)' % __def_CACHESIZE__
+    parser.add_argument(
+        '--cachesize',
+     default=__def_CACHESIZE__,
+     type=int,
+     help=help_text)
+    help_text = 'Only process pairs involving domains that are new or changed since the previous run and merge them into its results'
+    parser.add_argument(
+        '--incremental',
+     action='store_true',
+     help=help_text)
+    help_text = 'Resume an interrupted run, skipping the pairs already recorded in its journal'
+    parser.add_argument(
+        '--resume',
+     action='store_true',
+     help=help_text)
+    help_text = 'gzip compress the journal of pairwise results'
+    parser.add_argument(
+        '--compressjournal',
+     action='store_true',
+     help=help_text)
+    help_text = 'Seconds between syncs of the journal to disk (default: %d)' % __def_FSYNCINTERVAL__
+    parser.add_argument(
+        '--fsyncinterval',
+     default=__def_FSYNCINTERVAL__,
+     type=float,
+     help=help_text)
+    help_text = 'Wall-clock limit in seconds for a pair of domains, either for all of ce, tmalign and fast or per method as e.g. ce=600,tmalign=120 (default: no limit)'
+    parser.add_argument(
+        '--timeout',
+     default=None,
+     help=help_text)
+    help_text = 'CPU limit in seconds for a pair of domains, given as for --timeout (default: no limit)'
+    parser.add_argument(
+        '--cpulimit',
+     default=None,
+     help=help_text)
+    help_text = 'Directory for the run workspace holding staged input files and scratch files of the PSC binaries (default: /dev/shm if available)'
+    parser.add_argument(
+        '--scratchdir',
+     default=None,
+     help=help_text)
+
+    help_text = 'Skip the ce, tmalign and fast runs of pairs of domains whose descriptor similarity (the smallest of their size, shape, contact order and secondary structure similarities, 0 to 1) is below the threshold and give them the lowest score. The filter is lossy, it is not a bound on the PSC scores and can prune pairs of the same fold; with a ground truth the pairs of the same fold it prunes are reported. On the proteus dataset 0.3 prunes none of them (default: no prefilter)'
+    parser.add_argument(
+        '--prefilter',
+     default=None,
+     type=float,
+     help=help_text)
+    help_text = 'Sparse mode for large datasets, keep only the TOPK most similar neighbors of each domain per method and for the consensus instead of the dense all-to-all score tables (default: dense mode)'
+    parser.add_argument(
+        '--topk',
+     default=None,
+     type=int,
+     help=help_text)
+    help_text = 'Serve the ce, tmalign and fast pairs to worker nodes connecting on host:port, see run-pymcpsc worker (default: this node only)'
+    parser.add_argument(
+        '--coordinator',
+     default=None,
+     help=help_text)
+    help_text = 'Key shared with the worker nodes (default: $PYMCPSC_AUTHKEY or a generated key, written to the authkey file of the work directory)'
+    parser.add_argument(
+        '--authkey',
+     default=os.environ.get('PYMCPSC_AUTHKEY'),
+     help=help_text)
+    help_text = 'Number of worker processes started on the coordinator node (default: 0)'
+    parser.add_argument(
+        '--localworkers',
+     default=0,
+     type=int,
+     help=help_text)
+
+    help_text = 'Process only shard i of n of the pairs, balanced by expected cost, e.g. for cluster array jobs; merge the shards with run-pymcpsc merge (default: all pairs)'
+    parser.add_argument(
+        '--shard',
+     default=None,
+     metavar='i/n',
+     help=help_text)
+
+    help_text = 'Execute the ce, tmalign and fast binaries on a pool of worker processes or as subprocesses driven by asyncio from one process (default: pool)'
+    parser.add_argument(
+        '--executor',
+     default='pool',
+     choices=['pool', 'async'],
+     help=help_text)
+    help_text = 'Number of binaries executed at a time by the async executor, may exceed the number of cores (default: THREADS)'
+    parser.add_argument(
+        '--concurrency',
+     default=None,
+     type=int,
+     help=help_text)
+
+    help_text = 'Profile every stage with cProfile and tracemalloc and write the profiles, allocation reports and a summary to PROFILE (default: no profiling, profile if given without a directory)'
+    parser.add_argument(
+        '--profile',
+     nargs='?',
+     const='profile',
+     default=None,
+     help=help_text)
+
+    help_text = 'Also write the processed, imputed and consensus scores as CSV files to the output directory, besides the score matrices (default: score matrices only)'
+    parser.add_argument(
+        '--csv',
+     action='store_true',
+     help=help_text)
+
+    help_text = 'Scaling of the raw scores of the PSC methods to similarities (default: the scaling of the calibration, else %s)' % DEFAULT_SCALER
+    parser.add_argument(
+        '--scaling',
+     default=None,
+     choices=sorted(SCALERS),
+     help=help_text)
+    help_text = 'Scale the raw scores with the frozen statistics of the scaling.json calibration file written by a previous run, e.g. for an incremental run or a merge of shards (default: statistics of the scores of this run)'
+    parser.add_argument(
+        '--calibration',
+     default=None,
+     help=help_text)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.shard is not None:
+        try:
+            parse_shard(args.shard)
+        except ValueError as error:
+            parser.error(str(error))
 
     conf = CONF()
     conf.set_pdb_extn(args.pdbextn)
@@ -181,30 +559,81 @@ def process():
     conf.set_threads(args.threads)
     conf.set_weights(args.weights)
     conf.set_prog_dir(args.progdir)
+    conf.set_cache_dir(args.cachedir if len(args.cachedir) > 0 else None)
+    conf.set_cache_size(args.cachesize)
+    conf.set_incremental(args.incremental)
+    conf.set_resume(args.resume)
+    conf.set_journal(args.compressjournal, args.fsyncinterval)
+    conf.set_limits(args.timeout, args.cpulimit)
+    conf.set_scratch_dir(args.scratchdir)
+    conf.set_prefilter(args.prefilter)
+    conf.set_topk(args.topk)
+    conf.set_coordinator(args.coordinator, args.authkey, args.localworkers)
+    conf.set_shard(args.shard)
+    conf.set_executor(args.executor, args.concurrency)
+    conf.set_profile(args.profile)
+    conf.set_csv(args.csv)
+    conf.set_scaling(args.scaling, args.calibration)
 
     # End of configuration
     print(conf)
 
+    profiler = PSC_PROFILER(conf.PROFILE)
+    try:
+        run_stages(conf, merge, profiler)
+    finally:
+        profiler.summary()
+
+
+def run_stages(conf, merge, profiler):
+    """ Run the pipeline stages, each through the profiler
+
+    :param conf: (CONF) Configuration of the run
+    :param merge: (boolean) Merge the results of the shards of a sharded run instead of running the pairwise PSC jobs
+    :param profiler: (PSC_PROFILER) Profiler running the stages
+    """
     psc_methods = ['ce', 'fast', 'gralign', 'tmalign', 'usm']
     psc_method_names = ['ce', 'fast', 'gralign', 'tmalign', 'usm']
 
-    print("Running pairwise PSC jobs")
-    if not RunPairwisePSC().run(conf):
+    if merge:
+        print("Merging shards")
+        if not profiler.run('merge', merge_shards, conf.WORKDIR):
+            return
+    else:
+        print("Running pairwise PSC jobs")
+        if not profiler.run('pairwise', RunPairwisePSC().run, conf):
+            return
+
+    if conf.SHARD is not None:
+        print("Shard %s done, post process all shards with run-pymcpsc "
+              "merge" % conf.SHARD)
+        return
+
+    if conf.TOPK is not None:
+        print("Running sparse top-%d post processing" % conf.TOPK)
+        profiler.run('topk', topk, conf.WORKDIR, conf.OUTDIR, conf.TOPK,
+                     conf.GTIN, None if conf.WEIGHTS is None else list(map(
+                         float, conf.WEIGHTS.split(','))),
+                     psc_cols=psc_methods, scaler=conf.SCALING,
+                     calibration=conf.CALIBRATION)
+        print("Done")
         return
 
     print("Running post processing")
-    PostProcessor().run(conf)
+    profiler.run('postprocessing', PostProcessor().run, conf)
     print("Imputing")
-    impute(conf.OUTDIR)
+    profiler.run('impute', impute, conf.OUTDIR, conf.CSV)
     print("Making MCPSC consensus scores")
     if conf.WEIGHTS is None:
-        mcpsc(conf.OUTDIR, psc_cols=psc_methods)
+        profiler.run('mcpsc', mcpsc, conf.OUTDIR, psc_cols=psc_methods,
+                     csv=conf.CSV)
     else:
-        mcpsc(
+        profiler.run(
+            'mcpsc', mcpsc,
             conf.OUTDIR,
             map(float,
                 conf.WEIGHTS.split(',')),
-            psc_cols=psc_methods)
+            psc_cols=psc_methods, csv=conf.CSV)
 
     if conf.GTIN is None:
         print(
@@ -212,25 +641,70 @@ def process():
         return
 
     print("Nearest-neighbor classification")
-    nnclassify(conf.OUTDIR, conf.WEIGHTS is not None, psc_cols=psc_methods)
+    profiler.run('nnclassify', nnclassify, conf.OUTDIR,
+                 conf.WEIGHTS is not None, psc_cols=psc_methods)
     print("Making ROC curves")
-    rocauc(conf.OUTDIR, conf.WEIGHTS is not None, psc_cols=psc_methods)
-    mixedroc(conf.OUTDIR, conf.WEIGHTS is not None)
+    profiler.run('rocauc', rocauc, conf.OUTDIR, conf.WEIGHTS is not None,
+                 psc_cols=psc_methods)
+    profiler.run('mixedroc', mixedroc, conf.OUTDIR, conf.WEIGHTS is not None)
     print("Running MDS and clustering")
-    mdsclust(conf.OUTDIR, conf.THREADS, psc_cols=psc_methods)
+    profiler.run('visualize2', mdsclust, conf.OUTDIR, conf.THREADS,
+                 psc_cols=psc_methods)
     print("Making Heatmaps")
-    heatmap(conf.OUTDIR, psc_cols=psc_methods)
+    profiler.run('heatmaps', heatmap, conf.OUTDIR, psc_cols=psc_methods)
     print("Making Phylogenetic Trees")
-    phylotree(conf.OUTDIR, conf.WORKDIR, psc_cols=psc_methods, psc_names=psc_method_names)
+    profiler.run('phylo', phylotree, conf.OUTDIR, conf.WORKDIR,
+                 psc_cols=psc_methods, psc_names=psc_method_names)
     print("Done")
 
 
+def worker(argv):
+    """ Worker node of a distributed run, processing the pairs served by a
+    coordinator
+
+    :param argv: (list) Program arguments following the worker command
+    """
+    parser = argparse.ArgumentParser(
+        prog='run-pymcpsc worker',
+        description='Process pyMCPSC pairs served by a coordinator.')
+    help_text = 'Address of the coordinator'
+    parser.add_argument('--connect', required=True, metavar='HOST:PORT',
+                        help=help_text)
+    help_text = 'Key shared with the coordinator (default: $PYMCPSC_AUTHKEY)'
+    parser.add_argument('--authkey', default=os.environ.get('PYMCPSC_AUTHKEY'),
+                        help=help_text)
+    help_text = 'Number of worker processes (default: %d)' % __def_THREADS__
+    parser.add_argument('-t', '--threads', default=__def_THREADS__, type=int,
+                        help=help_text)
+    help_text = 'Directory containing the PSC binaries (default: pre packed)'
+    parser.add_argument('-p', '--progdir', default=__def_PROGDIR__,
+                        help=help_text)
+    help_text = 'Directory for the worker workspaces (default: /dev/shm if available)'
+    parser.add_argument('--scratchdir', default=None, help=help_text)
+    args = parser.parse_args(argv)
+    if args.authkey is None:
+        parser.error('the key printed by the coordinator is required')
+
+    address = parse_address(args.connect)
+    print('connecting %d workers to %s:%d' % ((args.threads,) + address))
+    workers = start_workers(address, args.authkey.encode('utf-8'),
+                            args.threads, args.progdir, args.scratchdir)
+    for p in workers:
+        p.join()
+
+
 def main():
     """ Main entry point of the utility created to complement the setup.py
     based auto executable creation
     """
     try:
-        process()
+        if sys.argv[1:2] == ['worker']:
+            worker(sys.argv[2:])
+            return
+        if sys.argv[1:2] == ['merge']:
+            process(sys.argv[2:], merge=True)
+        else:
+            process()
         print('pymcpsc completed')
     except (KeyboardInterrupt, SystemExit):
         sys.exit(-1)
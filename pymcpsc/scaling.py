@@ -0,0 +1,239 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Scaling of the raw scores of the PSC methods to similarities.
+
+Classes:
+    - *PSC_SCALE_STATS*: statistics of the raw scores of a PSC method, accumulated in one pass
+
+Functions:
+    - *min_max_scale*: MinMax scaling
+    - *variance_scale*: variance scaling
+    - *logistic_sigmoid*: autoscaling and logistic sigmoid
+    - *no_scale*: raw scores turned to similarities
+    - *calibrate*: statistics of raw scores
+    - *scale*: scale raw scores with a scaler of the registry
+    - *write_calibration*: write the scaler and the statistics of the PSC methods
+    - *read_calibration*: read a calibration written by a previous run
+
+The raw scores of the PSC methods are dissimilarities, the scalers of the
+*SCALERS* registry turn them to similarities, higher similarity == higher
+value. A scaler is a function of the raw scores and the statistics of the
+raw scores of the method (count, mean, variance, minimum and maximum), and
+applies NumPy ufuncs to the whole array.
+
+The statistics are accumulated in one pass over the scores, chunk by chunk
+(Welford's algorithm, merging the mean and the sum of squared deviations of
+every chunk). A run writes them with its scaler as a calibration file. The
+scores of a later run, e.g. an incremental run or the merge of the shards of
+a sharded run, can be scaled with the frozen statistics of that calibration
+instead of the statistics of its own scores, so that the scaled scores of
+both runs are comparable.
+"""
+import json
+
+import numpy as np
+
+MIN_MAX_SCALE = 'minmax'
+VARIANCE_SCALE = 'variance'
+LOGISTIC_SIGMOID = 'sigmoid'
+NO_SCALE = 'none'
+DEFAULT_SCALER = LOGISTIC_SIGMOID
+# calibration file written to the output directory
+CALIBRATION = 'scaling.json'
+
+
+class PSC_SCALE_STATS:
+
+    def __init__(self, n=0, mean=0., m2=0., low=np.inf, high=-np.inf,
+                 frozen=False):
+        """ Set the statistics, empty by default
+
+        :param n: (int) Number of scores
+        :param mean: (float) Mean of the scores
+        :param m2: (float) Sum of the squared deviations from the mean
+        :param low: (float) Minimum of the scores
+        :param high: (float) Maximum of the scores
+        :param frozen: (boolean) Statistics of a calibration, not updated with new scores
+        :rtype: None
+        """
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+        self.low = low
+        self.high = high
+        self.frozen = frozen
+
+    def update(self, values):
+        """ Add a chunk of scores, NaN scores are skipped. Frozen statistics
+        are not changed.
+
+        :param values: (array) Raw scores
+        :rtype: (PSC_SCALE_STATS) self
+        """
+        if self.frozen:
+            return self
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        nb = len(values)
+        if nb == 0:
+            return self
+        mean = np.mean(values)
+        m2 = np.sum(np.square(values - mean))
+        if self.n == 0:
+            self.mean = mean
+            self.m2 = m2
+        else:
+            n = self.n + nb
+            delta = mean - self.mean
+            self.mean += delta * nb / n
+            self.m2 += m2 + delta * delta * self.n * nb / n
+        self.n += nb
+        self.low = min(self.low, float(np.min(values)))
+        self.high = max(self.high, float(np.max(values)))
+        return self
+
+    def var(self):
+        """ Variance of the scores
+
+        :rtype: float
+        """
+        return self.m2 / self.n if self.n > 0 else np.nan
+
+    def std(self):
+        """ Standard deviation of the scores
+
+        :rtype: float
+        """
+        return np.sqrt(self.var())
+
+    def to_dict(self):
+        """ Statistics as a dictionary, for the calibration file
+
+        :rtype: dict
+        """
+        return {'n': int(self.n), 'mean': float(self.mean),
+                'm2': float(self.m2), 'min': float(self.low),
+                'max': float(self.high)}
+
+    @staticmethod
+    def from_dict(data, frozen=True):
+        """ Statistics read from a dictionary
+
+        :param data: (dict) Statistics as written by *to_dict*
+        :param frozen: (boolean) Do not update the statistics with new scores
+        :rtype: (PSC_SCALE_STATS) Statistics
+        """
+        return PSC_SCALE_STATS(data['n'], data['mean'], data['m2'],
+                               data['min'], data['max'], frozen)
+
+
+def min_max_scale(values, stats):
+    """ MinMax scaling, 1 - (x - min) / (max - min)
+
+    :param values: (array) Raw scores
+    :param stats: (PSC_SCALE_STATS) Statistics of the raw scores
+    :rtype: (array) Similarities
+    """
+    out = np.array(values, dtype=float)
+    np.subtract(out, stats.low, out=out)
+    np.divide(out, stats.high - stats.low, out=out)
+    return np.subtract(1., out, out=out)
+
+
+def variance_scale(values, stats):
+    """ Variance scaling, exp(-x / var)
+
+    :param values: (array) Raw scores
+    :param stats: (PSC_SCALE_STATS) Statistics of the raw scores
+    :rtype: (array) Similarities
+    """
+    out = np.array(values, dtype=float)
+    np.multiply(out, -1., out=out)
+    np.divide(out, stats.var(), out=out)
+    return np.exp(out, out=out)
+
+
+def logistic_sigmoid(values, stats):
+    """ Autoscaling and logistic sigmoid, 1 - 1 / (1 + exp(-(x - mu) / sig))
+
+    :param values: (array) Raw scores
+    :param stats: (PSC_SCALE_STATS) Statistics of the raw scores
+    :rtype: (array) Similarities
+    """
+    out = np.array(values, dtype=float)
+    np.subtract(out, stats.mean, out=out)
+    np.negative(out, out=out)
+    np.divide(out, stats.std(), out=out)
+    np.exp(out, out=out)
+    np.add(out, 1., out=out)
+    np.reciprocal(out, out=out)
+    return np.subtract(1., out, out=out)
+
+
+def no_scale(values, stats):
+    """ Raw scores turned to similarities, max - x
+
+    :param values: (array) Raw scores
+    :param stats: (PSC_SCALE_STATS) Statistics of the raw scores
+    :rtype: (array) Similarities
+    """
+    return np.subtract(stats.high, values)
+
+
+SCALERS = {MIN_MAX_SCALE: min_max_scale, VARIANCE_SCALE: variance_scale,
+           LOGISTIC_SIGMOID: logistic_sigmoid, NO_SCALE: no_scale}
+
+
+def calibrate(values):
+    """ Statistics of raw scores
+
+    :param values: (array) Raw scores
+    :rtype: (PSC_SCALE_STATS) Statistics
+    """
+    return PSC_SCALE_STATS().update(values)
+
+
+def scale(values, scaler=DEFAULT_SCALER, stats=None):
+    """ Scale raw scores to similarities
+
+    :param values: (array) Raw scores
+    :param scaler: (string) Name of the scaler in SCALERS
+    :param stats: (PSC_SCALE_STATS) Statistics of the raw scores, None to calibrate on the given scores
+    :rtype: (array) Similarities
+    """
+    if scaler not in SCALERS:
+        raise ValueError('unknown scaler %s, expected one of %s' % (
+            scaler, ', '.join(sorted(SCALERS))))
+    values = np.asarray(values, dtype=float)
+    if stats is None:
+        stats = calibrate(values)
+    return SCALERS[scaler](values, stats)
+
+
+def write_calibration(fname, scaler, stats):
+    """ Write the scaler and the statistics of the PSC methods
+
+    :param fname: (string) Path to the calibration file
+    :param scaler: (string) Name of the scaler in SCALERS
+    :param stats: (dict) PSC method name to statistics of its raw scores
+    :rtype: None
+    """
+    out = open(fname, 'w')
+    json.dump({'scaler': scaler,
+               'methods': dict(map(lambda x: (x[0], x[1].to_dict()),
+                                   stats.items()))},
+              out, indent=1, sort_keys=True)
+    out.close()
+
+
+def read_calibration(fname):
+    """ Read a calibration written by a previous run, the statistics are
+    frozen
+
+    :param fname: (string) Path to the calibration file
+    :rtype: (tuple) Name of the scaler and a dict of PSC method name to statistics
+    """
+    data = json.load(open(fname))
+    return data['scaler'], dict(map(
+        lambda x: (x[0], PSC_SCALE_STATS.from_dict(x[1])),
+        data['methods'].items()))
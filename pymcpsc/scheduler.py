@@ -0,0 +1,508 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Scheduler executing the pairwise jobs of all PSC methods on one pool.
+
+Classes:
+    - *PSC_SCHEDULER*: cross-method scheduler for pairwise PSC jobs
+
+Functions:
+    - *count_residues*: number of residues in a PDB file
+    - *estimate_cost*: expected relative cost of processing a pair with a PSC method
+    - *init_worker*: pool worker initializer installing the PSC handlers
+    - *process_chunk*: pool worker entry point for a chunk of scheduled tasks
+    - *process_job*: pool worker entry point for a single long running job
+    - *process_thread*: thread entry point for the pairs of a method processed next to the pool
+    - *hold_slot*: pool worker entry point holding the worker while a thread runs
+
+All pairwise tasks of all PSC methods are fed to a single long-lived worker
+pool. Tasks are ordered longest-expected-first across methods (largest
+structure pairs of the slowest methods first) so that the cheap tasks fill
+the tail of the run and no cores idle between method phases. Long single
+jobs such as the GR-align shards are submitted ahead of the pairwise
+tasks and execute concurrently with them on one of the pool workers. The
+pairs of a method with its own thread pool, such as USM, are processed on a
+thread of the scheduling process next to the pool workers, their outputs
+are queued and passed on by the main loop like the outputs of the pool. The
+main loop polls the queue and the jobs at least every WAIT seconds, also
+while long chunks keep the pool busy. A thread holds as many pool workers as
+it keeps cores busy for as long as it runs, so that the threads and the pool
+do not ask for more cores than the pool has. A task
+whose PSC binary fails is not retried, its failure record is passed on in
+place of an output.
+
+The PSC handlers and pair lists are installed once in every worker by the
+pool initializer, tasks are then sent as chunks of integer pair indices
+instead of pickling a handler with every pair. Consecutive cheap tasks of a
+method are batched into one chunk up to a cost bound, so that the per task
+dispatch overhead does not dominate fast methods such as USM and FAST, while
+expensive tasks are still sent one by one to keep the load balanced.
+
+Progress is reported by a PSC_METRICS object, updated as the outputs
+arrive.
+"""
+import threading
+import multiprocessing
+from multiprocessing import Pool, Event
+from timeit import default_timer as timer
+
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+from pymcpsc.execute import PSC_FAILURE
+from pymcpsc.metrics import PSC_METRICS
+
+# relative cost per residue pair of the PSC methods, measured roughly on the
+# proteus dataset
+METHOD_COST = {
+    'ce': 1.0,
+    'tmalign': 0.8,
+    'fast': 0.5,
+    'usm': 0.05}
+# maximum number of tasks in a chunk and number of chunks per worker the
+# total cost is divided into when bounding the cost of a chunk
+MAX_CHUNK = 64
+CHUNKS_PER_WORKER = 32
+# seconds between polls of the threads and jobs while waiting for outputs
+WAIT = 1.0
+
+# per worker process PSC methods and events releasing the workers held for
+# the threads, installed by the pool initializer
+_methods = None
+_holds = None
+
+# per process memo of residue counts keyed by path
+_residues = {}
+
+
+def count_residues(fname):
+    """ Count the residues (CA atoms) in a PDB file. For other files, such
+    as contact maps, the number of lines is used as size measure.
+
+    :param fname: (string) Path to the file
+    :rtype: (int) Number of residues
+    """
+    n = _residues.get(fname)
+    if n is not None:
+        return n
+    n = 0
+    try:
+        if fname.endswith('.gw'):
+            n = sum(1 for _ in open(fname))
+        else:
+            for line in open(fname):
+                if line.startswith('ATOM') and line[12:16] == ' CA ':
+                    n += 1
+    except (OSError, IOError):
+        pass
+    _residues[fname] = max(n, 1)
+    return _residues[fname]
+
+
+def estimate_cost(methodname, pair):
+    """ Expected relative cost of processing a pair of domains with a PSC
+    method. The pairwise methods scale with the product of the domain sizes.
+
+    :param methodname: (string) PSC method name
+    :param pair: (tuple) Paths to the files of the two domains
+    :rtype: (float) Expected cost
+    """
+    return METHOD_COST.get(methodname, 1.0) * \
+        count_residues(pair[0]) * count_residues(pair[1])
+
+
+def init_worker(methods, holds=None):
+    """ Pool worker initializer installing the PSC handlers and pairs of
+    all methods in the worker process
+
+    :param methods: (list) PSC convinience method, PSC handler object and pairs of each method
+    :param holds: (list) Event set once each thread is done, None without threads
+    :rtype: None
+    """
+    global _methods, _holds
+    _methods = methods
+    _holds = holds
+
+
+def process_chunk(chunk):
+    """ Pool worker entry point for a chunk of scheduled tasks
+
+    :param chunk: (tuple) Method index and list of pair indices
+    :rtype: (tuple) Method index and list of pair index, program output or PSC_FAILURE, seconds spent
+    """
+    m, indices = chunk
+    procmethod, pscmethod, pairs = _methods[m]
+    out = []
+    for i in indices:
+        start = timer()
+        try:
+            res = procmethod((pscmethod, pairs[i], None))
+        except PSC_FAILURE as e:
+            res = e
+        out.append((i, res, timer() - start))
+    return m, out
+
+
+def process_job(job):
+    """ Pool worker entry point for a single long running job
+
+    :param job: (tuple) Function to call and its argument
+    :rtype: (float) Seconds spent
+    """
+    procmethod, args = job
+    start = timer()
+    procmethod(args)
+    return timer() - start
+
+
+def process_thread(t, procmethod, pairs, queue):
+    """ Thread entry point for the pairs of a method processed next to the
+    pool. Outputs are queued with the thread index, followed by None once all
+    pairs are done, or by the exception raised.
+
+    :param t: (int) Thread index
+    :param procmethod: Function called with the pairs, returning the output of each pair
+    :param pairs: (list) Pairs of domains to be processed
+    :param queue: (Queue) Queue the outputs are put in
+    :rtype: None
+    """
+    try:
+        for res in procmethod(pairs):
+            queue.put((t, res))
+        queue.put((t, None))
+    except BaseException as e:
+        queue.put((t, e))
+
+
+def hold_slot(t):
+    """ Pool worker entry point holding the worker until a thread of the
+    scheduling process is done, the thread uses the core of the worker
+
+    :param t: (int) Thread index
+    :rtype: None
+    """
+    _holds[t].wait()
+
+
+class PSC_SCHEDULER:
+
+    def __init__(self, threads, metrics=None):
+        """ Set the number of pool workers
+
+        :param threads: (int) Number of worker processes
+        :param metrics: (PSC_METRICS) Metrics updated as outputs arrive, None to print them only
+        :rtype: None
+        """
+        self._threads = threads
+        self._metrics = metrics if metrics is not None else PSC_METRICS()
+        self._methods = []
+        self._jobs = []
+        self._local = []
+
+    def add_pairs(self, methodname, procmethod, pscmethod, pairs, collect,
+                  finish, fail=None):
+        """ Add the pairwise tasks of a PSC method
+
+        :param methodname: (string) PSC method name
+        :param procmethod: PSC convinience method to call
+        :param pscmethod: (object) PSC handler object
+        :param pairs: (list) Pairs of domains to be processed
+        :param collect: (function) Called with the output of each pair as it completes
+        :param finish: (function) Called once all pairs of the method are done
+        :param fail: (function) Called with the PSC_FAILURE of each failed pair, None to raise it
+        :rtype: None
+        """
+        self._methods.append((methodname, procmethod, pscmethod, pairs,
+                              collect, finish, fail))
+
+    def add_job(self, methodname, procmethod, args, finish=None):
+        """ Add a single long running job, e.g. a shard of a GR-align run
+
+        :param methodname: (string) PSC method name
+        :param procmethod: Function to call in a pool worker
+        :param args: Argument to call the function with
+        :param finish: (function) Called once the job is done
+        :rtype: None
+        """
+        self._jobs.append((methodname, procmethod, args, finish))
+
+    def add_thread(self, methodname, procmethod, pairs, collect, finish,
+                   slots=1):
+        """ Add the pairs of a PSC method processed on a thread of this
+        process next to the pool, e.g. by the USM engine, which runs its own
+        threads
+
+        :param methodname: (string) PSC method name
+        :param procmethod: Function called with the pairs, returning the output of each pair
+        :param pairs: (list) Pairs of domains to be processed
+        :param collect: (function) Called with the output of each pair as it completes
+        :param finish: (function) Called once all pairs of the method are done
+        :param slots: (int) Number of cores kept busy by the function, pool workers held while it runs
+        :rtype: None
+        """
+        self._local.append((methodname, procmethod, pairs, collect, finish,
+                            slots))
+
+    def _tasks(self):
+        """ Order the pairwise tasks of all methods longest-expected-first
+
+        :rtype: (list) Tuples of method index and pair index
+        """
+        return list(map(lambda x: (x[1], x[2]), self._order()))
+
+    def _order(self):
+        """ Expected costs of the pairwise tasks of all methods, most
+        expensive first
+
+        :rtype: (list) Tuples of negated expected cost, method index and pair index
+        """
+        order = []
+        for m, method in enumerate(self._methods):
+            for i, pair in enumerate(method[3]):
+                order.append((-estimate_cost(method[0], pair), m, i))
+        order.sort()
+        return order
+
+    def _chunks(self):
+        """ Group the ordered tasks into chunks. A chunk holds consecutive
+        tasks of one method whose summed expected cost stays below a fraction
+        of the total cost, at most MAX_CHUNK tasks.
+
+        :rtype: (list) Tuples of method index and list of pair indices
+        """
+        order = self._order()
+        bound = -sum(map(lambda x: x[0], order)) / \
+            (self._threads * CHUNKS_PER_WORKER)
+        chunks = []
+        cost = 0
+        for c, m, i in order:
+            if len(chunks) == 0 or chunks[-1][0] != m or \
+                    len(chunks[-1][1]) >= MAX_CHUNK or cost - c > bound:
+                chunks.append((m, []))
+                cost = 0
+            chunks[-1][1].append(i)
+            cost -= c
+        return chunks
+
+    def _start(self):
+        """ Finish the PSC methods without pairs and count the pairs left of
+        the others
+
+        :rtype: (tuple) Pairs left per method and seconds from start until each method completed
+        """
+        self._start_time = timer()
+        done = {}
+        left = list(map(lambda x: len(x[3]), self._methods))
+        for m, method in enumerate(self._methods):
+            if left[m] == 0:
+                method[5]()
+                done[method[0]] = 0
+            else:
+                self._metrics.start(method[0], left[m])
+        for method in self._local:
+            if len(method[2]) == 0:
+                method[4]()
+                done[method[0]] = 0
+            else:
+                # pairs are processed in tiles, their latency is not known
+                self._metrics.start(method[0], len(method[2]))
+        return left, done
+
+    def _start_jobs(self, p):
+        """ Submit the long running jobs to a pool
+
+        :param p: (Pool) Worker pool
+        :rtype: (list) Running jobs and their async results
+        """
+        running = []
+        for job in self._jobs:
+            print('%s started:' % job[0])
+            running.append((job, p.apply_async(
+                process_job, ((job[1], job[2]),))))
+        return running
+
+    def _start_threads(self, queue, done):
+        """ Start a thread for each method added with *add_thread* that has
+        pairs
+
+        :param queue: (Queue) Queue the outputs of the threads are put in
+        :param done: (dict) Seconds from start until each method completed
+        :rtype: (set) Indices of the running threads
+        """
+        running = set()
+        for t, method in enumerate(self._local):
+            if method[0] in done:
+                continue
+            thread = threading.Thread(target=process_thread, args=(
+                t, method[1], method[2], queue))
+            # a failing run does not wait for the thread
+            thread.daemon = True
+            thread.start()
+            running.add(t)
+        return running
+
+    def _slots(self, running):
+        """ Number of cores kept busy by the running threads
+
+        :param running: (set) Indices of the running threads
+        :rtype: (int) Number of cores
+        """
+        return sum(map(lambda x: self._local[x][5], running))
+
+    def _collect_threads(self, queue, running, wait, done):
+        """ Pass on the queued outputs of the threads and finish the methods
+        whose thread is done. Outputs are passed on from the main loop, never
+        from the threads.
+
+        :param queue: (Queue) Queue the outputs of the threads are put in
+        :param running: (set) Indices of the running threads, finished threads are removed
+        :param wait: (float) Seconds to wait for an output, 0 to pass on the queued outputs only
+        :param done: (dict) Seconds from start until each method completed
+        :rtype: None
+        """
+        while len(running) > 0:
+            try:
+                t, res = queue.get(wait > 0, wait)
+            except Empty:
+                return
+            wait = 0
+            methodname, _, _, collect, finish, _ = self._local[t]
+            if isinstance(res, BaseException):
+                raise res
+            if res is not None:
+                collect(res)
+                self._metrics.record(methodname)
+                continue
+            running.remove(t)
+            finish()
+            self._metrics.finish(methodname)
+            done[methodname] = timer() - self._start_time
+            print('%s processed in %d seconds' % (
+                methodname, done[methodname]))
+
+    def _release(self, holds, running):
+        """ Release the pool workers held for the threads that are done
+
+        :param holds: (list) Event set once each thread is done
+        :param running: (set) Indices of the running threads
+        :rtype: None
+        """
+        for t, hold in enumerate(holds):
+            if t not in running:
+                hold.set()
+
+    def _finish_jobs(self, running, wait, done):
+        """ Finish the jobs that are done. Jobs are finished from the main
+        loop, never from pool threads.
+
+        :param running: (list) Running jobs, finished jobs are removed
+        :param wait: (boolean) Wait for all jobs to finish
+        :param done: (dict) Seconds from start until each method completed
+        :rtype: (float) Seconds spent by the finished jobs
+        """
+        secs = 0.0
+        for job, result in list(running):
+            if wait or result.ready():
+                secs += result.get()
+                running.remove((job, result))
+                methodname, _, _, finish = job
+                if finish is not None:
+                    finish()
+                done[methodname] = timer() - self._start_time
+                print('%s processed in %d seconds' % (
+                    methodname, done[methodname]))
+        return secs
+
+    def _collect(self, m, out, left, done):
+        """ Pass on the outputs of a chunk of tasks of a method and finish
+        the method once all its pairs are done
+
+        :param m: (int) Method index
+        :param out: (list) Pair index, program output or PSC_FAILURE and seconds spent of each task
+        :param left: (list) Pairs left per method
+        :param done: (dict) Seconds from start until each method completed
+        :rtype: (float) Seconds spent by the tasks
+        """
+        methodname, _, _, _, collect, finish, fail = self._methods[m]
+        secs = 0.0
+        for _, res, busy in out:
+            failed = isinstance(res, PSC_FAILURE)
+            if not failed:
+                collect(res)
+            elif fail is not None:
+                fail(res)
+            else:
+                raise res
+            secs += busy
+            self._metrics.record(methodname, busy, failed)
+        left[m] -= len(out)
+        if left[m] == 0:
+            finish()
+            self._metrics.finish(methodname)
+            done[methodname] = timer() - self._start_time
+            print('%s processed in %d seconds' % (
+                methodname, done[methodname]))
+        return secs
+
+    def run(self):
+        """ Execute all jobs and tasks on one worker pool and the methods
+        added with *add_thread* on threads of this process. Outputs are passed
+        on as they arrive, in completion order, and each PSC method is
+        finished as soon as all its pairs are done.
+
+        :rtype: (dict) Seconds from start until each method completed
+        """
+        left, done = self._start()
+        chunks = self._chunks()
+        total = sum(map(lambda x: len(x[1]), chunks))
+        secs = 0.0
+        holds = list(map(lambda x: Event(), self._local))
+        p = Pool(self._threads, init_worker, (list(map(
+            lambda x: (x[1], x[2], x[3]), self._methods)), holds))
+        queue = Queue()
+        try:
+            threads = self._start_threads(queue, done)
+            # the held workers are taken ahead of the jobs and chunks
+            for t in threads:
+                for _ in range(min(self._local[t][5], self._threads)):
+                    p.apply_async(hold_slot, (t,))
+            running = self._start_jobs(p)
+            print('pairwise jobs started: %d pairs for %s' % (
+                total, ', '.join(map(lambda x: x[0], self._methods))))
+            self._metrics.inflight(max(0, min(
+                self._threads - len(running) - self._slots(threads), total)))
+            results = p.imap_unordered(process_chunk, chunks)
+            count = 0
+            while count < len(chunks):
+                self._collect_threads(queue, threads, 0, done)
+                self._release(holds, threads)
+                secs += self._finish_jobs(running, False, done)
+                try:
+                    m, out = results.next(WAIT)
+                except multiprocessing.TimeoutError:
+                    continue
+                count += 1
+                # workers not busy with a job or held are busy with pairs
+                self._metrics.inflight(max(0, min(
+                    self._threads - len(running) - self._slots(threads),
+                    sum(left) - len(out))))
+                secs += self._collect(m, out, left, done)
+            while len(threads) > 0:
+                self._collect_threads(queue, threads, WAIT, done)
+                secs += self._finish_jobs(running, False, done)
+            self._release(holds, threads)
+            secs += self._finish_jobs(running, True, done)
+            self._metrics.inflight(0)
+            self._metrics.report()
+            p.close()
+        except BaseException:
+            p.terminate()
+            raise
+        finally:
+            p.join()
+        wall = timer() - self._start_time
+        if wall > 0:
+            print('pairwise processing took %d seconds, worker utilization '
+                  '%0.0f%%' % (wall, 100. * secs / (wall * self._threads)))
+        return done
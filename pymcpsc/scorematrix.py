@@ -0,0 +1,280 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Symmetric pairwise score matrices of the dense mode stages.
+
+Classes:
+    - *PSC_SCORE_MATRIX*: score store of condensed symmetric score matrices
+
+Functions:
+    - *matrix_path*: path of a score matrix
+    - *condensed_size*: number of values of a condensed matrix
+    - *condensed_index*: position of domain pairs in a condensed matrix
+    - *condensed_pairs*: domain pairs at positions of a condensed matrix
+    - *condensed_row*: row of a condensed matrix
+
+The post processing writes the pairwise scores of all PSC methods to the
+*PROCESSED* matrix, the imputation adds the filled in scores in the *IMPUTED*
+matrix and the consensus scores are added in the *MCPSC* matrix. The
+benchmarking stages read the scores they need from the *MCPSC* matrix.
+
+The scores are symmetric, the score of a pair is stored once. The domains
+of the ground truth are numbered, and every column of scores is a float32
+array holding the upper triangle of the N x N matrix of scores, diagonal
+included, row by row (the condensed matrix). Pairs that are not in the ground
+truth are NaN, the *PAIR* column marks the pairs of the ground truth. The
+domain names and their classifications are stored with the *PROCESSED*
+matrix, the matrices derived from it read them from there.
+
+The columns are memory-mapped. *PSC_SCORE_MATRIX.row* and
+*PSC_SCORE_MATRIX.square* return the scores of a domain and the N x N matrix
+of scores, *PSC_SCORE_MATRIX.read* the table of the pairs of the ground truth.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from pymcpsc.scorestore import PSC_SCORE_STORE
+
+SUFFIX = '.matrix'
+# matrices of the dense mode stages
+PROCESSED = 'processed'
+IMPUTED = 'processed.imputed'
+MCPSC = 'processed.imputed.mcpsc'
+# column marking the pairs of the ground truth, and the arrays of the domains
+PAIR = 'pair'
+DOMAINS = 'domains'
+CLASSIFICATIONS = 'classifications'
+# columns of the pairs, from the domains of the pair
+DOMAIN_COLUMNS = ['dom1', 'dom2', 'cath1', 'cath2']
+
+
+def matrix_path(outdir, name):
+    """ Path of a score matrix
+
+    :param outdir: (string) Output directory of the run
+    :param name: (string) Matrix name, e.g. PROCESSED
+    :rtype: (string) Path to the matrix directory
+    """
+    return '%s%s%s%s' % (outdir, os.path.sep, name, SUFFIX)
+
+
+def condensed_size(n):
+    """ Number of values of a condensed matrix, the upper triangle with the
+    diagonal
+
+    :param n: (int) Number of domains
+    :rtype: int
+    """
+    return n * (n + 1) // 2
+
+
+def _row_starts(n):
+    """ Positions of the diagonal values in a condensed matrix
+
+    :param n: (int) Number of domains
+    :rtype: (array) Position of the first value of each row
+    """
+    i = np.arange(n, dtype=np.int64)
+    return i * n - i * (i - 1) // 2
+
+
+def condensed_index(ids1, ids2, n):
+    """ Position of domain pairs in a condensed matrix, in either order
+
+    :param ids1: (array) First domain number of each pair
+    :param ids2: (array) Second domain number of each pair
+    :param n: (int) Number of domains
+    :rtype: (array) Position of each pair
+    """
+    ids1 = np.asarray(ids1, dtype=np.int64)
+    ids2 = np.asarray(ids2, dtype=np.int64)
+    i = np.minimum(ids1, ids2)
+    return i * n - i * (i + 1) // 2 + np.maximum(ids1, ids2)
+
+
+def condensed_pairs(positions, n):
+    """ Domain pairs at positions of a condensed matrix
+
+    :param positions: (array) Positions in the condensed matrix
+    :param n: (int) Number of domains
+    :rtype: (tuple) Arrays of the first and second domain number of each pair, first <= second
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    starts = _row_starts(n)
+    i = np.searchsorted(starts, positions, side='right') - 1
+    return i, positions - starts[i] + i
+
+
+def condensed_row(values, k, n):
+    """ Row of a condensed matrix
+
+    :param values: (array) Condensed matrix
+    :param k: (int) Domain number
+    :param n: (int) Number of domains
+    :rtype: (array) Scores of domain k with every domain
+    """
+    i = np.arange(k, dtype=np.int64)
+    start = k * n - k * (k - 1) // 2
+    return np.concatenate([values[i * n - i * (i + 1) // 2 + k],
+                           values[start:start + n - k]])
+
+
+class PSC_SCORE_MATRIX(PSC_SCORE_STORE):
+
+    def __init__(self, outdir, name):
+        """ Set the matrix to read or write
+
+        :param outdir: (string) Output directory of the run
+        :param name: (string) Matrix name, e.g. PROCESSED
+        :rtype: None
+        """
+        PSC_SCORE_STORE.__init__(self, outdir, name)
+        self._path = matrix_path(outdir, name)
+        self._pairs = None
+
+    def _root(self):
+        """ Matrix the others of the chain are derived from
+
+        :rtype: (PSC_SCORE_MATRIX) Matrix holding the domains
+        """
+        parent = self.parent()
+        return self if parent is None else parent._root()
+
+    def domains(self):
+        """ Names of the domains, in the order they are numbered
+
+        :rtype: (array) Domain names
+        """
+        return self._root()._array(DOMAINS).astype(object)
+
+    def classifications(self):
+        """ Classifications of the domains
+
+        :rtype: (array) Classification of each domain
+        """
+        return self._root()._array(CLASSIFICATIONS).astype(object)
+
+    def pairs(self):
+        """ Positions of the pairs of the ground truth, the rows of *read*
+
+        :rtype: (array) Positions in the condensed matrices
+        """
+        if self._pairs is None:
+            store, k, _ = self._locate(PAIR)
+            self._pairs = np.flatnonzero(np.load(store._file(store._path, k)))
+        return self._pairs
+
+    def columns(self):
+        """ Names of all columns, the columns of the pairs first
+
+        :rtype: (list) Column names
+        """
+        return DOMAIN_COLUMNS + [x for x in PSC_SCORE_STORE.columns(self)
+                                 if x not in DOMAIN_COLUMNS + [PAIR]]
+
+    def condensed(self, name):
+        """ Memory-mapped condensed matrix of a column
+
+        :param name: (string) Column name
+        :rtype: (array) Condensed matrix
+        """
+        store, k, _ = self._locate(name)
+        return np.load(store._file(store._path, k), mmap_mode='r')
+
+    def row(self, name, k):
+        """ Scores of a domain with every domain
+
+        :param name: (string) Column name
+        :param k: (int) Domain number
+        :rtype: (array) Scores, NaN for pairs not in the ground truth
+        """
+        return condensed_row(self.condensed(name), k, len(self.domains()))
+
+    def square(self, name, index=None):
+        """ Square matrix of the scores of a column
+
+        :param name: (string) Column name
+        :param index: (array) Numbers of the domains of the rows and columns, None for all in order
+        :rtype: (array) Scores, NaN for pairs not in the ground truth
+        """
+        values = self.condensed(name)
+        n = len(self.domains())
+        square = np.empty((n, n), dtype=values.dtype)
+        for k, start in enumerate(_row_starts(n).tolist()):
+            square[k, k:] = values[start:start + n - k]
+            square[k:, k] = square[k, k:]
+        if index is not None:
+            square = square[np.ix_(index, index)]
+        return square
+
+    def read(self, columns=None, categorical=False):
+        """ Read columns as a table of the pairs of the ground truth, every
+        pair once, in the order of the condensed matrices. dom1, dom2, cath1
+        and cath2 are the domains of the pairs and their classifications.
+
+        :param columns: (list) Column names, None for all columns
+        :param categorical: (boolean) Return the domains and classifications as categoricals instead of strings
+        :rtype: (dataframe) Columns in the requested order
+        """
+        # checks that no matrix of the chain is stale
+        stored = self.columns()
+        if columns is None:
+            columns = stored
+        first, second = condensed_pairs(self.pairs(), len(self.domains()))
+        # dictionary encoded, domain numbers are codes of the domain names
+        derived = {}
+        for name, levels in [('dom', self.domains()),
+                             ('cath', self.classifications())]:
+            codes, names = pd.factorize(levels)
+            names = np.asarray(names, dtype=object)
+            derived['%s1' % name] = (codes[first], names)
+            derived['%s2' % name] = (codes[second], names)
+        data = {}
+        for name in columns:
+            if name not in derived:
+                data[name] = self.condensed(name)[self.pairs()]
+            elif categorical:
+                data[name] = pd.Categorical.from_codes(*derived[name])
+            else:
+                data[name] = derived[name][1][derived[name][0]]
+        return pd.DataFrame(data, columns=columns)
+
+    def write(self, data, parent=None, domains=None, classifications=None,
+              pairs=None):
+        """ Write the matrix, replacing a previous one. The rows of data are
+        scattered into condensed float32 matrices, the other pairs are NaN.
+
+        :param data: (dataframe) Scores of the pairs, in the order of *read* of the parent
+        :param parent: (PSC_SCORE_MATRIX) Matrix the other columns and the domains are read from, None for none
+        :param domains: (array) Names of the domains, without a parent
+        :param classifications: (array) Classification of each domain, without a parent
+        :param pairs: (array) Position of the pair of each row in the condensed matrices, without a parent
+        :rtype: None
+        """
+        arrays = None
+        if parent is None:
+            size = condensed_size(len(domains))
+            positions = np.asarray(pairs, dtype=np.int64)
+            arrays = {DOMAINS: np.array(list(map(str, domains)), dtype=str),
+                      CLASSIFICATIONS: np.array(list(map(
+                          str, classifications)), dtype=str)}
+        else:
+            size = len(parent)
+            positions = parent.pairs()
+        if len(data) != len(positions):
+            raise ValueError('%d rows written to %s, it has %d pairs' % (
+                len(data), self._path, len(positions)))
+        columns = {}
+        for name in data.columns:
+            values = np.full(size, np.nan, dtype=np.float32)
+            values[positions] = np.asarray(data[name], dtype=float)
+            columns[name] = values
+        names = list(data.columns)
+        if parent is None:
+            columns[PAIR] = np.zeros(size, dtype=bool)
+            columns[PAIR][positions] = True
+            names = [PAIR] + names
+        self._pairs = None
+        PSC_SCORE_STORE.write(self, pd.DataFrame(columns, columns=names),
+                              parent=parent, arrays=arrays)
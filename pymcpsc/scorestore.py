@@ -0,0 +1,252 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Columnar store of pairwise scores, read by column.
+
+Classes:
+    - *PSC_SCORE_STORE*: columnar table of pairwise scores, read by column
+
+Functions:
+    - *store_path*: path of a score store
+
+The dense mode stages keep their scores in score matrices, score stores
+whose rows are the pairs of all domains, see *pymcpsc.scorematrix*.
+
+A store is a directory holding a .npy file per column and a *SCHEMA* file
+listing the columns. Domain names, classifications and other strings are
+dictionary encoded, as int32 codes and a file of the distinct values. Scores
+are stored as float32. A store only holds the columns written by its stage,
+the columns of the store it was derived from (its parent) are read from the
+parent, so every column is written once. The rows of a store and its parent
+are the same pairs in the same order. A store records the id of its parent,
+a store derived from a parent that was written again since is refused.
+
+Stores are written to a temporary directory which then replaces the
+previous store. The CSV files of the stages can still be written on request,
+see *PSC_SCORE_STORE.to_csv*.
+"""
+import os
+import json
+import uuid
+import shutil
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import CategoricalDtype
+
+SUFFIX = '.store'
+SCHEMA = 'schema.json'
+# kinds of columns
+CATEGORY = 'category'
+FLOAT = 'float32'
+VALUES = 'values'
+
+
+def store_path(outdir, name):
+    """ Path of a score store
+
+    :param outdir: (string) Output directory of the run
+    :param name: (string) Store name
+    :rtype: (string) Path to the store directory
+    """
+    return '%s%s%s%s' % (outdir, os.path.sep, name, SUFFIX)
+
+
+class PSC_SCORE_STORE:
+
+    def __init__(self, outdir, name):
+        """ Set the store to read or write
+
+        :param outdir: (string) Output directory of the run
+        :param name: (string) Store name
+        :rtype: None
+        """
+        self._outdir = outdir
+        self._name = name
+        self._path = store_path(outdir, name)
+        self._schema = None
+
+    def _file(self, path, k, levels=False):
+        """ Path of the file of a column
+
+        :param path: (string) Path to the store directory
+        :param k: (int) Column number
+        :param levels: (boolean) The distinct values of a dictionary encoded column instead of its codes
+        :rtype: (string) Path to the file
+        """
+        return '%s%sc%03d%s.npy' % (path, os.path.sep, k,
+                                    '.levels' if levels else '')
+
+    def exists(self):
+        """ Check whether the store was written
+
+        :rtype: (boolean) The store exists
+        """
+        return os.path.exists('%s%s%s' % (self._path, os.path.sep, SCHEMA))
+
+    def _open(self):
+        """ Read the schema of the store
+
+        :rtype: (dict) Schema
+        """
+        if self._schema is None:
+            if not self.exists():
+                raise IOError('score store %s not found' % self._path)
+            self._schema = json.load(open('%s%s%s' % (
+                self._path, os.path.sep, SCHEMA)))
+        return self._schema
+
+    def parent(self):
+        """ Store the columns not in this store are read from
+
+        :rtype: (PSC_SCORE_STORE) Parent store of the same class, None if the store has no parent
+        """
+        schema = self._open()
+        if schema['parent'] is None:
+            return None
+        parent = self.__class__(self._outdir, schema['parent'])
+        if parent._open()['id'] != schema['parent_id']:
+            raise ValueError('score store %s is stale, %s was written again '
+                             'since' % (self._path, parent._path))
+        return parent
+
+    def __len__(self):
+        """ Number of rows of the store
+
+        :rtype: int
+        """
+        return self._open()['rows']
+
+    def columns(self):
+        """ Names of all columns, those of the parent first
+
+        :rtype: (list) Column names
+        """
+        parent = self.parent()
+        names = [] if parent is None else parent.columns()
+        return names + [x[0] for x in self._open()['columns']
+                        if x[0] not in names]
+
+    def _locate(self, name):
+        """ Store and position of a column
+
+        :param name: (string) Column name
+        :rtype: (tuple) Store holding the column, its number and kind
+        """
+        for k, (column, kind) in enumerate(self._open()['columns']):
+            if column == name:
+                return self, k, kind
+        parent = self.parent()
+        if parent is None:
+            raise KeyError(name)
+        return parent._locate(name)
+
+    def _read_column(self, k, kind, categorical):
+        """ Read a column of this store
+
+        :param k: (int) Column number
+        :param kind: (string) Column kind
+        :param categorical: (boolean) Return dictionary encoded columns as categoricals
+        :rtype: (array) Column values
+        """
+        values = np.load(self._file(self._path, k))
+        if kind != CATEGORY:
+            return values
+        levels = np.load(self._file(self._path, k, levels=True))
+        if categorical:
+            return pd.Categorical.from_codes(values, levels.astype(object))
+        # code -1 is a missing value
+        return np.append(levels.astype(object), [None])[values]
+
+    def read(self, columns=None, categorical=False):
+        """ Read columns of the store and its parents. Only the files of the
+        requested columns are read.
+
+        :param columns: (list) Column names, None for all columns
+        :param categorical: (boolean) Return dictionary encoded columns as categoricals instead of strings
+        :rtype: (dataframe) Columns in the requested order
+        """
+        # checks that no store of the chain is stale
+        stored = self.columns()
+        if columns is None:
+            columns = stored
+        data = {}
+        for name in columns:
+            store, k, kind = self._locate(name)
+            data[name] = store._read_column(k, kind, categorical)
+        return pd.DataFrame(data, columns=columns)
+
+    def _array(self, name):
+        """ Read an array stored with the store
+
+        :param name: (string) Array name
+        :rtype: (array) Array values
+        """
+        self._open()
+        return np.load('%s%s%s.npy' % (self._path, os.path.sep, name))
+
+    def write(self, data, parent=None, arrays=None):
+        """ Write the store, replacing a previous one. Float columns are
+        stored as float32, strings and categoricals dictionary encoded.
+
+        :param data: (dataframe) Columns of the store
+        :param parent: (PSC_SCORE_STORE) Store the other columns are read from, with the same rows, None for none
+        :param arrays: (dict) Arrays stored with the columns by name, not rows of the store, None for none
+        :rtype: None
+        """
+        if parent is not None and len(parent) != len(data):
+            raise ValueError('%d rows written to %s, its parent has %d' % (
+                len(data), self._path, len(parent)))
+        tmp = '%s.tmp' % self._path
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        columns = []
+        for k, name in enumerate(data.columns):
+            # numbers held as objects, e.g. after replacing values with None
+            values = data[name].infer_objects()
+            if isinstance(values.dtype, CategoricalDtype):
+                kind = CATEGORY
+                codes = values.cat.codes.values
+                levels = values.cat.categories
+            elif values.dtype.kind == 'f':
+                kind = FLOAT
+                codes = values.values.astype(np.float32)
+            elif values.dtype.kind in 'biu':
+                kind = VALUES
+                codes = values.values
+            else:
+                kind = CATEGORY
+                codes, levels = pd.factorize(values)
+            if kind == CATEGORY:
+                codes = codes.astype(np.int32)
+                np.save(self._file(tmp, k, levels=True),
+                        np.array(list(map(str, levels)), dtype=str))
+            np.save(self._file(tmp, k), codes)
+            columns.append([str(name), kind])
+        for name, values in (arrays or {}).items():
+            np.save('%s%s%s.npy' % (tmp, os.path.sep, name), values)
+        schema = {'id': uuid.uuid4().hex, 'rows': len(data),
+                  'columns': columns,
+                  'parent': None if parent is None else parent._name,
+                  'parent_id': None if parent is None else parent._open()['id']}
+        out = open('%s%s%s' % (tmp, os.path.sep, SCHEMA), 'w')
+        json.dump(schema, out, indent=1)
+        out.close()
+        # swap in the new store, readers of the previous one keep their files
+        old = '%s.old' % self._path
+        if os.path.exists(old):
+            shutil.rmtree(old)
+        if os.path.exists(self._path):
+            os.rename(self._path, old)
+        os.rename(tmp, self._path)
+        if os.path.exists(old):
+            shutil.rmtree(old)
+        self._schema = schema
+
+    def to_csv(self, fname):
+        """ Export all columns of the store and its parents as a CSV file
+
+        :param fname: (string) Path to the CSV file
+        :rtype: None
+        """
+        self.read().to_csv(fname, index=False)
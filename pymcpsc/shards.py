@@ -0,0 +1,283 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Static sharding of the pairwise PSC jobs for batch cluster array jobs.
+
+Functions:
+    - *parse_shard*: parse a shard specification i/n
+    - *shard_dir*: work directory of a shard
+    - *assign_shard*: select the pairwise tasks of a shard
+    - *write_shard*: record the pairs assigned to a shard
+    - *merge_shards*: merge the results of all shards into the work directory
+
+A run with a shard specification i/n enumerates the same pairs as an
+unsharded run but processes only a slice of them, so that n runs of an array
+job together process every pair once without talking to each other. The
+slices are balanced by the expected cost of the pairs (see
+*estimate_cost*) rather than by their number: all tasks of all methods are
+ordered most expensive first and every task is given to the shard with the
+smallest total cost so far. The order only depends on the domain names and
+sizes, every shard computes the same assignment. The GR-align all-to-all run
+is split into n query shards as for a local run and each shard processes
+one of them.
+
+A shard writes its results into the directory shards/iii-of-nnn of the work
+directory, along with the *SHARD* file listing the number of pairs of each
+method in the whole run and the pairs assigned to the shard. Once all shards
+are done, *merge_shards* checks that every shard is present, that no pair is
+assigned twice or not at all and that every assigned pair has a result or a
+failure record, and then writes the result files read by the post
+processing into the work directory.
+"""
+import os
+import heapq
+import shutil
+
+from pymcpsc.execute import FAILURES
+from pymcpsc.incremental import MANIFEST
+from pymcpsc.postprocessing import PSC_OUTPUTS
+from pymcpsc.prefilter import PRUNED
+from pymcpsc.scheduler import estimate_cost
+
+SHARD = 'shard.txt'
+_SHARDS = 'shards'
+
+
+def parse_shard(spec):
+    """ Parse a shard specification
+
+    :param spec: (string) Shard number and number of shards as i/n, 1 <= i <= n
+    :rtype: (tuple) Shard number and number of shards
+    """
+    try:
+        index, count = map(int, spec.split('/'))
+    except ValueError:
+        raise ValueError('invalid shard %s, expected i/n' % spec)
+    if count < 1 or index < 1 or index > count:
+        raise ValueError('invalid shard %s, expected 1 <= i <= n' % spec)
+    return index, count
+
+
+def shard_dir(workdir, index, count):
+    """ Work directory of a shard
+
+    :param workdir: (string) Work directory of the run
+    :param index: (int) Shard number
+    :param count: (int) Number of shards
+    :rtype: (string) Path to the work directory of the shard
+    """
+    return '%s%s%s%s%03d-of-%03d' % (workdir, os.path.sep, _SHARDS,
+                                     os.path.sep, index, count)
+
+
+def assign_shard(tasks, index, count):
+    """ Select the tasks of a shard. Tasks are assigned most expensive first
+    to the shard with the smallest total expected cost, ties are broken by
+    method and domain names so that every shard computes the same
+    assignment.
+
+    :param tasks: (list) Tuples of PSC method name and pair of domains
+    :param index: (int) Shard number
+    :param count: (int) Number of shards
+    :rtype: (tuple) Positions of the tasks of the shard in the task list and its total expected cost
+    """
+    order = sorted(map(lambda x: (
+        -estimate_cost(x[1][0], x[1][1]), x[1][0],
+        os.path.basename(x[1][1][0]), os.path.basename(x[1][1][1]), x[0]),
+        enumerate(tasks)))
+    loads = list(map(lambda x: (0.0, x), range(1, count + 1)))
+    selected = []
+    for cost, _, _, _, k in order:
+        load, shard = heapq.heappop(loads)
+        if shard == index:
+            selected.append(k)
+        heapq.heappush(loads, (load - cost, shard))
+    return sorted(selected), dict(map(lambda x: (x[1], x[0]), loads))[index]
+
+
+def write_shard(workdir, index, count, totals, assigned):
+    """ Record the pairs assigned to a shard
+
+    :param workdir: (string) Work directory of the shard
+    :param index: (int) Shard number
+    :param count: (int) Number of shards
+    :param totals: (dict) PSC method name to number of pairs of the whole run
+    :param assigned: (dict) PSC method name to domain name pairs assigned to the shard
+    :rtype: None
+    """
+    out = open('%s%s%s' % (workdir, os.path.sep, SHARD), 'w')
+    out.write('#shard\t%d\t%d\n' % (index, count))
+    for methodname in sorted(totals):
+        out.write('#total\t%s\t%d\n' % (methodname, totals[methodname]))
+    for methodname in sorted(assigned):
+        for name1, name2 in assigned[methodname]:
+            out.write('%s\t%s\t%s\n' % (methodname, name1, name2))
+    out.close()
+
+
+def _read_shard(fname):
+    """ Read the record of a shard
+
+    :param fname: (string) Path to the SHARD file
+    :rtype: (tuple) Shard number, number of shards, pair totals and assigned pairs per method
+    """
+    index = count = None
+    totals = {}
+    assigned = {}
+    for line in open(fname):
+        data = line.replace('\n', '').split('\t')
+        if data[0] == '#shard':
+            index, count = int(data[1]), int(data[2])
+        elif data[0] == '#total':
+            totals[data[1]] = int(data[2])
+        elif len(data) == 3:
+            assigned.setdefault(data[0], set()).add((data[1], data[2]))
+    return index, count, totals, assigned
+
+
+def _read_pairs(fname, sep):
+    """ Read the rows of a PSC output file keyed by domain name pair
+
+    :param fname: (string) Path to the output file
+    :param sep: (string) Field separator of the file
+    :rtype: (list) Domain name pair and line of each row
+    """
+    rows = []
+    if not os.path.exists(fname):
+        return rows
+    for line in open(fname):
+        data = line.split(None if sep == ' ' else sep)
+        if len(data) >= 2:
+            rows.append(((data[0], data[1]), line))
+    return rows
+
+
+def merge_shards(workdir):
+    """ Check the results of all shards of a run and merge them into the
+    result files of the work directory. Nothing is written unless all
+    checks pass.
+
+    :param workdir: (string) Work directory of the run
+    :rtype: (boolean) True if the shards were merged
+    """
+    base = '%s%s%s' % (workdir, os.path.sep, _SHARDS)
+    shards = {}
+    if os.path.isdir(base):
+        for name in sorted(os.listdir(base)):
+            fname = '%s%s%s%s%s' % (base, os.path.sep, name, os.path.sep,
+                                    SHARD)
+            if os.path.exists(fname):
+                shards[name] = _read_shard(fname)
+    if len(shards) == 0:
+        print('No shards found in %s' % base)
+        return False
+    errors = []
+    counts = set(map(lambda x: x[1], shards.values()))
+    count = max(counts)
+    if len(counts) > 1:
+        errors.append('shards of runs with %s shards found' % ', '.join(
+            map(str, sorted(counts))))
+    indices = set(map(lambda x: x[0], shards.values()))
+    for index in range(1, count + 1):
+        if index not in indices:
+            errors.append('shard %d/%d is missing' % (index, count))
+    totals = list(shards.values())[0][2]
+    if any(map(lambda x: x[2] != totals, shards.values())):
+        errors.append('shards enumerate different pairs, check the datasets '
+                      'and settings of the shard runs')
+    pruned = None
+    for name in shards:
+        fname = '%s%s%s%s%s' % (base, os.path.sep, name, os.path.sep, PRUNED)
+        data = open(fname).read() if os.path.exists(fname) else ''
+        if pruned is None:
+            pruned = data
+        elif data != pruned:
+            errors.append('shards pruned different pairs, check the '
+                          'prefilter settings of the shard runs')
+            break
+
+    failures = []
+    for name in shards:
+        fname = '%s%s%s%s%s' % (base, os.path.sep, name, os.path.sep,
+                                FAILURES)
+        if os.path.exists(fname):
+            failures += open(fname).readlines()
+    failed = set(map(lambda x: tuple(x.split('\t')[:3]), failures))
+
+    merged = {}
+    for methodname, outfilename, _, _, sep in PSC_OUTPUTS:
+        assigned = set()
+        rows = {}
+        head = None
+        for name in sorted(shards):
+            mine = shards[name][3].get(methodname, set())
+            if len(assigned & mine) > 0:
+                errors.append('%s: %d pairs assigned to more than one shard'
+                              % (methodname, len(assigned & mine)))
+            assigned |= mine
+            fname = '%s%s%s%s%s' % (base, os.path.sep, name, os.path.sep,
+                                    outfilename)
+            found = _read_pairs(fname, sep)
+            if methodname == 'gralign' and len(found) > 0:
+                # similarity file header
+                if head is None:
+                    head = found[0][1]
+                found = found[1:]
+            extra = 0
+            for pair, line in found:
+                if pair in rows:
+                    errors.append('%s: pair %s %s found in more than one '
+                                  'shard' % ((methodname,) + pair))
+                elif methodname != 'gralign' and pair not in mine:
+                    extra += 1
+                rows[pair] = line
+            if extra > 0:
+                errors.append('%s: %d pairs of %s were not assigned to it' %
+                              (methodname, extra, name))
+            missing = list(filter(
+                lambda x: x not in rows and x + (methodname,) not in failed,
+                mine))
+            if len(missing) > 0:
+                errors.append('%s: %d pairs of %s have neither a result nor '
+                              'a failure record' % (methodname, len(missing),
+                                                    name))
+        if methodname in totals and len(assigned) != totals[methodname]:
+            errors.append('%s: %d of %d pairs assigned to the shards' % (
+                methodname, len(assigned), totals[methodname]))
+        merged[outfilename] = (head, list(rows.values()))
+
+    if len(errors) > 0:
+        for error in errors[:20]:
+            print(error)
+        if len(errors) > 20:
+            print('... %d more problems' % (len(errors) - 20))
+        print('%d shards not merged' % len(shards))
+        return False
+
+    for outfilename, (head, lines) in merged.items():
+        fname = '%s%s%s' % (workdir, os.path.sep, outfilename)
+        if not os.path.exists(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        out = open(fname, 'w')
+        if head is not None:
+            out.write(head)
+        for line in lines:
+            out.write(line)
+        out.close()
+        print('%s: %d pairs merged' % (outfilename, len(lines)))
+    # preprocessing failures are recorded by every shard
+    out = open('%s%s%s' % (workdir, os.path.sep, FAILURES), 'w')
+    seen = set()
+    for line in failures:
+        if line not in seen:
+            seen.add(line)
+            out.write(line)
+    out.close()
+    out = open('%s%s%s' % (workdir, os.path.sep, PRUNED), 'w')
+    out.write(pruned)
+    out.close()
+    first = '%s%s%s' % (base, os.path.sep, sorted(shards)[0])
+    if os.path.exists('%s%s%s' % (first, os.path.sep, MANIFEST)):
+        shutil.copyfile('%s%s%s' % (first, os.path.sep, MANIFEST),
+                        '%s%s%s' % (workdir, os.path.sep, MANIFEST))
+    print('%d shards merged into %s' % (len(shards), workdir))
+    return True
@@ -0,0 +1,466 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Sparse top-k neighbor mode for datasets too large for dense all-to-all
+score matrices.
+
+Classes:
+    - *PSC_TOPK*: bounded per domain heaps of the most similar neighbors
+    - *TOPK_CSR*: top-k neighbors of all domains in compressed sparse row form
+
+Functions:
+    - *stream_method*: stream the output file of a PSC method into top-k heaps
+    - *read_classification*: read the domain classification from the ground truth file
+    - *topk_nnclassifyacc*: nearest neighbor classification accuracy on top-k neighbors
+    - *topk_roc*: ROC data for the retained pairs of domains
+    - *topk_fold_heatmap*: mean similarity of pairs of folds over the retained pairs
+    - *make*: main entry method
+
+In dense mode every pair of domains is written to the N x N processed score
+matrices read by the benchmarking steps. In sparse mode
+the output files of the PSC methods are streamed line by line instead. Only
+the k most similar neighbors of each domain are kept, in a bounded heap per
+domain, for every PSC method, so that memory grows with N * k. The scores
+are normalized with the scaler of the post-processing (see pymcpsc.scaling),
+its statistics are accumulated while streaming or frozen from the calibration
+file of a previous run. As the normalization is monotonic the neighbors can be selected on the raw scores and normalized
+once the file has been read.
+
+The consensus score of a pair is the weighted mean of the normalized scores
+of the methods that scored it. It is calculated for the candidate pairs in
+the top-k of any method, the scores of the candidates are collected in a
+second pass over the output files. Self pairs are not retained, the nearest
+neighbor classification is leave-one-out.
+"""
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import os
+import heapq
+
+import numpy as np
+import pandas as pd
+import seaborn as sb
+from sklearn import metrics
+
+from pymcpsc.groundtruth import read_ground_truth
+from pymcpsc.postprocessing import PSC_OUTPUTS, iter_psc_data
+from pymcpsc.rocauc import metrics_auc
+from pymcpsc.scaling import DEFAULT_SCALER, CALIBRATION, PSC_SCALE_STATS, \
+    scale, write_calibration, read_calibration
+
+CONSENSUS = 'mcpsc'
+# raw scores added to the statistics of the normalization at a time
+STATS_CHUNK = 100000
+
+
+class PSC_TOPK:
+
+    def __init__(self, k):
+        """ Set the number of neighbors kept per domain
+
+        :param k: (int) Number of neighbors
+        :rtype: None
+        """
+        self._k = k
+        self._ids = {}
+        self._names = []
+        self._heaps = []
+        # neighbor id to score of the entries of each heap
+        self._kept = []
+
+    def _id(self, name):
+        """ Integer id of a domain
+
+        :param name: (string) Domain name
+        :rtype: (int) Domain id
+        """
+        i = self._ids.get(name)
+        if i is None:
+            i = self._ids[name] = len(self._names)
+            self._names.append(name)
+            self._heaps.append([])
+            self._kept.append({})
+        return i
+
+    def _push(self, i, j, score):
+        """ Offer a neighbor to the heap of a domain
+
+        :param i: (int) Domain id
+        :param j: (int) Neighbor id
+        :param score: (float) Similarity, higher is more similar
+        :rtype: None
+        """
+        heap = self._heaps[i]
+        kept = self._kept[i]
+        if j in kept:
+            # a repeated pair replaces the earlier score, the heap is only
+            # rebuilt if the score changed
+            if kept[j] != score:
+                for k, entry in enumerate(heap):
+                    if entry[1] == j:
+                        heap[k] = (score, j)
+                        break
+                heapq.heapify(heap)
+                kept[j] = score
+            return
+        if len(heap) < self._k:
+            heapq.heappush(heap, (score, j))
+            kept[j] = score
+        elif (score, j) > heap[0]:
+            del kept[heapq.heapreplace(heap, (score, j))[1]]
+            kept[j] = score
+
+    def push(self, name1, name2, score):
+        """ Offer a scored pair of domains as neighbors of both domains
+
+        :param name1: (string) Name of domain 1
+        :param name2: (string) Name of domain 2
+        :param score: (float) Similarity, higher is more similar
+        :rtype: None
+        """
+        i = self._id(name1)
+        j = self._id(name2)
+        if i == j:
+            return
+        self._push(i, j, score)
+        self._push(j, i, score)
+
+    def to_csr(self, transform=None, names=None):
+        """ Convert the heaps into compressed sparse row form
+
+        :param transform: (function) Applied to the array of retained scores, None to keep them
+        :param names: (list) Domain names giving the row order, None for sorted names
+        :rtype: (TOPK_CSR) Top-k neighbors
+        """
+        if names is None:
+            names = sorted(self._names)
+        row = dict(map(lambda x: (x[1], x[0]), enumerate(names)))
+        indptr = [0]
+        indices = []
+        data = []
+        for name in names:
+            i = self._ids.get(name)
+            heap = [] if i is None else self._heaps[i]
+            for score, j in sorted(heap, reverse=True):
+                indices.append(row[self._names[j]])
+                data.append(score)
+            indptr.append(len(indices))
+        data = np.array(data, dtype=float)
+        if transform is not None and len(data) > 0:
+            data = transform(data)
+        return TOPK_CSR(names, np.array(indptr, dtype=np.int64),
+                        np.array(indices, dtype=np.int32),
+                        np.asarray(data, dtype=np.float32))
+
+
+class TOPK_CSR:
+
+    def __init__(self, names, indptr, indices, data):
+        """ Set the arrays of the sparse matrix. The neighbors of row i are
+        indices[indptr[i]:indptr[i + 1]], most similar first.
+
+        :param names: (list) Domain names of the rows
+        :param indptr: (numpy.ndarray) Row start offsets
+        :param indices: (numpy.ndarray) Column (neighbor) indices
+        :param data: (numpy.ndarray) Similarities
+        :rtype: None
+        """
+        self.names = list(names)
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    def __len__(self):
+        """ Number of retained neighbor entries
+
+        :rtype: int
+        """
+        return len(self.indices)
+
+    def save(self, fname):
+        """ Store the matrix as .npz file
+
+        :param fname: (string) Path to the output file
+        :rtype: None
+        """
+        np.savez(fname, names=np.array(self.names), indptr=self.indptr,
+                 indices=self.indices, data=self.data)
+
+    @staticmethod
+    def load(fname):
+        """ Load a matrix stored with save
+
+        :param fname: (string) Path to the .npz file
+        :rtype: (TOPK_CSR) Top-k neighbors
+        """
+        f = np.load(fname)
+        return TOPK_CSR(list(map(str, f['names'])), f['indptr'],
+                        f['indices'], f['data'])
+
+    def neighbors(self, name):
+        """ Neighbors of a domain, most similar first
+
+        :param name: (string) Domain name
+        :rtype: (list) Neighbor names and similarities
+        """
+        i = self.names.index(name)
+        s = slice(self.indptr[i], self.indptr[i + 1])
+        return list(zip(map(lambda x: self.names[x], self.indices[s]),
+                        self.data[s]))
+
+    def rows(self):
+        """ Row index of every retained entry
+
+        :rtype: (numpy.ndarray) Row indices
+        """
+        return np.repeat(np.arange(len(self.names)), np.diff(self.indptr))
+
+
+def stream_method(topk, fname, idx, inv=0, sep=' ', scaler=DEFAULT_SCALER,
+                  stats=None):
+    """ Stream the output file of a PSC method into top-k heaps. Neighbors
+    are selected on the raw score, which is a distance, and the statistics
+    of the normalization are accumulated a chunk of scores at a time
+    (Welford).
+
+    :param topk: (PSC_TOPK) Heaps to push the pairs into
+    :param fname: (string) Path to the output file
+    :param idx: (int) Column index of the score
+    :param inv: (int) Set to 1 if the score needs to be inverted
+    :param sep: (string) Column separator
+    :param scaler: (string) Name of the scaler in pymcpsc.scaling.SCALERS
+    :param stats: (PSC_SCALE_STATS) Statistics the raw scores are accumulated into, frozen statistics of a calibration are used as they are, None for new statistics
+    :rtype: (function) Normalization of raw scores to similarities
+    """
+    if stats is None:
+        stats = PSC_SCALE_STATS()
+    chunk = []
+    if os.path.exists(fname):
+        for (k1, k2), value in iter_psc_data(fname, idx, inv, sep):
+            chunk.append(value)
+            if len(chunk) == STATS_CHUNK:
+                stats.update(chunk)
+                chunk = []
+            topk.push(k1, k2, -value)
+    stats.update(chunk)
+
+    def normalize(x):
+        # same scaling as postprocessing.scale_psc_data
+        return scale(x, scaler, stats)
+    return normalize
+
+
+def read_classification(fname):
+    """ Read the classification of each domain from the ground truth file
+
+    :param fname: (string) Path to the ground truth file, of either format
+    :rtype: (dict) Domain name to classification
+    """
+    domains, classifications, _ = read_ground_truth(fname)
+    return dict(zip(map(lambda x: x.split('.')[0], domains),
+                    classifications))
+
+
+def _level(klass, level):
+    """ Truncate classifications to a level of the hierarchy
+
+    :param klass: (dict) Domain name to classification
+    :param level: (int) Number of levels to keep
+    :rtype: (dict) Domain name to truncated classification
+    """
+    return dict(map(lambda x: (x[0], '.'.join(x[1].split('.')[:level])),
+                    klass.items()))
+
+
+def topk_nnclassifyacc(csr, klass):
+    """ Leave-one-out nearest neighbor classification accuracy, the nearest
+    neighbor is the first retained neighbor of a domain
+
+    :param csr: (TOPK_CSR) Top-k neighbors
+    :param klass: (dict) Domain name to classification
+    :rtype: (float) Accuracy
+    """
+    total = 0
+    correct = 0
+    for i, name in enumerate(csr.names):
+        if csr.indptr[i] == csr.indptr[i + 1] or name not in klass:
+            continue
+        total += 1
+        correct += klass[name] == klass.get(
+            csr.names[csr.indices[csr.indptr[i]]])
+    if total == 0:
+        return 0
+    return correct * 1.0 / total
+
+
+def topk_roc(csr, klass):
+    """ ROC data for the retained pairs of classified domains
+
+    :param csr: (TOPK_CSR) Top-k neighbors
+    :param klass: (dict) Domain name to classification
+    :rtype: (tuple) False positive rates, true positive rates and thresholds
+    """
+    labels = np.array(list(map(lambda x: klass.get(x), csr.names)),
+                      dtype=object)
+    label1 = labels[csr.rows()]
+    label2 = labels[csr.indices]
+    known = np.array(list(map(lambda x: x[0] is not None and
+                              x[1] is not None, zip(label1, label2))),
+                     dtype=bool)
+    if not known.any():
+        return (None, None, None)
+    return metrics.roc_curve(label1[known] == label2[known],
+                             csr.data[known])
+
+
+def topk_fold_heatmap(csr, folds):
+    """ Mean similarity of pairs of folds over the retained pairs of
+    classified domains
+
+    :param csr: (TOPK_CSR) Top-k neighbors
+    :param folds: (dict) Domain name to fold
+    :rtype: (dataframe) Fold x fold mean similarities
+    """
+    labels = np.array(list(map(lambda x: folds.get(x, ''), csr.names)),
+                      dtype=object)
+    df = pd.DataFrame({'fold1': labels[csr.rows()],
+                       'fold2': labels[csr.indices],
+                       'd': csr.data})
+    df = df[(df['fold1'] != '') & (df['fold2'] != '')]
+    return df.groupby(['fold1', 'fold2'])['d'].mean().unstack()
+
+
+def make(workdir='work', outdir='outdir', k=50, gtin=None, weights=None,
+         psc_cols=[], make_images=True, scaler=None, calibration=None):
+    """ Runs the sparse top-k mode. The top-k neighbors of every PSC method
+    and of the consensus are stored in outdir as topk_<method>.npz. With a
+    ground truth file the nearest neighbor classification accuracies and
+    the ROC-AUCs on the retained pairs are printed and fold heatmaps are
+    written.
+
+    :param workdir: (string) Path to the work directory with the PSC output files
+    :param outdir: (string) Path to output directory
+    :param k: (int) Number of neighbors kept per domain
+    :param gtin: (string) Path to the ground truth file, None to skip benchmarking
+    :param weights: (list) Weights of the PSC methods in the consensus, None for equal weights
+    :param psc_cols: (list) List of psc method names to be included
+    :param make_images: (boolean) Enable or disable image generation
+    :param scaler: (string) Name of the scaler in pymcpsc.scaling.SCALERS, None for the scaler of the calibration or the default
+    :param calibration: (string) Path to the calibration file of a previous run whose statistics are used, None to calibrate on this run
+    :rtype: (dict) Method name to top-k neighbors
+    """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    outputs = list(filter(lambda x: x[0] in psc_cols, PSC_OUTPUTS))
+    if weights is None:
+        weights = [1.] * len(PSC_OUTPUTS)
+    weight = dict(map(lambda x: (x[0][0], float(x[1])),
+                      zip(PSC_OUTPUTS, weights)))
+
+    stats = {}
+    if calibration is not None:
+        # frozen statistics of a previous run
+        stored, stats = read_calibration(calibration)
+        if scaler is None:
+            scaler = stored
+    if scaler is None:
+        scaler = DEFAULT_SCALER
+
+    # top-k neighbors of every method, streamed from its output file
+    csrs = {}
+    normalizers = {}
+    for method, fname, idx, inv, sep in outputs:
+        print('.')
+        topk = PSC_TOPK(k)
+        stats.setdefault(method, PSC_SCALE_STATS())
+        normalizers[method] = stream_method(
+            topk, '%s%s%s' % (workdir, os.path.sep, fname), idx, inv, sep,
+            scaler, stats[method])
+        csrs[method] = topk.to_csr(lambda x: normalizers[method](-x))
+    write_calibration('%s%s%s' % (outdir, os.path.sep, CALIBRATION), scaler,
+                      stats)
+    names = sorted(set().union(*map(lambda x: x.names, csrs.values())))
+
+    # consensus of the candidate pairs in the top-k of any method
+    candidates = {}
+    for csr in csrs.values():
+        for i, j in zip(csr.rows(), csr.indices):
+            pair = tuple(sorted((csr.names[i], csr.names[j])))
+            candidates[pair] = [0., 0.]
+    for method, fname, idx, inv, sep in outputs:
+        print('.')
+        fname = '%s%s%s' % (workdir, os.path.sep, fname)
+        if not os.path.exists(fname) or weight[method] == 0:
+            continue
+        seen = set()
+        for pair, value in iter_psc_data(fname, idx, inv, sep):
+            pair = tuple(sorted(pair))
+            acc = candidates.get(pair)
+            if acc is None or pair in seen:
+                continue
+            seen.add(pair)
+            acc[0] += weight[method] * normalizers[method](value)
+            acc[1] += weight[method]
+    topk = PSC_TOPK(k)
+    for (name1, name2), (total, w) in candidates.items():
+        if w != 0:
+            topk.push(name1, name2, total / w)
+    csrs[CONSENSUS] = topk.to_csr(names=names)
+
+    for method, csr in csrs.items():
+        csr.save('%s%stopk_%s.npz' % (outdir, os.path.sep, method))
+    print('top-%d neighbors of %d domains: %s' % (k, len(names), ', '.join(
+        map(lambda x: '%s %d' % (x, len(csrs[x])), sorted(csrs)))))
+
+    if gtin is None:
+        print('Not performing performance benchmarking because no '
+              'ground-truth file supplied')
+        return csrs
+    klass = read_classification(gtin)
+    columns = list(map(lambda x: x[0], outputs)) + [CONSENSUS]
+
+    print('Nearest Neighbor Performances (top-%d)' % k)
+    for method in columns:
+        perfs = [method]
+        for level in range(1, 5):
+            perfs.append('%0.2f' % topk_nnclassifyacc(
+                csrs[method], _level(klass, level)))
+        print(' & '.join(perfs) + ' \\\\hline')
+
+    # ROC/AUC at Topology/Fold Level on the retained pairs
+    roc = []
+    auc = []
+    for method in columns:
+        fpr, tpr, _ = topk_roc(csrs[method], _level(klass, 3))
+        roc.append([fpr, tpr])
+        auc.append(metrics_auc(fpr, tpr) if fpr is not None else 0)
+    print(columns)
+    print(['Retained pairs'] + auc)
+    if make_images:
+        if not os.path.exists('figures'):
+            os.makedirs('figures')
+        for (fpr, tpr), method, a in zip(roc, columns, auc):
+            if fpr is not None:
+                plt.plot(fpr, tpr, label='%s (%0.2f)' % (method.upper(), a))
+        plt.plot([0, 1], [0, 1], 'k--')
+        plt.xlabel('False Positive Rate')
+        plt.ylabel('True Positive Rate')
+        plt.legend(loc='lower right')
+        plt.savefig('figures%stopk_roc.png' % os.path.sep)
+        plt.close()
+
+    # fold heatmaps on the retained pairs
+    folds = _level(klass, 2)
+    for method in columns:
+        p1 = topk_fold_heatmap(csrs[method], folds)
+        p1.to_csv('%s%s%s_topk_fold_heatmap.csv' % (
+            outdir, os.path.sep, method))
+        if make_images and 0 < len(p1) <= 300:
+            fig, ax = plt.subplots(figsize=(8, 6))
+            sb.heatmap(p1, ax=ax, cmap='YlGnBu')
+            plt.tight_layout()
+            fig.savefig('figures%s%s_topk_fold_heatmap.png' % (
+                os.path.sep, method))
+            plt.close(fig)
+    return csrs
@@ -0,0 +1,300 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Store of parsed structures with memory mapped coordinates.
+
+Classes:
+    - *PSC_STRUCTURE_STORE*: content-addressed store of residues and CA/CB coordinates
+
+Functions:
+    - *parse_structure*: parse the residues and CA/CB coordinates of a PDB file
+
+Every PDB file of a dataset is parsed once. Its residues and the coordinates
+of their CA and CB atoms are appended to two arrays holding the residues of
+all structures, a float32 coordinate block of shape (residues, 2, 3) and a
+record array of residue names and numbers. An index maps the content hash of
+each PDB file to the offset and number of its residues in the arrays. The
+arrays are stored as .npy files and opened memory mapped and read-only, so
+that all worker processes of a run share the same pages of the page cache
+instead of each reading and parsing the PDB files again.
+
+As the store is keyed by content hash it stays valid across runs and work
+directories, structures already in it are not parsed again. A changed PDB
+file gets a new entry, the entry of its previous content is kept.
+
+The store is shared by the runs started from the same directory, e.g. the
+array jobs of a sharded run. Every ingest writes the index and the arrays to
+a new version directory and then atomically replaces the *CURRENT* file
+naming the version, so readers always load an index and arrays of the same
+version. Ingests are serialized by a lock on the store, a process waiting
+for the lock reads the index again and only parses what is still missing.
+Older versions are removed by later ingests, processes mapping their arrays
+are not affected.
+"""
+import os
+import fcntl
+import shutil
+import tempfile
+from multiprocessing import Pool
+
+import numpy as np
+
+from pymcpsc.cache import file_digest
+
+_INDEX = 'index.txt'
+_COORDS = 'coords.npy'
+_RESIDUES = 'residues.npy'
+# file naming the current version directory, and the lock of the ingests
+CURRENT = 'current'
+_LOCK = 'lock'
+_VERSION = 'v-'
+
+RESIDUE_DTYPE = np.dtype([('name', 'S3'), ('chain', 'S1'), ('num', '<i4'),
+                          ('icode', 'S1')])
+
+
+def parse_structure(fname):
+    """ Parse the residues of the first model of a PDB file along with the
+    coordinates of their CA and CB atoms. Residues without a CA atom are
+    skipped, CB coordinates are NaN where the residue has no CB atom (e.g.
+    glycine). Of alternate locations only the first is read.
+
+    :param fname: (string) Path to the PDB file
+    :rtype: (tuple) Record array of residues and float32 array of shape (residues, 2, 3)
+    """
+    residues = []
+    coords = []
+    index = {}
+    for line in open(fname):
+        if line.startswith('ENDMDL'):
+            break
+        if not line.startswith('ATOM') or line[16] not in ' A':
+            continue
+        atom = line[12:16]
+        if atom not in (' CA ', ' CB '):
+            continue
+        try:
+            xyz = (float(line[30:38]), float(line[38:46]), float(line[46:54]))
+            key = (line[21], int(line[22:26]), line[26])
+        except ValueError:
+            continue
+        k = index.get(key)
+        if k is None:
+            k = index[key] = len(residues)
+            residues.append((line[17:20].strip(), key[0], key[1], key[2]))
+            coords.append([[np.nan] * 3, [np.nan] * 3])
+        coords[k][0 if atom == ' CA ' else 1] = xyz
+    keep = [k for k in range(len(coords)) if not np.isnan(coords[k][0][0])]
+    return np.array([residues[k] for k in keep], dtype=RESIDUE_DTYPE), \
+        np.array([coords[k] for k in keep], dtype=np.float32).reshape(-1, 2, 3)
+
+
+class PSC_STRUCTURE_STORE:
+
+    def __init__(self, storeDir):
+        """ Set the directory of the store
+
+        :param storeDir: (string) Path to the store directory
+        :rtype: None
+        """
+        self._storeDir = storeDir
+        if not os.path.exists(storeDir):
+            os.makedirs(storeDir)
+        # per process state, opened on first use in every worker
+        self._index = None
+        self._coords = None
+        self._residues = None
+        self._version = None
+
+    def __getstate__(self):
+        """ Drop the memory maps when the store is sent to a worker
+
+        :rtype: (dict) Picklable state
+        """
+        state = self.__dict__.copy()
+        state['_index'] = None
+        state['_coords'] = None
+        state['_residues'] = None
+        state['_version'] = None
+        return state
+
+    def _path(self, name):
+        """ Path of a file of the store
+
+        :param name: (string) File name
+        :rtype: (string) Path to the file
+        """
+        return '%s%s%s' % (self._storeDir, os.path.sep, name)
+
+    def _current(self):
+        """ Name of the current version directory
+
+        :rtype: (string) Directory name, None if nothing was ingested yet
+        """
+        try:
+            return open(self._path(CURRENT)).read().strip()
+        except (IOError, OSError):
+            return None
+
+    def _open(self):
+        """ Read the index and memory map the arrays of the current version
+
+        :rtype: None
+        """
+        if self._index is not None:
+            return
+        while True:
+            version = self._current()
+            if version is None:
+                self._index = {}
+                self._coords = np.zeros((0, 2, 3), dtype=np.float32)
+                self._residues = np.zeros(0, dtype=RESIDUE_DTYPE)
+                return
+            path = self._path(version)
+            try:
+                index = {}
+                for line in open('%s%s%s' % (path, os.path.sep, _INDEX)):
+                    data = line.replace('\n', '').split('\t')
+                    if len(data) == 3:
+                        index[data[0]] = (int(data[1]), int(data[2]))
+                coords = np.load('%s%s%s' % (path, os.path.sep, _COORDS),
+                                 mmap_mode='r')
+                residues = np.load('%s%s%s' % (path, os.path.sep, _RESIDUES),
+                                   mmap_mode='r')
+            except (IOError, OSError):
+                # the version was replaced and removed since it was named
+                if self._current() != version:
+                    continue
+                raise
+            self._version = version
+            self._index = index
+            self._coords = coords
+            self._residues = residues
+            return
+
+    def __len__(self):
+        """ Number of structures in the store
+
+        :rtype: int
+        """
+        self._open()
+        return len(self._index)
+
+    def ingest(self, fnames, threads=1):
+        """ Parse the PDB files not in the store yet and add them to it. The
+        arrays are written anew to a new version of the store, processes
+        that still map the previous arrays are not affected. Concurrent
+        ingests into the same store are serialized.
+
+        :param fnames: (list) Paths to the PDB files
+        :param threads: (int) Number of worker processes parsing the files
+        :rtype: (int) Number of PDB files parsed
+        """
+        lock = open(self._path(_LOCK), 'a')
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            # another process may have ingested while this one waited
+            self._index = None
+            self._open()
+            return self._ingest(fnames, threads)
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+            lock.close()
+
+    def _ingest(self, fnames, threads):
+        """ Parse the PDB files not in the store yet and write a new version,
+        with the lock of the store held
+
+        :param fnames: (list) Paths to the PDB files
+        :param threads: (int) Number of worker processes parsing the files
+        :rtype: (int) Number of PDB files parsed
+        """
+        todo = {}
+        for fname in fnames:
+            digest = file_digest(fname)
+            if digest not in self._index:
+                todo[digest] = fname
+        if len(todo) == 0:
+            return 0
+        digests = sorted(todo)
+        if threads > 1 and len(digests) > 1:
+            p = Pool(threads)
+            try:
+                parsed = p.map(parse_structure, [todo[x] for x in digests])
+            finally:
+                p.close()
+                p.join()
+        else:
+            parsed = list(map(parse_structure, [todo[x] for x in digests]))
+        offset = len(self._residues)
+        index = dict(self._index)
+        for digest, (residues, _) in zip(digests, parsed):
+            index[digest] = (offset, len(residues))
+            offset += len(residues)
+        residues = np.concatenate(
+            [self._residues] + list(map(lambda x: x[0], parsed)))
+        coords = np.concatenate(
+            [self._coords] + list(map(lambda x: x[1], parsed)))
+        path = tempfile.mkdtemp(prefix=_VERSION, dir=self._storeDir)
+        np.save('%s%s%s' % (path, os.path.sep, _COORDS), coords)
+        np.save('%s%s%s' % (path, os.path.sep, _RESIDUES), residues)
+        out = open('%s%s%s' % (path, os.path.sep, _INDEX), 'w')
+        for digest in sorted(index):
+            out.write('%s\t%d\t%d\n' % ((digest,) + index[digest]))
+        out.close()
+        part = '%s.%d' % (self._path(CURRENT), os.getpid())
+        out = open(part, 'w')
+        out.write(os.path.basename(path))
+        out.close()
+        os.rename(part, self._path(CURRENT))
+        # the previous version is kept for processes that just named it
+        for name in os.listdir(self._storeDir):
+            if name.startswith(_VERSION) and \
+                    name not in (os.path.basename(path), self._version):
+                shutil.rmtree(self._path(name), ignore_errors=True)
+        self._index = None
+        return len(digests)
+
+    def _slice(self, fname):
+        """ Position of the residues of a PDB file in the arrays
+
+        :param fname: (string) Path to the PDB file
+        :rtype: (slice) Residues of the file, None if it is not in the store
+        """
+        self._open()
+        entry = self._index.get(file_digest(fname))
+        if entry is None:
+            return None
+        return slice(entry[0], entry[0] + entry[1])
+
+    def residues(self, fname):
+        """ Residues of a structure
+
+        :param fname: (string) Path to the PDB file
+        :rtype: (numpy.ndarray) Read-only record array of residue names, chains, numbers and insertion codes, None if the file is not in the store
+        """
+        s = self._slice(fname)
+        if s is None:
+            return None
+        return self._residues[s]
+
+    def coordinates(self, fname):
+        """ CA and CB coordinates of a structure
+
+        :param fname: (string) Path to the PDB file
+        :rtype: (numpy.ndarray) Read-only float32 array of shape (residues, 2, 3), None if the file is not in the store
+        """
+        s = self._slice(fname)
+        if s is None:
+            return None
+        return self._coords[s]
+
+    def ca(self, fname):
+        """ CA coordinates of a structure
+
+        :param fname: (string) Path to the PDB file
+        :rtype: (numpy.ndarray) Read-only float32 array of shape (residues, 3), None if the file is not in the store
+        """
+        coords = self.coordinates(fname)
+        if coords is None:
+            return None
+        return coords[:, 0, :]
@@ -0,0 +1,254 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Synthetic pairwise PSC results for scaling tests of the post processing.
+
+Functions:
+    - *classify*: SCOP-like classification of synthetic domains
+    - *make*: write synthetic PSC results and ground truth for N domains
+    - *main*: command line entry point
+
+The bundled binaries cannot score the pairs of tens of thousands of domains
+in reasonable time. This module writes result files in the formats of the
+five PSC methods (see *PSC_OUTPUTS*) and a matching ground truth file
+instead, so that the stages after the pairwise run can be exercised and
+benchmarked at that scale, e.g. with scripts/bench_pipeline.py --synthetic.
+
+The domains are given a SCOP-like classification: families of a few domains
+each are grouped into superfamilies, folds and the classes a to d. The
+similarity of a pair follows from the deepest level the two domains share,
+with some spread per pair that all methods see alike. Each method adds its
+own noise to it and turns it into the score of its output file, e.g. a
+RMSD for CE and FAST or a TM-score for TM-align, and a share of its pairs
+is missing. Missing pairs of CE, TM-align and FAST are partly recorded as
+failures. All pairs of the domains are written, or a random share of them
+given a density below 1, the same pairs for all methods and the ground
+truth. The output only depends on the settings and the seed.
+"""
+import os
+import sys
+import argparse
+import numpy as np
+
+from pymcpsc.execute import FAILURES, parse_limits
+from pymcpsc.postprocessing import PSC_OUTPUTS
+
+CLASSES = ['a', 'b', 'c', 'd']
+# share of the domains in each class, as in the proteus dataset
+CLASS_SHARE = [0.16, 0.13, 0.33, 0.38]
+# average number of domains per family, families per superfamily and
+# superfamilies per fold
+FAMILY_SIZE = 8
+FAMILIES = 2
+SUPERFAMILIES = 2
+# similarity of two domains sharing nothing, a class, fold, superfamily and
+# family, and the spread of the similarity of a pair
+LEVELS = [0.1, 0.25, 0.45, 0.65, 0.85]
+SPREAD = 0.05
+# noise added to the similarity by each method and share of missing pairs
+NOISE = {'ce': 0.08, 'fast': 0.12, 'gralign': 0.15, 'tmalign': 0.06,
+         'usm': 0.2}
+MISSING = {'ce': 0.002, 'fast': 0.01, 'gralign': 0.001, 'tmalign': 0.001,
+           'usm': 0.0}
+# share of the missing pairs of the binaries recorded as failures
+FAILED = 0.5
+METHODS = ['ce', 'fast', 'gralign', 'tmalign', 'usm']
+
+
+def classify(domains, rng):
+    """ SCOP-like classification of synthetic domains
+
+    :param domains: (int) Number of domains
+    :param rng: (RandomState) Random number generator
+    :rtype: (array) Class, fold, superfamily and family number of each domain, and (list) sccs string of each domain
+    """
+    families = max(1, domains // FAMILY_SIZE)
+    superfamilies = max(1, families // FAMILIES)
+    folds = max(1, superfamilies // SUPERFAMILIES)
+
+    # uneven sizes at every level, every group gets at least one member
+    def assign(count, groups, share=None):
+        if share is None:
+            share = rng.dirichlet(np.ones(groups))
+        members = np.concatenate([np.arange(min(count, groups)), rng.choice(
+            groups, max(0, count - groups), p=share)]).astype(int)
+        rng.shuffle(members)
+        return members
+
+    fold_class = assign(folds, len(CLASSES), CLASS_SHARE)
+    sf_fold = assign(superfamilies, folds)
+    family_sf = assign(families, superfamilies)
+    dom_family = assign(domains, families)
+    levels = np.zeros((domains, 4), dtype=int)
+    levels[:, 3] = dom_family
+    levels[:, 2] = family_sf[dom_family]
+    levels[:, 1] = sf_fold[levels[:, 2]]
+    levels[:, 0] = fold_class[levels[:, 1]]
+
+    # number the groups within their parent group as SCOP does
+    def number(parents):
+        counts = {}
+        local = np.zeros(len(parents), dtype=int)
+        for k, parent in enumerate(parents):
+            counts[parent] = counts.get(parent, 0) + 1
+            local[k] = counts[parent]
+        return local
+
+    fold_no = number(fold_class)
+    sf_no = number(sf_fold)
+    family_no = number(family_sf)
+    sccs = list(map(lambda x: '%s.%d.%d.%d' % (
+        CLASSES[x[0]], fold_no[x[1]], sf_no[x[2]], family_no[x[3]]), levels))
+    return levels, sccs
+
+
+def _lines(methodname, names, i, js, lengths, sim):
+    """ Output lines of a method for the pairs of a domain
+
+    :param methodname: (string) PSC method name
+    :param names: (list) Domain names as written by the PSC methods
+    :param i: (int) Domain number
+    :param js: (array) Numbers of the other domains of the pairs
+    :param lengths: (array) Number of residues of each domain
+    :param sim: (array) Similarity of each pair as seen by the method
+    :rtype: (list) Output lines
+    """
+    l1 = lengths[i]
+    l2 = lengths[js]
+    aln = (np.minimum(l1, l2) * (0.4 + 0.6 * sim)).astype(int)
+    n1 = names[i]
+    if methodname == 'ce':
+        # a self pair has no gaps, as CE writes it
+        gaps = np.where(js == i, 0, np.maximum(
+            1, (aln * 0.3 * (1 - sim)).astype(int)))
+        return list(map(lambda x: '%s %s A %d A %d %d %.2f %.1f %d(%.1f%%) '
+                        '%.1f%%\n' % (n1, names[x[0]], l1, x[1], x[2],
+                                      6. * (1 - x[3]), 8. * x[3], x[4],
+                                      100. * x[4] / x[2], 60. * x[3]),
+                        zip(js, l2, aln, sim, gaps)))
+    if methodname == 'fast':
+        return list(map(lambda x: '%s %s %d %d %d %.3f\n' % (
+            n1, names[x[0]], x[2], l1, x[1], 4.5 * (1 - x[3])),
+            zip(js, l2, aln, sim)))
+    if methodname == 'tmalign':
+        return list(map(lambda x: '%s %s %d %d %d, %.2f, %.3f %.5f %.5f\n' % (
+            n1, names[x[0]], l1, x[1], x[2], 5. * (1 - x[3]),
+            0.1 + 0.9 * x[3], 0.1 + 0.9 * x[3], 0.1 + 0.9 * x[3]),
+            zip(js, l2, aln, sim)))
+    if methodname == 'gralign':
+        e1 = 7 * l1
+        return list(map(lambda x: '%s\t%s\t%d\t%d\t%d\t%f\t%f\n' % (
+            n1, names[x[0]], e1, 7 * x[1], int(0.8 * x[2] * min(e1, 7 * x[1])),
+            0.8 * x[2], x[2]), zip(js, l2, 0.05 + 0.9 * sim)))
+    return list(map(lambda x: '%s %s %f\n' % (n1, names[x[0]], 1 - 0.9 * x[1]),
+                    zip(js, sim)))
+
+
+def make(WORKDIR, domains, gtout, seed=0, noise=None, missing=None,
+         density=1.0, failed=FAILED):
+    """ Write synthetic results of all PSC methods and their ground truth
+
+    :param WORKDIR: (string) Work directory the result files are written to
+    :param domains: (int) Number of domains
+    :param gtout: (string) Path of the ground truth file
+    :param seed: (int) Seed of the random number generator
+    :param noise: (dict) PSC method name to noise added to the similarity, None for the defaults
+    :param missing: (dict) PSC method name to share of missing pairs, None for the defaults
+    :param density: (float) Share of the pairs of the domains written
+    :param failed: (float) Share of the missing pairs of CE, TM-align and FAST recorded as failures
+    :rtype: (int) Number of pairs in the ground truth
+    """
+    rng = np.random.RandomState(seed)
+    noise = dict(NOISE, **(noise or {}))
+    missing = dict(MISSING, **(missing or {}))
+    levels, sccs = classify(domains, rng)
+    names = list(map(lambda x: 'd%07d' % x, range(domains)))
+    written = list(map(lambda x: x + '.', names))
+    lengths = np.clip(rng.lognormal(np.log(150), 0.5, domains), 30,
+                      1200).astype(int)
+
+    if not os.path.exists('%s%sgralign' % (WORKDIR, os.path.sep)):
+        os.makedirs('%s%sgralign' % (WORKDIR, os.path.sep))
+    outs = {}
+    for methodname, outfilename, _, _, _ in PSC_OUTPUTS:
+        outs[methodname] = open('%s%s%s' % (WORKDIR, os.path.sep,
+                                            outfilename), 'w')
+    outs['gralign'].write('Query_1\tQuery_2\t#E1\t#E2\tNCE\tEC\tGS\n')
+    failures = open('%s%s%s' % (WORKDIR, os.path.sep, FAILURES), 'w')
+    gt = open(gtout, 'w')
+    total = 0
+    for i in range(domains):
+        js = np.arange(i, domains)
+        keep = rng.random_sample(len(js)) < density
+        keep[0] = True
+        js = js[keep]
+        # deepest level shared by the pairs
+        same = levels[js] == levels[i]
+        depth = np.where(same[:, 0], 1 + np.sum(np.cumprod(same[:, 1:],
+                                                           axis=1), axis=1), 0)
+        sim = np.clip(np.array(LEVELS)[depth] + rng.normal(
+            0, SPREAD, len(js)), 0, 1)
+        sim[js == i] = 1.
+        for methodname in METHODS:
+            pick = js if methodname != 'gralign' else js[1:]
+            msim = sim if methodname != 'gralign' else sim[1:]
+            msim = np.clip(msim + rng.normal(0, noise[methodname],
+                                             len(msim)), 0, 1)
+            msim[pick == i] = 1.
+            lost = rng.random_sample(len(pick)) < missing[methodname]
+            outs[methodname].writelines(_lines(
+                methodname, written, i, pick[~lost], lengths, msim[~lost]))
+            if methodname in ['ce', 'fast', 'tmalign']:
+                for j in pick[lost]:
+                    if rng.random_sample() < failed:
+                        failures.write('%s\t%s\t%s\texit\tstatus -11\n' % (
+                            written[i], written[j], methodname))
+        gt.writelines(map(lambda j: '%s\t%s\t%s\t%s\n' % (
+            names[i], names[j], sccs[i], sccs[j]), js[1:]))
+        total += len(js) - 1
+    for out in list(outs.values()) + [failures, gt]:
+        out.close()
+    return total
+
+
+def main(argv=None):
+    """ Command line entry point
+
+    :param argv: (list) Program arguments, None for the command line
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m pymcpsc.synthetic',
+        description='Write synthetic pairwise PSC results and ground truth.')
+    parser.add_argument('-n', '--domains', required=True, type=int,
+                        help='Number of domains')
+    parser.add_argument('-w', '--workdir', default='work',
+                        help='Work directory of the results (default: work)')
+    parser.add_argument('-g', '--gtout', default='ground_truth',
+                        help='Ground truth file (default: ground_truth)')
+    parser.add_argument('-s', '--seed', default=0, type=int,
+                        help='Seed of the random number generator '
+                             '(default: 0)')
+    parser.add_argument('--noise', default=None,
+                        help='Noise added to the similarity, either for all '
+                             'methods or per method as e.g. ce=0.1,usm=0.3 '
+                             '(default: %s)' % ','.join(map(
+                                 lambda x: '%s=%s' % (x, NOISE[x]), METHODS)))
+    parser.add_argument('--missing', default=None,
+                        help='Share of missing pairs, given as for --noise '
+                             '(default: %s)' % ','.join(map(
+                                 lambda x: '%s=%s' % (x, MISSING[x]),
+                                 METHODS)))
+    parser.add_argument('--density', default=1.0, type=float,
+                        help='Share of the pairs of the domains written '
+                             '(default: 1)')
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.workdir):
+        os.makedirs(args.workdir)
+    pairs = make(args.workdir, args.domains, args.gtout, args.seed,
+                 parse_limits(args.noise, METHODS),
+                 parse_limits(args.missing, METHODS), args.density)
+    print('%d domains, %d pairs written to %s' % (args.domains, pairs,
+                                                   args.workdir))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,205 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" All-to-all USM engine reusing the per domain compression work.
+
+Classes:
+    - *USM_ENGINE*: threaded USM scoring of many pairs of contact maps
+
+Functions:
+    - *read_contact_map*: read and truncate a GR-align contact map
+    - *usm_score*: USM distance from compressed sizes
+
+The USM distance of two contact maps x and y is computed from the compressed
+sizes C(x), C(y), C(xy) and C(yx). Processed pair by pair, every contact map
+is read from disk and compressed alone once per pair it appears in. The
+engine reads and truncates every contact map once and compresses it alone
+once. C(xy) is obtained by cloning a zlib compressor that has already been
+fed x, so that only y is compressed for the pair. As long as no flush happens
+in between, deflate output does not depend on how the input is split, and
+the compressor uses the same settings as zlib.compress, the sizes and
+therefore the scores are identical to the ones of compressing xy at once.
+
+The pairs are processed in tiles of up to *BLOCK_SIZE* x *BLOCK_SIZE*
+domains. Only the compressors primed for the domains of a tile are kept
+alive, which bounds the memory used (a compressor holds about 256KB of
+state), while priming costs one compression per domain and tile. Tiles run
+on a pool of threads, zlib releases the GIL while compressing.
+"""
+import os
+import sys
+import zlib
+from multiprocessing.pool import ThreadPool
+
+# number of contacts kept of a contact map
+MAX_CONTACTS = 1000
+# number of domains along each side of a tile
+BLOCK_SIZE = 64
+
+
+def read_contact_map(fname, maxContacts=MAX_CONTACTS):
+    """ Read the contacts of a GR-align contact map, truncated to the maximum
+    number of contacts
+
+    :param fname: (string) Path to the contact map file
+    :param maxContacts: (int) Maximum number of contacts to keep
+    :rtype: (bytes) Contacts
+    """
+    cm = ''.join(list(filter(lambda x: not x.startswith('|'),
+                             open(fname).readlines()))[:maxContacts])
+    if sys.version_info < (3, 0):
+        return cm
+    return cm.encode('utf-8')
+
+
+def usm_score(x, y, xy, yx):
+    """ USM distance from the compressed sizes of two contact maps and of
+    their concatenations
+
+    :param x: (float) Compressed size of contact map 1
+    :param y: (float) Compressed size of contact map 2
+    :param xy: (float) Compressed size of contact map 1 followed by 2
+    :param yx: (float) Compressed size of contact map 2 followed by 1
+    :rtype: (string) USM distance as written to the output file
+    """
+    return '%f' % (max(yx - y, xy - x) / max(x, y))
+
+
+class USM_ENGINE:
+
+    def __init__(self, threads=1, cache=None, maxContacts=MAX_CONTACTS,
+                 blockSize=BLOCK_SIZE):
+        """ Set the number of threads and the contact map truncation
+
+        :param threads: (int) Number of threads
+        :param cache: (PSC_CACHE) Result cache to use, None to disable caching
+        :param maxContacts: (int) Maximum number of contacts to keep in a contact map
+        :param blockSize: (int) Number of domains along each side of a tile
+        :rtype: None
+        """
+        self._threads = max(1, threads)
+        self._cache = cache
+        self._maxContacts = maxContacts
+        self._blockSize = blockSize
+        # same version as USM_HANDLER, the results are identical
+        self._binDigest = 'usm-%d' % maxContacts
+        self._maps = {}
+        self._sizes = {}
+
+    def _name(self, fname):
+        """ Domain name of a contact map file
+
+        :param fname: (string) Path to the contact map file
+        :rtype: (string) Domain name
+        """
+        return fname.split(os.path.sep)[-1].replace('.gw', '')
+
+    def from_cache(self, fname1, fname2, pdbextn=None):
+        """ Look up the USM output for a pair of domains in the result cache
+
+        :param fname1: (string) Path to domain 1 contact map file
+        :param fname2: (string) Path to domain 2 contact map file
+        :param pdbextn: (string) Unused, present for handler compatibility
+        :rtype: (list) Cached output data or None
+        """
+        if self._cache is None:
+            return None
+        return self._cache.get('usm', self._binDigest, fname1, fname2,
+                               [self._name(fname1), self._name(fname2)])
+
+    def _load(self, fname):
+        """ Read a contact map and compress it alone
+
+        :param fname: (string) Path to the contact map file
+        :rtype: (tuple) Path, contacts and compressed size
+        """
+        cm = read_contact_map(fname, self._maxContacts)
+        return fname, cm, float(len(zlib.compress(cm)))
+
+    def load(self, fnames, pool=None):
+        """ Read and compress the contact maps not loaded yet
+
+        :param fnames: (list) Paths to the contact map files
+        :param pool: (ThreadPool) Pool to load the files on, None to create one
+        :rtype: None
+        """
+        todo = sorted(set(fnames) - set(self._maps))
+        if len(todo) == 0:
+            return
+        own = pool is None
+        if own:
+            pool = ThreadPool(self._threads)
+        try:
+            for fname, cm, size in pool.imap_unordered(self._load, todo):
+                self._maps[fname] = cm
+                self._sizes[fname] = size
+        finally:
+            if own:
+                pool.close()
+                pool.join()
+
+    def _tiles(self, pairs):
+        """ Group pairs into tiles of up to blockSize x blockSize domains
+
+        :param pairs: (list) Pairs of contact map files
+        :rtype: (list) Lists of pairs in a tile
+        """
+        index = {}
+        for fname in sorted(set([x[0] for x in pairs] +
+                                [x[1] for x in pairs])):
+            index[fname] = len(index) // self._blockSize
+        tiles = {}
+        for pair in pairs:
+            tiles.setdefault(
+                (index[pair[0]], index[pair[1]]), []).append(pair)
+        return [tiles[x] for x in sorted(tiles)]
+
+    def _process_tile(self, tile):
+        """ Score the pairs of a tile
+
+        :param tile: (list) Pairs of contact map files
+        :rtype: (list) Pair of contact map files and output data of each pair
+        """
+        primed = {}
+
+        def concat(fname1, fname2):
+            # C(xy) from the compressor primed with x
+            if fname1 not in primed:
+                comp = zlib.compressobj()
+                primed[fname1] = (comp, len(comp.compress(
+                    self._maps[fname1])))
+            comp, head = primed[fname1]
+            comp = comp.copy()
+            return float(head + len(comp.compress(self._maps[fname2])) +
+                         len(comp.flush()))
+
+        out = []
+        for fname1, fname2 in tile:
+            score = usm_score(self._sizes[fname1], self._sizes[fname2],
+                              concat(fname1, fname2), concat(fname2, fname1))
+            out.append(((fname1, fname2),
+                        [[self._name(fname1), self._name(fname2), score]]))
+        return out
+
+    def process_pairs(self, pairs):
+        """ Process pairs of domains using USM. The outputs are returned in
+        tile completion order and stored in the result cache.
+
+        :param pairs: (list) Pairs of contact map files, further items of a pair are ignored
+        :rtype: (generator) Output data of each pair
+        """
+        pairs = list(map(lambda x: (x[0], x[1]), pairs))
+        if len(pairs) == 0:
+            return
+        pool = ThreadPool(self._threads)
+        try:
+            self.load([x[0] for x in pairs] + [x[1] for x in pairs], pool)
+            for out in pool.imap_unordered(self._process_tile,
+                                           self._tiles(pairs)):
+                for pair, res in out:
+                    if self._cache is not None:
+                        self._cache.put('usm', self._binDigest, pair[0],
+                                        pair[1], res)
+                    yield res
+        finally:
+            pool.close()
+            pool.join()
@@ -15,11 +15,12 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 
 import os.path
-import pandas as pd
 import numpy as np
 
 from sklearn.manifold import MDS
 
+from pymcpsc.scorematrix import PSC_SCORE_MATRIX, MCPSC
+
 _s = 20 * 2
 
 matplotlib.rcParams['pdf.fonttype'] = 42
@@ -59,7 +60,7 @@ def cmdscale(D):
 
 
 def mdsscatter(
-        raw_data,
+        matrix,
         classes,
         cl,
         classes_dict,
@@ -72,7 +73,7 @@ def mdsscatter(
     """ Performs MDS on pairwise similarity of a psc method in 2-dimensions
     and generates scatter plot for it.
 
-    :param raw_data: (dataframe) Similarity scores data
+    :param matrix: (PSC_SCORE_MATRIX) Similarity scores data
     :param classes: (list) SCOP classes     
     :param cl: (list) Colors corresponding to the SCOP classes to be used in the plots
     :param classes_dict: (dict) Mapping of class to index
@@ -88,17 +89,21 @@ def mdsscatter(
     ODIR = 'figures'
     print('.')
 
-    dataDf = raw_data[['dom1', 'dom2', colname]]
-    dataDf = dataDf[dataDf[colname] >= thresh]
+    # domains ordered by name, without the pairs below the threshold
+    index = np.argsort(matrix.domains())
+    scores = matrix.square(colname, index)
+    scores[scores < thresh] = np.nan
+    kept = ~np.all(np.isnan(scores), axis=1)
     #
-    dom_dist = 1 - dataDf.pivot(index='dom1', columns='dom2', values=colname)
+    dom_dist = 1 - scores[np.ix_(kept, kept)]
 
-    Y_c = list(map(lambda x: int(cath_c_dict[x]), dom_dist.index))
+    Y_c = list(map(lambda x: int(cath_c_dict[x]),
+                   matrix.domains()[index][kept]))
     f = '%s%s%s.coord.%d.%f.txt' % (ODIR, os.path.sep, colname, fill, thresh)
     if os.path.isfile(f):
         o = np.loadtxt(f)
     else:
-        X = dom_dist.replace(np.nan, fill).as_matrix()
+        X = np.where(np.isnan(dom_dist), fill, dom_dist)
         np.fill_diagonal(X, 0)
         mds = MDS(
             n_components=2,
@@ -130,43 +135,36 @@ def make(
     n_jobs=16,
         psc_cols=[]):
     """ Manages creation of MDS based scatter plots. Reades in pairwise domain
-    PSC and MCPSC scores from a file. MDS followed by scatter plots are then
-    generated for each PSC method.
+    PSC and MCPSC scores from the MCPSC score matrix. MDS followed by scatter
+    plots are then generated for each PSC method.
 
     :param outdir: (string) Path to output directory where processed data files can be found
     :param n_jobs: (int) Number of parallel threads that can be used for the MDS step
     :param psc_cols: (list) List of psc method names to be included in mean calculations
     :rtype: None
     """
-    raw_data = pd.read_csv(
-        '%s%sprocessed.imputed.mcpsc.csv' %
-        (outdir, os.path.sep))
+    cols = list(map(lambda x: '%s_fill_mean' % x, psc_cols)) + list(
+        map(lambda x: 'mcpsc_fill_%d' % x, range(5))) + ['mcpsc_fill_median']
+    matrix = PSC_SCORE_MATRIX(outdir, MCPSC)
+    stored = matrix.columns()
+    cols = list(filter(lambda x: x in stored, cols))
 
     cl = list('bgrcmykkkkk')
     classes = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k']  # SCOP
 
     classes_dict = dict(zip(classes, range(len(classes))))
     cath_c_dict = dict()
-    idx = 0
     cath_a_dict = dict()
-    for line in open(
-        '%s%sprocessed.imputed.mcpsc.csv' %
-            (outdir, os.path.sep)):
-        idx += 1
-        if idx == 1:
-            continue
-        data = line.split(',')
-        d = data[4].split('.')
-        cath_c_dict[data[2]] = classes_dict[d[0]]
-        cath_a_dict[data[2]] = '.'.join(d[:2])
+    for dom, cath in zip(matrix.domains(), matrix.classifications()):
+        d = cath.split('.')
+        cath_c_dict[dom] = classes_dict[d[0]]
+        cath_a_dict[dom] = '.'.join(d[:2])
 
     print('Make MDS scatter plots')
-    for x in list(map(lambda x: '%s_fill_mean' %
-                      x, psc_cols)) + list(map(lambda x: 'mcpsc_fill_%d' %
-                                               x, range(5))) + ['mcpsc_fill_median']:
+    for x in cols:
         try:
             mdsscatter(
-                raw_data,
+                matrix,
                 classes,
                 cl,
                 classes_dict,
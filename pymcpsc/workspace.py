@@ -0,0 +1,158 @@
+# This code is part of the pymcpsc distribution and governed by its
+# license.  Please see the LICENSE.md file.
+""" Reusable scratch workspace for the external PSC binaries.
+
+Classes:
+    - *PSC_WORKSPACE*: run workspace with staged inputs and per worker scratch directories
+
+Functions:
+    - *default_base_dir*: directory the workspaces are created in by default
+
+A workspace is created once per run, on tmpfs (/dev/shm) where available. It
+holds a copy of the pom database CE expects in its working directory, so that
+CE is executed inside the workspace and concurrent runs started from the same
+directory no longer share a pom copy. Input PDB files are staged into the
+workspace on first use and read from there by all workers. Every worker
+process gets one scratch directory that is reused for all of its pairs;
+between pairs the files in it are truncated rather than the directory being
+removed and created again, which avoids most of the file system metadata
+operations otherwise done per pair. Directories left in it by a binary are
+removed.
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+
+SHM = '/dev/shm'
+
+
+def default_base_dir():
+    """ Directory workspaces are created in by default, tmpfs if available
+    and the system temporary directory otherwise.
+
+    :rtype: (string) Path to the directory
+    """
+    if os.path.isdir(SHM) and os.access(SHM, os.W_OK | os.X_OK):
+        return SHM
+    return tempfile.gettempdir()
+
+
+class PSC_WORKSPACE:
+
+    def __init__(self, baseDir=None, pomPath=None):
+        """ Create the workspace and stage the pom database
+
+        :param baseDir: (string) Directory to create the workspace in, None for the default
+        :param pomPath: (string) Path to the pom database of CE, None if CE is not used
+        :rtype: None
+        """
+        if baseDir is None:
+            baseDir = default_base_dir()
+        elif not os.path.exists(baseDir):
+            os.makedirs(baseDir)
+        self.root = tempfile.mkdtemp(prefix='pymcpsc-', dir=baseDir)
+        self._pdbDir = '%s%spdb' % (self.root, os.path.sep)
+        os.makedirs(self._pdbDir)
+        if pomPath is not None:
+            shutil.copytree(pomPath, '%s%spom' % (self.root, os.path.sep))
+        # per process state, rebuilt in every worker
+        self._staged = {}
+        self._scratch = {}
+        self._pid = None
+
+    def __getstate__(self):
+        """ Drop the per process state when the workspace is sent to a worker
+
+        :rtype: (dict) Picklable state
+        """
+        state = self.__dict__.copy()
+        state['_staged'] = {}
+        state['_scratch'] = {}
+        state['_pid'] = None
+        return state
+
+    def stage(self, fname):
+        """ Copy an input file into the workspace, once per run. Workers
+        staging the same file concurrently each write a private copy and
+        atomically rename it into place.
+
+        :param fname: (string) Path to the input file
+        :rtype: (string) Path to the staged copy
+        """
+        staged = self._staged.get(fname)
+        if staged is not None:
+            return staged
+        path = os.path.abspath(fname)
+        staged = '%s%s%s_%s' % (
+            self._pdbDir, os.path.sep,
+            hashlib.sha1(path.encode('utf-8')).hexdigest()[:12],
+            os.path.basename(path))
+        if not os.path.exists(staged):
+            part = '%s.%d' % (staged, os.getpid())
+            shutil.copyfile(path, part)
+            os.rename(part, staged)
+        self._staged[fname] = staged
+        return staged
+
+    def put(self, fname, data):
+        """ Write the contents of an input file that is not readable locally,
+        e.g. one received from another node, as its staged copy
+
+        :param fname: (string) Path to the input file on its node
+        :param data: (bytes) Contents of the file
+        :rtype: (string) Path to the staged copy
+        """
+        staged = '%s%s%s_%s' % (
+            self._pdbDir, os.path.sep,
+            hashlib.sha1(fname.encode('utf-8')).hexdigest()[:12],
+            os.path.basename(fname))
+        part = '%s.%d' % (staged, os.getpid())
+        out = open(part, 'wb')
+        out.write(data)
+        out.close()
+        os.rename(part, staged)
+        self._staged[fname] = staged
+        return staged
+
+    def scratch(self, slot=None):
+        """ Scratch directory of the calling process. It is created on first
+        use, on later calls the files left in it by the previous pair are
+        truncated, and directories and symbolic links left in it removed. A
+        process executing several binaries at a time uses one
+        scratch directory per execution slot.
+
+        :param slot: (int) Execution slot of the calling process, None if it executes one binary at a time
+        :rtype: (string) Path to the scratch directory
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._scratch = {}
+        scratch = self._scratch.get(slot)
+        if scratch is None:
+            name = '%d' % self._pid
+            if slot is not None:
+                name = '%d-%d' % (self._pid, slot)
+            scratch = '%s%sscratch%s%s' % (
+                self.root, os.path.sep, os.path.sep, name)
+            if not os.path.exists(scratch):
+                os.makedirs(scratch)
+            self._scratch[slot] = scratch
+            return scratch
+        for name in os.listdir(scratch):
+            path = '%s%s%s' % (scratch, os.path.sep, name)
+            if os.path.islink(path):
+                # truncating would empty the file it points to
+                os.remove(path)
+            elif os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                open(path, 'w').close()
+        return scratch
+
+    def remove(self):
+        """ Remove the workspace with all staged files and scratch directories
+
+        :rtype: None
+        """
+        shutil.rmtree(self.root, ignore_errors=True)
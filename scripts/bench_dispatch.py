@@ -0,0 +1,121 @@
+#
+"""
+This is a microbenchmark of the per pair overhead of dispatching pairwise PSC
+jobs to the worker pool and of starting the PSC binaries.
+
+The PSC binary is replaced by /bin/true, so that the measured time is the
+overhead alone. Three variants are compared:
+
+    - *old*: one pool task per pair, each task pickling the handler along with
+      the pair, the binary started through /bin/sh
+    - *spawn*: as old, but the binary is executed directly (posix_spawn where
+      available)
+    - *new*: the handler installed once per worker, tasks sent as chunks of
+      pair indices through PSC_SCHEDULER, the binary executed directly
+
+Usage:
+    python scripts/bench_dispatch.py [-n PAIRS] [-t THREADS]
+"""
+import os
+import sys
+import argparse
+import subprocess
+from multiprocessing import Pool
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from pymcpsc.execute import run_command
+from pymcpsc.scheduler import PSC_SCHEDULER
+
+TRUE = '/bin/true'
+
+
+class TRUE_HANDLER:
+
+    def __init__(self, shell, payload):
+        """ Set how to start the binary
+
+        :param shell: (boolean) Start the binary through the shell
+        :param payload: (int) Bytes of handler state pickled with every task
+        """
+        self._shell = shell
+        # stands in for the state of a real handler, e.g. paths and the cache
+        self._payload = 'x' * payload
+
+    def process_pair(self, fname1, fname2, pdbextn):
+        """ Run the binary for a pair
+
+        :rtype: (list) Output data in the format of the PSC handlers
+        """
+        if self._shell:
+            proc = subprocess.Popen('%s %s %s' % (TRUE, fname1, fname2),
+                                    shell=True, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            proc.communicate()
+        else:
+            run_command([TRUE, fname1, fname2])
+        return [[fname1, fname2]]
+
+
+def true_process_pair(ps):
+    """ convinience method for the benchmark handler
+
+    :param ps: (tuple) Handler object, pair and unused lock
+    """
+    return ps[0].process_pair(*ps[1])
+
+
+def old_dispatch(handler, pairs, threads):
+    """ Dispatch one task per pair, pickling the handler with every task
+
+    :rtype: (float) Seconds spent
+    """
+    start = timer()
+    p = Pool(threads)
+    list(p.imap_unordered(true_process_pair,
+                          [(handler, x, None) for x in pairs]))
+    p.close()
+    p.join()
+    return timer() - start
+
+
+def new_dispatch(handler, pairs, threads):
+    """ Dispatch chunks of pair indices through the scheduler
+
+    :rtype: (float) Seconds spent
+    """
+    start = timer()
+    scheduler = PSC_SCHEDULER(threads)
+    out = []
+    scheduler.add_pairs('usm', true_process_pair, handler, pairs,
+                        out.append, lambda: None)
+    scheduler.run()
+    return timer() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure the per pair dispatch overhead.')
+    parser.add_argument('-n', '--pairs', default=2000, type=int,
+                        help='Number of pairs (default: 2000)')
+    parser.add_argument('-t', '--threads', default=4, type=int,
+                        help='Number of worker processes (default: 4)')
+    parser.add_argument('--payload', default=4096, type=int,
+                        help='Bytes of handler state (default: 4096)')
+    args = parser.parse_args()
+
+    pairs = [('a%d.ent' % i, 'b%d.ent' % i, '.ent')
+             for i in range(args.pairs)]
+    results = [
+        ('old', old_dispatch(TRUE_HANDLER(True, args.payload), pairs,
+                             args.threads)),
+        ('spawn', old_dispatch(TRUE_HANDLER(False, args.payload), pairs,
+                               args.threads)),
+        ('new', new_dispatch(TRUE_HANDLER(False, args.payload), pairs,
+                             args.threads))]
+    print('')
+    print('%-8s %10s %14s' % ('variant', 'seconds', 'us/pair/core'))
+    for name, secs in results:
+        print('%-8s %10.3f %14.1f' % (
+            name, secs, 1e6 * secs * args.threads / args.pairs))
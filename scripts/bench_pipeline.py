@@ -0,0 +1,484 @@
+#
+"""
+This is a benchmark of every stage of the pyMCPSC pipeline as executed by
+run-pymcpsc: the pairwise PSC run (with the seconds until each of its
+methods completed, from the metrics of the run), post processing,
+imputation, MCPSC consensus, nearest-neighbor classification, ROC curves,
+MDS and clustering, heatmaps and phylogenetic trees.
+
+Each stage runs in a fresh child process on the output of the previous
+stages, so that the peak resident memory of the process (and of the PSC
+binaries it starts) can be attributed to the stage. The pipeline modules are
+only imported by the children. The wall time of a stage is the best of
+--repeat runs of the pipeline, its peak memory the smallest. A stage that
+fails is recorded with its error and left out of the comparison.
+
+The pairwise stage runs on the bundled proteus dataset by default, or on the
+first --domains domains of it. The result cache is disabled. Larger inputs
+for the stages after the pairwise run are benchmarked on --synthetic
+results of N domains, written by pymcpsc.synthetic before the stages run,
+or by pointing --results at a work directory holding pairwise results, e.g.
+of a previous run. The pairwise stage is skipped in both cases.
+
+The measurements are written as JSON with --output. Given a --baseline file
+written that way, every stage slower or using more memory than the baseline
+by more than --tolerance (and by more than --min-seconds, --min-mb) is
+reported as a regression and the exit status is 1.
+
+Usage:
+    python scripts/bench_pipeline.py [-d DATADIR] [-g GTIN] [-n DOMAINS]
+        [--synthetic N [--density DENSITY]] [--results WORKDIR] [-t THREADS] [--stages STAGES] [--repeat REPEAT]
+        [-o OUTPUT] [-b BASELINE] [--tolerance TOLERANCE]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import traceback
+from multiprocessing import Process, Pipe
+from timeit import default_timer as timer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import pymcpsc
+
+_base_dir = os.path.dirname(pymcpsc.__file__)
+DATADIR = os.path.join(_base_dir, 'testdata', 'proteus')
+GTIN = os.path.join(_base_dir, 'testdata', 'ground_truth_proteus')
+PROGDIR = os.path.join(_base_dir, 'ext', 'x86_64', 'linux')
+WEIGHTS = '2.55,1.79,4.23,14.36,-0.38'
+PSC_METHODS = ['ce', 'fast', 'gralign', 'tmalign', 'usm']
+
+
+def _conf(settings):
+    """ Configuration of the pipeline as set up by run-pymcpsc
+
+    :param settings: (dict) Benchmark settings
+    :rtype: (CONF) Configuration
+    """
+    from pymcpsc.run_pymcpsc import CONF
+    conf = CONF()
+    conf.set_data_dir(settings['datadir'])
+    conf.set_pdb_extn(settings['pdbextn'])
+    conf.set_gtin(settings['gtin'])
+    conf.set_threads(settings['threads'])
+    conf.set_weights(settings['weights'])
+    conf.set_prog_dir(settings['progdir'])
+    conf.set_cache_dir(None)
+    conf.WORKDIR = settings['workdir']
+    conf.OUTDIR = settings['outdir']
+    return conf
+
+
+def _weights(conf):
+    """ Weights of the PSC methods as passed on by run-pymcpsc
+
+    :rtype: (list) Weights, None for the default
+    """
+    if conf.WEIGHTS is None:
+        return None
+    return list(map(float, conf.WEIGHTS.split(',')))
+
+
+def stage_pairwise(conf):
+    from pymcpsc.run import RunPairwisePSC
+    if not RunPairwisePSC().run(conf):
+        raise RuntimeError('pairwise PSC run failed')
+
+
+def stage_postprocessing(conf):
+    from pymcpsc.postprocessing import PostProcessor
+    PostProcessor().run(conf)
+
+
+def stage_impute(conf):
+    from pymcpsc.impute import make
+    make(conf.OUTDIR)
+
+
+def stage_mcpsc(conf):
+    from pymcpsc.mcpsc import make
+    if conf.WEIGHTS is None:
+        make(conf.OUTDIR, psc_cols=PSC_METHODS)
+    else:
+        make(conf.OUTDIR, _weights(conf), psc_cols=PSC_METHODS)
+
+
+def stage_nnclassify(conf):
+    from pymcpsc.nnclassify import make
+    make(conf.OUTDIR, conf.WEIGHTS is not None, psc_cols=PSC_METHODS)
+
+
+def stage_rocauc(conf):
+    from pymcpsc.rocauc import make
+    make(conf.OUTDIR, conf.WEIGHTS is not None, psc_cols=PSC_METHODS)
+
+
+def stage_mixedroc(conf):
+    from pymcpsc.mixedroc import make
+    make(conf.OUTDIR, conf.WEIGHTS is not None)
+
+
+def stage_visualize2(conf):
+    from pymcpsc.visualize2 import make
+    make(conf.OUTDIR, conf.THREADS, psc_cols=PSC_METHODS)
+
+
+def stage_heatmaps(conf):
+    from pymcpsc.heatmaps import make
+    make(conf.OUTDIR, psc_cols=PSC_METHODS)
+
+
+def stage_phylo(conf):
+    from pymcpsc.phylo import make
+    make(conf.OUTDIR, conf.WORKDIR, psc_cols=PSC_METHODS,
+         psc_names=PSC_METHODS)
+
+
+# stages in pipeline order, and whether they need a ground truth
+STAGES = [
+    ('pairwise', stage_pairwise, False),
+    ('postprocessing', stage_postprocessing, False),
+    ('impute', stage_impute, False),
+    ('mcpsc', stage_mcpsc, False),
+    ('nnclassify', stage_nnclassify, True),
+    ('rocauc', stage_rocauc, True),
+    ('mixedroc', stage_mixedroc, True),
+    ('visualize2', stage_visualize2, True),
+    ('heatmaps', stage_heatmaps, True),
+    ('phylo', stage_phylo, True)]
+
+
+def _peak_mb(who):
+    """ Peak resident memory of this process or of its waited for children
+
+    :rtype: (float) Peak memory in MB, None if unknown
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024. * 1024. if sys.platform == 'darwin' else 1024.)
+
+
+def _measure(fn, settings, conn):
+    """ Child process entry point running a stage
+
+    :param fn: (function) Stage to run
+    :param settings: (dict) Benchmark settings
+    :param conn: (Connection) Pipe the measurement is sent back on
+    """
+    error = None
+    start = timer()
+    try:
+        fn(_conf(settings))
+    except BaseException:
+        error = traceback.format_exc().strip().split('\n')[-1]
+    secs = timer() - start
+    peak = None
+    if resource is not None:
+        peak = max(_peak_mb(resource.RUSAGE_SELF),
+                   _peak_mb(resource.RUSAGE_CHILDREN))
+    conn.send((secs, peak, error))
+    conn.close()
+
+
+def run_stage(name, fn, settings):
+    """ Run a stage in a child process
+
+    :param name: (string) Stage name
+    :param fn: (function) Stage to run
+    :param settings: (dict) Benchmark settings
+    :rtype: (dict) Seconds, peak memory in MB and error of the stage
+    """
+    print('== %s' % name)
+    sys.stdout.flush()
+    parent, child = Pipe(False)
+    p = Process(target=_measure, args=(fn, settings, child))
+    p.start()
+    child.close()
+    try:
+        secs, peak, error = parent.recv()
+    except EOFError:
+        secs, peak, error = None, None, 'stage process exited with status ' \
+            '%s' % p.exitcode
+    p.join()
+    if error is not None:
+        print('%s failed: %s' % (name, error))
+        return {'error': error}
+    return {'seconds': secs, 'peak_mb': peak}
+
+
+def pairwise_methods(workdir):
+    """ Seconds until each pairwise method completed, as recorded in the
+    metrics of the pairwise run
+
+    :param workdir: (string) Work directory of the run
+    :rtype: (dict) Seconds per PSC method
+    """
+    from pymcpsc.metrics import JSON
+    fname = os.path.join(workdir, JSON)
+    if not os.path.exists(fname):
+        return {}
+    methods = json.load(open(fname))['methods']
+    return dict(map(lambda x: (x, methods[x]['elapsed_seconds']), methods))
+
+
+def subset(datadir, gtin, pdbextn, domains, workdir):
+    """ Link the first domains of a dataset into a data directory and keep
+    the ground truth rows of their pairs, or of the domains for a
+    classification ground truth
+
+    :rtype: (tuple) Data directory and ground truth file of the subset
+    """
+    names = sorted(filter(lambda x: x.endswith('.' + pdbextn),
+                          os.listdir(datadir)))[:domains]
+    subdir = os.path.join(workdir, 'data')
+    os.makedirs(subdir)
+    for name in names:
+        os.symlink(os.path.abspath(os.path.join(datadir, name)),
+                   os.path.join(subdir, name))
+    if gtin is None:
+        return subdir, None
+    keep = set(map(lambda x: x[:-len(pdbextn) - 1], names))
+    subgt = os.path.join(workdir, 'ground_truth')
+    out = open(subgt, 'w')
+    for line in open(gtin):
+        data = line.rstrip('\n').split('\t')
+        # domain and classification, or a pair of domains
+        if len(data) == 2 and data[0] in keep or \
+                len(data) > 2 and data[0] in keep and data[1] in keep:
+            out.write(line)
+    out.close()
+    return subdir, subgt
+
+
+def run_pipeline(args, base):
+    """ Run the selected stages once
+
+    :rtype: (dict) Measurements per stage
+    """
+    settings = {'datadir': args.datadir, 'gtin': args.gtin,
+                'pdbextn': args.pdbextn, 'threads': args.threads,
+                'weights': args.weights, 'progdir': args.progdir,
+                'workdir': args.results or os.path.join(base, 'work'),
+                'outdir': os.path.join(base, 'outdir')}
+    if args.domains is not None:
+        settings['datadir'], settings['gtin'] = subset(
+            args.datadir, args.gtin, args.pdbextn, args.domains, base)
+    skip = args.results is not None
+    if args.synthetic is not None:
+        from pymcpsc.synthetic import make
+        settings['gtin'] = os.path.join(base, 'ground_truth')
+        os.makedirs(settings['workdir'])
+        start = timer()
+        pairs = make(settings['workdir'], args.synthetic, settings['gtin'],
+                     density=args.density)
+        print('%d synthetic domains, %d pairs written in %0.1f seconds' % (
+            args.synthetic, pairs, timer() - start))
+        skip = True
+    results = {}
+    for name, fn, needs_gt in STAGES:
+        if name not in args.stages:
+            continue
+        if name == 'pairwise' and skip:
+            continue
+        if needs_gt and settings['gtin'] is None:
+            print('== %s skipped, no ground truth' % name)
+            continue
+        results[name] = run_stage(name, fn, settings)
+        if name == 'pairwise' and 'error' not in results[name]:
+            for methodname, secs in pairwise_methods(
+                    settings['workdir']).items():
+                results['pairwise:%s' % methodname] = {'seconds': secs}
+    return results
+
+
+def best(runs):
+    """ Best measurement of each stage over several runs
+
+    :param runs: (list) Measurements per stage of each run
+    :rtype: (dict) Smallest seconds and peak memory of each stage, the error of stages failing in any run
+    """
+    stages = {}
+    for results in runs:
+        for name, res in results.items():
+            prev = stages.get(name)
+            if prev is not None and 'error' in prev:
+                continue
+            if prev is None or 'error' in res:
+                stages[name] = dict(res)
+                continue
+            for key in ['seconds', 'peak_mb']:
+                if res.get(key) is not None:
+                    stages[name][key] = min(stages[name][key], res[key])
+    return stages
+
+
+def _order(name):
+    """ Sort key of a stage name in pipeline order
+
+    :rtype: (tuple) Position of the stage and the name
+    """
+    names = list(map(lambda x: x[0], STAGES))
+    return names.index(name.split(':')[0]), name
+
+
+def compare(stages, baseline, tolerance, minSeconds, minMb):
+    """ Compare the measurements with a baseline and print them
+
+    :param stages: (dict) Measurements per stage
+    :param baseline: (dict) Baseline measurements per stage, None for none
+    :param tolerance: (float) Allowed relative increase, e.g. 0.25
+    :param minSeconds: (float) Allowed absolute increase of the seconds
+    :param minMb: (float) Allowed absolute increase of the peak memory
+    :rtype: (list) Names of the stages that regressed
+    """
+    regressions = []
+    print('')
+    print('%-16s %10s %10s %10s %10s  %s' % (
+        'stage', 'seconds', 'base', 'peak MB', 'base', ''))
+    for name in sorted(stages, key=_order):
+        res = stages[name]
+        if 'error' in res:
+            print('%-16s %s' % (name, res['error']))
+            continue
+        ref = (baseline or {}).get(name, {})
+        flags = []
+        for key, floor in [('seconds', minSeconds), ('peak_mb', minMb)]:
+            if res.get(key) is None or ref.get(key) is None:
+                continue
+            if res[key] > ref[key] * (1 + tolerance) and \
+                    res[key] - ref[key] > floor:
+                flags.append('%s +%0.0f%%' % (key, 100. * (
+                    res[key] / ref[key] - 1) if ref[key] > 0 else 100.))
+
+        def fmt(x, key):
+            return '%10.2f' % x[key] if x.get(key) is not None else \
+                '%10s' % '-'
+
+        print('%-16s %s %s %s %s  %s' % (
+            name, fmt(res, 'seconds'), fmt(ref, 'seconds'),
+            fmt(res, 'peak_mb'), fmt(ref, 'peak_mb'),
+            'REGRESSION ' + ', '.join(flags) if flags else ''))
+        if flags:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure the wall time and peak memory of every stage '
+                    'of the pyMCPSC pipeline.')
+    parser.add_argument('-d', '--datadir', default=DATADIR,
+                        help='Directory containing the PDB files (default: '
+                             'proteus dataset)')
+    parser.add_argument('-g', '--gtin', default=None,
+                        help='Ground truth file (default: proteus ground '
+                             'truth for the proteus dataset, none otherwise)')
+    parser.add_argument('-e', '--pdbextn', default='ent',
+                        help='Extension of the PDB files (default: ent)')
+    parser.add_argument('-n', '--domains', default=None, type=int,
+                        help='Use the first DOMAINS domains of the dataset '
+                             '(default: all)')
+    parser.add_argument('--synthetic', default=None, type=int, metavar='N',
+                        help='Post process synthetic results of N domains, '
+                             'skipping the pairwise stage')
+    parser.add_argument('--density', default=1.0, type=float,
+                        help='Share of the pairs of the synthetic domains '
+                             'scored (default: 1)')
+    parser.add_argument('--results', default=None,
+                        help='Work directory holding pairwise results to '
+                             'post process, skipping the pairwise stage')
+    parser.add_argument('-t', '--threads', default=4, type=int,
+                        help='Number of threads (default: 4)')
+    parser.add_argument('-p', '--progdir', default=PROGDIR,
+                        help='Directory containing the PSC binaries '
+                             '(default: pre packed)')
+    parser.add_argument('-w', '--weights', default=WEIGHTS,
+                        help='Weights of the PSC methods (default: %s)' %
+                             WEIGHTS)
+    parser.add_argument('--stages', default=','.join(map(
+        lambda x: x[0], STAGES)),
+        help='Comma separated stages to run (default: all)')
+    parser.add_argument('--repeat', default=1, type=int,
+                        help='Number of pipeline runs, the best is kept '
+                             '(default: 1)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Write the measurements as JSON, e.g. as a new '
+                             'baseline')
+    parser.add_argument('-b', '--baseline', default=None,
+                        help='JSON measurements to compare with')
+    parser.add_argument('--tolerance', default=0.25, type=float,
+                        help='Allowed relative increase over the baseline '
+                             '(default: 0.25)')
+    parser.add_argument('--min-seconds', default=1.0, type=float,
+                        help='Allowed absolute increase of the seconds of a '
+                             'stage (default: 1.0)')
+    parser.add_argument('--min-mb', default=20.0, type=float,
+                        help='Allowed absolute increase of the peak memory '
+                             'of a stage (default: 20)')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the work directories')
+    args = parser.parse_args()
+    args.stages = args.stages.split(',')
+    unknown = set(args.stages) - set(map(lambda x: x[0], STAGES))
+    if len(unknown) > 0:
+        parser.error('unknown stages %s' % ', '.join(sorted(unknown)))
+    if args.gtin is None and args.datadir == DATADIR:
+        args.gtin = GTIN
+    if args.results is not None:
+        args.results = os.path.abspath(args.results)
+
+    baseline = None
+    if args.baseline is not None:
+        baseline = json.load(open(args.baseline))
+        for key in ['datadir', 'domains', 'synthetic', 'density', 'results',
+                    'threads']:
+            if baseline['settings'].get(key) != getattr(args, key):
+                print('warning: baseline %s was %s' % (
+                    key, baseline['settings'].get(key)))
+
+    runs = []
+    for r in range(args.repeat):
+        base = tempfile.mkdtemp(prefix='pymcpsc-bench-')
+        try:
+            runs.append(run_pipeline(args, base))
+        finally:
+            if args.keep:
+                print('work directory kept in %s' % base)
+            else:
+                shutil.rmtree(base, ignore_errors=True)
+    stages = best(runs)
+
+    regressions = compare(stages, None if baseline is None else
+                          baseline['stages'], args.tolerance,
+                          args.min_seconds, args.min_mb)
+    if args.output is not None:
+        out = open(args.output, 'w')
+        json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'settings': {'datadir': args.datadir,
+                                'domains': args.domains,
+                                'synthetic': args.synthetic,
+                                'density': args.density,
+                                'results': args.results,
+                                'threads': args.threads,
+                                'repeat': args.repeat},
+                   'stages': stages}, out, indent=1, sort_keys=True)
+        out.close()
+        print('measurements written to %s' % args.output)
+    if len(regressions) > 0:
+        print('%d stages regressed: %s' % (len(regressions),
+                                           ', '.join(regressions)))
+        sys.exit(1)
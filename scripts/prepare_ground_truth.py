@@ -8,23 +8,43 @@ current working directory. A sample input file (for this scritp) can be
 seen at tests/chew_kedem_dataset/scop_classifications.csv.
 
 The output ground truth file is written to the current working directory.
+It lists the classification of each domain, all pairs of different domains
+are benchmarked (see pymcpsc.groundtruth). With --convert a pairwise ground
+truth file, with a line per pair of domains, is converted to the
+classifications of its domains instead.
+
+Usage:
+    python scripts/prepare_ground_truth.py [-i INPUT] [-o OUTPUT] [--convert PAIRWISE]
 """
+import argparse
 
+from pymcpsc.groundtruth import write_classification, convert
 
-# read classification data
-data = []
-for inline in open('scop_classifications.csv'):
-    dom, scop = inline.replace(' ', '').replace('\n','').split(',')
-    data.append([dom, scop])
+parser = argparse.ArgumentParser(
+    description='Prepare the ground truth file of pyMCPSC.')
+parser.add_argument('-i', '--input', default='scop_classifications.csv',
+                    help='Comma separated domain names and classifications '
+                         '(default: scop_classifications.csv)')
+parser.add_argument('-o', '--output', default='ground_truth',
+                    help='Ground truth file written (default: ground_truth)')
+parser.add_argument('--convert', default=None, metavar='PAIRWISE',
+                    help='Convert this pairwise ground truth file instead of '
+                         'reading INPUT')
+args = parser.parse_args()
 
-# create dom to class dict
-dom_scop = dict(data)
+if args.convert is not None:
+    print('%d domains written' % convert(args.convert, args.output))
+else:
+    # read classification data
+    data = []
+    for inline in open(args.input):
+        if inline.strip() == '':
+            continue
+        dom, scop = inline.replace(' ', '').replace('\n', '').split(',')
+        data.append([dom, scop])
 
-# prepare all-to-all groundtruth file (triangular)
-of = open('ground_truth', 'w')
-doms = dom_scop.keys()
-for i in range(len(dom_scop)):
-    for j in range(i + 1, len(dom_scop)):
-        outstr = '%s\t%s\t%s\t%s\n' %(doms[i], doms[j], dom_scop[doms[i]], dom_scop[doms[j]])
-        of.write(outstr)
-of.close()
\ No newline at end of file
+    # create dom to class dict, the last classification of a domain wins
+    dom_scop = dict(data)
+    doms = list(dom_scop.keys())
+    write_classification(args.output, doms, list(map(dom_scop.get, doms)))
+    print('%d domains written' % len(doms))
@@ -24,7 +24,7 @@ elif sys.version_info[0] == 3 and sys.version_info[:2] < (3, 5):
 
 if sys.version_info < (3, 0):
     install_requires = ['numpy>=1.9',
-                        'pandas>=0.17',
+                        'pandas>=0.21',
                         'scikit-learn>=0.16',
                         'matplotlib>=1.4',
                         'seaborn>=0.6',
@@ -32,7 +32,7 @@ if sys.version_info < (3, 0):
                         'ete3<3.1'],
 else:
     install_requires = ['numpy>=1.10',
-                        'pandas>=0.18',
+                        'pandas>=0.21',
                         'scikit-learn>=0.17',
                         'matplotlib>=1.5',
                         'seaborn>=0.8',
@@ -5,23 +5,61 @@ import os
 import sys
 import subprocess
 import shutil
+import tempfile
+import time
+import pickle
+import json
+import threading
+from multiprocessing import Pool
+from multiprocessing.connection import Client
 
 import pymcpsc.mcpsc as m1
 import pymcpsc.run as run
+import pymcpsc.cache as cache
+import pymcpsc.incremental as incremental
+import pymcpsc.scheduler as scheduler
+import pymcpsc.journal as journal
+import pymcpsc.execute as execute
+import pymcpsc.workspace as workspace
+import pymcpsc.usm as usm
+import pymcpsc.prefilter as prefilter
+import pymcpsc.impute as impute
+import pymcpsc.structures as structures
+import pymcpsc.sparse as sparse
+import pymcpsc.postprocessing as postprocessing
+import pymcpsc.distributed as distributed
+import pymcpsc.shards as shards
+import pymcpsc.metrics as metrics
+import pymcpsc.synthetic as synthetic
+import pymcpsc.profiling as profiling
+import pymcpsc.scorestore as scorestore
+import pymcpsc.scorematrix as scorematrix
+import pymcpsc.groundtruth as groundtruth
+import pymcpsc.scaling as scaling
+if sys.version_info >= (3, 5):
+    import asyncio
+    import pymcpsc.asyncexec as asyncexec
 
 
-def setUpClass(cls):
+def fail_locally(args):
     '''
-    Setup class data to be used in multiple tests to avoid duplication. Also
-    include any heavy initializations here.
+    PSC convinience method failing like a worker whose scratch space is full.
     '''
-    cls.FNULL = open(os.devnull, 'w')
-    cls.base_dir = os.path.dirname(m1.__file__)
-    cls.exec_dir = os.path.join(cls.base_dir, 'ext', 'x86_64', 'linux')
+    raise IOError('No space left on device')
 
 
 class TestPymcpsc(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        '''
+        Setup class data to be used in multiple tests to avoid duplication. Also
+        include any heavy initializations here.
+        '''
+        cls.FNULL = open(os.devnull, 'w')
+        cls.base_dir = os.path.dirname(m1.__file__)
+        cls.exec_dir = os.path.join(cls.base_dir, 'ext', 'x86_64', 'linux')
+
     def test_W1(self):
         '''
         Test method that generates weight vector based on size of non-null
@@ -169,7 +207,1238 @@ class TestPymcpsc(unittest.TestCase):
         self.assertEqual(run_output,
                          [['d1a04a2.', 'd1cqxa1.', '45', '138', '150', '4.970']])
 
+    def test_Cache_Roundtrip(self):
+        '''
+        Test that cached PSC output is keyed by file contents and returned
+        with the domain names of the current lookup.
+        '''
+        pdb_file_path = os.path.dirname(os.path.abspath(__file__))
+        pdb_file1 = os.path.join(pdb_file_path, 'd1a04a2.ent')
+        pdb_file2 = os.path.join(pdb_file_path, 'd1cqxa1.ent')
+        cache_dir = tempfile.mkdtemp()
+        try:
+            psc_cache = cache.PSC_CACHE(cache_dir)
+            self.assertIsNone(psc_cache.get(
+                'fast', 'x', pdb_file1, pdb_file2, ['a', 'b']))
+            psc_cache.put('fast', 'x', pdb_file1, pdb_file2,
+                          [['a', 'b', '45', '138', '150', '4.970']])
+            copy_file = os.path.join(cache_dir, 'copy.ent')
+            shutil.copy(pdb_file1, copy_file)
+            self.assertEqual(
+                psc_cache.get('fast', 'x', copy_file, pdb_file2, ['c', 'b']),
+                [['c', 'b', '45', '138', '150', '4.970']])
+            self.assertIsNone(psc_cache.get(
+                'fast', 'y', pdb_file1, pdb_file2, ['a', 'b']))
+            stats = psc_cache.stats()
+            self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_Cache_Eviction(self):
+        '''
+        Test that least recently used entries are evicted once the cache
+        grows beyond its size bound.
+        '''
+        pdb_file_path = os.path.dirname(os.path.abspath(__file__))
+        pdb_file1 = os.path.join(pdb_file_path, 'd1a04a2.ent')
+        pdb_file2 = os.path.join(pdb_file_path, 'd1cqxa1.ent')
+        cache_dir = tempfile.mkdtemp()
+        try:
+            psc_cache = cache.PSC_CACHE(cache_dir, 300)
+            for i in range(10):
+                psc_cache.put('usm', str(i), pdb_file1, pdb_file2,
+                              [['a', 'b', '%f' % i]])
+            stats = psc_cache.stats()
+            self.assertGreater(stats['evictions'], 0)
+            self.assertLessEqual(stats['bytes'], 300)
+            self.assertIsNone(psc_cache.get(
+                'usm', '0', pdb_file1, pdb_file2, ['a', 'b']))
+            self.assertEqual(psc_cache.get(
+                'usm', '9', pdb_file1, pdb_file2, ['a', 'b']),
+                [['a', 'b', '9.000000']])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_Cache_Exec_TMALIGN(self):
+        '''
+        Test that a cached TM-align handler serves repeated pairs from the
+        cache.
+        '''
+        pdb_file_path = os.path.dirname(os.path.abspath(__file__))
+        pdb_file1 = os.path.join(pdb_file_path, 'd1a04a2.ent')
+        pdb_file2 = os.path.join(pdb_file_path, 'd1cqxa1.ent')
+        cache_dir = tempfile.mkdtemp()
+        try:
+            psc_cache = cache.PSC_CACHE(cache_dir)
+            tm_runner = run.TM_HANDLER(
+                os.path.join(self.exec_dir, 'tmalign'), psc_cache)
+            first = tm_runner.process_pair(pdb_file1, pdb_file2, 'ent')
+            second = tm_runner.process_pair(pdb_file1, pdb_file2, 'ent')
+            self.assertEqual(first, second)
+            self.assertEqual(psc_cache.stats()['hits'], 1)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_Incremental_Merge(self):
+        '''
+        Test that incremental runs schedule only pairs with new domains and
+        that merging drops the results of domains no longer kept.
+        '''
+        self.assertEqual(incremental.incremental_pairs(['a', 'b'], []),
+                         [('a', 'a'), ('a', 'b'), ('b', 'b')])
+        self.assertEqual(incremental.incremental_pairs(['c'], ['a', 'b']),
+                         [('c', 'c'), ('c', 'a'), ('c', 'b')])
+        work_dir = tempfile.mkdtemp()
+        try:
+            outfile = os.path.join(work_dir, 'fast_results_1.txt')
+            newfile = os.path.join(work_dir, 'fast_results_1.txt.new')
+            with open(outfile, 'w') as f:
+                f.write('a. a. 1\na. b. 2\nb. b.\n')
+            with open(newfile, 'w') as f:
+                f.write('c. c. 3\nc. a. 4\n')
+            dropped = incremental.merge_result_file(
+                outfile, [newfile], set(['a.']))
+            self.assertEqual(dropped, 2)
+            self.assertEqual(open(outfile).read(),
+                             'a. a. 1\nc. c. 3\nc. a. 4\n')
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_Scheduler_TMALIGN(self):
+        '''
+        Test that the scheduler orders tasks longest-expected-first, batches
+        cheap tasks into chunks and passes on the output of every pair.
+        '''
+        pdb_file_path = os.path.dirname(os.path.abspath(__file__))
+        pdb_file1 = os.path.join(pdb_file_path, 'd1a04a2.ent')
+        pdb_file2 = os.path.join(pdb_file_path, 'd1cqxa1.ent')
+        self.assertEqual(scheduler.count_residues(pdb_file1), 138)
+        tm_runner = run.TM_HANDLER(os.path.join(self.exec_dir, 'tmalign'))
+        pairs = [(pdb_file1, pdb_file1, 'ent'), (pdb_file1, pdb_file2, 'ent'),
+                 (pdb_file2, pdb_file2, 'ent')]
+        collected = []
+        finished = []
+        psc_scheduler = scheduler.PSC_SCHEDULER(2)
+        psc_scheduler.add_pairs('tmalign', run.tm_process_pair, tm_runner,
+                                pairs, collected.append,
+                                lambda: finished.append(len(collected)))
+        self.assertEqual(psc_scheduler._tasks(), [(0, 2), (0, 1), (0, 0)])
+        self.assertEqual(psc_scheduler._chunks(),
+                         [(0, [2]), (0, [1]), (0, [0])])
+        cheap_scheduler = scheduler.PSC_SCHEDULER(2)
+        cheap_scheduler.add_pairs('usm', None, None, pairs[:1] * 640,
+                                  None, None)
+        chunks = cheap_scheduler._chunks()
+        self.assertEqual(len(chunks), 64)
+        self.assertEqual(sorted(sum(map(lambda x: x[1], chunks), [])),
+                         list(range(640)))
+        psc_scheduler.run()
+        self.assertEqual(finished, [3])
+        self.assertEqual(sorted(map(lambda x: x[0][:2], collected)),
+                         [['d1a04a2.', 'd1a04a2.'], ['d1a04a2.', 'd1cqxa1.'],
+                          ['d1cqxa1.', 'd1cqxa1.']])
+
+    def test_Scheduler_Thread(self):
+        '''
+        Test that the pairs of a method added as a thread are processed
+        next to the pool, with outputs passed on and cached from the thread.
+        '''
+        pdb_file_path = os.path.dirname(os.path.abspath(__file__))
+        pdb_file1 = os.path.join(pdb_file_path, 'd1a04a2.ent')
+        pdb_file2 = os.path.join(pdb_file_path, 'd1cqxa1.ent')
+        work_dir = tempfile.mkdtemp()
+        try:
+            cm_files = []
+            for n in range(3):
+                cm_file = os.path.join(work_dir, 'd%d.gw' % n)
+                out = open(cm_file, 'w')
+                out.write('LEDA.GRAPH\nstring\nshort\n%d\n' % (20 + n))
+                for i in range(20 + n):
+                    out.write('|{ALA_%d}|\n' % i)
+                for i in range(30 * n + 50):
+                    out.write('%d %d 0 |{%d}|\n' % (
+                        i % (20 + n), (i * 7 + n) % (20 + n), i % 3))
+                out.close()
+                cm_files.append(cm_file)
+            usm_pairs = [(x, y) for x in cm_files for y in cm_files if x != y]
+            psc_cache = cache.PSC_CACHE(os.path.join(work_dir, 'cache'))
+            engine = usm.USM_ENGINE(2, psc_cache, blockSize=2)
+            pooled = threading.Event()
+            overlapped = []
+
+            def produce(pairs):
+                for n, res in enumerate(engine.process_pairs(pairs)):
+                    # wait for an output of the pool before the second one
+                    if n == 1:
+                        overlapped.append(pooled.wait(60))
+                    yield res
+
+            def collect_tm(res):
+                collected_tm.append(res)
+                pooled.set()
+
+            tm_runner = run.TM_HANDLER(os.path.join(self.exec_dir, 'tmalign'))
+            collected_tm = []
+            collected_usm = []
+            finished = []
+            psc_scheduler = scheduler.PSC_SCHEDULER(2)
+            psc_scheduler.add_pairs('tmalign', run.tm_process_pair, tm_runner,
+                                    [(pdb_file1, pdb_file2, 'ent')],
+                                    collect_tm,
+                                    lambda: finished.append('tmalign'))
+            psc_scheduler.add_thread('usm', produce, usm_pairs,
+                                     collected_usm.append,
+                                     lambda: finished.append('usm'))
+            psc_scheduler.add_thread('none', produce, [], None,
+                                     lambda: finished.append('none'))
+            done = psc_scheduler.run()
+            self.assertEqual(overlapped, [True])
+            self.assertEqual(sorted(finished), ['none', 'tmalign', 'usm'])
+            self.assertEqual(sorted(done), ['none', 'tmalign', 'usm'])
+            self.assertEqual(len(collected_tm), 1)
+            self.assertEqual(len(collected_usm), len(usm_pairs))
+            self.assertEqual(sorted(engine.from_cache(*x) for x in usm_pairs),
+                             sorted(collected_usm))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_Scheduler_Thread_Held(self):
+        '''
+        Test that a thread holds a worker while it runs, that its outputs are
+        passed on while the pool waits and that its failure is raised.
+        '''
+        pdb_file_path = os.path.dirname(os.path.abspath(__file__))
+        pdb_file1 = os.path.join(pdb_file_path, 'd1a04a2.ent')
+        tm_runner = run.TM_HANDLER(os.path.join(self.exec_dir, 'tmalign'))
+        schedulers = [lambda: scheduler.PSC_SCHEDULER(1)]
+        if sys.version_info >= (3, 5):
+            schedulers.append(lambda: asyncexec.PSC_ASYNC_SCHEDULER(1, 1))
+        for make_scheduler in schedulers:
+            order = []
+            drained = []
+            passed = threading.Event()
+
+            def produce(pairs):
+                for pair in pairs:
+                    yield pair
+                    # the output is passed on while the worker is held
+                    drained.append(passed.wait(60))
+                    passed.clear()
+
+            def collect(res):
+                order.append('thread')
+                passed.set()
+
+            psc_scheduler = make_scheduler()
+            psc_scheduler.add_pairs('tmalign', run.tm_process_pair, tm_runner,
+                                    [(pdb_file1, pdb_file1, 'ent')],
+                                    lambda x: order.append('tmalign'),
+                                    lambda: None)
+            psc_scheduler.add_thread('thread', produce, [1, 2], collect,
+                                     lambda: None)
+            psc_scheduler.run()
+            self.assertEqual(drained, [True, True])
+            self.assertEqual(order, ['thread', 'thread', 'tmalign'])
+
+            def fail(pairs):
+                raise ValueError('thread failed')
+                yield
+
+            psc_scheduler = make_scheduler()
+            psc_scheduler.add_pairs('tmalign', run.tm_process_pair, tm_runner,
+                                    [(pdb_file1, pdb_file1, 'ent')],
+                                    lambda x: None, lambda: None)
+            psc_scheduler.add_thread('thread', fail, [1], None, lambda: None)
+            self.assertRaises(ValueError, psc_scheduler.run)
+
+    def test_Journal_Resume(self):
+        '''
+        Test that a resumed journal keeps the complete records of the
+        interrupted run and drops a truncated tail.
+        '''
+        for compress in [False, True]:
+            work_dir = tempfile.mkdtemp()
+            try:
+                psc_journal = journal.PSC_JOURNAL(work_dir, compress)
+                self.assertEqual(psc_journal.start(), {})
+                psc_journal.record('fast', 'a. b. 45 138 150 4.970')
+                psc_journal.record('ce', 'a. b.')
+                psc_journal.record_done('gralign')
+                psc_journal.close()
+                if not compress:
+                    with open(os.path.join(work_dir, journal.JOURNAL),
+                              'a') as f:
+                        f.write('fast\tb. c. 4')
+                psc_journal = journal.PSC_JOURNAL(work_dir, compress)
+                self.assertTrue(psc_journal.exists())
+                recorded = psc_journal.start(True)
+                self.assertEqual(recorded, {'fast': set([('a.', 'b.')]),
+                                            'ce': set([('a.', 'b.')]),
+                                            'gralign': set([journal.DONE])})
+                psc_journal.record('fast', 'b. c. 12 100 90 3.1')
+                self.assertEqual(list(psc_journal.lines('fast')),
+                                 ['a. b. 45 138 150 4.970',
+                                  'b. c. 12 100 90 3.1'])
+                psc_journal.remove()
+                self.assertFalse(psc_journal.exists())
+            finally:
+                shutil.rmtree(work_dir)
+
+    def test_Execute_Limits(self):
+        '''
+        Test that a binary exceeding its wall-clock limit is killed together
+        with its children and that failures carry their pair through pickling.
+        '''
+        start = time.time()
+        with self.assertRaises(execute.PSC_FAILURE) as ctx:
+            execute.run_command('sleep 30 & sleep 30', timeout=0.5)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(ctx.exception.reason, execute.TIMEOUT)
+        with self.assertRaises(execute.PSC_FAILURE) as ctx:
+            execute.run_command('exit 3')
+        self.assertEqual(ctx.exception.reason, execute.EXIT)
+        self.assertEqual(execute.run_command('echo ok'), 'ok\n')
+        failure = pickle.loads(pickle.dumps(
+            ctx.exception.set_pair('ce', 'a.', 'b.')))
+        self.assertEqual(failure.record(), 'a.\tb.\tce\texit\tstatus 3')
+        self.assertEqual(execute.parse_limits('60,ce=600', ['ce', 'fast']),
+                         {'ce': 600.0, 'fast': 60.0})
+
+    def test_GRALIGN_PreProcess(self):
+        '''
+        Test that the GR-align preprocessing writes verified contact maps and
+        signatures and restores them from the cache.
+        '''
+        pdb_file_path = os.path.dirname(os.path.abspath(__file__))
+        files = ['d1a04a2.ent', 'd1cqxa1.ent']
+        work_dir = tempfile.mkdtemp()
+        try:
+            psc_cache = cache.PSC_CACHE(os.path.join(work_dir, 'cache'))
+            for n, hits in [('1', 0), ('2', 2)]:
+                psc_cache.reset_stats()
+                pre_processor = run.GRALIGN_PRE_PROCESSOR(
+                    os.path.join(self.exec_dir, 'CMap'),
+                    os.path.join(self.exec_dir, 'DCount'),
+                    os.path.join(work_dir, n), psc_cache, 2)
+                self.assertEqual(pre_processor.pre_process_all_to_all(
+                    pdb_file_path, 'ent', files), [])
+                self.assertEqual(psc_cache.hits, hits)
+                self.assertEqual(sorted(os.listdir(
+                    os.path.join(work_dir, n, 'gralign'))),
+                    ['d1a04a2..gw', 'd1a04a2..ndump',
+                     'd1cqxa1..gw', 'd1cqxa1..ndump'])
+            failures = pre_processor.pre_process_all_to_all(
+                pdb_file_path, 'ent', ['missing.ent'])
+            self.assertEqual(failures[0].reason, 'parse')
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_GRALIGN_Shards(self):
+        '''
+        Test that GR-align shards cover every pair once and that their output
+        is merged in the order of an unsharded run.
+        '''
+        queries = ['a.', 'b.', 'c.', 'd.', 'e.']
+        for targets in [[], ['x.', 'y.']]:
+            shards = run.gr_shards(queries, targets, 3)
+            self.assertEqual(len(shards), 3)
+            pairs = []
+            for block, others in shards:
+                for i, q in enumerate(block):
+                    pairs += [(q, t) for t in block[i + 1:] + others]
+            self.assertEqual(sorted(pairs), sorted(
+                [(q, t) for i, q in enumerate(queries)
+                 for t in queries[i + 1:] + targets]))
+        work_dir = tempfile.mkdtemp()
+        try:
+            head = 'Query_1\tQuery_2\tGS\n'
+            sims = []
+            for n, rows in enumerate(['b.\tc.\t2\nb.\tc.\t2\nc.\tc.\t1\n',
+                                      'a.\tc.\t3\na.\tb.\t4\n']):
+                sims.append(os.path.join(work_dir, '%d.sim' % n))
+                with open(sims[-1], 'w') as f:
+                    f.write(head + rows)
+            outfile = os.path.join(work_dir, 'results.txt.sim')
+            self.assertEqual(run.gr_merge_shards(
+                outfile, sims, ['a.', 'b.', 'c.'], set()), 3)
+            self.assertEqual(open(outfile).read(), head +
+                             'a.\tb.\t4\na.\tc.\t3\nb.\tc.\t2\n')
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_Workspace_CE(self):
+        '''
+        Test that CE runs in a workspace with staged inputs and a scratch
+        directory that is reused across pairs.
+        '''
+        pdb_file_path = os.path.dirname(os.path.abspath(__file__))
+        pdb_file1 = os.path.join(pdb_file_path, 'd1a04a2.ent')
+        pdb_file2 = os.path.join(pdb_file_path, 'd1cqxa1.ent')
+        base_dir = tempfile.mkdtemp()
+        try:
+            psc_workspace = workspace.PSC_WORKSPACE(
+                base_dir, os.path.join(self.exec_dir, 'pom'))
+            ce_runner = run.CE_HANDLER(
+                os.path.join(self.exec_dir, 'ce'), 'tmp',
+                workspace=psc_workspace)
+            for _ in range(2):
+                self.assertEqual(ce_runner.process_pair(
+                    pdb_file1, pdb_file2, 'ent'),
+                    [['d1a04a2.', 'd1cqxa1.', 'A', '138', 'A', '150', '55',
+                      '4.16', '2.6', '45(81.8%)', '12.7%']])
+            self.assertFalse(os.path.exists('tmp'))
+            self.assertEqual(len(os.listdir(os.path.join(
+                psc_workspace.root, 'scratch'))), 1)
+            self.assertEqual(len(os.listdir(os.path.join(
+                psc_workspace.root, 'pdb'))), 2)
+            psc_workspace.remove()
+            self.assertEqual(os.listdir(base_dir), [])
+        finally:
+            shutil.rmtree(base_dir)
+
+    def test_Workspace_Scratch(self):
+        '''
+        Test that the files left in a scratch directory are truncated and
+        the directories left in it removed between pairs.
+        '''
+        base_dir = tempfile.mkdtemp()
+        try:
+            psc_workspace = workspace.PSC_WORKSPACE(base_dir)
+            scratch = psc_workspace.scratch()
+            out = open(os.path.join(scratch, 'out.txt'), 'w')
+            out.write('scores')
+            out.close()
+            os.makedirs(os.path.join(scratch, 'tmp', 'sub'))
+            target = os.path.join(base_dir, 'target.txt')
+            out = open(target, 'w')
+            out.write('kept')
+            out.close()
+            os.symlink(target, os.path.join(scratch, 'link'))
+            self.assertEqual(psc_workspace.scratch(), scratch)
+            self.assertEqual(os.listdir(scratch), ['out.txt'])
+            self.assertEqual(os.path.getsize(os.path.join(scratch,
+                                                          'out.txt')), 0)
+            self.assertEqual(open(target).read(), 'kept')
+            self.assertEqual(psc_workspace.scratch(), scratch)
+            psc_workspace.remove()
+        finally:
+            shutil.rmtree(base_dir)
+
+    def test_USM_Engine(self):
+        '''
+        Test that the USM engine produces the scores of the pairwise USM
+        handler, across tiles and in both orientations of a pair.
+        '''
+        work_dir = tempfile.mkdtemp()
+        try:
+            cm_files = []
+            for n in range(5):
+                cm_file = os.path.join(work_dir, 'd%d.gw' % n)
+                out = open(cm_file, 'w')
+                out.write('LEDA.GRAPH\nstring\nshort\n%d\n' % (20 + n))
+                for i in range(20 + n):
+                    out.write('|{ALA_%d}|\n' % i)
+                for i in range(300 * n + 50):
+                    out.write('%d %d 0 |{%d}|\n' % (
+                        i % (20 + n), (i * 7 + n) % (20 + n), i % 3))
+                out.close()
+                cm_files.append(cm_file)
+            pairs = [(x, y) for x in cm_files for y in cm_files if x != y]
+            usm_runner = run.USM_HANDLER()
+            expected = sorted(map(lambda x: usm_runner.process_pair(*x)[0],
+                                  pairs))
+            psc_cache = cache.PSC_CACHE(os.path.join(work_dir, 'cache'))
+            engine = usm.USM_ENGINE(3, psc_cache, blockSize=2)
+            self.assertEqual(sorted(map(lambda x: x[0],
+                                        engine.process_pairs(pairs))),
+                             expected)
+            self.assertEqual(engine.from_cache(*pairs[0]),
+                             usm_runner.process_pair(*pairs[0]))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_Prefilter(self):
+        '''
+        Test that the prefilter prunes pairs of domains of very different size
+        only and that pruned pairs keep an explicit low score when imputing.
+        '''
+        pdb_file_path = os.path.dirname(os.path.abspath(__file__))
+        pdb_file1 = os.path.join(pdb_file_path, 'd1a04a2.ent')
+        pdb_file2 = os.path.join(pdb_file_path, 'd1cqxa1.ent')
+        work_dir = tempfile.mkdtemp()
+        try:
+            # the first 25 residues of domain 1 as a tiny domain
+            pdb_file3 = os.path.join(work_dir, 'tiny.ent')
+            out = open(pdb_file3, 'w')
+            for line in open(pdb_file1):
+                if line.startswith('ATOM') and int(line[22:26]) < 30:
+                    out.write(line)
+            out.close()
+            descriptors = prefilter.compute_descriptors(
+                [pdb_file1, pdb_file2, pdb_file3, 'missing.ent'], 2)
+            self.assertEqual(descriptors[pdb_file1][0], 138)
+            self.assertEqual(descriptors[pdb_file2][0], 150)
+            self.assertIsNone(descriptors['missing.ent'])
+            pairs = [(pdb_file1, pdb_file1, 'ent'),
+                     (pdb_file1, pdb_file2, 'ent'),
+                     (pdb_file1, pdb_file3, 'ent'),
+                     (pdb_file3, 'missing.ent', 'ent')]
+            kept, pruned, similarities = prefilter.prune_pairs(
+                pairs, descriptors, 0.3)
+            self.assertEqual(kept, [pairs[0], pairs[1], pairs[3]])
+            self.assertEqual(pruned, [pairs[2]])
+            self.assertLess(similarities[0], 25. / 138 + 1e-6)
+            prefilter.write_pruned(
+                os.path.join(work_dir, prefilter.PRUNED),
+                [('d1a04a2.', 'tiny.')], similarities)
+            self.assertEqual(prefilter.read_pruned(work_dir),
+                             set([('d1a04a2.', 'tiny.')]))
+        finally:
+            shutil.rmtree(work_dir)
+        self.assertEqual(impute.cmean2(
+            ['a', 'b', 0.0], {'a': [0.5], 'b': [0.7]}, 0.4), 0.0)
+
+    def test_Prefilter_Recall(self):
+        '''
+        Test that the prefilter keeps the pairs of the same fold of the
+        proteus dataset at the suggested threshold while still pruning, and
+        that the threshold chosen for a recall keeps that share of them.
+        '''
+        base_dir = os.path.dirname(structures.__file__)
+        datadir = os.path.join(base_dir, 'testdata', 'proteus')
+        domains, klass, _ = groundtruth.read_ground_truth(
+            os.path.join(base_dir, 'testdata', 'ground_truth_proteus'))
+        folds = dict(zip(domains, map(
+            lambda x: '.'.join(x.split('.')[:2]), klass)))
+        fnames = list(map(lambda x: os.path.join(datadir, x + '.ent'),
+                          domains))
+        descriptors = prefilter.compute_descriptors(fnames)
+        pairs = [(fnames[i], fnames[j]) for i in range(len(fnames))
+                 for j in range(i + 1, len(fnames))]
+        names = [(domains[i] + '.', domains[j] + '.')
+                 for i in range(len(fnames))
+                 for j in range(i + 1, len(fnames))]
+        similarities = prefilter.pair_similarities(pairs, descriptors)
+        same, lost, recall = prefilter.fold_recall(names, similarities,
+                                                   folds, 0.3)
+        self.assertGreater(same, 1000)
+        self.assertGreaterEqual(recall, 0.99)
+        self.assertGreater(np.sum(similarities < 0.3), 0.05 * len(pairs))
+        threshold = prefilter.recall_threshold(names, similarities, folds,
+                                               0.95)
+        self.assertGreaterEqual(threshold, 0.3)
+        self.assertGreaterEqual(prefilter.fold_recall(
+            names, similarities, folds, threshold)[2], 0.95)
+
+    def test_Structure_Store(self):
+        '''
+        Test that structures are parsed once into the store and read back
+        memory mapped, also by an unpickled copy of the store.
+        '''
+        pdb_file_path = os.path.dirname(os.path.abspath(__file__))
+        pdb_file1 = os.path.join(pdb_file_path, 'd1a04a2.ent')
+        pdb_file2 = os.path.join(pdb_file_path, 'd1cqxa1.ent')
+        work_dir = tempfile.mkdtemp()
+        try:
+            store = structures.PSC_STRUCTURE_STORE(work_dir)
+            self.assertEqual(store.ingest([pdb_file1], 1), 1)
+            self.assertEqual(store.ingest([pdb_file1, pdb_file2], 2), 1)
+            self.assertEqual(store.ingest([pdb_file1, pdb_file2], 2), 0)
+            self.assertEqual(len(store), 2)
+            residues, coords = structures.parse_structure(pdb_file2)
+            copy = pickle.loads(pickle.dumps(store))
+            self.assertEqual(len(copy.residues(pdb_file1)), 138)
+            self.assertTrue(np.array_equal(copy.residues(pdb_file2),
+                                           residues))
+            self.assertTrue(np.array_equal(copy.coordinates(pdb_file2),
+                                           coords, equal_nan=True))
+            self.assertIsInstance(copy.ca(pdb_file2), np.memmap)
+            glycine = copy.residues(pdb_file2)['name'] == b'GLY'
+            self.assertTrue(np.isnan(
+                copy.coordinates(pdb_file2)[glycine, 1]).all())
+            self.assertIsNone(copy.ca(os.path.abspath(__file__)))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_Structure_Store_Concurrent(self):
+        '''
+        Test that concurrent ingests into the same store are serialized,
+        parse every file once and leave a consistent index and arrays.
+        '''
+        datadir = os.path.join(os.path.dirname(structures.__file__),
+                               'testdata', 'proteus')
+        pdb_files = sorted(map(lambda x: os.path.join(datadir, x),
+                               os.listdir(datadir)))[:50]
+        work_dir = tempfile.mkdtemp()
+        try:
+            store = structures.PSC_STRUCTURE_STORE(work_dir)
+            p = Pool(4)
+            try:
+                counts = p.map(store.ingest, [pdb_files[k * 10:k * 10 + 20]
+                                              for k in range(4)])
+            finally:
+                p.close()
+                p.join()
+            self.assertEqual(sum(counts), 50)
+            self.assertEqual(len(store), 50)
+            for pdb_file in pdb_files:
+                residues, coords = structures.parse_structure(pdb_file)
+                self.assertTrue(np.array_equal(store.residues(pdb_file),
+                                               residues))
+                self.assertTrue(np.array_equal(store.coordinates(pdb_file),
+                                               coords, equal_nan=True))
+            versions = list(filter(lambda x: x.startswith('v-'),
+                                   os.listdir(work_dir)))
+            self.assertTrue(1 <= len(versions) <= 2)
+            self.assertIn(open(os.path.join(
+                work_dir, structures.CURRENT)).read(), versions)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_Sparse_TopK(self):
+        '''
+        Test that the sparse mode keeps the k most similar neighbors of each
+        domain with the normalized scores of the dense post-processing.
+        '''
+        names = ['d%d' % i for i in range(6)]
+        work_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(work_dir, 'usm_results.txt')
+            out = open(fname, 'w')
+            for i in range(6):
+                for j in range(i, 6):
+                    out.write('%s. %s. %f\n' % (names[i], names[j],
+                                                 abs(i - j) + 0.1 * i))
+            out.close()
+            topk = sparse.PSC_TOPK(2)
+            normalize = sparse.stream_method(topk, fname, 2)
+            csr = topk.to_csr(lambda x: normalize(-x))
+            self.assertEqual(csr.names, names)
+            self.assertEqual(len(csr), 12)
+            self.assertEqual([x[0] for x in csr.neighbors('d0')],
+                             ['d1', 'd2'])
+            self.assertEqual([x[0] for x in csr.neighbors('d3')],
+                             ['d2', 'd4'])
+            dense = postprocessing.read_psc_data(fname, 2)
+            for name, score in csr.neighbors('d3'):
+                self.assertAlmostEqual(score, dense[('d3', name)], 6)
+            csr.save(os.path.join(work_dir, 'topk.npz'))
+            csr = sparse.TOPK_CSR.load(os.path.join(work_dir, 'topk.npz'))
+            self.assertEqual(csr.neighbors('d5'),
+                             topk.to_csr(lambda x: normalize(-x)).neighbors(
+                                 'd5'))
+            klass = {'d0': 'a', 'd1': 'a', 'd2': 'b', 'd3': 'b', 'd4': 'b',
+                     'd5': 'c'}
+            self.assertAlmostEqual(sparse.topk_nnclassifyacc(csr, klass),
+                                   4. / 6)
+
+            # a repeated pair replaces the score it retained, an evicted
+            # neighbor may come back
+            topk = sparse.PSC_TOPK(2)
+            for name, score in [('d1', 0.5), ('d2', 0.4), ('d1', 0.1),
+                                ('d3', 0.3), ('d1', 0.9), ('d1', 0.9)]:
+                topk.push('d0', name, score)
+            self.assertEqual(topk.to_csr().neighbors('d0'),
+                             [('d1', 0.9), ('d2', 0.4)])
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_Distributed_TMALIGN(self):
+        '''
+        Test that a coordinator serves all pairs to worker processes on
+        localhost and leases the batches of a disconnected and of a silent
+        worker again.
+        '''
+        pdb_file_path = os.path.dirname(os.path.abspath(__file__))
+        pdb_file1 = os.path.join(pdb_file_path, 'd1a04a2.ent')
+        pdb_file2 = os.path.join(pdb_file_path, 'd1cqxa1.ent')
+        tm_runner = run.TM_HANDLER(os.path.join(self.exec_dir, 'tmalign'))
+        pairs = [(pdb_file1, pdb_file1, 'ent'), (pdb_file1, pdb_file2, 'ent'),
+                 (pdb_file2, pdb_file2, 'ent')]
+        collected = []
+        finished = []
+        coordinator = distributed.PSC_COORDINATOR(
+            1, ('127.0.0.1', 0), b'test', leaseTimeout=2,
+            localize=run.localize_handler)
+        coordinator.add_pairs('tmalign', run.tm_process_pair, tm_runner,
+                              pairs, collected.append,
+                              lambda: finished.append(len(collected)))
+        failed = []
+
+        def lease():
+            conn = Client(coordinator.address, authkey=b'test')
+            conn.send(('hello', 'test', os.getpid()))
+            conn.recv()
+            conn.send(('ready',))
+            self.assertEqual(conn.recv()[0], 'batch')
+            return conn
+
+        def workers():
+            try:
+                # one worker stays silent, one disconnects with its batch
+                failed.append(lease())
+                lease().close()
+                failed.append(distributed.start_workers(
+                    coordinator.address, b'test', 2, self.exec_dir))
+            except Exception as e:
+                failed.append(e)
+
+        thread = threading.Thread(target=workers)
+        thread.start()
+        coordinator.run()
+        thread.join()
+        silent, local = failed
+        for p in local:
+            p.join()
+        silent.close()
+        self.assertEqual(finished, [3])
+        self.assertEqual(coordinator._released, 2)
+        self.assertEqual(sorted(map(lambda x: x[0][:2], collected)),
+                         [['d1a04a2.', 'd1a04a2.'], ['d1a04a2.', 'd1cqxa1.'],
+                          ['d1cqxa1.', 'd1cqxa1.']])
+
+    def test_Distributed_Failures(self):
+        '''
+        Test that local errors of a worker fail the pairs of its batch and
+        that a batch released too often is given up.
+        '''
+        pdb_file_path = os.path.dirname(os.path.abspath(__file__))
+        pdb_file1 = os.path.join(pdb_file_path, 'd1a04a2.ent')
+        pdb_file2 = os.path.join(pdb_file_path, 'd1cqxa1.ent')
+        tm_runner = run.TM_HANDLER(os.path.join(self.exec_dir, 'tmalign'))
+        pairs = [(pdb_file1, pdb_file2, 'ent'), (pdb_file2, pdb_file2, 'ent')]
+        failed = []
+        coordinator = distributed.PSC_COORDINATOR(
+            1, ('127.0.0.1', 0), b'test', localWorkers=1)
+        coordinator.add_pairs('tmalign', fail_locally, tm_runner, pairs,
+                              None, lambda: None, failed.append)
+        coordinator.run()
+        self.assertEqual(sorted(map(lambda x: (x.names[0], x.reason), failed)),
+                         [('d1a04a2.', execute.WORKER),
+                          ('d1cqxa1.', execute.WORKER)])
+
+        failed = []
+        coordinator = distributed.PSC_COORDINATOR(
+            1, ('127.0.0.1', 0), b'test')
+        coordinator.add_pairs('tmalign', run.tm_process_pair, tm_runner,
+                              pairs[:1], None, lambda: None, failed.append)
+        leased = []
+
+        def lease():
+            # disconnect with the batch until it is given up
+            while len(leased) < distributed.MAX_RELEASES:
+                conn = Client(coordinator.address, authkey=b'test')
+                conn.send(('hello', 'test', os.getpid()))
+                conn.recv()
+                conn.send(('ready',))
+                msg = conn.recv()
+                conn.close()
+                if msg[0] == 'batch':
+                    leased.append(msg[1])
+                time.sleep(0.1)
+
+        thread = threading.Thread(target=lease)
+        thread.start()
+        coordinator.run()
+        thread.join()
+        self.assertEqual(leased, [0] * distributed.MAX_RELEASES)
+        self.assertEqual(list(map(lambda x: x.reason, failed)),
+                         [execute.WORKER])
+
+    def test_Distributed_Authkey(self):
+        '''
+        Test that a generated key is written to a file readable by its owner
+        only, also when the file existed with wider permissions.
+        '''
+        work_dir = tempfile.mkdtemp()
+        try:
+            key_file = os.path.join(work_dir, distributed.AUTHKEY)
+            out = open(key_file, 'w')
+            out.write('old')
+            out.close()
+            os.chmod(key_file, 0o644)
+            distributed.write_authkey(key_file, b'0123abcd')
+            self.assertEqual(os.stat(key_file).st_mode & 0o777, 0o600)
+            self.assertEqual(open(key_file, 'rb').read(), b'0123abcd')
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_Shards_Merge(self):
+        '''
+        Test that the shards of a run partition the pairs with balanced cost
+        and that the merge rejects missing and duplicated pairs.
+        '''
+        pdb_file_path = os.path.dirname(os.path.abspath(__file__))
+        pdb_file1 = os.path.join(pdb_file_path, 'd1a04a2.ent')
+        pdb_file2 = os.path.join(pdb_file_path, 'd1cqxa1.ent')
+        tasks = [(m, (f1, f2, 'ent')) for m in ['ce', 'usm']
+                 for f1 in [pdb_file1, pdb_file2]
+                 for f2 in [pdb_file1, pdb_file2]]
+        self.assertEqual(shards.parse_shard('2/3'), (2, 3))
+        self.assertRaises(ValueError, shards.parse_shard, '4/3')
+        selected = [shards.assign_shard(tasks, i, 3)[0] for i in [1, 2, 3]]
+        self.assertEqual(sorted(sum(selected, [])), list(range(len(tasks))))
+        self.assertEqual(selected, [shards.assign_shard(tasks, i, 3)[0]
+                                    for i in [1, 2, 3]])
+        work_dir = tempfile.mkdtemp()
+        try:
+            names = [('a.', 'b.'), ('a.', 'c.'), ('b.', 'c.')]
+            for i, part in [(1, names[:2]), (2, names[2:])]:
+                shard_dir = shards.shard_dir(work_dir, i, 2)
+                os.makedirs(shard_dir)
+                shards.write_shard(shard_dir, i, 2, {'usm': 3},
+                                   {'usm': part})
+                out = open(os.path.join(shard_dir, 'usm_results.txt'), 'w')
+                for name1, name2 in part:
+                    out.write('%s %s 0.5\n' % (name1, name2))
+                out.close()
+            self.assertTrue(shards.merge_shards(work_dir))
+            self.assertEqual(len(open(os.path.join(
+                work_dir, 'usm_results.txt')).readlines()), 3)
+            # a pair without result and a pair processed twice
+            out = open(os.path.join(shards.shard_dir(work_dir, 2, 2),
+                                    'usm_results.txt'), 'w')
+            out.write('a. b. 0.5\n')
+            out.close()
+            self.assertFalse(shards.merge_shards(work_dir))
+        finally:
+            shutil.rmtree(work_dir)
+
+    @unittest.skipIf(sys.version_info < (3, 5),
+                     'asyncio executor needs Python 3.5')
+    def test_Async_Executor(self):
+        '''
+        Test that the asyncio executor passes on the output of every pair and
+        kills binaries exceeding their wall-clock limit.
+        '''
+        pdb_file_path = os.path.dirname(os.path.abspath(__file__))
+        pdb_file1 = os.path.join(pdb_file_path, 'd1a04a2.ent')
+        pdb_file2 = os.path.join(pdb_file_path, 'd1cqxa1.ent')
+        loop = asyncio.new_event_loop()
+        try:
+            start = time.time()
+            with self.assertRaises(execute.PSC_FAILURE) as ctx:
+                loop.run_until_complete(asyncexec.run_command_async(
+                    ['sh', '-c', 'sleep 30 & sleep 30'], timeout=0.5))
+            self.assertLess(time.time() - start, 10)
+            self.assertEqual(ctx.exception.reason, execute.TIMEOUT)
+            self.assertEqual(loop.run_until_complete(
+                asyncexec.run_command_async(['echo', 'ok'])), ['ok'])
+        finally:
+            loop.close()
+        tm_runner = run.TM_HANDLER(os.path.join(self.exec_dir, 'tmalign'))
+        pairs = [(pdb_file1, pdb_file1, 'ent'), (pdb_file1, pdb_file2, 'ent'),
+                 (pdb_file2, pdb_file2, 'ent')]
+        collected = []
+        finished = []
+        psc_scheduler = asyncexec.PSC_ASYNC_SCHEDULER(1, 2)
+        psc_scheduler.add_pairs('tmalign', run.tm_process_pair, tm_runner,
+                                pairs, collected.append,
+                                lambda: finished.append(len(collected)))
+        psc_scheduler.run()
+        self.assertEqual(finished, [3])
+        self.assertEqual(sorted(collected),
+                         sorted(map(lambda x: run.tm_process_pair(
+                             (tm_runner, x, None)), pairs)))
+
+    def test_Metrics(self):
+        '''
+        Test that the metrics count pairs and failures, estimate latency
+        percentiles and ETA and are written to the work directory.
+        '''
+        work_dir = tempfile.mkdtemp()
+        try:
+            psc_metrics = metrics.PSC_METRICS(work_dir, interval=0)
+            psc_metrics.start('ce', 4)
+            psc_metrics.inflight(2)
+            for secs in [0.2, 0.3, 0.4]:
+                psc_metrics.record('ce', secs, secs > 0.35)
+            summary = psc_metrics.summary('ce')
+            self.assertEqual((summary['done'], summary['failed']), (3, 1))
+            self.assertFalse(summary['finished'])
+            self.assertGreater(summary['eta_seconds'], 0)
+            p50 = psc_metrics.percentile('ce', 50)
+            self.assertTrue(0.25 <= p50 <= 0.5)
+            data = json.load(open(os.path.join(work_dir,
+                                               metrics.JSON)))
+            self.assertEqual(data['inflight'], 2)
+            self.assertEqual(data['methods']['ce']['done'], 3)
+            psc_metrics.record('ce', 20.0)
+            psc_metrics.finish('ce')
+            self.assertEqual(psc_metrics.summary('ce')['eta_seconds'], 0)
+            prom = open(os.path.join(work_dir, metrics.PROMETHEUS)).read()
+            self.assertIn('pymcpsc_pairs_done_total{method="ce"} 4.0', prom)
+            self.assertIn('pymcpsc_pair_latency_seconds_bucket{method="ce",'
+                          'le="+Inf"} 4.0', prom)
+            self.assertIn('pymcpsc_pair_latency_seconds_count{method="ce"} '
+                          '4.0', prom)
+            self.assertEqual(metrics.format_duration(3725), '1:02:05')
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_Synthetic(self):
+        '''
+        Test that the synthetic results are readable by the post processing,
+        reproducible and score pairs of a family above the other pairs.
+        '''
+        work_dir = tempfile.mkdtemp()
+        try:
+            gt_file = os.path.join(work_dir, 'ground_truth')
+            pairs = synthetic.make(work_dir, 60, gt_file, seed=3,
+                                   missing={'fast': 0.1})
+            self.assertEqual(pairs, 60 * 59 // 2)
+            domains, klass, (first, second) = \
+                groundtruth.read_ground_truth(gt_file)
+            gt = dict(zip(zip(domains[first], domains[second]),
+                          zip(klass[first], klass[second])))
+            self.assertEqual(len(gt), pairs)
+            for method, outfile, idx, inv, sep in postprocessing.PSC_OUTPUTS:
+                scores = postprocessing.read_psc_data(
+                    os.path.join(work_dir, outfile), idx, inv, sep)
+                found = list(filter(lambda x: x in scores, gt))
+                if method == 'fast':
+                    self.assertLess(len(found), 0.95 * pairs)
+                else:
+                    self.assertGreater(len(found), 0.95 * pairs)
+                family = [scores[x] for x in found if gt[x][0] == gt[x][1]]
+                other = [scores[x] for x in found if gt[x][0] != gt[x][1]]
+                self.assertGreater(np.mean(family), np.mean(other))
+            self.assertGreater(len(execute.read_failures(work_dir)['fast']),
+                               0)
+            data = open(os.path.join(work_dir, 'ce_results_1.txt')).read()
+            synthetic.make(work_dir, 60, gt_file, seed=3,
+                           missing={'fast': 0.1})
+            self.assertEqual(open(os.path.join(
+                work_dir, 'ce_results_1.txt')).read(), data)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_Profiler(self):
+        '''
+        Test that profiled stages return their result and leave a profile,
+        an allocation report and a summary behind.
+        '''
+        work_dir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(profiling.PSC_PROFILER().run('sum', sum, [1, 2]),
+                             3)
+            profiler = profiling.PSC_PROFILER(work_dir, top=5)
+            self.assertEqual(len(profiler.run(
+                'build', lambda n: [str(x) for x in range(n)], 10000)), 10000)
+            self.assertRaises(ValueError, profiler.run, 'fail', int, 'x')
+            profiler.summary()
+            for name in ['01-build.prof', '01-build.alloc.txt',
+                         '02-fail.prof', profiling.SUMMARY]:
+                self.assertTrue(os.path.exists(os.path.join(work_dir, name)))
+            summary = open(os.path.join(work_dir, profiling.SUMMARY)).read()
+            self.assertIn('build', summary)
+            self.assertIn('fail', summary)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_PostProcessor_Vectorized(self):
+        '''
+        Test that the bulk parsed scores equal the streamed ones and that the
+        processed scores match the per pair lookups, in both orders.
+        '''
+        work_dir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(work_dir)
+            synthetic.make(work_dir, 40, 'ground_truth', seed=5,
+                           missing={'ce': 0.05})
+            scores = {}
+            for method, outfile, idx, inv, sep in postprocessing.PSC_OUTPUTS:
+                fname = os.path.join(work_dir, outfile)
+                names, id1, id2, values = postprocessing.load_psc_data(
+                    fname, idx, inv, sep)
+                streamed = list(postprocessing.iter_psc_data(
+                    fname, idx, inv, sep))
+                self.assertEqual(list(zip(names[id1], names[id2])),
+                                 list(map(lambda x: x[0], streamed)))
+                self.assertTrue(np.allclose(values, list(map(
+                    lambda x: x[1], streamed))))
+                scores[method] = postprocessing.read_psc_data(
+                    fname, idx, inv, sep)
+            domains, klass, (first, second) = \
+                groundtruth.read_ground_truth('ground_truth')
+            gt = dict(zip(zip(domains[first], domains[second]),
+                          zip(klass[first], klass[second])))
+            lost = list(filter(lambda x: x not in scores['ce'], gt))[0]
+            out = open(os.path.join(work_dir, prefilter.PRUNED), 'w')
+            out.write('%s.\t%s.\n' % lost)
+            out.close()
+
+            class CONF:
+                WORKDIR = work_dir
+                GTIN = 'ground_truth'
+                OUTDIR = 'out'
+                CSV = True
+            postprocessing.PostProcessor().run(CONF())
+            data = pd.read_csv(os.path.join('out', 'processed.csv'))
+            stored = scorematrix.PSC_SCORE_MATRIX(
+                'out', scorematrix.PROCESSED).read()
+            self.assertEqual(list(stored.columns),
+                             list(data.columns[:4]) + list(data.columns[8:]))
+            self.assertEqual(len(stored), len(gt))
+            merged = stored.merge(data, on=['dom1', 'dom2'],
+                                  suffixes=('', '_csv'))
+            self.assertEqual(len(merged), len(gt))
+            self.assertTrue((merged['cath2'] == merged['cath2_csv']).all())
+            self.assertTrue(np.allclose(merged['ce'], merged['ce_csv'],
+                                        atol=1e-6))
+            self.assertEqual(len(data), 2 * len(gt))
+            for row in data.itertuples():
+                k = (row.dom1, row.dom2) if (row.dom1, row.dom2) in gt else \
+                    (row.dom2, row.dom1)
+                for method, _, _, _, _ in postprocessing.PSC_OUTPUTS:
+                    expected = scores[method].get(k, -1)
+                    if k == lost and method == 'ce':
+                        expected = postprocessing.PRUNED_SCORE
+                    self.assertAlmostEqual(getattr(row, method), expected, 5)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(work_dir)
+
+    def test_Score_Store(self):
+        '''
+        Test that score stores return the requested columns, including
+        those of their parent, and refuse a parent written again since.
+        '''
+        work_dir = tempfile.mkdtemp()
+        try:
+            data = pd.DataFrame({'dom1': ['d1', 'd1', 'd2', 'd3'],
+                                 'cath1': pd.Categorical(['a.1', 'a.1',
+                                                          'b.2', 'a.1']),
+                                 'ce': [0.5, -1., 0.25, np.nan],
+                                 'n': [1, 2, 3, 4]},
+                                columns=['dom1', 'cath1', 'ce', 'n'])
+            parent = scorestore.PSC_SCORE_STORE(work_dir, 'scores')
+            self.assertFalse(parent.exists())
+            parent.write(data)
+            self.assertTrue(os.path.isdir(scorestore.store_path(
+                work_dir, 'scores')))
+            self.assertEqual(len(parent), 4)
+            read = parent.read(['ce', 'dom1'])
+            self.assertEqual(list(read.columns), ['ce', 'dom1'])
+            self.assertEqual(read['ce'].dtype, np.float32)
+            self.assertEqual(list(read['dom1']), ['d1', 'd1', 'd2', 'd3'])
+            self.assertTrue(np.isnan(read['ce'][3]))
+            cath = parent.read(['cath1'], categorical=True)['cath1']
+            self.assertEqual(list(cath), ['a.1', 'a.1', 'b.2', 'a.1'])
+            self.assertEqual(list(parent.read(['n'])['n']), [1, 2, 3, 4])
+
+            child = scorestore.PSC_SCORE_STORE(work_dir, 'scores.child')
+            child.write(pd.DataFrame({'ce': [1., 2., 3., 4.],
+                                      'x': [0., 0., 0., 1.]}), parent=parent)
+            self.assertEqual(child.columns(), ['dom1', 'cath1', 'ce', 'n',
+                                               'x'])
+            read = child.read(['dom1', 'ce', 'x'])
+            self.assertEqual(list(read['dom1']), ['d1', 'd1', 'd2', 'd3'])
+            self.assertEqual(list(read['ce']), [1., 2., 3., 4.])
+            self.assertRaises(KeyError, child.read, ['y'])
+            self.assertRaises(ValueError, child.write, data.iloc[:2],
+                              parent=parent)
+            child.to_csv(os.path.join(work_dir, 'child.csv'))
+            self.assertEqual(list(pd.read_csv(os.path.join(
+                work_dir, 'child.csv'))['x']), [0., 0., 0., 1.])
+
+            parent.write(data)
+            child = scorestore.PSC_SCORE_STORE(work_dir, 'scores.child')
+            self.assertRaises(ValueError, child.read, ['x'])
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_Score_Matrix(self):
+        '''
+        Test that score matrices store every pair once and return the rows,
+        square matrices and pairs of the ground truth of their columns.
+        '''
+        n = 5
+        first, second = scorematrix.condensed_pairs(
+            np.arange(scorematrix.condensed_size(n)), n)
+        self.assertTrue((first <= second).all())
+        self.assertEqual(list(scorematrix.condensed_index(second, first, n)),
+                         list(range(scorematrix.condensed_size(n))))
+        work_dir = tempfile.mkdtemp()
+        try:
+            domains = ['d1', 'd2', 'd3']
+            pairs = scorematrix.condensed_index([0, 2, 1], [1, 0, 1], 3)
+            matrix = scorematrix.PSC_SCORE_MATRIX(work_dir, 'scores')
+            matrix.write(pd.DataFrame({'ce': [0.5, 0.25, -1.]}),
+                         domains=domains,
+                         classifications=['a.1', 'b.1', 'a.2'], pairs=pairs)
+            self.assertEqual(len(matrix), 6)
+            self.assertEqual(list(matrix.domains()), domains)
+            read = matrix.read()
+            self.assertEqual(list(read.columns), ['dom1', 'dom2', 'cath1',
+                                                  'cath2', 'ce'])
+            self.assertEqual(list(zip(read['dom1'], read['dom2'])), [
+                ('d1', 'd2'), ('d1', 'd3'), ('d2', 'd2')])
+            self.assertEqual(list(read['cath2']), ['b.1', 'a.2', 'b.1'])
+            self.assertEqual(list(read['ce']), [0.5, 0.25, -1.])
+            square = matrix.square('ce')
+            self.assertTrue(np.array_equal(square, square.T, equal_nan=True))
+            self.assertEqual(square[2, 0], 0.25)
+            self.assertTrue(np.isnan(square[2, 2]))
+            self.assertTrue(np.array_equal(matrix.row('ce', 1), square[1],
+                                           equal_nan=True))
+            self.assertEqual(list(matrix.square('ce', [1, 0])[0]), [-1., 0.5])
+
+            child = scorematrix.PSC_SCORE_MATRIX(work_dir, 'scores.child')
+            child.write(pd.DataFrame({'x': [1., 2., 3.]}), parent=matrix)
+            self.assertEqual(child.columns(), ['dom1', 'dom2', 'cath1',
+                                               'cath2', 'ce', 'x'])
+            self.assertEqual(list(child.domains()), domains)
+            self.assertEqual(child.square('x')[1, 0], 1.)
+            self.assertEqual(list(child.read(['dom2', 'x'])['dom2']),
+                             ['d2', 'd3', 'd2'])
+            self.assertRaises(ValueError, child.write,
+                              pd.DataFrame({'x': [1.]}), parent=matrix)
+            matrix.write(pd.DataFrame({'ce': [0.5]}), domains=domains,
+                         classifications=['a.1', 'b.1', 'a.2'],
+                         pairs=pairs[:1])
+            child = scorematrix.PSC_SCORE_MATRIX(work_dir, 'scores.child')
+            self.assertRaises(ValueError, child.square, 'x')
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_Ground_Truth(self):
+        '''
+        Test that pairwise ground truth files are read as the classifications
+        of their domains and converted, and that all pairs of the domains of
+        a classification ground truth are processed.
+        '''
+        work_dir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(work_dir)
+            out = open('pairwise', 'w')
+            out.write('d2.\td1.\tb.1\ta.1\n'
+                      'd2.\td3.\tb.1\ta.2\n'
+                      'd2.\td1.\tb.2\ta.1\n')
+            out.close()
+            self.assertEqual(groundtruth.ground_truth_format('pairwise'),
+                             groundtruth.PAIRWISE)
+            domains, klass, pairs = groundtruth.read_ground_truth('pairwise')
+            self.assertEqual(list(domains), ['d2.', 'd1.', 'd3.'])
+            self.assertEqual(list(klass), ['b.2', 'a.1', 'a.2'])
+            self.assertEqual(list(zip(*pairs)), [(0, 1), (0, 2)])
+            self.assertEqual(groundtruth.convert('pairwise', 'classes'), 3)
+            self.assertEqual(groundtruth.ground_truth_format('classes'),
+                             groundtruth.CLASSIFICATION)
+            domains, klass, pairs = groundtruth.read_ground_truth('classes')
+            self.assertEqual(list(domains), ['d2.', 'd1.', 'd3.'])
+            self.assertEqual(list(klass), ['b.2', 'a.1', 'a.2'])
+            self.assertTrue(pairs is None)
+            self.assertEqual(sparse.read_classification('pairwise'),
+                             sparse.read_classification('classes'))
+
+            synthetic.make(work_dir, 20, 'ground_truth', seed=3)
+            groundtruth.convert('ground_truth', 'classes')
+
+            class CONF:
+                WORKDIR = work_dir
+                GTIN = 'classes'
+                OUTDIR = 'out'
+                CSV = True
+            postprocessing.PostProcessor().run(CONF())
+            matrix = scorematrix.PSC_SCORE_MATRIX('out', scorematrix.PROCESSED)
+            n = len(matrix.domains())
+            self.assertEqual(len(matrix.pairs()), n * (n - 1) // 2)
+            data = matrix.read()
+            self.assertFalse((data['dom1'] == data['dom2']).any())
+            domains, klass, (first, second) = \
+                groundtruth.read_ground_truth('ground_truth')
+            gt = dict(zip(zip(domains[first], domains[second]),
+                          zip(klass[first], klass[second])))
+            listed = data[[(x, y) in gt or (y, x) in gt for x, y in
+                           zip(data['dom1'], data['dom2'])]]
+            self.assertEqual(len(listed), len(gt))
+            self.assertEqual(len(pd.read_csv(
+                os.path.join('out', 'processed.csv'))), 2 * len(data))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(work_dir)
+
+    def test_Scaling(self):
+        '''
+        Test that the statistics accumulated in chunks equal those of all
+        scores, and that the scores of a later run are scaled with the frozen
+        statistics of the calibration of a previous run.
+        '''
+        values = np.random.RandomState(2).rand(1000) * 5
+        stats = scaling.PSC_SCALE_STATS()
+        for chunk in np.array_split(values, 7):
+            stats.update(chunk)
+        self.assertEqual(stats.n, 1000)
+        self.assertAlmostEqual(stats.mean, np.mean(values), 12)
+        self.assertAlmostEqual(stats.std(), np.std(values), 12)
+        self.assertEqual((stats.low, stats.high), (np.min(values),
+                                                   np.max(values)))
+        expected = {
+            scaling.MIN_MAX_SCALE: 1 - (values - np.min(values)) /
+            (np.max(values) - np.min(values)),
+            scaling.VARIANCE_SCALE: np.exp(-values / np.var(values)),
+            scaling.LOGISTIC_SIGMOID: 1 - 1. / (1 + np.exp(
+                -(values - np.mean(values)) / np.std(values))),
+            scaling.NO_SCALE: np.max(values) - values}
+        self.assertEqual(sorted(expected), sorted(scaling.SCALERS))
+        for scaler in expected:
+            self.assertTrue(np.allclose(scaling.scale(values, scaler),
+                                        expected[scaler]))
+            self.assertTrue(np.allclose(scaling.scale(values, scaler, stats),
+                                        expected[scaler]))
+        self.assertRaises(ValueError, scaling.scale, values, 'softmax')
+
+        work_dir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(work_dir)
+            synthetic.make(work_dir, 20, 'ground_truth', seed=4)
+
+            class CONF:
+                WORKDIR = work_dir
+                GTIN = 'ground_truth'
+                OUTDIR = 'out'
+                CSV = False
+                SCALING = scaling.MIN_MAX_SCALE
+                CALIBRATION = None
+            postprocessing.PostProcessor().run(CONF())
+            calibration = os.path.join('out', scaling.CALIBRATION)
+            scaler, frozen = scaling.read_calibration(calibration)
+            self.assertEqual(scaler, scaling.MIN_MAX_SCALE)
+            self.assertTrue(frozen['ce'].frozen)
+            before = scorematrix.PSC_SCORE_MATRIX(
+                'out', scorematrix.PROCESSED).read()
+
+            # a later run scoring only some of the pairs
+            fname = os.path.join(work_dir, 'ce_results_1.txt')
+            lines = open(fname).readlines()
+            open(fname, 'w').writelines(lines[:len(lines) // 2])
+            CONF.SCALING = None
+            CONF.CALIBRATION = calibration
+            postprocessing.PostProcessor().run(CONF())
+            after = scorematrix.PSC_SCORE_MATRIX(
+                'out', scorematrix.PROCESSED).read()
+            kept = (after['ce'] != -1).values
+            self.assertTrue(kept.any() and not kept.all())
+            self.assertTrue(np.allclose(after['ce'][kept],
+                                        before['ce'][kept], atol=1e-6))
+            self.assertEqual(scaling.read_calibration(calibration)[1][
+                'ce'].n, frozen['ce'].n)
+
+            topk = sparse.PSC_TOPK(3)
+            normalize = sparse.stream_method(
+                topk, fname, 7, stats=frozen['ce'],
+                scaler=scaling.MIN_MAX_SCALE)
+            self.assertEqual(frozen['ce'].n, scaling.read_calibration(
+                calibration)[1]['ce'].n)
+            self.assertAlmostEqual(float(normalize(frozen['ce'].low)), 1.)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(work_dir)
+
 if __name__ == '__main__':
-    setUpClass(TestPymcpsc)
     suite = unittest.TestLoader().loadTestsFromTestCase(TestPymcpsc)
     unittest.TextTestRunner(verbosity=2).run(suite)